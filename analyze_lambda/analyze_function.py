@@ -1,22 +1,54 @@
 import json
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, Optional
-
-import boto3
-import tiktoken
-from openai import OpenAI
-
-# S3クライアント作成
-s3 = boto3.client("s3")
-# OpenAIクライアント作成
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+from typing import Any, Dict, List, Optional, Tuple
+
+from pubmed_common import (
+    budget,
+    cache,
+    candidate_store,
+    clients,
+    ledger,
+    metrics,
+    profiling,
+    rate_limiter,
+    records,
+    s3_layout,
+)
+
+# 内容のハッシュから除外するフィールド（再取得のたびに変わる値）
+VOLATILE_ARTICLE_FIELDS = ("fetch_date",)
+
+# 予算の縮退時の事前選別で優先する研究デザイン・論文種別（タイトルと抄録から判定）
+PRESCREEN_KEYWORDS = (
+    "randomized",
+    "randomised",
+    "trial",
+    "meta-analysis",
+    "systematic review",
+    "cohort",
+    "multicenter",
+    "guideline",
+)
+
+# ストリーミング分析で同時に分析するチャンク数
+STREAM_ANALYSIS_CONCURRENCY = int(os.environ.get("STREAM_ANALYSIS_CONCURRENCY", "4"))
+
+
+class ShardAnalysisFailed(Exception):
+    """分析に失敗したシャードがあり、分析結果を保存できない"""
 
 
 def num_tokens_from_string(string: str, model: str = "gpt-4") -> int:
-    """文字列のトークン数を計算"""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(string))
+    """文字列のトークン数を計算（コンテナ内で計算済みの文字列は再計算しない）"""
+    return cache.get_cache().get_or_compute(
+        cache.TOKENS,
+        cache.cache_key(model, string),
+        lambda: len(clients.get_encoding(model).encode(string)),
+    )
 
 
 def create_article_text(article: Dict[str, Any], pmid: str) -> str:
@@ -90,67 +122,171 @@ IMPORTANT: If none of the articles meet the criteria for being impactful or from
 """
 
 
-def analyze_papers_with_gpt(
-    articles_data: Dict[str, Any], max_retries: int = 3
-) -> List[Dict[str, Any]]:
+def request_analysis(
+    prompt: str,
+    max_retries: int = 3,
+    chunk_articles: int = 0,
+    budget_plan: Optional[Dict[str, Any]] = None,
+) -> Any:
     """
-    ChatGPT APIを使用して論文を分析し、インパクトの高い論文を抽出・要約する
-    重要な論文がない場合は空のリストを返す
+    ChatGPT APIで分析を依頼し、パースした応答を返す（リトライ付き）
+    budget_planを渡すと呼び出しごとに予算を予約する（上限を超える場合・予算の状態を更新できない場合はリトライしない）
+    呼び出しの前に全Lambdaで共有するOpenAIのクォータの枠を取得する
     """
-    # 論文データをチャンクに分割
-    chunks = chunk_articles(articles_data)
-    all_results = []
-
-    for chunk in chunks:
+    estimated_tokens = budget.estimate_tokens(budget_plan, prompt, 1000)
+    for retry in range(max_retries):
         try:
-            # プロンプトの構築
-            text_for_prompt = ""
-            for pmid, article in chunk.items():
-                text_for_prompt += create_article_text(article, pmid)
-
-            prompt = get_analysis_prompt(text_for_prompt)
-
-            # チャンクのトークン数を確認
-            chunk_tokens = num_tokens_from_string(prompt)
-            print(f"Chunk tokens: {chunk_tokens}")
-
-            if chunk_tokens > 7000:  # 安全マージンを確保
-                print(f"Skipping chunk with {chunk_tokens} tokens (too large)")
-                continue
-
-            # ChatGPT APIの呼び出し（リトライ付き）
-            for retry in range(max_retries):
-                try:
-                    response = client.chat.completions.create(
-                        model=os.environ.get("GPT_MODEL", "gpt-4"),
+            with budget.reserve(budget_plan, estimated_tokens) as call:
+                with rate_limiter.slot(prompt, 1000, budget.term_of(budget_plan)):
+                    started = time.perf_counter()
+                    response = clients.get_openai().chat.completions.create(
+                        model=budget.model_for(budget_plan),
                         messages=[{"role": "user", "content": prompt}],
                         temperature=0.2,
                         max_tokens=1000,
                     )
-                    break
-                except Exception as e:
-                    if retry == max_retries - 1:
-                        raise
-                    print(f"Retry {retry + 1}/{max_retries} due to error: {str(e)}")
-                    continue
-
-            # レスポンスのパース
-            content = response.choices[0].message.content
-            chunk_results = json.loads(content)
-            if isinstance(chunk_results, list):
-                all_results.extend(chunk_results)
-            else:
-                all_results.append(chunk_results)
+                call["response"] = response
+            break
+        except (budget.BudgetExceeded, budget.BudgetUnavailable):
+            raise
+        except Exception as e:
+            if retry == max_retries - 1:
+                raise
+            print(f"Retry {retry + 1}/{max_retries} due to error: {str(e)}")
+
+    metrics.record_llm_call(started, response, ChunkArticles=chunk_articles, Retries=retry)
+
+    # レスポンスのパース（パースできた応答のみキャッシュする）
+    return json.loads(response.choices[0].message.content)
+
+
+def analyze_chunk(
+    chunk: Dict[str, Any],
+    max_retries: int = 3,
+    budget_plan: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    1つのチャンクをChatGPT APIで分析し、インパクトの高い論文の候補を返す
+    予算の上限に達した場合はBudgetExceeded、予算の状態を更新できない場合はBudgetUnavailableを送出する
+    """
+    # プロンプトの構築
+    text_for_prompt = ""
+    for pmid, article in chunk.items():
+        text_for_prompt += create_article_text(article, pmid)
+
+    prompt = get_analysis_prompt(text_for_prompt)
 
+    # チャンクのトークン数を確認
+    chunk_tokens = num_tokens_from_string(prompt)
+    print(f"Chunk tokens: {chunk_tokens}")
+
+    if chunk_tokens > 7000:  # 安全マージンを確保
+        print(f"Skipping chunk with {chunk_tokens} tokens (too large)")
+        return []
+
+    # ChatGPT APIの呼び出し（同じプロンプトの応答はキャッシュから取得）
+    chunk_results = cache.get_cache().get_or_compute(
+        cache.COMPLETIONS,
+        cache.cache_key(budget.model_for(budget_plan), prompt, 0.2, 1000),
+        lambda: request_analysis(prompt, max_retries, len(chunk), budget_plan),
+    )
+    return chunk_results if isinstance(chunk_results, list) else [chunk_results]
+
+
+def analyze_chunks(
+    chunks: List[Dict[str, Any]],
+    max_retries: int = 3,
+    budget_plan: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    チャンクごとにChatGPT APIで論文を分析し、インパクトの高い論文の候補をすべて返す
+    予算の上限に達した場合はBudgetExceeded、予算の状態を更新できない場合はBudgetUnavailableを送出する
+    """
+    all_results = []
+
+    for chunk in chunks:
+        try:
+            all_results.extend(analyze_chunk(chunk, max_retries, budget_plan))
+        except (budget.BudgetExceeded, budget.BudgetUnavailable):
+            raise
         except Exception as e:
             print(f"Error processing chunk: {str(e)}")
             continue
 
-    # 空のリストでなければ、最大3つの論文を選択
-    if all_results:
-        return sorted(all_results, key=lambda x: len(x.get("impact_reason", "")), reverse=True)[:3]
-    else:
-        return []
+    return all_results
+
+
+def select_top_articles(results: List[Dict[str, Any]], limit: int = 3) -> List[Dict[str, Any]]:
+    """分析結果から最大limit件の論文を選択"""
+    return sorted(results, key=lambda x: len(x.get("impact_reason", "")), reverse=True)[:limit]
+
+
+def analyze_papers_with_gpt(
+    articles_data: Dict[str, Any],
+    max_retries: int = 3,
+    budget_plan: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    ChatGPT APIを使用して論文を分析し、インパクトの高い論文を抽出・要約する
+    重要な論文がない場合は空のリストを返す
+    """
+    # 論文データをチャンクに分割して分析し、最大3つの論文を選択
+    chunks = chunk_articles(articles_data)
+    return select_top_articles(analyze_chunks(chunks, max_retries, budget_plan))
+
+
+def prescreen_score(article: Dict[str, Any]) -> Tuple[int, int]:
+    """研究デザインのキーワードの数と抄録の長さによる事前選別のスコア"""
+    abstract = article.get("abstract") or ""
+    text = f"{article.get('title') or ''} {abstract}".lower()
+    return sum(keyword in text for keyword in PRESCREEN_KEYWORDS), len(abstract)
+
+
+def prescreen_articles(articles: Dict[str, Any], budget_plan: Dict[str, Any]) -> Dict[str, Any]:
+    """予算の縮退で事前選別が有効な場合は、スコア上位の論文のみをLLMに渡す"""
+    limit = budget.prescreen_limit()
+    if not budget_plan["prescreen"] or len(articles) <= limit:
+        return articles
+
+    ranked = sorted(articles, key=lambda pmid: prescreen_score(articles[pmid]), reverse=True)
+    selected = set(ranked[:limit])
+    print(f"Prescreened {len(articles)} articles down to {limit}")
+    return {pmid: article for pmid, article in articles.items() if pmid in selected}
+
+
+def split_into_shards(
+    articles: Dict[str, Any], chunks_per_shard: int = 3, max_tokens: int = 4000
+) -> List[List[str]]:
+    """
+    論文データをトークン数で区切ったチャンクに分割し、chunks_per_shard個ずつのシャード（PMIDのリスト）にまとめる
+    """
+    chunks = chunk_articles(articles, max_tokens)
+    shards = []
+    for i in range(0, len(chunks), max(chunks_per_shard, 1)):
+        shard = []
+        for chunk in chunks[i : i + chunks_per_shard]:
+            shard.extend(chunk.keys())
+        shards.append(shard)
+    return shards
+
+
+def merge_shard_results(shard_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    各シャードの分析結果を統合し、PMIDの重複を除いて最大3つの論文を選択
+    失敗したシャードは結果なしとして扱う
+    """
+    best_by_pmid: Dict[str, Dict[str, Any]] = {}
+    for shard_result in shard_results:
+        if shard_result.get("statusCode") != 200:
+            print(f"Skipping failed shard: {shard_result.get('details', 'unknown error')}")
+        for article in shard_result.get("results", []):
+            pmid = str(article.get("pmid", ""))
+            current = best_by_pmid.get(pmid)
+            if current is None or len(article.get("impact_reason", "")) > len(
+                current.get("impact_reason", "")
+            ):
+                best_by_pmid[pmid] = article
+    return select_top_articles(list(best_by_pmid.values()))
 
 
 def get_s3_object_from_event(event: Dict) -> Optional[tuple[str, str]]:
@@ -172,6 +308,305 @@ def get_s3_object_from_event(event: Dict) -> Optional[tuple[str, str]]:
         return None
 
 
+def load_pubmed_data(bucket: str, key: str, etag: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    S3から論文データを取得（形式が不正な場合はNone、論文データはrecords.Articleとして返す）
+    ETagを指定した場合は同じ内容のパース済みデータをキャッシュから取得し、S3にはアクセスしない
+    """
+
+    def fetch() -> Any:
+        with metrics.timer("S3GetLatency") as m:
+            response = clients.get_s3().get_object(Bucket=bucket, Key=key)
+            body = response["Body"].read()
+            m["S3GetBytes"] = (len(body), metrics.BYTES)
+        return records.loads(body.decode("utf-8"))
+
+    if etag:
+        pubmed_data = cache.get_cache().get_or_compute(
+            cache.ARTICLES, cache.cache_key(bucket, key, etag), fetch
+        )
+        # /tmpから読み込んだ論文データは辞書のためrecords.Articleに変換する（キャッシュの値は変更しない）
+        if isinstance(pubmed_data, dict) and isinstance(pubmed_data.get("articles"), dict):
+            pubmed_data = {**pubmed_data, "articles": records.from_json(pubmed_data["articles"])}
+    else:
+        pubmed_data = fetch()
+
+    if not isinstance(pubmed_data, dict) or "articles" not in pubmed_data:
+        return None
+    return pubmed_data
+
+
+def articles_content_hash(articles: Dict[str, Any]) -> str:
+    """論文データの内容ハッシュを計算（同日の再取得で変わるだけのフィールドは除外）"""
+    return ledger.content_hash(
+        {
+            pmid: {k: v for k, v in article.items() if k not in VOLATILE_ARTICLE_FIELDS}
+            for pmid, article in articles.items()
+        }
+    )
+
+
+def claim_input(bucket: str, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    処理台帳を確認し、未処理の入力ファイルであれば処理権を取得して論文データを返す
+    ETagが処理済みのものと一致する場合は論文データを読み込まずに重複と判定する
+    論文データ（重複の場合はNone）と、重複時の台帳エントリを返す
+    """
+    s3 = clients.get_s3()
+    entry = ledger.get_entry(s3, bucket, ledger.ANALYSIS_STAGE, key)
+    etag = s3.head_object(Bucket=bucket, Key=key)["ETag"]
+    if ledger.is_duplicate(entry[0], etag=etag):
+        return None, entry[0]
+
+    pubmed_data = load_pubmed_data(bucket, key, etag)
+    if pubmed_data is None:
+        raise ValueError(f"Invalid file format: s3://{bucket}/{key}")
+
+    digest = articles_content_hash(pubmed_data["articles"])
+    if not ledger.claim(s3, bucket, ledger.ANALYSIS_STAGE, key, digest, etag, entry=entry):
+        return None, entry[0] or {}
+
+    return {**pubmed_data, "etag": etag, "content_hash": digest}, None
+
+
+def skipped_output(bucket: str, key: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+    """重複した入力ファイルに対する出力（LLMによる分析は行わない）"""
+    print(f"Skipping duplicate input s3://{bucket}/{key} (status: {entry.get('status')})")
+    return {
+        "statusCode": 200,
+        "skipped": True,
+        "bucket": bucket,
+        "input_key": key,
+        "output_key": entry.get("output_key", s3_layout.analysis_key(key)),
+        "message": "Input already processed",
+    }
+
+
+def defer_input(
+    bucket: str, key: str, content_hash: str, budget_plan: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    予算の縮退で延期する入力ファイルの処理権を解放し、延期を記録する
+    延期した入力は翌日のディスパッチャーがワークフローを再実行する
+    """
+    ledger.release(
+        clients.get_s3(), bucket, ledger.ANALYSIS_STAGE, key, content_hash, "Deferred by budget"
+    )
+    budget.record_deferred(budget_plan, key=key)
+    return {
+        "statusCode": 200,
+        "skipped": True,
+        "deferred": True,
+        "bucket": bucket,
+        "input_key": key,
+        "output_key": None,
+        "message": "Deferred by budget",
+        "budget": budget.summary(budget_plan),
+    }
+
+
+def renew_claim(bucket: str, key: str, digest: str) -> None:
+    """処理台帳の分析の処理権の期限を延長（失敗しても分析は続ける）"""
+    try:
+        if not ledger.renew(clients.get_s3(), bucket, ledger.ANALYSIS_STAGE, key, digest):
+            print(f"Analysis claim for s3://{bucket}/{key} is no longer held")
+    except Exception as e:
+        print(f"Error renewing analysis claim for s3://{bucket}/{key}: {str(e)}")
+
+
+def save_analysis(
+    bucket: str,
+    key: str,
+    search_term: str,
+    total_analyzed: int,
+    analysis_results: List[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    分析結果をS3に保存し、週次分析用のマニフェストと週次候補ストアを更新
+    Step Functions用の出力を返す
+    """
+    s3 = clients.get_s3()
+
+    # 出力JSONの作成
+    output_json = {
+        "metadata": {
+            "original_file": f"s3://{bucket}/{key}",
+            "analysis_date": datetime.now().isoformat(),
+            "search_term": search_term,
+            "total_analyzed": total_analyzed,
+            "total_selected": len(analysis_results),
+        },
+        "impactful_articles": analysis_results,
+    }
+
+    # 分析結果をS3に保存
+    output_key = s3_layout.analysis_key(key)
+    body = json.dumps(output_json, ensure_ascii=False, indent=2)
+    with metrics.timer("S3PutLatency") as m:
+        s3.put_object(
+            Bucket=bucket,
+            Key=output_key,
+            Body=body,
+            ContentType="application/json",
+        )
+        m["S3PutBytes"] = (len(body.encode("utf-8")), metrics.BYTES)
+
+    # 週次分析用に検索語ごとのマニフェストと週次候補ストアを更新
+    key_info = s3_layout.parse_key(key)
+    if key_info:
+        s3_layout.update_manifest(
+            s3, bucket, search_term, key_info["date"], raw=key, analysis=output_key
+        )
+        candidate_store.add_candidates(
+            s3,
+            bucket,
+            search_term,
+            analysis_results,
+            key_info["date"],
+            output_key,
+            output_json["metadata"]["analysis_date"],
+        )
+
+    # Step Functions用の出力
+    return {
+        "statusCode": 200,
+        "bucket": bucket,
+        "input_key": key,
+        "output_key": output_key,
+        "articles_analyzed": total_analyzed,
+        "articles_selected": len(analysis_results),
+    }
+
+
+class StreamingAnalysis:
+    """
+    論文取得中にEFetchのページごとに論文を受け取り、チャンクが埋まるたびにそのチャンクの分析を開始する
+    チャンクの区切り方はchunk_articlesと同じ（論文の並びが同じであれば同じプロンプトになる）
+    取得の終了後に残りのチャンクを分析し、取得結果の書き込みを待って分析結果と処理台帳を記録する
+    予算の縮退で事前選別する場合は、全論文のスコアで選ぶため取得の終了まで分析を始めない
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        search_term: str,
+        max_tokens: int = 4000,
+        max_workers: int = STREAM_ANALYSIS_CONCURRENCY,
+    ):
+        self.bucket = bucket
+        self.search_term = search_term
+        self.max_tokens = max_tokens
+        self.budget_plan = budget.plan(bucket, "analyze", search_term)
+        self.streaming = not self.budget_plan["defer"] and not self.budget_plan["prescreen"]
+        self.base_tokens = num_tokens_from_string(get_analysis_prompt(""))
+        self.chunk: Dict[str, Any] = {}
+        self.chunk_tokens = 0
+        self.futures: List[Future] = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.first_result_seconds: Optional[float] = None
+
+    def _analyze(self, chunk: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with metrics.scope(stage="analyze", term=self.search_term):
+            results = analyze_chunk(chunk, budget_plan=self.budget_plan)
+        with self.lock:
+            if self.first_result_seconds is None:
+                self.first_result_seconds = time.perf_counter() - self.started
+        return results
+
+    def _submit(self, chunk: Dict[str, Any]) -> None:
+        self.futures.append(self.executor.submit(self._analyze, chunk))
+
+    def add(self, articles: Dict[str, Any]) -> None:
+        """取得したページの論文をチャンクに追加し、埋まったチャンクの分析を開始"""
+        if not self.streaming:
+            return
+        for pmid, article in articles.items():
+            article_tokens = num_tokens_from_string(create_article_text(article, pmid))
+            if (
+                self.chunk_tokens + article_tokens + self.base_tokens > self.max_tokens
+                and self.chunk
+            ):
+                self._submit(self.chunk)
+                self.chunk, self.chunk_tokens = {}, 0
+            self.chunk[pmid] = article
+            self.chunk_tokens += article_tokens
+
+    def _collect(self, articles: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """残りのチャンクを分析し、すべてのチャンクの候補論文を返す"""
+        if not self.streaming:
+            selected = prescreen_articles(articles, self.budget_plan)
+            for chunk in chunk_articles(selected, self.max_tokens):
+                self._submit(chunk)
+        elif self.chunk:
+            self._submit(self.chunk)
+            self.chunk, self.chunk_tokens = {}, 0
+
+        results = []
+        for future in self.futures:
+            try:
+                results.extend(future.result())
+            except (budget.BudgetExceeded, budget.BudgetUnavailable):
+                raise
+            except Exception as e:
+                print(f"Error processing chunk: {str(e)}")
+        return results
+
+    def finish(
+        self, key: str, pubmed_data: Dict[str, Any], upload: Future
+    ) -> Optional[Dict[str, Any]]:
+        """
+        分析結果を保存し、lambda_handlerと同じ形式で出力する
+        延期・予算の超過・処理権を取得できない場合は保存せずにNoneを返す
+        （取得結果の作成イベントから起動される通常のワークフローが処理する）
+        uploadは取得結果の書き込み（put_objectの応答を返すFuture）
+        """
+        articles = pubmed_data["articles"]
+        try:
+            if self.budget_plan["defer"]:
+                print(f"Streaming analysis of s3://{self.bucket}/{key} deferred by budget")
+                return None
+            results = self._collect(articles)
+        except budget.BudgetExceeded as e:
+            print(f"Budget exceeded while streaming analysis: {str(e)}")
+            return None
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+        s3 = clients.get_s3()
+        etag = upload.result()["ETag"]
+        digest = articles_content_hash(articles)
+        if not ledger.claim(s3, self.bucket, ledger.ANALYSIS_STAGE, key, digest, etag):
+            print(f"s3://{self.bucket}/{key} is already being analyzed")
+            return None
+
+        try:
+            output = save_analysis(
+                self.bucket, key, self.search_term, len(articles), select_top_articles(results)
+            )
+        except Exception as e:
+            ledger.release(s3, self.bucket, ledger.ANALYSIS_STAGE, key, digest, str(e))
+            raise
+        ledger.complete(
+            s3,
+            self.bucket,
+            ledger.ANALYSIS_STAGE,
+            key,
+            digest,
+            etag=etag,
+            output_key=output["output_key"],
+        )
+
+        if self.first_result_seconds is not None:
+            print(f"First chunk analyzed {self.first_result_seconds:.2f}s after the fetch started")
+            latency = self.first_result_seconds * 1000
+            metrics.emit({"StreamFirstResultLatency": (latency, metrics.MILLISECONDS)})
+        return {**output, "budget": budget.summary(self.budget_plan)}
+
+
+@metrics.instrument_handler("analyze")
+@profiling.profile_handler("analyze")
 def lambda_handler(event, context):
     try:
         print(f"Received event: {json.dumps(event)}")
@@ -189,12 +624,12 @@ def lambda_handler(event, context):
 
         bucket, key = s3_info
         print(f"Processing s3://{bucket}/{key}")
+        s3 = clients.get_s3()
 
-        # S3から論文データを取得
-        response = s3.get_object(Bucket=bucket, Key=key)
-        pubmed_data = json.loads(response["Body"].read().decode("utf-8"))
-
-        if not isinstance(pubmed_data, dict) or "articles" not in pubmed_data:
+        # 処理台帳を確認してS3から論文データを取得（重複した入力は分析しない）
+        try:
+            pubmed_data, duplicate = claim_input(bucket, key)
+        except ValueError:
             return {
                 "statusCode": 400,
                 "body": {
@@ -202,43 +637,222 @@ def lambda_handler(event, context):
                     "message": "Expected JSON with 'articles' field.",
                 },
             }
+        if pubmed_data is None:
+            return skipped_output(bucket, key, duplicate)
 
-        # ChatGPTによる分析
-        analysis_results = analyze_papers_with_gpt(pubmed_data["articles"])
-
-        # 出力JSONの作成
-        output_json = {
-            "metadata": {
-                "original_file": f"s3://{bucket}/{key}",
-                "analysis_date": datetime.now().isoformat(),
-                "search_term": pubmed_data.get("metadata", {}).get("search_term", "unknown"),
-                "total_analyzed": len(pubmed_data["articles"]),
-                "total_selected": len(analysis_results),
-            },
-            "impactful_articles": analysis_results,
-        }
+        search_term = pubmed_data.get("metadata", {}).get("search_term", "unknown")
+        budget_plan = budget.plan(bucket, "analyze", search_term)
+        if budget_plan["defer"]:
+            return defer_input(bucket, key, pubmed_data["content_hash"], budget_plan)
 
-        # 分析結果をS3に保存
-        output_key = key.replace(".json", "_analysis.json")
-        s3.put_object(
-            Bucket=bucket,
-            Key=output_key,
-            Body=json.dumps(output_json, ensure_ascii=False, indent=2),
-            ContentType="application/json",
+        try:
+            # ChatGPTによる分析（予算の縮退時は事前選別した論文のみ）
+            analysis_results = analyze_papers_with_gpt(
+                prescreen_articles(pubmed_data["articles"], budget_plan), budget_plan=budget_plan
+            )
+
+            output = save_analysis(
+                bucket, key, search_term, len(pubmed_data["articles"]), analysis_results
+            )
+        except Exception as e:
+            ledger.release(
+                s3, bucket, ledger.ANALYSIS_STAGE, key, pubmed_data["content_hash"], str(e)
+            )
+            if isinstance(e, budget.BudgetExceeded):
+                budget.record_deferred(budget_plan, key=key)
+            raise
+
+        ledger.complete(
+            s3,
+            bucket,
+            ledger.ANALYSIS_STAGE,
+            key,
+            pubmed_data["content_hash"],
+            etag=pubmed_data["etag"],
+            output_key=output["output_key"],
         )
+        return {**output, "budget": budget.summary(budget_plan)}
+
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return {
+            "statusCode": 500,
+            "error": "Error processing request",
+            "details": str(e),
+        }
+
+
+@metrics.instrument_handler("split")
+@profiling.profile_handler("split")
+def split_handler(event, context):
+    """
+    Step FunctionsのMapステート用に論文データをシャードに分割
+    入力が不正な場合はワークフローを失敗させるため例外を送出する
+    処理台帳で重複と判定された入力と、予算の縮退で延期した入力はskipped=Trueを返し、
+    以降の分析・翻訳を行わない
+    """
+    print(f"Received event: {json.dumps(event)}")
+
+    s3_info = get_s3_object_from_event(event)
+    if not s3_info:
+        raise ValueError("Expected S3 event or direct bucket/key specification.")
+
+    bucket, key = s3_info
+    pubmed_data, duplicate = claim_input(bucket, key)
+    if pubmed_data is None:
+        return skipped_output(bucket, key, duplicate)
+
+    search_term = pubmed_data.get("metadata", {}).get("search_term", "unknown")
+    try:
+        budget_plan = budget.plan(bucket, "analyze", search_term)
+    except Exception as e:
+        s3 = clients.get_s3()
+        ledger.release(s3, bucket, ledger.ANALYSIS_STAGE, key, pubmed_data["content_hash"], str(e))
+        raise
+    if budget_plan["defer"]:
+        return defer_input(bucket, key, pubmed_data["content_hash"], budget_plan)
+
+    chunks_per_shard = int(os.environ.get("ANALYZE_CHUNKS_PER_SHARD", "3"))
+    articles = prescreen_articles(pubmed_data["articles"], budget_plan)
+    shards = split_into_shards(articles, chunks_per_shard)
+    print(f"Split {len(articles)} articles into {len(shards)} shards")
+
+    return {
+        "statusCode": 200,
+        "skipped": False,
+        "bucket": bucket,
+        "key": key,
+        "etag": pubmed_data["etag"],
+        "content_hash": pubmed_data["content_hash"],
+        "search_term": search_term,
+        "total_articles": len(pubmed_data["articles"]),
+        "budget": budget.summary(budget_plan),
+        "shards": [
+            {
+                "bucket": bucket,
+                "key": key,
+                "etag": pubmed_data["etag"],
+                "content_hash": pubmed_data["content_hash"],
+                "pmids": pmids,
+                "budget": budget_plan,
+            }
+            for pmids in shards
+        ],
+    }
+
+
+@metrics.instrument_handler("analyze")
+@profiling.profile_handler("analyze")
+def analyze_shard_handler(event, context):
+    """
+    1つのシャード（PMIDのリスト）の論文を分析し、候補論文をすべて返す
+    分割時に決めた予算の縮退（モデルの切り替えなど）をシャード間で共通に使う
+    分析の前に処理台帳の期限を延長し、待機の多い実行でも期限切れで重複して分析されないようにする
+    """
+    try:
+        bucket, key, pmids = event["bucket"], event["key"], event["pmids"]
+        print(f"Analyzing {len(pmids)} articles of s3://{bucket}/{key}")
+        if event.get("content_hash"):
+            renew_claim(bucket, key, event["content_hash"])
+
+        pubmed_data = load_pubmed_data(bucket, key, event.get("etag"))
+        if pubmed_data is None:
+            raise ValueError(f"Invalid file format: s3://{bucket}/{key}")
+
+        budget_plan = event.get("budget") or budget.plan(bucket, "analyze")
+        articles = {pmid: pubmed_data["articles"][pmid] for pmid in pmids}
+        results = analyze_chunks(chunk_articles(articles), budget_plan=budget_plan)
 
-        # Step Functions用の出力
         return {
             "statusCode": 200,
-            "bucket": bucket,
-            "input_key": key,
-            "output_key": output_key,
-            "articles_analyzed": len(pubmed_data["articles"]),
-            "articles_selected": len(analysis_results),
+            "pmids_analyzed": len(pmids),
+            "results": results,
+            "budget": budget.summary(budget_plan),
         }
 
+    except budget.BudgetExceeded as e:
+        print(f"Budget exceeded: {str(e)}")
+        return {
+            "statusCode": 500,
+            "results": [],
+            "error": "Budget exceeded",
+            "budget_exceeded": True,
+            "details": str(e),
+        }
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return {
+            "statusCode": 500,
+            "results": [],
+            "error": "Error processing shard",
+            "details": str(e),
+        }
+
+
+@metrics.instrument_handler("merge")
+@profiling.profile_handler("merge")
+def merge_handler(event, context):
+    """
+    各シャードの分析結果を統合して分析結果を保存（lambda_handlerと同じ形式で出力）
+    保存後に処理台帳へ完了を記録する
+    予算の上限に達したシャードがある場合は一部の結果で保存せず、入力を延期してワークフローを失敗させる
+    その他の理由で失敗したシャードがある場合も保存せずに処理権を解放し、ワークフローを失敗させて再実行できるようにする
+    """
+    s3 = clients.get_s3()
+    shard_results = event.get("shard_results", [])
+    if any(shard_result.get("budget_exceeded") for shard_result in shard_results):
+        bucket, key = event["bucket"], event["key"]
+        if event.get("content_hash"):
+            ledger.release(
+                s3, bucket, ledger.ANALYSIS_STAGE, key, event["content_hash"], "Budget exceeded"
+            )
+        budget.record_deferred(budget.plan(bucket, "analyze", event.get("search_term")), key=key)
+        raise budget.BudgetExceeded(f"Budget exceeded while analyzing s3://{bucket}/{key}")
+
+    failed = [result for result in shard_results if result.get("statusCode") != 200]
+    if failed:
+        bucket, key = event["bucket"], event["key"]
+        details = "; ".join(str(result.get("details", "unknown error")) for result in failed)
+        message = f"{len(failed)} of {len(shard_results)} shards failed: {details}"
+        if event.get("content_hash"):
+            ledger.release(s3, bucket, ledger.ANALYSIS_STAGE, key, event["content_hash"], message)
+        raise ShardAnalysisFailed(f"{message} (s3://{bucket}/{key})")
+
+    try:
+        bucket, key = event["bucket"], event["key"]
+        print(f"Merging {len(shard_results)} shard results for s3://{bucket}/{key}")
+
+        output = save_analysis(
+            bucket,
+            key,
+            event.get("search_term", "unknown"),
+            event.get("total_articles", 0),
+            merge_shard_results(shard_results),
+        )
+
+        if event.get("content_hash"):
+            ledger.complete(
+                s3,
+                bucket,
+                ledger.ANALYSIS_STAGE,
+                key,
+                event["content_hash"],
+                etag=event.get("etag"),
+                output_key=output["output_key"],
+            )
+        return output
+
     except Exception as e:
         print(f"Error: {str(e)}")
+        if event.get("content_hash"):
+            ledger.release(
+                s3,
+                event["bucket"],
+                ledger.ANALYSIS_STAGE,
+                event["key"],
+                event["content_hash"],
+                str(e),
+            )
         return {
             "statusCode": 500,
             "error": "Error processing request",
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+エンドツーエンドの負荷試験・リプレイハーネス（ネットワークにはアクセスしない）
+E-utilitiesとOpenAIの模擬サーバー、ローカルディレクトリ上のS3互換ストアに対して、
+N日 × M検索語の日次ワークフロー（取得 → 分割 → シャード分析 → 統合 → 翻訳）と週次分析を実行し、
+スループット、処理段階ごとのp50/p99レイテンシ、トークン使用量、失敗の内訳を出力する
+
+使用例:
+    python benchmarks/e2e.py                                         # 7日 × 2検索語
+    python benchmarks/e2e.py --days 30 --term-count 20 --concurrency 16
+    python benchmarks/e2e.py --llm-latency-ms 2000 --rate-limit-rate 0.1 --truncation-rate 0.02
+    python benchmarks/e2e.py --passes 2 --json e2e.json              # 2回目は重複入力のスキップを計測
+    python benchmarks/e2e.py --quota-tpm 200000 --rate-limit         # クォータを共有レート制限で守る
+    python benchmarks/e2e.py --articles-per-day 1000 --stream-analysis  # 取得中のページから分析
+
+トークン数の計算にはtiktokenのエンコーディングファイルが必要（./create-layer.sh でレイヤーに同梱される）
+エンコーディングファイルがない場合は、ダウンロードを試みて途中で失敗しないよう開始前に終了する
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List
+
+import fake_services
+import run
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from local_pipeline import workflow  # noqa: E402
+from local_pipeline.s3 import LocalS3  # noqa: E402
+
+BUCKET = "loadtest"
+STAGES = ["fetch", "split", "analyze", "merge", "translate", "weekly"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """最近傍順位法によるパーセンタイル（valuesは空でないこと）"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    """ハンドラー呼び出しの所要時間・ステータス・エラーをスレッドセーフに記録"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invocations: List[Dict[str, Any]] = []
+
+    def __call__(self, invocation: Dict[str, Any]) -> None:
+        with self.lock:
+            self.invocations.append(invocation)
+
+    def stage_summary(self) -> Dict[str, Any]:
+        summary = {}
+        for stage in STAGES:
+            records = [record for record in self.invocations if record["stage"] == stage]
+            if not records:
+                continue
+            latencies = [record["seconds"] * 1000 for record in records]
+            summary[stage] = {
+                "invocations": len(records),
+                "failed": sum(1 for record in records if record["error"]),
+                "skipped": sum(1 for record in records if record["skipped"]),
+                "p50_ms": round(percentile(latencies, 50), 2),
+                "p90_ms": round(percentile(latencies, 90), 2),
+                "p99_ms": round(percentile(latencies, 99), 2),
+                "max_ms": round(max(latencies), 2),
+                "total_s": round(sum(latencies) / 1000, 3),
+            }
+        return summary
+
+    def failure_modes(self) -> List[Dict[str, Any]]:
+        # 位置や件数などの数値を除いて同じ種類のエラーをまとめる
+        counts = Counter(
+            (record["stage"], re.sub(r"\d+", "N", str(record["error"]))[:160])
+            for record in self.invocations
+            if record["error"]
+        )
+        return [
+            {"stage": stage, "error": error, "count": count}
+            for (stage, error), count in counts.most_common()
+        ]
+
+
+def configure_environment(
+    args: argparse.Namespace, eutils: fake_services.FakeEutils, llm: fake_services.FakeOpenAI
+) -> str:
+    """ハンドラーをインポートする前に、模擬サーバーとローカルの設定を環境変数に反映"""
+    cache_dir = tempfile.mkdtemp(prefix="pubmed_e2e_cache_")
+    os.environ.update(
+        {
+            "BUCKET_NAME": BUCKET,
+            "CACHE_BUCKET": BUCKET,
+            "CACHE_DIR": cache_dir,
+            "NCBI_EUTILS_URL": eutils.eutils_url,
+            "OPENAI_BASE_URL": llm.base_url,
+            "OPENAI_API_KEY": "loadtest",
+            "ANALYZE_CHUNKS_PER_SHARD": str(args.chunks_per_shard),
+        }
+    )
+    if args.metrics_file:
+        os.environ["METRICS_FILE"] = args.metrics_file
+        os.environ.pop("METRICS_DISABLED", None)
+    else:
+        os.environ["METRICS_DISABLED"] = "1"
+    os.environ.pop("PROFILE_HANDLERS", None)
+    # 模擬サーバーと同じクォータでプロセス内のレート制限を有効にする
+    for name, quota in (("OPENAI_RPM", args.quota_rpm), ("OPENAI_TPM", args.quota_tpm)):
+        if args.rate_limit and quota:
+            os.environ[name] = str(quota)
+        else:
+            os.environ.pop(name, None)
+    os.environ["RATE_LIMIT_BACKEND"] = "memory"
+    os.environ["FETCH_STREAM_ANALYSIS"] = "1" if args.stream_analysis else "0"
+    os.environ["EFETCH_PAGE_SIZE"] = str(args.efetch_page_size)
+    tiktoken_cache = ROOT / "layers" / "openai" / "tiktoken_cache"
+    if tiktoken_cache.exists():
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(tiktoken_cache))
+    return cache_dir
+
+
+def replay(
+    pipeline: workflow.Workflow, terms: List[str], days: List[date], concurrency: int
+) -> List[Dict[str, Any]]:
+    """日付 × 検索語の日次ワークフローを指定した同時実行数で実行"""
+    jobs = [(term, day) for day in days for term in terms]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda job: pipeline.run_daily(*job), jobs))
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    print(
+        f"Replayed {report['days']} days x {report['terms']} terms "
+        f"(concurrency {report['concurrency']}, passes {report['passes']})"
+    )
+    for run in report["passes_detail"]:
+        outcomes = ", ".join(f"{status} {count}" for status, count in run["outcomes"].items())
+        print(
+            f"  pass {run['pass']}: {run['wall_s']:.2f}s, "
+            f"{run['workflows_per_s']:.2f} workflows/s, {run['articles_per_s']:.1f} articles/s "
+            f"({outcomes})"
+        )
+    if "weekly" in report:
+        print(f"  weekly: {report['weekly']['wall_s']:.2f}s, status {report['weekly']['status']}")
+
+    print(f"{'stage':<10} {'calls':>6} {'failed':>6} {'skipped':>7} {'p50 ms':>10} {'p99 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(
+            f"{stage:<10} {stats['invocations']:>6} {stats['failed']:>6} {stats['skipped']:>7} "
+            f"{stats['p50_ms']:>10.1f} {stats['p99_ms']:>10.1f}"
+        )
+
+    llm = report["llm"]
+    print(
+        f"LLM: {llm.get('requests', 0)} requests, {llm.get('prompt_tokens', 0)} prompt tokens, "
+        f"{llm.get('completion_tokens', 0)} completion tokens, "
+        f"{llm.get('rate_limited', 0)} rate limited, {llm.get('truncated', 0)} truncated"
+    )
+    ncbi = report["ncbi"]
+    print(
+        f"NCBI: {ncbi.get('esearch', 0)} searches, {ncbi.get('efetch', 0)} fetches, "
+        f"{ncbi.get('errors', 0)} errors"
+    )
+    for failure in report["failures"]:
+        print(f"  {failure['count']:>5} x {failure['stage']}: {failure['error']}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay the pipeline against local fakes")
+    parser.add_argument("--days", type=int, default=7, help="Number of days to replay")
+    parser.add_argument("--terms", default="sepsis,ards", help="Comma separated search terms")
+    parser.add_argument("--term-count", type=int, help="Generate this many synthetic terms")
+    parser.add_argument("--articles-per-day", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent daily workflows")
+    parser.add_argument(
+        "--map-concurrency",
+        type=int,
+        default=workflow.DEFAULT_MAP_CONCURRENCY,
+        help="Concurrent shards per workflow (Map state max_concurrency)",
+    )
+    parser.add_argument("--chunks-per-shard", type=int, default=3)
+    parser.add_argument("--passes", type=int, default=1, help="Replay the same inputs again")
+    parser.add_argument("--no-weekly", action="store_true", help="Skip the weekly analysis")
+    parser.add_argument("--llm-latency-ms", type=float, default=200.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100.0)
+    parser.add_argument("--llm-ms-per-token", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of 429 responses")
+    parser.add_argument("--retry-after-ms", type=int, default=50)
+    parser.add_argument("--truncation-rate", type=float, default=0.0)
+    parser.add_argument("--quota-rpm", type=int, default=0, help="Fake OpenAI requests per minute")
+    parser.add_argument("--quota-tpm", type=int, default=0, help="Fake OpenAI tokens per minute")
+    parser.add_argument(
+        "--rate-limit", action="store_true", help="Enable the shared rate limiter at the quota"
+    )
+    parser.add_argument(
+        "--stream-analysis",
+        action="store_true",
+        help="Analyze EFetch pages while the later pages are still downloading",
+    )
+    parser.add_argument("--efetch-page-size", type=int, default=200)
+    parser.add_argument("--ncbi-latency-ms", type=float, default=50.0)
+    parser.add_argument("--ncbi-error-rate", type=float, default=0.0)
+    parser.add_argument("--s3-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--store", help="Keep the local S3 store in this directory")
+    parser.add_argument("--log", help="Write handler output to this file (default: discarded)")
+    parser.add_argument("--metrics-file", help="Also write the handlers' EMF metrics here")
+    parser.add_argument("--json", help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    if args.term_count:
+        terms = [f"term{i:03d}" for i in range(args.term_count)]
+    else:
+        terms = [term.strip() for term in args.terms.split(",") if term.strip()]
+    today = date.today()
+    days = [today - timedelta(days=offset) for offset in range(args.days - 1, -1, -1)]
+
+    eutils = fake_services.FakeEutils(
+        args.articles_per_day, args.ncbi_latency_ms, 0.0, args.ncbi_error_rate, args.seed
+    )
+    llm = fake_services.FakeOpenAI(
+        args.llm_latency_ms,
+        args.llm_jitter_ms,
+        args.llm_ms_per_token,
+        args.rate_limit_rate,
+        args.truncation_rate,
+        args.retry_after_ms,
+        args.seed,
+        args.quota_rpm,
+        args.quota_tpm,
+    )
+    store_dir = args.store or tempfile.mkdtemp(prefix="pubmed_e2e_store_")
+    cache_dir = configure_environment(args, eutils, llm)
+    token_skip_reason = run.token_benchmark_skip_reason()
+    if token_skip_reason:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        raise SystemExit(f"Cannot replay the pipeline without token counting: {token_skip_reason}")
+    recorder = Recorder()
+
+    report: Dict[str, Any] = {
+        "timestamp": datetime.now().isoformat(),
+        "days": len(days),
+        "terms": len(terms),
+        "articles_per_day": args.articles_per_day,
+        "concurrency": args.concurrency,
+        "map_concurrency": args.map_concurrency,
+        "passes": args.passes,
+        "settings": vars(args),
+        "passes_detail": [],
+    }
+
+    log = open(args.log, "w", encoding="utf-8") if args.log else open(os.devnull, "w")
+    try:
+        with eutils, llm, log, contextlib.redirect_stdout(log):
+            pipeline = workflow.Workflow(BUCKET, args.map_concurrency, recorder)
+            workflow.use_s3(LocalS3(store_dir, args.s3_latency_ms / 1000))
+
+            for number in range(1, args.passes + 1):
+                started = time.perf_counter()
+                results = replay(pipeline, terms, days, args.concurrency)
+                wall = time.perf_counter() - started
+                articles = sum(
+                    result.get("articles", 0)
+                    for result in results
+                    if result["status"] == "completed"
+                )
+                report["passes_detail"].append(
+                    {
+                        "pass": number,
+                        "wall_s": round(wall, 3),
+                        "workflows": len(results),
+                        "workflows_per_s": round(len(results) / wall, 3),
+                        "articles_per_s": round(articles / wall, 2),
+                        "outcomes": dict(Counter(result["status"] for result in results)),
+                        "failed_stages": dict(
+                            Counter(result["stage"] for result in results if "stage" in result)
+                        ),
+                    }
+                )
+
+            if not args.no_weekly:
+                started = time.perf_counter()
+                weekly = pipeline.weekly(terms)
+                report["weekly"] = {
+                    "wall_s": round(time.perf_counter() - started, 3),
+                    "status": weekly.get("statusCode"),
+                }
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        if not args.store:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    report["stages"] = recorder.stage_summary()
+    report["failures"] = recorder.failure_modes()
+    report["llm"] = dict(llm.stats)
+    report["ncbi"] = dict(eutils.stats)
+    print_report(report)
+    if args.store:
+        print(f"Local S3 store kept in {store_dir}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"Report written to {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+負荷試験用のE-utilities（ESearch/EFetch）とOpenAI互換APIの模擬サーバー
+ローカルのポートで起動し、合成データとレイテンシ・エラーを設定どおりに返す
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import fixtures
+
+# 分析プロンプトの論文ブロック（analyze_function.create_article_text の形式）
+ARTICLE_BLOCK = re.compile(r"PMID: (\S+)\nTitle: (.*)\n[\s\S]*?Journal: (.*)\nYear: (.*)\n")
+TRANSLATION_START = "翻訳対象のJSONデータ:\n"
+TRANSLATION_END = "\n\nJSON形式で返答"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, body: str, content_type: str, headers=None) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    server: "_Server"
+
+    def do_GET(self) -> None:
+        self.server.service.handle_get(self)
+
+    def do_POST(self) -> None:
+        self.server.service.handle_post(self)
+
+
+class _Server(ThreadingHTTPServer):
+    """リクエストを処理する模擬サーバー（FakeService）を保持するHTTPサーバー"""
+
+    daemon_threads = True
+
+    def __init__(self, service: "FakeService"):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.service = service
+
+
+class FakeService:
+    """模擬サーバーの共通部分（バックグラウンドのスレッドで起動し、統計を集計する）"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {}
+        self.server = _Server(self)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode("utf-8")
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeService":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, **increments: int) -> None:
+        with self.lock:
+            for name, value in increments.items():
+                self.stats[name] = self.stats.get(name, 0) + value
+
+    def chance(self, rate: float) -> bool:
+        with self.lock:
+            return self.rng.random() < rate
+
+    def wait(self, extra_ms: float = 0.0) -> None:
+        with self.lock:
+            jitter = self.rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0
+        delay = (self.latency_ms + jitter + extra_ms) / 1000
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle_get(self, request: _Handler) -> None:
+        request._send(404, "{}", "application/json")
+
+    def handle_post(self, request: _Handler) -> None:
+        request._send(404, "{}", "application/json")
+
+
+class FakeEutils(FakeService):
+    """
+    ESearch/EFetchの模擬サーバー（NCBI_EUTILS_URLに {url}/entrez/eutils を指定する）
+    検索語と日付から決まるPMIDを返し、EFetchでは合成した論文XMLを返す
+    """
+
+    def __init__(
+        self,
+        articles_per_day: int = 50,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(latency_ms, jitter_ms, seed)
+        self.articles_per_day = articles_per_day
+        self.error_rate = error_rate
+
+    @property
+    def eutils_url(self) -> str:
+        return f"{self.url}/entrez/eutils"
+
+    def search(self, term: str, maxdate: str) -> List[str]:
+        """検索語と日付ごとに重複しないPMIDを生成（同じ条件では常に同じ結果）"""
+        start = 10_000_000 + zlib.crc32(f"{term}|{maxdate}".encode("utf-8")) % 80_000 * 1000
+        return [str(start + i) for i in range(self.articles_per_day)]
+
+    def handle_get(self, request: _Handler) -> None:
+        url = urlparse(request.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.wait()
+        if self.chance(self.error_rate):
+            self.count(errors=1)
+            request._send(503, "Service Unavailable", "text/plain")
+            return
+
+        if url.path.endswith("/esearch.fcgi"):
+            idlist = self.search(params.get("term", ""), params.get("maxdate", ""))
+            self.count(esearch=1)
+            body = {"esearchresult": {"count": str(len(idlist)), "idlist": idlist}}
+            request._send(200, json.dumps(body), "application/json")
+        elif url.path.endswith("/efetch.fcgi"):
+            ids = [pmid for pmid in params.get("id", "").split(",") if pmid]
+            self.count(efetch=1, articles=len(ids))
+            xml = fixtures.efetch_xml_for(ids, seed=zlib.crc32(",".join(ids).encode("utf-8")))
+            request._send(200, xml, "text/xml")
+        else:
+            request._send(404, "Not Found", "text/plain")
+
+
+class FakeOpenAI(FakeService):
+    """
+    OpenAI互換のChat Completions APIの模擬サーバー（OPENAI_BASE_URLに {url}/v1 を指定する）
+    プロンプトの種類（分析・週次選定・翻訳）を判別して、パースできる応答を返す
+    rate_limit_rateの割合で429を返し、truncation_rateの割合で応答を途中で打ち切る
+    rpm_quota・tpm_quotaを指定すると、直近60秒のリクエスト数・トークン数（プロンプト + max_tokens）が
+    クォータを超えるリクエストに429を返す（OpenAIのアカウント単位のクォータを模擬）
+    トークン数は文字数から概算する（4文字 ≒ 1トークン）
+    """
+
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        ms_per_output_token: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        truncation_rate: float = 0.0,
+        retry_after_ms: int = 50,
+        seed: int = 0,
+        rpm_quota: int = 0,
+        tpm_quota: int = 0,
+    ):
+        super().__init__(latency_ms, jitter_ms, seed)
+        self.ms_per_output_token = ms_per_output_token
+        self.rate_limit_rate = rate_limit_rate
+        self.truncation_rate = truncation_rate
+        self.retry_after_ms = retry_after_ms
+        self.rpm_quota = rpm_quota
+        self.tpm_quota = tpm_quota
+        # クォータの計上（受け付けた時刻とトークン数）
+        self.window: Deque[Tuple[float, int]] = deque()
+
+    @property
+    def base_url(self) -> str:
+        return f"{self.url}/v1"
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // 4 + 1
+
+    def within_quota(self, tokens: int) -> bool:
+        """直近60秒のリクエスト数・トークン数がクォータ内であれば計上してTrueを返す"""
+        if not self.rpm_quota and not self.tpm_quota:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            while self.window and self.window[0][0] <= now - 60:
+                self.window.popleft()
+            if self.rpm_quota and len(self.window) >= self.rpm_quota:
+                return False
+            if self.tpm_quota and sum(used for _, used in self.window) + tokens > self.tpm_quota:
+                return False
+            self.window.append((now, tokens))
+            return True
+
+    @staticmethod
+    def respond(prompt: str) -> Tuple[str, Any]:
+        """プロンプトの種類と応答の内容"""
+        if TRANSLATION_START in prompt:
+            # 翻訳: 入力のJSONをそのまま返す
+            data = prompt.split(TRANSLATION_START, 1)[1].split(TRANSLATION_END, 1)[0]
+            return "translation", json.loads(data)
+
+        if "Articles to analyze:" in prompt:
+            # 日次分析: PMIDの末尾が0-2の論文をインパクトのある論文として選ぶ
+            selected = []
+            for pmid, title, journal, year in ARTICLE_BLOCK.findall(prompt):
+                if pmid[-1] in "012":
+                    selected.append(
+                        {
+                            "pmid": pmid,
+                            "journal": journal,
+                            "publication_year": year,
+                            "impact_reason": f"Published in {journal} with a rigorous design.",
+                            "summary": title,
+                            "implications": "May change the standard of care.",
+                        }
+                    )
+            return "analysis", selected
+
+        # 週次選定: 短縮キーのJSON配列から先頭の3件を選ぶ
+        candidates: List[Dict[str, Any]] = []
+        for line in prompt.splitlines():
+            if line.startswith("[{") or line == "[]":
+                candidates = json.loads(line)
+                break
+        return "selection", [
+            {
+                "pmid": article.get("id"),
+                "journal": article.get("j", ""),
+                "title": article.get("t", ""),
+                "weekly_importance_reason": "Largest expected clinical impact this week.",
+                "key_findings": article.get("s", ""),
+                "clinical_impact": article.get("i", ""),
+            }
+            for article in candidates[:3]
+        ]
+
+    def handle_post(self, request: _Handler) -> None:
+        length = int(request.headers.get("Content-Length") or 0)
+        payload = json.loads(request.rfile.read(length) or b"{}")
+        if not urlparse(request.path).path.endswith("/chat/completions"):
+            request._send(404, "{}", "application/json")
+            return
+
+        prompt = "\n".join(message.get("content", "") for message in payload.get("messages", []))
+        requested_tokens = self.estimate_tokens(prompt) + int(payload.get("max_tokens") or 0)
+        if self.chance(self.rate_limit_rate) or not self.within_quota(requested_tokens):
+            self.count(requests=1, rate_limited=1)
+            error = {"error": {"message": "Rate limit reached", "code": "rate_limit_exceeded"}}
+            request._send(
+                429,
+                json.dumps(error),
+                "application/json",
+                {"retry-after-ms": str(self.retry_after_ms)},
+            )
+            return
+
+        kind, content = self.respond(prompt)
+        text = json.dumps(content, ensure_ascii=False)
+        finish_reason = "stop"
+        if self.chance(self.truncation_rate):
+            text = text[: len(text) // 2]
+            finish_reason = "length"
+            self.count(truncated=1)
+
+        prompt_tokens = self.estimate_tokens(prompt)
+        completion_tokens = self.estimate_tokens(text)
+        self.wait(completion_tokens * self.ms_per_output_token)
+        self.count(
+            requests=1,
+            **{f"{kind}_requests": 1},
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+        body = {
+            "id": f"chatcmpl-{self.stats.get('requests', 0)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-4"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": finish_reason,
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+        request._send(200, json.dumps(body, ensure_ascii=False), "application/json")
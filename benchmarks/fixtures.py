@@ -0,0 +1,194 @@
+"""
+ベンチマーク用の合成データ（EFetch XML、論文取得結果、分析結果）
+同じ件数・シードからは常に同じデータを生成する
+"""
+
+import random
+from typing import Any, Dict, List
+from xml.sax.saxutils import escape
+
+DEFAULT_SEED = 20250319
+
+JOURNALS = [
+    "New England Journal of Medicine",
+    "The Lancet",
+    "JAMA",
+    "BMJ",
+    "Critical Care Medicine",
+    "Intensive Care Medicine",
+    "American Journal of Respiratory and Critical Care Medicine",
+    "Critical Care",
+    "Chest",
+    "Annals of Intensive Care",
+]
+
+WORDS = (
+    "sepsis septic shock acute respiratory distress syndrome mortality randomized controlled "
+    "trial cohort patients intensive care unit mechanical ventilation corticosteroids "
+    "vasopressor norepinephrine lactate fluid resuscitation biomarker procalcitonin outcome "
+    "hospital admission multicenter prospective retrospective analysis cytokine inflammation "
+    "organ dysfunction antibiotic therapy timing risk ratio confidence interval significant "
+    "reduction increase association adjusted hazard primary secondary endpoint day survival "
+    "oxygenation prone positioning extracorporeal membrane lung injury kidney renal failure"
+).split()
+
+LABELS = ["BACKGROUND", "METHODS", "RESULTS", "CONCLUSIONS"]
+PUBLICATION_TYPES = [
+    "Randomized Controlled Trial",
+    "Observational Study",
+    "Review",
+    "Meta-Analysis",
+    "Multicenter Study",
+]
+LAST_NAMES = ["Smith", "Tanaka", "Müller", "García", "Chen", "Rossi", "Kim", "Dubois", "Sato"]
+FORE_NAMES = ["John", "Yuki", "Anna", "Carlos", "Wei", "Marco", "Ji-woo", "Claire", "Kenji"]
+
+# 分析結果を模した日本語の文（翻訳後のデータや日本語を含むJSONのシリアライズ計測用）
+JAPANESE_SENTENCES = [
+    "敗血症性ショック患者における早期の血管収縮薬投与は死亡率の低下と関連した。",
+    "多施設共同の無作為化比較試験であり、臨床実践への影響が大きい。",
+    "腹臥位療法の適応拡大を検討する根拠となる。",
+]
+
+
+def _sentence(rng: random.Random, min_words: int = 8, max_words: int = 24) -> str:
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng: random.Random, sentences: int) -> str:
+    return " ".join(_sentence(rng) for _ in range(sentences))
+
+
+def pmids(count: int, start: int = 38000000) -> List[str]:
+    return [str(start + i) for i in range(count)]
+
+
+def publication_types(pmid: str) -> List[str]:
+    """PMIDから決まる出版タイプ（乱数の系列を変えないようにシードを使わない）"""
+    return ["Journal Article", PUBLICATION_TYPES[int(pmid) % len(PUBLICATION_TYPES)]]
+
+
+def efetch_xml(count: int, seed: int = DEFAULT_SEED) -> str:
+    """EFetch（rettype=abstract, retmode=xml）のレスポンスを模したXML"""
+    return efetch_xml_for(pmids(count), seed)
+
+
+def efetch_xml_for(pmid_list: List[str], seed: int = DEFAULT_SEED) -> str:
+    """指定したPMIDの論文のEFetchレスポンスを模したXML"""
+    rng = random.Random(seed)
+    articles = []
+    for pmid in pmid_list:
+        abstract = "".join(
+            f'<AbstractText Label="{label}" NlmCategory="{label}">'
+            f"{escape(_paragraph(rng, rng.randint(2, 4)))}</AbstractText>"
+            for label in LABELS
+        )
+        authors = "".join(
+            f'<Author ValidYN="Y"><LastName>{rng.choice(LAST_NAMES)}</LastName>'
+            f"<ForeName>{rng.choice(FORE_NAMES)}</ForeName><Initials>J</Initials>"
+            f"<AffiliationInfo><Affiliation>{escape(_sentence(rng, 6, 12))}</Affiliation>"
+            f"</AffiliationInfo></Author>"
+            for _ in range(rng.randint(3, 12))
+        )
+        mesh = "".join(
+            f'<MeshHeading><DescriptorName UI="D{rng.randint(100000, 999999)}">'
+            f"{escape(rng.choice(WORDS).capitalize())}</DescriptorName></MeshHeading>"
+            for _ in range(rng.randint(5, 15))
+        )
+        types = "".join(
+            f"<PublicationType>{escape(name)}</PublicationType>" for name in publication_types(pmid)
+        )
+        articles.append(
+            f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM">'
+            f'<PMID Version="1">{pmid}</PMID>'
+            f'<Article PubModel="Print-Electronic"><Journal>'
+            f'<ISSN IssnType="Electronic">1234-5678</ISSN>'
+            f'<JournalIssue CitedMedium="Internet"><Volume>{rng.randint(1, 400)}</Volume>'
+            f"<Issue>{rng.randint(1, 12)}</Issue><PubDate><Year>{rng.randint(2023, 2025)}</Year>"
+            f"<Month>Mar</Month></PubDate></JournalIssue>"
+            f"<Title>{escape(rng.choice(JOURNALS))}</Title></Journal>"
+            f"<ArticleTitle>{escape(_sentence(rng, 10, 20))}</ArticleTitle>"
+            f"<Abstract>{abstract}</Abstract>"
+            f'<AuthorList CompleteYN="Y">{authors}</AuthorList>'
+            f"<Language>eng</Language>"
+            f"<PublicationTypeList>{types}</PublicationTypeList></Article>"
+            f"<MeshHeadingList>{mesh}</MeshHeadingList></MedlineCitation>"
+            f"<PubmedData><PublicationStatus>aheadofprint</PublicationStatus><ArticleIdList>"
+            f'<ArticleId IdType="pubmed">{pmid}</ArticleId>'
+            f'<ArticleId IdType="doi">10.1000/{pmid}</ArticleId></ArticleIdList></PubmedData>'
+            f"</PubmedArticle>"
+        )
+    return (
+        '<?xml version="1.0" ?>\n'
+        '<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" '
+        '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n'
+        f"<PubmedArticleSet>{''.join(articles)}</PubmedArticleSet>"
+    )
+
+
+def raw_articles(count: int, seed: int = DEFAULT_SEED) -> Dict[str, Dict[str, Any]]:
+    """論文取得結果（raw/）の articles と同じ形式の論文データ"""
+    rng = random.Random(seed)
+    return {
+        pmid: {
+            "pmid": pmid,
+            "title": _sentence(rng, 10, 20),
+            "abstract": "\n".join(
+                f"{label}: {_paragraph(rng, rng.randint(2, 4))}" for label in LABELS
+            ),
+            "authors": [
+                f"{rng.choice(LAST_NAMES)} {rng.choice(FORE_NAMES)}"
+                for _ in range(rng.randint(3, 12))
+            ],
+            "journal": rng.choice(JOURNALS),
+            "publication_year": str(rng.randint(2023, 2025)),
+            "publication_types": publication_types(pmid),
+            "fetch_date": "2025-03-19T00:00:00",
+        }
+        for pmid in pmids(count)
+    }
+
+
+def raw_output(count: int, seed: int = DEFAULT_SEED) -> Dict[str, Any]:
+    """論文取得結果ファイル全体"""
+    return {
+        "metadata": {
+            "search_term": "sepsis",
+            "search_date": "2025-03-19T00:00:00",
+            "total_articles": count,
+            "date_range": {"from": "2025-03-18", "to": "2025-03-19"},
+        },
+        "articles": raw_articles(count, seed),
+    }
+
+
+def analysis_articles(count: int, seed: int = DEFAULT_SEED) -> List[Dict[str, Any]]:
+    """分析結果（analysis/）の impactful_articles と同じ形式の論文データ"""
+    rng = random.Random(seed)
+    return [
+        {
+            "pmid": pmid,
+            "title": _sentence(rng, 10, 20),
+            "journal": rng.choice(JOURNALS),
+            "publication_year": str(rng.randint(2023, 2025)),
+            "impact_reason": _paragraph(rng, 2),
+            "summary": _paragraph(rng, 3),
+            "implications": _paragraph(rng, 2) + rng.choice(JAPANESE_SENTENCES),
+        }
+        for pmid in pmids(count)
+    ]
+
+
+def analysis_output(count: int, seed: int = DEFAULT_SEED) -> Dict[str, Any]:
+    """分析結果ファイル全体"""
+    return {
+        "metadata": {
+            "original_file": "s3://benchmark/raw/sepsis/2025/03/19/pubmed_sepsis_20250319.json",
+            "analysis_date": "2025-03-19T00:10:00",
+            "search_term": "sepsis",
+            "total_analyzed": count,
+            "total_selected": count,
+        },
+        "impactful_articles": analysis_articles(count, seed),
+    }
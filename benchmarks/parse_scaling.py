@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+EFetchのXMLの並列解析のスケーリングを計測する（合成データを使用し、ネットワークにはアクセスしない）
+同じページ群を解析プロセス数を変えて取得・解析し、スループットと1プロセスに対する倍率を出力する
+
+使用例:
+    python benchmarks/parse_scaling.py                               # 1, 2, 4, ... CPU数のプロセス
+    python benchmarks/parse_scaling.py --articles 10000 --workers 1,4,8
+    python benchmarks/parse_scaling.py --download-ms 300 --json scaling.json   # EFetchの待ち時間を再現
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+from unittest import mock
+
+import fixtures
+import run
+
+DEFAULT_ARTICLES = 4000
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_REPEAT = 3
+
+
+def default_workers() -> str:
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    if counts[-1] != (os.cpu_count() or 1):
+        counts.append(os.cpu_count() or 1)
+    return ",".join(str(count) for count in counts)
+
+
+def fake_efetch(pages: Dict[str, str], download_seconds: float) -> Callable[..., Any]:
+    """URLのPMIDに対応するページのXMLを返すrequests.getの代わり"""
+
+    def get(url: str, *args: Any, **kwargs: Any) -> run._FakeResponse:
+        pmid_list = url.split("&id=", 1)[1].split("&", 1)[0]
+        time.sleep(download_seconds)
+        return run._FakeResponse(pages[pmid_list])
+
+    return get
+
+
+def parse_all(pmid_list: List[str], page_size: int, workers: int) -> Dict[str, Any]:
+    """1プロセス（workers=1）または解析用のプロセスプールで全ページを取得・解析"""
+    import lambda_function
+
+    articles_data: Dict[str, Any] = {}
+    if workers < 2:
+        for start in range(0, len(pmid_list), page_size):
+            page = lambda_function.fetch_article_data(pmid_list[start : start + page_size])
+            articles_data.update(page)
+        return articles_data
+
+    pool = lambda_function.get_parse_pool()
+    for page in lambda_function.iter_parsed_pages(pmid_list, page_size, pool):
+        articles_data.update(page)
+    return articles_data
+
+
+def measure(pmid_list: List[str], page_size: int, workers: int, repeat: int) -> List[float]:
+    """ウォームアップ（プロセスの起動）の後にrepeat回計測し、結果が1プロセスと同じ順序であることを確認"""
+    import lambda_function
+
+    pool = lambda_function.get_parse_pool()
+    if pool is not None:
+        pool.shutdown()
+    lambda_function.get_parse_pool.cache_clear()
+    lambda_function.EFETCH_PARSE_WORKERS = workers
+
+    timings = []
+    for i in range(repeat + 1):
+        started = time.perf_counter()
+        articles_data = parse_all(pmid_list, page_size, workers)
+        if i > 0:
+            timings.append(time.perf_counter() - started)
+    assert list(articles_data) == pmid_list
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure EFetch parse throughput per worker count")
+    parser.add_argument("--articles", type=int, default=DEFAULT_ARTICLES)
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument(
+        "--workers", default=default_workers(), help="Comma separated parse process counts"
+    )
+    parser.add_argument(
+        "--download-ms", type=float, default=0.0, help="Simulated EFetch latency per page"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=DEFAULT_REPEAT, help="Measured runs per worker count"
+    )
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    run.setup_environment()
+    pmid_list = fixtures.pmids(args.articles)
+    pages = {
+        ",".join(page): fixtures.efetch_xml_for(page)
+        for page in (
+            pmid_list[start : start + args.page_size]
+            for start in range(0, len(pmid_list), args.page_size)
+        )
+    }
+    nbytes = sum(len(xml.encode("utf-8")) for xml in pages.values())
+    print(f"{args.articles} articles in {len(pages)} pages ({nbytes / 1024 / 1024:.1f} MB)")
+
+    import lambda_function
+
+    results = []
+    baseline = None
+    get = fake_efetch(pages, args.download_ms / 1000)
+    with mock.patch.object(lambda_function.requests, "get", side_effect=get):
+        for workers in [int(count) for count in args.workers.split(",") if count.strip()]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                timings = measure(pmid_list, args.page_size, workers, args.repeat)
+            median = statistics.median(timings)
+            baseline = baseline or median
+            result = {
+                "workers": workers,
+                "median_ms": round(median * 1000, 2),
+                "articles_per_second": round(args.articles / median, 1),
+                "mb_per_second": round(nbytes / median / 1024 / 1024, 2),
+                "speedup": round(baseline / median, 2),
+            }
+            results.append(result)
+            print(
+                f"workers {workers:>3}  median {result['median_ms']:>10.1f} ms "
+                f"{result['articles_per_second']:>10,.0f} articles/s "
+                f"{result['mb_per_second']:>7.2f} MB/s  x{result['speedup']:.2f}"
+            )
+
+    pool = lambda_function.get_parse_pool()
+    if pool is not None:
+        pool.shutdown()
+
+    if args.json:
+        output = {
+            "environment": run.environment_info(),
+            "articles": args.articles,
+            "page_size": args.page_size,
+            "download_ms": args.download_ms,
+            "results": results,
+        }
+        Path(args.json).write_text(json.dumps(output, ensure_ascii=False, indent=2))
+        print(f"Results written to {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+ホットパスのマイクロベンチマーク（合成データを使用し、ネットワークにはアクセスしない）
+EFetchのパース、トークン数計算とチャンク分割（日次・週次）、プロンプト生成、成果物のJSON変換、
+論文データのコンパクトな表現への変換、列指向パーティションでの傾向の集計を計測する
+
+使用例:
+    python benchmarks/run.py                                  # 全ベンチマークを計測
+    python benchmarks/run.py -k chunk --sizes 100,1000        # 名前に chunk を含むものを指定件数で計測
+    python benchmarks/run.py --json results.json              # 結果をJSONで保存
+    python benchmarks/run.py --baseline results.json          # 以前の結果と比較し、遅くなったものがあれば終了コード1
+    python benchmarks/run.py -k raw_loads --sizes 100000 --memory   # 論文データの保持に使うメモリも計測
+
+トークン数の計算にはtiktokenのエンコーディングファイルが必要（./create-layer.sh でレイヤーに同梱される）
+エンコーディングファイルがない場合、トークン数を計算するベンチマークはダウンロードせずにスキップする
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest import mock
+
+import fixtures
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_SIZES = [10, 100, 1000]
+DEFAULT_REPEAT = 5
+# 以前の結果と比較して遅くなったとみなす割合（中央値）
+DEFAULT_THRESHOLD = 0.25
+
+# トークン数の計算に使うエンコーディングのファイル（tiktokenはURLのSHA-1をキャッシュのファイル名にする）
+TIKTOKEN_ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+
+
+def setup_environment() -> None:
+    """Lambdaのレイヤー構成を再現し、外部サービスを使わない設定にする"""
+    for path in (
+        ROOT / "layers" / "openai" / "python",
+        ROOT / "layers" / "common" / "python",
+        ROOT / "lambda",
+        ROOT / "analyze_lambda",
+        ROOT / "translate_lambda",
+        ROOT / "weekly_analyze_lambda",
+    ):
+        if path.exists():
+            sys.path.insert(0, str(path))
+
+    os.environ["METRICS_DISABLED"] = "1"
+    os.environ.pop("PROFILE_HANDLERS", None)
+    os.environ.pop("CACHE_BUCKET", None)
+    os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="pubmed_benchmark_cache_")
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("BUCKET_NAME", "benchmark")
+    tiktoken_cache = ROOT / "layers" / "openai" / "tiktoken_cache"
+    if tiktoken_cache.exists():
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(tiktoken_cache))
+
+
+def token_benchmark_skip_reason() -> Optional[str]:
+    """トークン数の計算をネットワークなしで実行できない場合にその理由を返す"""
+    try:
+        import tiktoken  # noqa: F401
+    except ImportError:
+        return "tiktoken is not installed"
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR") or os.environ.get("DATA_GYM_CACHE_DIR")
+    if not cache_dir:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    cache_key = hashlib.sha1(TIKTOKEN_ENCODING_URL.encode()).hexdigest()
+    if not os.path.exists(os.path.join(cache_dir, cache_key)):
+        return "no tiktoken cache (run ./create-layer.sh or set TIKTOKEN_CACHE_DIR)"
+    return None
+
+
+def clear_cache() -> None:
+    """コンテナ内キャッシュを破棄（新しいコンテナでの処理を再現する）"""
+    from pubmed_common import cache
+
+    cache.get_cache.cache_clear()
+
+
+class _FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+# ベンチマークの準備関数: 件数を受け取り、(計測する関数, 繰り返しごとの初期化関数, 処理バイト数) を返す
+Setup = Callable[[int], Tuple[Callable[[], Any], Optional[Callable[[], None]], int]]
+
+
+def bench_parse_efetch(size: int):
+    import lambda_function
+
+    xml = fixtures.efetch_xml(size)
+    pmid_list = fixtures.pmids(size)
+
+    def run():
+        with mock.patch.object(lambda_function.requests, "get", return_value=_FakeResponse(xml)):
+            result = lambda_function.fetch_article_data(pmid_list)
+        assert len(result) == size
+        return result
+
+    return run, None, len(xml.encode("utf-8"))
+
+
+def bench_analyze_tokens(size: int):
+    import analyze_function
+
+    texts = [
+        analyze_function.create_article_text(article, pmid)
+        for pmid, article in fixtures.raw_articles(size).items()
+    ]
+
+    def run():
+        for text in texts:
+            analyze_function.num_tokens_from_string(text)
+
+    return run, clear_cache, sum(len(text.encode("utf-8")) for text in texts)
+
+
+def bench_analyze_chunk(size: int):
+    import analyze_function
+
+    articles = fixtures.raw_articles(size)
+    return lambda: analyze_function.chunk_articles(articles), clear_cache, 0
+
+
+def bench_weekly_tokens(size: int):
+    import weekly_analyze_function
+
+    articles = fixtures.analysis_articles(size)
+
+    def run():
+        for article in articles:
+            weekly_analyze_function.article_tokens(article)
+
+    return run, clear_cache, 0
+
+
+def bench_weekly_chunk(size: int):
+    import weekly_analyze_function
+
+    articles = fixtures.analysis_articles(size)
+    return lambda: weekly_analyze_function.chunk_articles(articles), clear_cache, 0
+
+
+def bench_prompt_analysis(size: int):
+    import analyze_function
+
+    articles = fixtures.raw_articles(size)
+
+    def run():
+        text = "".join(
+            analyze_function.create_article_text(article, pmid)
+            for pmid, article in articles.items()
+        )
+        return analyze_function.get_analysis_prompt(text)
+
+    return run, None, 0
+
+
+def bench_prompt_weekly(size: int):
+    import weekly_analyze_function
+
+    articles = fixtures.analysis_articles(size)
+    return lambda: weekly_analyze_function.create_weekly_analysis_prompt(articles), None, 0
+
+
+def bench_prompt_final_selection(size: int):
+    import weekly_analyze_function
+
+    articles = fixtures.analysis_articles(size)
+    return lambda: weekly_analyze_function.create_final_selection_prompt(articles), None, 0
+
+
+def bench_prompt_translation(size: int):
+    import translate_function
+
+    analysis = fixtures.analysis_output(size)
+    return lambda: translate_function.get_translation_prompt(analysis), None, 0
+
+
+def bench_columnar_trend(size: int):
+    """1日あたり size 件の取得結果を半年分圧縮した列で、週ごと・ジャーナルごとの構成比を集計"""
+    from datetime import date, timedelta
+
+    from pubmed_common import columnar, s3_layout
+
+    raw = fixtures.raw_output(size)
+    analysis = fixtures.analysis_output(max(1, size // 10))
+    start = date(2025, 1, 1)
+    documents = [
+        (s3_layout.raw_key("sepsis", start + timedelta(days=offset)), raw, analysis)
+        for offset in range(182)
+    ]
+    partition = columnar.empty_partition()
+    rows = columnar.build_rows(documents, partition["dictionaries"])
+    dataset = {"columns": rows, "dictionaries": partition["dictionaries"]}
+
+    def run():
+        mask = columnar.select(dataset, terms=["sepsis"], start=start + timedelta(days=30))
+        return columnar.trend(dataset, mask, bucket="week", by="journal", share=True, top=5)
+
+    return run, None, sum(column.nbytes for column in rows.values())
+
+
+def _json_benchmarks(make: Callable[[int], Dict[str, Any]]) -> Tuple[Setup, Setup]:
+    """成果物と同じ設定（ensure_ascii=False, indent=2）でのシリアライズ・デシリアライズ"""
+
+    def dumps(size: int):
+        data = make(size)
+        body = json.dumps(data, ensure_ascii=False, indent=2)
+        return lambda: json.dumps(data, ensure_ascii=False, indent=2), None, len(body.encode())
+
+    def loads(size: int):
+        body = json.dumps(make(size), ensure_ascii=False, indent=2).encode("utf-8")
+        return lambda: json.loads(body.decode("utf-8")), None, len(body)
+
+    return dumps, loads
+
+
+def bench_records_raw_loads(size: int):
+    """取得結果を読み込み、論文データをrecords.Articleに変換（分析での読み込みと同じ）"""
+    from pubmed_common import records
+
+    body = json.dumps(fixtures.raw_output(size), ensure_ascii=False, indent=2).encode("utf-8")
+
+    def run():
+        return records.loads(body.decode("utf-8"))
+
+    return run, None, len(body)
+
+
+raw_dumps, raw_loads = _json_benchmarks(fixtures.raw_output)
+analysis_dumps, analysis_loads = _json_benchmarks(fixtures.analysis_output)
+
+BENCHMARKS: Dict[str, Setup] = {
+    "fetch.parse_efetch": bench_parse_efetch,
+    "analyze.count_tokens": bench_analyze_tokens,
+    "analyze.chunk_articles": bench_analyze_chunk,
+    "weekly.count_tokens": bench_weekly_tokens,
+    "weekly.chunk_articles": bench_weekly_chunk,
+    "prompt.analysis": bench_prompt_analysis,
+    "prompt.weekly": bench_prompt_weekly,
+    "prompt.final_selection": bench_prompt_final_selection,
+    "prompt.translation": bench_prompt_translation,
+    "columnar.trend": bench_columnar_trend,
+    "json.raw_dumps": raw_dumps,
+    "json.raw_loads": raw_loads,
+    "records.raw_loads": bench_records_raw_loads,
+    "json.analysis_dumps": analysis_dumps,
+    "json.analysis_loads": analysis_loads,
+}
+
+# tiktokenのエンコーディングファイルが必要なベンチマーク
+TOKEN_BENCHMARKS = {
+    "analyze.count_tokens",
+    "analyze.chunk_articles",
+    "weekly.count_tokens",
+    "weekly.chunk_articles",
+}
+
+
+def measure(name: str, size: int, repeat: int, memory: bool = False) -> Dict[str, Any]:
+    """
+    1つのベンチマークを指定件数で繰り返し計測（初回はウォームアップとして除外）
+    memory=Trueの場合はウォームアップで確保したメモリの最大値と、戻り値として保持されるメモリを計測する
+    """
+    result: Dict[str, Any] = {"name": name, "size": size}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run, reset, nbytes = BENCHMARKS[name](size)
+            timings = []
+            for i in range(repeat + 1):
+                if reset:
+                    reset()
+                if i == 0 and memory:
+                    tracemalloc.start()
+                    value = run()
+                    retained, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    del value
+                    result["peak_kb"] = round(peak / 1024, 1)
+                    result["retained_kb"] = round(retained / 1024, 1)
+                    continue
+                started = time.perf_counter()
+                run()
+                if i > 0:
+                    timings.append(time.perf_counter() - started)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {str(e)}"
+        return result
+
+    median = statistics.median(timings)
+    result.update(
+        {
+            "repeat": repeat,
+            "median_ms": round(median * 1000, 4),
+            "min_ms": round(min(timings) * 1000, 4),
+            "max_ms": round(max(timings) * 1000, 4),
+            "stdev_ms": round(statistics.stdev(timings) * 1000, 4) if len(timings) > 1 else 0.0,
+            "items_per_second": round(size / median, 1) if median > 0 else None,
+        }
+    )
+    if nbytes:
+        result["bytes"] = nbytes
+        result["mb_per_second"] = round(nbytes / median / 1024 / 1024, 2) if median > 0 else None
+    return result
+
+
+def environment_info() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(
+    results: List[Dict[str, Any]], baseline: Dict[str, Any], threshold: float
+) -> List[Dict[str, Any]]:
+    """以前の結果と中央値を比較し、閾値を超えて遅くなったものを返す"""
+    previous = {
+        (entry["name"], entry["size"]): entry
+        for entry in baseline.get("results", [])
+        if "median_ms" in entry
+    }
+    regressions = []
+    for result in results:
+        before = previous.get((result["name"], result["size"]))
+        if not before or "median_ms" not in result or not before["median_ms"]:
+            continue
+        result["baseline_median_ms"] = before["median_ms"]
+        result["change"] = round(result["median_ms"] / before["median_ms"] - 1, 4)
+        if result["change"] > threshold:
+            regressions.append(result)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run offline micro-benchmarks of the hot paths")
+    parser.add_argument("-k", dest="pattern", help="Only run benchmarks whose name contains this")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in DEFAULT_SIZES),
+        help="Comma separated article counts",
+    )
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Measured runs per size")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with a previous JSON result")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Allowed slowdown of the median before reporting a regression (0.25 = 25%%)",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="Also trace peak and retained memory of the warm-up run",
+    )
+    parser.add_argument("--list", action="store_true", help="List benchmark names and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    names = [name for name in BENCHMARKS if not args.pattern or args.pattern in name]
+    if not names:
+        parser.error(f"no benchmarks match {args.pattern!r}")
+
+    setup_environment()
+    token_skip_reason = token_benchmark_skip_reason()
+    results = []
+    for name in names:
+        for size in sizes:
+            if name in TOKEN_BENCHMARKS and token_skip_reason:
+                results.append({"name": name, "size": size, "skipped": token_skip_reason})
+                print(f"{name:<24} {size:>6}  skipped: {token_skip_reason}")
+                continue
+            result = measure(name, size, args.repeat, args.memory)
+            results.append(result)
+            if "error" in result:
+                print(f"{name:<24} {size:>6}  error: {result['error']}")
+                continue
+            throughput = f"{result['items_per_second']:>12,.0f} items/s"
+            if "mb_per_second" in result:
+                throughput += f" {result['mb_per_second']:>8.2f} MB/s"
+            print(
+                f"{name:<24} {size:>6}  median {result['median_ms']:>10.3f} ms "
+                f"(min {result['min_ms']:.3f}, max {result['max_ms']:.3f}) {throughput}"
+            )
+            if "peak_kb" in result:
+                print(
+                    f"{'':<24} {'':>6}  peak {result['peak_kb'] / 1024:>12.1f} MB "
+                    f"retained {result['retained_kb'] / 1024:.1f} MB"
+                )
+
+    regressions = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = compare(results, baseline, args.threshold)
+        for result in regressions:
+            print(
+                f"Regression: {result['name']} [{result['size']}] "
+                f"{result['baseline_median_ms']:.3f} ms -> {result['median_ms']:.3f} ms "
+                f"(+{result['change'] * 100:.1f}%)"
+            )
+        if not regressions:
+            print(f"No regressions over {args.threshold * 100:.0f}% against {args.baseline}")
+
+    if args.json:
+        output = {
+            "environment": environment_info(),
+            "sizes": sizes,
+            "repeat": args.repeat,
+            "results": results,
+        }
+        Path(args.json).write_text(json.dumps(output, ensure_ascii=False, indent=2))
+        print(f"Results written to {args.json}")
+
+    failed = any("error" in result for result in results)
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+import os
+from datetime import date, datetime, timedelta
+
+from pubmed_common import clients, columnar, metrics, profiling, s3_layout, s3_loader
+
+# 日次の実行で圧縮し直す期間（月をまたいだ直後も前月の分析結果の更新を反映する）
+DEFAULT_LOOKBACK_DAYS = 7
+
+
+@metrics.instrument_handler("compact")
+@profiling.profile_handler("compact")
+def lambda_handler(event, context):
+    """
+    取得結果・分析結果を月ごとの列指向パーティションに圧縮する（毎日実行）
+    event の months（"yyyy-mm" のリスト）で対象の月を、rebuild で作り直しを指定できる
+    省略した場合は直近 COMPACT_LOOKBACK_DAYS 日を含む月を対象とする
+    """
+    event = event or {}
+    if event.get("months"):
+        months = [datetime.strptime(month, "%Y-%m").date() for month in event["months"]]
+    else:
+        today = date.today()
+        lookback = int(os.environ.get("COMPACT_LOOKBACK_DAYS", DEFAULT_LOOKBACK_DAYS))
+        months = columnar.months_between(today - timedelta(days=lookback), today)
+
+    s3 = clients.get_s3(s3_loader.DEFAULT_MAX_WORKERS)
+    bucket = os.environ["BUCKET_NAME"]
+    terms = s3_layout.list_manifest_terms(s3, bucket)
+    results = []
+    for month in months:
+        try:
+            results.append(
+                columnar.compact_month(s3, bucket, month, terms, bool(event.get("rebuild")))
+            )
+        except Exception as e:
+            print(f"Error compacting {month.strftime('%Y-%m')}: {str(e)}")
+            results.append({"month": month.strftime("%Y-%m"), "error": str(e)})
+
+    failed = any("error" in result or result["failed"] for result in results)
+    return {"statusCode": 500 if failed else 200, "months": results}
@@ -10,8 +10,8 @@ echo "Creating OpenAI Lambda Layer..."
 
 # レイヤーディレクトリのクリーンアップと作成
 echo "Cleaning up layer directory..."
-rm -rf layers/openai/python
-mkdir -p layers/openai/python
+rm -rf layers/openai/python layers/openai/tiktoken_cache
+mkdir -p layers/openai/python layers/openai/tiktoken_cache
 
 # Dockerを使用してAmazon Linux 2互換の環境でビルド
 echo "Installing dependencies using Docker..."
@@ -31,6 +31,22 @@ if [ $? -ne 0 ]; then
     exit 1
 fi
 
+# tiktokenのエンコーディングファイルを事前に取得してレイヤーに同梱
+# （Lambdaでは TIKTOKEN_CACHE_DIR=/opt/tiktoken_cache を参照し、実行時にダウンロードしない）
+echo "Bundling tiktoken encodings..."
+docker run --rm \
+  -v "$(pwd)/layers/openai/python:/lambda" \
+  -v "$(pwd)/layers/openai/tiktoken_cache:/tiktoken_cache" \
+  -e PYTHONPATH=/lambda \
+  -e TIKTOKEN_CACHE_DIR=/tiktoken_cache \
+  public.ecr.aws/sam/build-python3.11:latest \
+  python -c "import tiktoken; [tiktoken.get_encoding(name) for name in ('cl100k_base',)]"
+
+if [ $? -ne 0 ]; then
+    echo "Error: Failed to bundle tiktoken encodings"
+    exit 1
+fi
+
 # 不要なファイルの削除
 echo "Cleaning up unnecessary files..."
 cd layers/openai/python || exit
@@ -41,6 +57,17 @@ find . -type f -name "*.pyo" -delete
 find . -type d -name "*.dist-info" -exec rm -rf {} +
 find . -type d -name "*.egg-info" -exec rm -rf {} +
 
+# 実行時に使用しないパッケージ・ファイルの削除
+# （コマンドラインツール、OpenAI CLI、NumPyのビルド用ヘッダー・f2py・distutils、型スタブ）
+rm -rf bin openai/cli
+rm -rf numpy/f2py numpy/distutils numpy/_pyinstaller numpy/core/include
+find . -type f -name "*.pyi" -delete
+
+# 共有ライブラリのデバッグシンボルを削除
+if command -v strip > /dev/null; then
+    find . -type f -name "*.so" -exec strip --strip-unneeded {} + 2> /dev/null
+fi
+
 # サイズの確認
 echo "Layer size:"
 du -sh .
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+from datetime import date, timedelta
+from typing import Any, Dict, List
+
+from pubmed_common import budget, clients, metrics, profiling, term_registry
+
+# 1回のSendMessageBatchで送信できるメッセージ数の上限
+SQS_BATCH_SIZE = 10
+
+
+def shard_messages(registry: Dict[str, Any], job: str, day: date) -> List[Dict[str, Any]]:
+    """
+    指定日に実行する検索語を優先度順にシャードに分割し、シャードごとのメッセージを作成
+    シャードの開始時刻をずらして、NCBIとOpenAIへのリクエストが同時に集中しないようにする
+    """
+    due = term_registry.due_terms(registry, job, day)
+    shards = term_registry.shard(due, registry["shard_size"])
+    delays = term_registry.stagger_delays(len(shards), registry["stagger_seconds"])
+
+    messages = []
+    for index, (entries, delay) in enumerate(zip(shards, delays)):
+        if job == "weekly":
+            body = {"search_terms": [entry["term"] for entry in entries]}
+        else:
+            body = {
+                "terms": [
+                    {
+                        "term": entry["term"],
+                        "query": entry["query"],
+                        "days": term_registry.fetch_days(entry),
+                    }
+                    for entry in entries
+                ]
+            }
+        body["date"] = day.isoformat()
+        messages.append(
+            {
+                "id": str(index),
+                "terms": [entry["term"] for entry in entries],
+                "body": body,
+                "delay_seconds": delay,
+            }
+        )
+    return messages
+
+
+def send_messages(queue_url: str, messages: List[Dict[str, Any]]) -> List[str]:
+    """シャードのメッセージをまとめてSQSに送信し、送信に失敗したメッセージのIDを返す"""
+    sqs = clients.get_sqs()
+    failed = []
+    for start in range(0, len(messages), SQS_BATCH_SIZE):
+        batch = messages[start : start + SQS_BATCH_SIZE]
+        response = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {
+                    "Id": message["id"],
+                    "MessageBody": json.dumps(message["body"], ensure_ascii=False),
+                    "DelaySeconds": message["delay_seconds"],
+                }
+                for message in batch
+            ],
+        )
+        for failure in response.get("Failed", []):
+            print(f"Failed to send shard {failure['Id']}: {failure.get('Message')}")
+            failed.append(failure["Id"])
+    return failed
+
+
+def resubmit_deferred(bucket: str, day: date) -> Dict[str, int]:
+    """
+    前日に予算の縮退で延期された処理を再投入する
+    分析はワークフローを再実行し（実行名は延期日ごとに決定的）、週次レポートは週次分析のキューに送信する
+    """
+    previous = day - timedelta(days=1)
+    items = budget.deferred_items(bucket, previous)
+    counts = {"resubmitted": 0, "failed": 0}
+    if not items:
+        return counts
+
+    for item in items:
+        try:
+            if item["stage"] == "analyze":
+                sfn = clients.get_stepfunctions()
+                digest = hashlib.sha256(f"{item['key']}:{previous}".encode("utf-8")).hexdigest()
+                try:
+                    sfn.start_execution(
+                        stateMachineArn=os.environ["STATE_MACHINE_ARN"],
+                        name=f"deferred-{previous.strftime('%Y%m%d')}-{digest[:16]}",
+                        input=json.dumps({"bucket": bucket, "key": item["key"]}),
+                    )
+                except sfn.exceptions.ExecutionAlreadyExists:
+                    print(f"Deferred execution already exists for {item['key']}")
+                    continue
+            elif item["stage"] == "weekly":
+                message = {
+                    "search_terms": [item["term"]],
+                    "date": item["date"],
+                    # 週次候補ストアは直近1週間のみを保持するため、解析済みファイルから読み込む
+                    "use_candidate_store": False,
+                }
+                clients.get_sqs().send_message(
+                    QueueUrl=os.environ["WEEKLY_QUEUE_URL"], MessageBody=json.dumps(message)
+                )
+            else:
+                continue
+            counts["resubmitted"] += 1
+        except Exception as e:
+            print(f"Failed to resubmit deferred {item['stage']} for {item['term']}: {str(e)}")
+            counts["failed"] += 1
+
+    print(f"Resubmitted {counts['resubmitted']}/{len(items)} deferred items from {previous}")
+    return counts
+
+
+@metrics.instrument_handler("dispatch")
+@profiling.profile_handler("dispatch")
+def lambda_handler(event, context):
+    """
+    検索語レジストリを読み込み、論文取得（job="fetch"）または週次分析（job="weekly"）を
+    シャードに分けて各Lambdaのキューに送信する
+    job="fetch"では前日に予算の縮退で延期された処理も再投入する
+    """
+    try:
+        bucket_name = os.environ["BUCKET_NAME"]
+        job = event.get("job", "fetch")
+        if job not in ("fetch", "weekly"):
+            raise ValueError(f"Unknown job: {job}")
+        day = date.fromisoformat(event["date"]) if event.get("date") else date.today()
+
+        deferred = {"resubmitted": 0, "failed": 0}
+        if job == "fetch" and os.environ.get("STATE_MACHINE_ARN"):
+            deferred = resubmit_deferred(bucket_name, day)
+
+        fallback_terms = os.environ.get("SEARCH_TERMS", "sepsis").split(",")
+        registry = term_registry.load_registry(clients.get_s3(), bucket_name, fallback_terms)
+        messages = shard_messages(registry, job, day)
+        if not messages:
+            print(f"No terms to dispatch for {job} on {day.isoformat()}")
+            return {
+                "statusCode": 500 if deferred["failed"] else 200,
+                "job": job,
+                "date": day.isoformat(),
+                "shards": [],
+                "deferred": deferred,
+            }
+
+        queue_url = os.environ["WEEKLY_QUEUE_URL" if job == "weekly" else "FETCH_QUEUE_URL"]
+        failed = send_messages(queue_url, messages)
+
+        terms = sum(len(message["terms"]) for message in messages)
+        print(f"Dispatched {terms} terms in {len(messages)} shards for {job}")
+        metrics.emit(
+            {
+                "TermsDispatched": (terms, metrics.COUNT),
+                "ShardsDispatched": (len(messages) - len(failed), metrics.COUNT),
+                "ShardsFailed": (len(failed), metrics.COUNT),
+                "DeferredResubmitted": (deferred["resubmitted"], metrics.COUNT),
+            }
+        )
+
+        return {
+            "statusCode": 500 if failed or deferred["failed"] else 200,
+            "job": job,
+            "date": day.isoformat(),
+            "terms": terms,
+            "deferred": deferred,
+            "shards": [
+                {
+                    "terms": message["terms"],
+                    "delay_seconds": message["delay_seconds"],
+                    "sent": message["id"] not in failed,
+                }
+                for message in messages
+            ],
+        }
+
+    except Exception as e:
+        print(f"Error dispatching terms: {str(e)}")
+        return {
+            "statusCode": 500,
+            "error": "Error processing request",
+            "details": str(e),
+        }
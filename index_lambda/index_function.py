@@ -0,0 +1,76 @@
+import json
+import os
+from typing import Any, Dict, List, Tuple
+from urllib.parse import unquote_plus
+
+from pubmed_common import article_index, clients, metrics, profiling, s3_loader
+
+
+def parse_object_events(
+    sqs_records: List[Dict[str, Any]],
+) -> Tuple[Dict[str, str], Dict[str, List[str]], List[str]]:
+    """
+    SQSメッセージ本文のEventBridgeのS3作成イベントから、キーごとのバージョン（ETag）を取得
+    同じキーのイベントはsequencerが最も新しいものを採用する
+    キーごとのバージョン、キーごとのSQSメッセージID、解析できなかったメッセージIDを返す
+    """
+    latest: Dict[str, Tuple[str, str]] = {}
+    message_ids: Dict[str, List[str]] = {}
+    invalid_message_ids = []
+
+    for sqs_record in sqs_records:
+        try:
+            detail = json.loads(sqs_record["body"])["detail"]
+            key = unquote_plus(detail["object"]["key"])
+            version = article_index.object_version(detail["object"])
+            sequencer = detail["object"].get("sequencer", "")
+        except Exception as e:
+            print(f"Error parsing message {sqs_record.get('messageId')}: {str(e)}")
+            invalid_message_ids.append(sqs_record["messageId"])
+            continue
+
+        message_ids.setdefault(key, []).append(sqs_record["messageId"])
+        current = latest.get(key)
+        if current is None or int(sequencer or "0", 16) >= int(current[1] or "0", 16):
+            latest[key] = (version, sequencer)
+
+    return {key: version for key, (version, _) in latest.items()}, message_ids, invalid_message_ids
+
+
+@metrics.instrument_handler("index")
+@profiling.profile_handler("index")
+def lambda_handler(event, context):
+    """
+    SQSに蓄積された取得結果・分析結果の作成イベントをバッチで受け取り、論文索引に反映する
+    他の実行と差し替えが競合した場合は、最新のスナップショットに反映し直す
+    読み込めなかった成果物のメッセージはbatchItemFailuresとして返し、SQSから再配信させる
+    """
+    sqs_records = event.get("Records", [])
+    versions, message_ids, failed_message_ids = parse_object_events(sqs_records)
+    print(f"Received {len(sqs_records)} messages for {len(versions)} objects")
+
+    try:
+        result = article_index.update_index(
+            clients.get_s3(s3_loader.DEFAULT_MAX_WORKERS),
+            os.environ["BUCKET_NAME"],
+            versions,
+        )
+    except Exception as e:
+        print(f"Error updating article index: {str(e)}")
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": sqs_record["messageId"]} for sqs_record in sqs_records
+            ]
+        }
+
+    for key in result["failed"]:
+        failed_message_ids.extend(message_ids.get(key, []))
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in dict.fromkeys(failed_message_ids)
+        ],
+        "indexed": result["indexed"],
+        "articles": result["articles"],
+        "snapshot": result["snapshot"],
+    }
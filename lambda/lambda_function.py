@@ -1,22 +1,37 @@
 import datetime
 import json
 import os
+import queue
+import threading
+import time
 import xml.etree.ElementTree as ET
-from typing import Dict, List
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
-import boto3
 import requests
+from pubmed_common import cache, clients, metrics, profiling, records, s3_layout
 
-# S3クライアント作成
-s3 = boto3.client("s3")
+# E-utilitiesのベースURL（ローカルでの負荷試験では模擬サーバーを指定する）
+NCBI_EUTILS_URL = os.environ.get("NCBI_EUTILS_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils")
 
+# ストリーミング分析・並列解析でのEFetchの1ページの論文数と、分析に渡す前に取得済みで待機できるページ数
+EFETCH_PAGE_SIZE = int(os.environ.get("EFETCH_PAGE_SIZE", "200"))
+STREAM_QUEUE_PAGES = int(os.environ.get("STREAM_QUEUE_PAGES", "2"))
 
-def fetch_article_data(pmid_list: List[str]) -> Dict:
-    """
-    EFetchを使用して論文の詳細情報とアブストラクトを取得
-    """
+# EFetchのXMLを並列に解析するプロセス数（2未満の場合は取得と同じプロセスで解析する）
+# Lambdaの実行環境ではプロセスプールを作成できないため、ローカルでの過去分の取得で指定する
+EFETCH_PARSE_WORKERS = int(os.environ.get("EFETCH_PARSE_WORKERS", "0"))
+# 並列に解析する最小の論文数（これより少ない場合はプロセス間の受け渡しのほうが高くつく）
+PARALLEL_PARSE_MIN_ARTICLES = int(os.environ.get("PARALLEL_PARSE_MIN_ARTICLES", "400"))
+
+
+def download_efetch(pmid_list: List[str]) -> bytes:
+    """EFetchを使用して論文の詳細情報とアブストラクトのXMLを取得"""
     efetch_url = (
-        "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+        f"{NCBI_EUTILS_URL}/efetch.fcgi"
         "?db=pubmed"
         f"&id={','.join(pmid_list)}"
         "&rettype=abstract"
@@ -24,10 +39,19 @@ def fetch_article_data(pmid_list: List[str]) -> Dict:
     )
 
     print(f"Fetching detailed data from EFetch API: {efetch_url}")
-    response = requests.get(efetch_url)
-    response.raise_for_status()
+    with metrics.timer("NcbiRequestLatency", Endpoint="efetch") as m:
+        response = requests.get(efetch_url)
+        response.raise_for_status()
+        m["NcbiResponseBytes"] = (len(response.content), metrics.BYTES)
+    return response.content
+
 
-    root = ET.fromstring(response.text)
+def parse_efetch(content: bytes, fetch_date: str) -> Dict[str, records.Article]:
+    """
+    EFetchのXMLから論文データ（PMIDをキーとするrecords.Articleの辞書）を作成
+    並列に解析する場合はプロセスプールのワーカーで実行する
+    """
+    root = ET.fromstring(content)
     articles_data = {}
 
     for article in root.findall("./PubmedArticle"):
@@ -69,16 +93,24 @@ def fetch_article_data(pmid_list: List[str]) -> Dict:
             journal = article.findtext(".//Journal/Title", "")
             pub_date = article.findtext(".//PubDate/Year", "")
 
+            # 出版タイプ（Randomized Controlled Trial、Reviewなど）の取得
+            publication_types = [
+                elem.text.strip()
+                for elem in article.findall(".//PublicationTypeList/PublicationType")
+                if elem.text
+            ]
+
             # データの格納
-            articles_data[pmid] = {
-                "pmid": pmid,
-                "title": title,
-                "abstract": full_abstract,
-                "authors": authors,
-                "journal": journal,
-                "publication_year": pub_date,
-                "fetch_date": datetime.datetime.now().isoformat(),
-            }
+            articles_data[pmid] = records.Article(
+                pmid=pmid,
+                title=title,
+                abstract=full_abstract,
+                authors=authors,
+                journal=journal,
+                publication_year=pub_date,
+                publication_types=publication_types,
+                fetch_date=fetch_date,
+            )
 
         except Exception as e:
             print(f"Error processing article {pmid}: {str(e)}")
@@ -87,91 +119,338 @@ def fetch_article_data(pmid_list: List[str]) -> Dict:
     return articles_data
 
 
-def lambda_handler(event, context):
+def _parse_page(content: bytes, fetch_date: str) -> Tuple[Dict[str, records.Article], float]:
+    """1ページのXMLを解析し、論文データと解析にかかった秒数を返す"""
+    parse_started = time.perf_counter()
+    articles_data = parse_efetch(content, fetch_date)
+    return articles_data, time.perf_counter() - parse_started
+
+
+def emit_parse_metrics(articles_data: Dict[str, records.Article], parse_seconds: float) -> None:
+    metrics.emit(
+        {
+            "ArticlesParsed": (len(articles_data), metrics.COUNT),
+            "ArticlesParsedPerSecond": (
+                len(articles_data) / parse_seconds if parse_seconds > 0 else 0.0,
+                metrics.COUNT_PER_SECOND,
+            ),
+        }
+    )
+
+
+def fetch_article_data(pmid_list: List[str]) -> Dict:
+    """
+    EFetchを使用して論文の詳細情報とアブストラクトを取得
+    論文データはPMIDをキーとするrecords.Articleの辞書で返す
+    """
+    content = download_efetch(pmid_list)
+    # 取得日時は同じEFetchで取得した論文で共有する
+    articles_data, parse_seconds = _parse_page(content, datetime.datetime.now().isoformat())
+    emit_parse_metrics(articles_data, parse_seconds)
+    return articles_data
+
+
+@lru_cache(maxsize=None)
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    EFetchのXMLを解析するプロセスプール（EFETCH_PARSE_WORKERSが2未満、または作成できない環境ではNone）
+    プロセスの起動を繰り返さないよう、プロセス内で共有する
+    """
+    if EFETCH_PARSE_WORKERS < 2:
+        return None
     try:
-        # 環境変数から設定を取得
-        search_terms_str = os.environ.get("SEARCH_TERMS", "sepsis")
-        search_terms = [term.strip() for term in search_terms_str.split(",")]
-        bucket_name = os.environ.get("BUCKET_NAME", "my-pubmed-bucket")
+        return ProcessPoolExecutor(max_workers=EFETCH_PARSE_WORKERS)
+    except (OSError, NotImplementedError) as e:
+        print(f"Parsing EFetch pages in a single process: {str(e)}")
+        return None
 
-        # イベントから特定の検索語が指定されているか確認
-        if "search_term" in event:
-            search_terms = [event["search_term"]]
-            print(f"Using search term from event: {search_terms[0]}")
 
-        results = []
+def iter_parsed_pages(
+    pmid_list: List[str], page_size: int, pool: ProcessPoolExecutor
+) -> Iterator[Dict]:
+    """
+    EFetchのページを順に取得し、XMLの解析は1ページを1タスクとしてプロセスプールで並行させる
+    解析が終わった順に関わらず、取得した順にページを返す
+    """
 
-        # 前日の日付を取得
-        yesterday = datetime.date.today() - datetime.timedelta(days=1)
-
-        for search_term in search_terms:
-            # ESearch APIのURL作成
-            esearch_url = (
-                "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-                "?db=pubmed"
-                f"&term={search_term}"
-                "&retmode=json"
-                "&retmax=1000"
-                f"&datetype=edat"
-                f"&mindate={yesterday.strftime('%Y/%m/%d')}"
-                f"&maxdate={datetime.date.today().strftime('%Y/%m/%d')}"
-            )
+    def parsed(future: Future) -> Dict[str, records.Article]:
+        articles_data, parse_seconds = future.result()
+        emit_parse_metrics(articles_data, parse_seconds)
+        return articles_data
 
-            print(f"Searching PubMed with URL: {esearch_url}")
+    pending: Deque[Future] = deque()
+    for start in range(0, len(pmid_list), max(page_size, 1)):
+        content = download_efetch(pmid_list[start : start + page_size])
+        pending.append(pool.submit(_parse_page, content, datetime.datetime.now().isoformat()))
+        # 解析済みのページは次の取得の前に返し、解析待ちのページはワーカー数の2倍までにする
+        while pending and (pending[0].done() or len(pending) > 2 * EFETCH_PARSE_WORKERS):
+            yield parsed(pending.popleft())
+    while pending:
+        yield parsed(pending.popleft())
 
-            # ESearch APIリクエスト
-            response = requests.get(esearch_url)
-            response.raise_for_status()
-            data = response.json()
-            pmid_list = data.get("esearchresult", {}).get("idlist", [])
 
-            print(f"Found {len(pmid_list)} articles for term '{search_term}'.")
+def iter_article_pages(pmid_list: List[str], page_size: int) -> Iterator[Dict]:
+    """
+    論文の詳細情報をEFetchのページ（page_size件）ごとに取得して返す
+    コンテナ内で取得済みの論文は最初にまとめて返し、EFetchを呼び出さない
+    取得する論文がPARALLEL_PARSE_MIN_ARTICLES件以上の場合は、XMLの解析をプロセスプールで並行させる
+    """
+    article_cache = cache.get_cache()
+    cached = {}
+    missing = []
+    for pmid in pmid_list:
+        article = article_cache.get(cache.ARTICLES, cache.cache_key("efetch", pmid))
+        if article is None:
+            missing.append(pmid)
+        else:
+            cached[pmid] = records.Article.from_dict(article, pmid)
+
+    print(f"Using {len(cached)} cached articles, fetching {len(missing)} articles")
+    if cached:
+        yield cached
+
+    pool = get_parse_pool() if len(missing) >= PARALLEL_PARSE_MIN_ARTICLES else None
+    if pool is not None:
+        pages = iter_parsed_pages(missing, page_size, pool)
+    else:
+        pages = (
+            fetch_article_data(missing[start : start + page_size])
+            for start in range(0, len(missing), max(page_size, 1))
+        )
+    for page in pages:
+        for pmid, article in page.items():
+            article_cache.put(cache.ARTICLES, cache.cache_key("efetch", pmid), article)
+        yield page
+
+
+def fetch_articles(pmid_list: List[str]) -> Dict:
+    """
+    論文の詳細情報を取得（コンテナ内で取得済みの論文はキャッシュを使い、EFetchを呼び出さない）
+    """
+    # 並列に解析する場合のみページに分けて取得する（それ以外は1回のEFetchでまとめて取得する）
+    page_size = EFETCH_PAGE_SIZE if EFETCH_PARSE_WORKERS >= 2 else len(pmid_list)
+    articles_data = {}
+    for page in iter_article_pages(pmid_list, page_size):
+        articles_data.update(page)
 
-            if not pmid_list:
-                print(f"No new articles found for {search_term}.")
-                continue
+    # 検索結果の順序で返す
+    return {pmid: articles_data[pmid] for pmid in pmid_list if pmid in articles_data}
 
-            # 詳細情報とアブストラクトの取得
-            articles_data = fetch_article_data(pmid_list)
-
-            # ファイル名作成（検索語と日付）
-            date_str = datetime.datetime.now().strftime("%Y%m%d")
-            # ファイル名に使用できる形式に検索語を変換（空白をアンダースコアに置換など）
-            safe_term = search_term.replace(" ", "_").replace("/", "_").replace("\\", "_")
-            file_name = f"pubmed_{safe_term}_{date_str}.json"
-
-            # メタデータの追加
-            output_data = {
-                "metadata": {
-                    "search_term": search_term,
-                    "search_date": datetime.datetime.now().isoformat(),
-                    "total_articles": len(articles_data),
-                    "date_range": {
-                        "from": yesterday.isoformat(),
-                        "to": datetime.date.today().isoformat(),
-                    },
-                },
-                "articles": articles_data,
-            }
 
-            # S3にアップロード
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=file_name,
-                Body=json.dumps(output_data, ensure_ascii=False, indent=2),
-                ContentType="application/json",
-            )
+def stream_articles(pmid_list: List[str], consumer: Any, search_term: str) -> Dict:
+    """
+    EFetchのページを別スレッドで取得し、上限付きのキューを介して取得済みのページから順にconsumerへ渡す
+    consumer.add（LLMによる分析の開始）と後続のページの取得を並行させる
+    """
+    pages: queue.Queue = queue.Queue(maxsize=STREAM_QUEUE_PAGES)
+    stop = threading.Event()
+    done = object()
+
+    def produce() -> None:
+        with metrics.scope(term=search_term):
+            try:
+                for page in iter_article_pages(pmid_list, EFETCH_PAGE_SIZE):
+                    if stop.is_set():
+                        return
+                    pages.put(page)
+                pages.put(done)
+            except Exception as e:
+                pages.put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
 
-            print(f"Uploaded file to s3://{bucket_name}/{file_name}")
+    articles_data = {}
+    try:
+        while True:
+            page = pages.get()
+            if page is done:
+                break
+            if isinstance(page, Exception):
+                raise page
+            articles_data.update(page)
+            consumer.add(page)
+    finally:
+        # 途中で失敗した場合も、取得スレッドがキューの空きを待ち続けないようにする
+        stop.set()
+        while producer.is_alive():
+            try:
+                pages.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    # 検索結果の順序で返す
+    return {pmid: articles_data[pmid] for pmid in pmid_list if pmid in articles_data}
+
+
+def stream_consumer(bucket_name: str, search_term: str) -> Any:
+    """
+    取得中の論文を分析するconsumer（analyze_function.StreamingAnalysis）を作成
+    分析のコードをインポートできない環境（論文取得Lambdaのみのデプロイ）ではNoneを返す
+    """
+    try:
+        import analyze_function
+    except ImportError as e:
+        print(f"Streaming analysis is not available: {str(e)}")
+        return None
+    return analyze_function.StreamingAnalysis(bucket_name, search_term)
+
+
+def upload_raw(bucket_name: str, key: str, body: str) -> Dict[str, Any]:
+    """論文取得結果をS3にアップロードし、put_objectの応答を返す"""
+    with metrics.timer("S3PutLatency") as m:
+        response = clients.get_s3().put_object(
+            Bucket=bucket_name,
+            Key=key,
+            Body=body,
+            ContentType="application/json",
+        )
+        m["S3PutBytes"] = (len(body.encode("utf-8")), metrics.BYTES)
+    print(f"Uploaded file to s3://{bucket_name}/{key}")
+    return response
+
+
+def search_pmids(search_term: str, yesterday: datetime.date, day: datetime.date) -> List[str]:
+    """ESearchを使用して前日から指定日までの論文のPMIDを検索（search_termは検索式）"""
+    # ESearch APIのURL作成
+    esearch_url = (
+        f"{NCBI_EUTILS_URL}/esearch.fcgi"
+        "?db=pubmed"
+        f"&term={quote(search_term)}"
+        "&retmode=json"
+        "&retmax=1000"
+        f"&datetype=edat"
+        f"&mindate={yesterday.strftime('%Y/%m/%d')}"
+        f"&maxdate={day.strftime('%Y/%m/%d')}"
+    )
 
-            # 結果を記録
-            results.append(
-                {
-                    "search_term": search_term,
-                    "articles_count": len(articles_data),
-                    "file_name": file_name,
-                }
-            )
+    print(f"Searching PubMed with URL: {esearch_url}")
+
+    # ESearch APIリクエスト
+    with metrics.timer("NcbiRequestLatency", Endpoint="esearch") as m:
+        response = requests.get(esearch_url)
+        response.raise_for_status()
+        m["NcbiResponseBytes"] = (len(response.content), metrics.BYTES)
+    data = response.json()
+    return data.get("esearchresult", {}).get("idlist", [])
+
+
+def fetch_search_term(
+    search_term: str,
+    bucket_name: str,
+    day: Optional[datetime.date] = None,
+    query: Optional[str] = None,
+    days: int = 1,
+    stream: bool = False,
+) -> Optional[Dict]:
+    """
+    1つの検索語の前日分の論文を取得してS3に保存（論文がない場合はNone）
+    dayを指定した場合はその日の実行として取得する（過去分の再取得用）
+    queryを指定した場合は検索語の代わりにその検索式で検索し、daysで遡る日数を指定する
+    stream=Trueの場合は取得中のページから順に分析し、取得結果の書き込みと残りの分析を並行させる
+    """
+    # 前日（daysを指定した場合はその日数前）の日付を取得
+    day = day or datetime.date.today()
+    yesterday = day - datetime.timedelta(days=days)
+
+    pmid_list = search_pmids(query or search_term, yesterday, day)
+    print(f"Found {len(pmid_list)} articles for term '{search_term}'.")
+
+    if not pmid_list:
+        print(f"No new articles found for {search_term}.")
+        return None
+
+    # 詳細情報とアブストラクトの取得
+    consumer = stream_consumer(bucket_name, search_term) if stream else None
+    if consumer is not None:
+        articles_data = stream_articles(pmid_list, consumer, search_term)
+    else:
+        articles_data = fetch_articles(pmid_list)
+
+    # 日付パーティション化されたキーを作成（検索語と日付）
+    file_name = s3_layout.raw_key(search_term, day)
+
+    # メタデータの追加
+    output_data = {
+        "metadata": {
+            "search_term": search_term,
+            "search_date": datetime.datetime.now().isoformat(),
+            "total_articles": len(articles_data),
+            "date_range": {
+                "from": yesterday.isoformat(),
+                "to": day.isoformat(),
+            },
+        },
+        "articles": articles_data,
+    }
+
+    # S3にアップロード
+    body = json.dumps(output_data, ensure_ascii=False, indent=2, default=records.json_default)
+    result = {
+        "search_term": search_term,
+        "articles_count": len(articles_data),
+        "file_name": file_name,
+    }
+    if consumer is None:
+        upload_raw(bucket_name, file_name, body)
+        return result
+
+    # アップロードを残りのチャンクの分析と並行させ、分析結果はアップロードの完了後に保存する
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        upload = writer.submit(upload_raw, bucket_name, file_name, body)
+        try:
+            analysis = consumer.finish(file_name, output_data, upload)
+        except Exception as e:
+            # 分析に失敗しても取得結果は保存し、通常のワークフローで分析する
+            print(f"Streaming analysis failed: {str(e)}")
+            analysis = None
+        upload.result()
+    if analysis:
+        result["analysis_key"] = analysis["output_key"]
+    return result
+
+
+def requested_terms(event: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    イベントから取得する検索語を決定
+    ディスパッチャーのシャード（terms）、単一の検索語（search_term）、環境変数SEARCH_TERMSの順に参照する
+    """
+    if "terms" in event:
+        return [
+            {"term": entry["term"], "query": entry.get("query"), "days": entry.get("days", 1)}
+            for entry in event["terms"]
+        ]
+    if "search_term" in event:
+        print(f"Using search term from event: {event['search_term']}")
+        return [{"term": event["search_term"], "query": event.get("query"), "days": 1}]
+
+    search_terms_str = os.environ.get("SEARCH_TERMS", "sepsis")
+    return [
+        {"term": term.strip(), "query": None, "days": 1} for term in search_terms_str.split(",")
+    ]
+
+
+def fetch_terms(event: Dict[str, Any]) -> Dict[str, Any]:
+    """イベントで指定された検索語の論文を順に取得"""
+    try:
+        bucket_name = os.environ.get("BUCKET_NAME", "my-pubmed-bucket")
+        terms = requested_terms(event)
+
+        # イベントで日付（YYYY-MM-DD）が指定された場合はその日の実行として取得
+        day = datetime.date.fromisoformat(event["date"]) if event.get("date") else None
+        # 取得と分析を1つのプロセスで並行させる（分析のコードをインポートできる場合のみ）
+        stream = bool(event.get("stream_analysis", os.environ.get("FETCH_STREAM_ANALYSIS") == "1"))
+
+        results = []
+
+        for entry in terms:
+            # 検索語ごとにメトリクスを記録
+            with metrics.scope(term=entry["term"]):
+                result = fetch_search_term(
+                    entry["term"], bucket_name, day, entry["query"], entry["days"], stream
+                )
+            if result:
+                results.append(result)
 
         if not results:
             return {
@@ -194,3 +473,31 @@ def lambda_handler(event, context):
     except Exception as e:
         print(f"Unexpected error: {str(e)}")
         return {"statusCode": 500, "body": f"Unexpected error occurred: {str(e)}"}
+
+
+@metrics.instrument_handler("fetch")
+@profiling.profile_handler("fetch")
+def lambda_handler(event, context):
+    """
+    EventBridgeなどからの直接の呼び出しと、ディスパッチャーがSQSに送信したシャードの両方を処理する
+    SQSの場合は取得に失敗したシャードのメッセージをbatchItemFailuresとして返し、再配信させる
+    """
+    if "Records" not in event:
+        return fetch_terms(event)
+
+    failed_message_ids = []
+    results = []
+    for record in event["Records"]:
+        try:
+            result = fetch_terms(json.loads(record["body"]))
+        except Exception as e:
+            result = {"statusCode": 500, "body": f"Invalid message: {str(e)}"}
+        if result["statusCode"] != 200:
+            print(f"Failed to process message {record['messageId']}: {result['body']}")
+            failed_message_ids.append(record["messageId"])
+        results.extend(result.get("results", []))
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids],
+        "results": results,
+    }
@@ -0,0 +1,3 @@
+"""
+全Lambda関数で共有するユーティリティ（Lambda Layerとして配布）
+"""
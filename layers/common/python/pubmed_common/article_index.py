@@ -0,0 +1,561 @@
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from pubmed_common import candidate_store, metrics, s3_layout, s3_loader
+
+# 取得結果（raw/）と分析結果（analysis/）の論文を全文検索できるSQLite（FTS5）の論文索引
+# 索引はS3上の1つのスナップショット（gzip圧縮）として保存し、現在のスナップショットを指すポインタ
+# （index/articles.json）をETagによる条件付き書き込みで差し替える。読み取り側は常に完全な索引を参照する
+# 書き込み: 論文索引Lambda（S3の作成イベントをまとめて反映）、scripts/article_index.py update
+# 読み取り: 週次分析（索引済みの分析結果）、scripts/article_index.py search / facets
+
+# 索引の作業ディレクトリ（ARTICLE_INDEX_DIRで変更可能）
+DEFAULT_INDEX_DIR = "/tmp/article_index"
+WORKING_FILE = "working.sqlite"
+# 1回に並列で読み込む成果物の数
+LOAD_BATCH_SIZE = 200
+# IN句に渡すキーの数の上限
+QUERY_CHUNK_SIZE = 500
+DEFAULT_LIMIT = 50
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# 索引の対象とする成果物の種類
+INDEXED_ROOTS = (s3_layout.RAW_ROOT, s3_layout.ANALYSIS_ROOT)
+
+# 集計できる項目と対応する列
+FACETS = {
+    "term": "s.term",
+    "journal": "a.journal",
+    "year": "a.publication_year",
+    "month": "substr(s.day, 1, 7)",
+    "day": "s.day",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY,
+    pmid TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL DEFAULT '',
+    abstract TEXT NOT NULL DEFAULT '',
+    journal TEXT NOT NULL DEFAULT '',
+    publication_year TEXT NOT NULL DEFAULT '',
+    authors TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS sightings (
+    pmid TEXT NOT NULL,
+    term TEXT NOT NULL,
+    day TEXT NOT NULL,
+    source_key TEXT NOT NULL,
+    PRIMARY KEY (pmid, term, day)
+);
+CREATE INDEX IF NOT EXISTS sightings_term_day ON sightings (term, day);
+CREATE INDEX IF NOT EXISTS sightings_day ON sightings (day);
+CREATE INDEX IF NOT EXISTS sightings_source ON sightings (source_key);
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    pmid TEXT NOT NULL,
+    term TEXT NOT NULL,
+    day TEXT NOT NULL,
+    source_key TEXT NOT NULL,
+    analysis_date TEXT NOT NULL DEFAULT '',
+    score REAL NOT NULL DEFAULT 0,
+    impact_reason TEXT NOT NULL DEFAULT '',
+    summary TEXT NOT NULL DEFAULT '',
+    implications TEXT NOT NULL DEFAULT '',
+    article TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analyses_source ON analyses (source_key);
+CREATE INDEX IF NOT EXISTS analyses_term_day ON analyses (term, day);
+CREATE INDEX IF NOT EXISTS analyses_pmid ON analyses (pmid);
+CREATE TABLE IF NOT EXISTS sources (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    indexed_at TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS article_fts USING fts5(
+    title, abstract, content='articles', content_rowid='id'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS analysis_fts USING fts5(
+    impact_reason, summary, implications, content='analyses', content_rowid='id',
+    tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS articles_ai AFTER INSERT ON articles BEGIN
+    INSERT INTO article_fts (rowid, title, abstract) VALUES (new.id, new.title, new.abstract);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_ad AFTER DELETE ON articles BEGIN
+    INSERT INTO article_fts (article_fts, rowid, title, abstract)
+    VALUES ('delete', old.id, old.title, old.abstract);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_au AFTER UPDATE ON articles BEGIN
+    INSERT INTO article_fts (article_fts, rowid, title, abstract)
+    VALUES ('delete', old.id, old.title, old.abstract);
+    INSERT INTO article_fts (rowid, title, abstract) VALUES (new.id, new.title, new.abstract);
+END;
+CREATE TRIGGER IF NOT EXISTS analyses_ai AFTER INSERT ON analyses BEGIN
+    INSERT INTO analysis_fts (rowid, impact_reason, summary, implications)
+    VALUES (new.id, new.impact_reason, new.summary, new.implications);
+END;
+CREATE TRIGGER IF NOT EXISTS analyses_ad AFTER DELETE ON analyses BEGIN
+    INSERT INTO analysis_fts (analysis_fts, rowid, impact_reason, summary, implications)
+    VALUES ('delete', old.id, old.impact_reason, old.summary, old.implications);
+END;
+"""
+
+# 作業コピーに反映済みのスナップショット（""は空の索引、Noneは作業コピーが無効）
+# コンテナが再利用される間は、自分が公開したスナップショットをダウンロードし直さない
+_working: Dict[str, Optional[str]] = {"snapshot": None}
+
+
+def index_dir() -> str:
+    path = os.environ.get("ARTICLE_INDEX_DIR", DEFAULT_INDEX_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def open_index(path: str) -> sqlite3.Connection:
+    """索引を開く（スキーマがない場合は作成）"""
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def object_version(obj: Dict[str, Any]) -> str:
+    """一覧・イベントのオブジェクト情報からバージョンを取得（ETagがない場合はサイズと更新日時）"""
+    etag = str(obj.get("ETag") or obj.get("eTag") or "").strip('"')
+    if etag:
+        return etag
+    return f"{obj.get('Size', 0)}-{int(obj['LastModified'].timestamp())}"
+
+
+def indexed_version(connection: sqlite3.Connection, key: str) -> Optional[str]:
+    row = connection.execute("SELECT version FROM sources WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _index_raw(
+    connection: sqlite3.Connection, key: str, term: str, day: str, data: Dict[str, Any]
+) -> int:
+    connection.execute("DELETE FROM sightings WHERE source_key = ?", (key,))
+    articles = list((data.get("articles") or {}).values())
+    for article in articles:
+        pmid = str(article.get("pmid", ""))
+        if not pmid:
+            continue
+        # 内容が変わらない場合は更新せず、全文検索の索引を書き換えない
+        connection.execute(
+            "INSERT INTO articles (pmid, title, abstract, journal, publication_year, authors) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (pmid) DO UPDATE SET title = excluded.title, "
+            "abstract = excluded.abstract, journal = excluded.journal, "
+            "publication_year = excluded.publication_year, authors = excluded.authors "
+            "WHERE articles.title != excluded.title OR articles.abstract != excluded.abstract "
+            "OR articles.journal != excluded.journal "
+            "OR articles.publication_year != excluded.publication_year "
+            "OR articles.authors != excluded.authors",
+            (
+                pmid,
+                article.get("title") or "",
+                article.get("abstract") or "",
+                article.get("journal") or "",
+                str(article.get("publication_year") or ""),
+                json.dumps(article.get("authors") or [], ensure_ascii=False),
+            ),
+        )
+        connection.execute(
+            "INSERT OR REPLACE INTO sightings (pmid, term, day, source_key) VALUES (?, ?, ?, ?)",
+            (pmid, term, day, key),
+        )
+    return len(articles)
+
+
+def _index_analysis(
+    connection: sqlite3.Connection, key: str, term: str, day: str, data: Dict[str, Any]
+) -> int:
+    # 再分析された場合は以前の分析結果を置き換える
+    connection.execute("DELETE FROM analyses WHERE source_key = ?", (key,))
+    analysis_date = (data.get("metadata") or {}).get("analysis_date", "")
+    articles = data.get("impactful_articles") or []
+    for article in articles:
+        connection.execute(
+            "INSERT INTO analyses (pmid, term, day, source_key, analysis_date, score, "
+            "impact_reason, summary, implications, article) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                str(article.get("pmid", "")),
+                term,
+                day,
+                key,
+                analysis_date,
+                candidate_store.candidate_score(article),
+                str(article.get("impact_reason") or ""),
+                str(article.get("summary") or ""),
+                str(article.get("implications") or ""),
+                json.dumps(article, ensure_ascii=False),
+            ),
+        )
+    return len(articles)
+
+
+def index_document(connection: sqlite3.Connection, key: str, version: str, data: Any) -> int:
+    """成果物1件を索引に反映し、反映した論文数を返す（索引の対象外の成果物は0）"""
+    info = s3_layout.parse_key(key)
+    if not info or info["root"] not in INDEXED_ROOTS or not isinstance(data, dict):
+        return 0
+
+    day = info["date"].isoformat()
+    if info["root"] == s3_layout.RAW_ROOT:
+        count = _index_raw(connection, key, info["term"], day, data)
+    else:
+        count = _index_analysis(connection, key, info["term"], day, data)
+    connection.execute(
+        "INSERT OR REPLACE INTO sources (key, version, indexed_at) VALUES (?, ?, ?)",
+        (key, version, datetime.now().isoformat()),
+    )
+    return count
+
+
+def index_stats(connection: sqlite3.Connection) -> Dict[str, int]:
+    return {
+        table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in ("articles", "analyses", "sources")
+    }
+
+
+def compact(connection: sqlite3.Connection) -> None:
+    """全文検索の索引のセグメントを統合し、空き領域を解放する（トランザクション外で呼び出す）"""
+    connection.execute("INSERT INTO article_fts (article_fts) VALUES ('optimize')")
+    connection.execute("INSERT INTO analysis_fts (analysis_fts) VALUES ('optimize')")
+    connection.commit()
+    connection.execute("VACUUM")
+
+
+def _where(
+    query: Optional[str] = None,
+    analysis_query: Optional[str] = None,
+    terms: Optional[List[str]] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    journals: Optional[List[str]] = None,
+    analyzed: bool = False,
+) -> Tuple[str, List[Any]]:
+    """検索条件からFROM句・WHERE句とパラメータを作成（sは検索語・日付、aは論文、hは全文検索の関連度）"""
+    params: List[Any] = []
+    if query:
+        source = (
+            "(SELECT rowid AS id, rank FROM article_fts "
+            "WHERE article_fts MATCH ?) h JOIN articles a ON a.id = h.id"
+        )
+        params.append(query)
+    else:
+        source = "articles a"
+    source += " JOIN sightings s ON s.pmid = a.pmid"
+
+    clauses = []
+    if terms:
+        clauses.append(f"s.term IN ({', '.join('?' * len(terms))})")
+        params.extend(s3_layout.safe_term(term) for term in terms)
+    if start:
+        clauses.append("s.day >= ?")
+        params.append(start)
+    if end:
+        clauses.append("s.day <= ?")
+        params.append(end)
+    if journals:
+        clauses.append(f"a.journal IN ({', '.join('?' * len(journals))})")
+        params.extend(journals)
+    if analyzed:
+        clauses.append("EXISTS (SELECT 1 FROM analyses an WHERE an.pmid = a.pmid)")
+    if analysis_query:
+        clauses.append(
+            "a.pmid IN (SELECT an.pmid FROM analysis_fts "
+            "JOIN analyses an ON an.id = analysis_fts.rowid WHERE analysis_fts MATCH ?)"
+        )
+        params.append(analysis_query)
+
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return f"FROM {source}{where}", params
+
+
+def search(
+    connection: sqlite3.Connection, limit: int = DEFAULT_LIMIT, **filters: Any
+) -> List[Dict[str, Any]]:
+    """
+    論文を全文検索（query: タイトル・アブストラクト、analysis_query: 分析結果）し、
+    検索語（terms）・取得日の範囲（start / end、YYYY-MM-DD）・ジャーナル・分析済みかで絞り込む
+    queryを指定した場合は関連度順、それ以外は最後に取得した日の新しい順
+    """
+    clause, params = _where(**filters)
+    rank = "min(h.rank), " if filters.get("query") else ""
+    rows = connection.execute(
+        "SELECT a.pmid, a.title, a.journal, a.publication_year, group_concat(DISTINCT s.term), "
+        "min(s.day), max(s.day), "
+        "(SELECT COUNT(*) FROM analyses an WHERE an.pmid = a.pmid) "
+        f"{clause} GROUP BY a.id ORDER BY {rank}max(s.day) DESC, a.pmid LIMIT ?",
+        params + [limit],
+    ).fetchall()
+    return [
+        {
+            "pmid": pmid,
+            "title": title,
+            "journal": journal,
+            "publication_year": year,
+            "terms": sorted(terms.split(",")),
+            "first_seen": first_seen,
+            "last_seen": last_seen,
+            "analyses": analyses,
+        }
+        for pmid, title, journal, year, terms, first_seen, last_seen, analyses in rows
+    ]
+
+
+def facets(
+    connection: sqlite3.Connection, field: str, limit: int = DEFAULT_LIMIT, **filters: Any
+) -> List[Tuple[str, int]]:
+    """検索条件に一致する論文数を項目（FACETSのキー）の値ごとに集計（論文数の多い順）"""
+    if field not in FACETS:
+        raise ValueError(f"Unknown facet: {field}")
+    clause, params = _where(**filters)
+    rows = connection.execute(
+        f"SELECT {FACETS[field]}, COUNT(DISTINCT a.pmid) {clause} "
+        "GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT ?",
+        params + [limit],
+    ).fetchall()
+    return [(value, count) for value, count in rows]
+
+
+def analyses_for_sources(
+    connection: sqlite3.Connection, keys: List[str]
+) -> Dict[str, List[Dict[str, Any]]]:
+    """索引済みの分析結果のキーごとに、分析結果の論文（解析済みファイルと同じ形式）を返す"""
+    results: Dict[str, List[Dict[str, Any]]] = {}
+    for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+        chunk = keys[start : start + QUERY_CHUNK_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
+        for (key,) in connection.execute(
+            f"SELECT key FROM sources WHERE key IN ({placeholders})", chunk
+        ):
+            results[key] = []
+        for key, article, analysis_date in connection.execute(
+            "SELECT source_key, article, analysis_date FROM analyses "
+            f"WHERE source_key IN ({placeholders}) ORDER BY id",
+            chunk,
+        ):
+            article = json.loads(article)
+            article["source_file"] = key
+            article["analysis_date"] = analysis_date
+            results[key].append(article)
+    return {key: results[key] for key in keys if key in results}
+
+
+def load_pointer(s3, bucket: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """現在のスナップショットを指すポインタとETagを取得（索引がない場合はNoneとNone）"""
+    return s3_layout.get_json_object(s3, bucket, s3_layout.ARTICLE_INDEX_KEY)
+
+
+def download_snapshot(s3, bucket: str, snapshot: str, path: str) -> None:
+    """スナップショットを展開しながらダウンロード（書き込み途中のファイルは使わない）"""
+    response = s3.get_object(Bucket=bucket, Key=snapshot)
+    temp_path = f"{path}.tmp"
+    with gzip.GzipFile(fileobj=response["Body"]) as source, open(temp_path, "wb") as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    os.replace(temp_path, path)
+
+
+def upload_snapshot(s3, bucket: str, path: str) -> Tuple[str, int]:
+    """索引をgzip圧縮して新しいスナップショットとしてアップロードし、キーとサイズを返す"""
+    name = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    snapshot = s3_layout.index_snapshot_key(name)
+    compressed_path = f"{path}.gz"
+    with open(path, "rb") as source, gzip.open(compressed_path, "wb", compresslevel=6) as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    try:
+        with open(compressed_path, "rb") as body:
+            s3.put_object(Bucket=bucket, Key=snapshot, Body=body, ContentType="application/gzip")
+        return snapshot, os.path.getsize(compressed_path)
+    finally:
+        os.remove(compressed_path)
+
+
+def working_copy(s3, bucket: str, pointer: Optional[Dict[str, Any]], rebuild: bool = False) -> str:
+    """更新用の作業コピーを用意（現在のスナップショットを反映済みの場合はダウンロードしない）"""
+    path = os.path.join(index_dir(), WORKING_FILE)
+    snapshot = "" if rebuild or not pointer else pointer["snapshot"]
+    if _working["snapshot"] == snapshot and os.path.exists(path):
+        return path
+
+    _working["snapshot"] = None
+    if os.path.exists(path):
+        os.remove(path)
+    if snapshot:
+        download_snapshot(s3, bucket, snapshot, path)
+    _working["snapshot"] = snapshot
+    return path
+
+
+def update_index(
+    s3,
+    bucket: str,
+    versions: Dict[str, str],
+    rebuild: bool = False,
+    max_workers: int = s3_loader.DEFAULT_MAX_WORKERS,
+) -> Dict[str, Any]:
+    """
+    成果物（キーとバージョン）を索引に反映し、新しいスナップショットに差し替える
+    同じバージョンを索引済みの成果物は読み込まない。rebuild=Trueの場合は空の索引から作り直す
+    他の更新と競合した場合は、最新のスナップショットに反映し直す
+    反映した成果物数・論文数、読み込めなかったキー、現在のスナップショットを返す
+    """
+    for retry in range(s3_layout.CONDITIONAL_WRITE_MAX_RETRIES):
+        pointer, etag = load_pointer(s3, bucket)
+        path = working_copy(s3, bucket, pointer, rebuild)
+        result: Dict[str, Any] = {
+            "indexed": 0,
+            "articles": 0,
+            "failed": [],
+            "snapshot": pointer["snapshot"] if pointer else None,
+        }
+
+        connection = open_index(path)
+        try:
+            stale = [
+                key
+                for key, version in versions.items()
+                if indexed_version(connection, key) != version
+            ]
+            for start in range(0, len(stale), LOAD_BATCH_SIZE):
+                loaded, failures = s3_loader.load_json_objects(
+                    s3, bucket, stale[start : start + LOAD_BATCH_SIZE], max_workers, missing_ok=True
+                )
+                result["failed"].extend(failures)
+                for key, data in loaded.items():
+                    result["articles"] += index_document(connection, key, versions[key], data)
+                    result["indexed"] += 1
+            if not result["indexed"] and not rebuild:
+                return result
+
+            # コミット後は公開するまで作業コピーがスナップショットと一致しない
+            _working["snapshot"] = None
+            connection.commit()
+            if rebuild:
+                compact(connection)
+            stats = index_stats(connection)
+        finally:
+            connection.close()
+
+        snapshot, size = upload_snapshot(s3, bucket, path)
+        updated = {
+            "snapshot": snapshot,
+            "previous": result["snapshot"],
+            "updated_at": datetime.now().isoformat(),
+            "bytes": size,
+            **stats,
+        }
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=bucket,
+                Key=s3_layout.ARTICLE_INDEX_KEY,
+                Body=json.dumps(updated, ensure_ascii=False, sort_keys=True),
+                ContentType="application/json",
+                **condition,
+            )
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            print(
+                f"Index snapshot conflict, retry {retry + 1}/"
+                f"{s3_layout.CONDITIONAL_WRITE_MAX_RETRIES}"
+            )
+            metrics.emit({"IndexSwapConflicts": (1, metrics.COUNT)})
+            s3.delete_object(Bucket=bucket, Key=snapshot)
+            continue
+
+        _working["snapshot"] = snapshot
+        # 直前のスナップショットは読み込み中の読み取り側のために残し、その前のものを削除する
+        if pointer and pointer.get("previous"):
+            try:
+                s3.delete_object(Bucket=bucket, Key=pointer["previous"])
+            except Exception as e:
+                print(f"Failed to delete old snapshot {pointer['previous']}: {str(e)}")
+
+        print(
+            f"Indexed {result['indexed']} objects ({result['articles']} articles) "
+            f"into {snapshot} ({size} bytes)"
+        )
+        metrics.emit(
+            {
+                "IndexedObjects": (result["indexed"], metrics.COUNT),
+                "IndexedArticles": (result["articles"], metrics.COUNT),
+                "IndexSnapshotBytes": (size, metrics.BYTES),
+            }
+        )
+        result["snapshot"] = snapshot
+        return result
+
+    raise RuntimeError(f"Failed to update s3://{bucket}/{s3_layout.ARTICLE_INDEX_KEY}")
+
+
+def list_versions(s3, bucket: str) -> Dict[str, str]:
+    """索引の対象となる成果物のキーとバージョンを一覧"""
+    versions = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for root in INDEXED_ROOTS:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{root}/"):
+            for obj in page.get("Contents", []):
+                info = s3_layout.parse_key(obj["Key"])
+                if obj["Key"].endswith(".json") and info and info["root"] == root:
+                    versions[obj["Key"]] = object_version(obj)
+    return versions
+
+
+def sync_index(s3, bucket: str, rebuild: bool = False) -> Dict[str, Any]:
+    """バケット内の取得結果・分析結果のうち、索引に未反映のものを反映する"""
+    return update_index(s3, bucket, list_versions(s3, bucket), rebuild)
+
+
+def open_snapshot(s3, bucket: str) -> Optional[sqlite3.Connection]:
+    """
+    現在のスナップショットを読み取り専用で開く（索引がない場合はNone）
+    ダウンロードしたスナップショットはコンテナが再利用される間は使い回し、古いものは削除する
+    """
+    pointer, _ = load_pointer(s3, bucket)
+    if not pointer:
+        return None
+
+    directory = index_dir()
+    name = os.path.basename(pointer["snapshot"]).removesuffix(".gz")
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        for old in os.listdir(directory):
+            if old.endswith(".sqlite") and old != WORKING_FILE:
+                os.remove(os.path.join(directory, old))
+        download_snapshot(s3, bucket, pointer["snapshot"], path)
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def indexed_analyses(s3, bucket: str, keys: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    分析結果のキーのうち索引済みのものについて、索引から分析結果の論文を取得
+    索引がない・読み込めない場合は空（呼び出し元はS3から読み込む）
+    """
+    if not keys:
+        return {}
+    try:
+        connection = open_snapshot(s3, bucket)
+        if connection is None:
+            return {}
+        try:
+            return analyses_for_sources(connection, keys)
+        finally:
+            connection.close()
+    except Exception as e:
+        print(f"Article index unavailable: {str(e)}")
+        return {}
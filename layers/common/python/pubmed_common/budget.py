@@ -0,0 +1,528 @@
+import os
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pubmed_common import clients, s3_layout, term_registry
+
+# LLMのトークン・費用の日次予算（全Lambdaで共有する）
+#   BUDGET_TABLEがある場合: 使用量・予約をDynamoDBのテーブルに日付・集計単位ごとに保存し、
+#     条件付きのUpdateItem（ADD）で原子的に予約する（同時実行でも競合のリトライが不要）
+#   ない場合: S3の budget/yyyy-mm-dd.json を条件付き書き込みで更新する（ローカル実行用）
+#   延期した処理の一覧はいずれの場合もS3の budget/yyyy-mm-dd.json に保存する
+# LLMを呼び出す前に見積もりトークン数を予約し、呼び出し後に実際の使用量で確定する
+# 予算の使用率に応じて、設定した順序で処理を縮退させる
+#   prescreen: LLMに渡す論文を事前選別で絞り込む
+#   cheaper_model: 安価なモデル（BUDGET_FALLBACK_MODEL）に切り替える
+#   defer: 優先度の低い検索語の処理を翌日以降に延期する
+# 上限の環境変数（いずれも未設定の場合は予算管理を行わない）:
+#   BUDGET_DAILY_TOKENS=2000000, BUDGET_DAILY_USD=20
+#   BUDGET_STAGE_TOKENS="analyze=1500000,translate=300000,weekly=500000"
+#   BUDGET_TERM_TOKENS="default=200000,sepsis=800000"
+
+DEGRADATION_STEPS = ("prescreen", "cheaper_model", "defer")
+DEFAULT_DEGRADATION = "prescreen:0.7,cheaper_model:0.85,defer:0.95"
+DEFAULT_FALLBACK_MODEL = "gpt-4o-mini"
+# 事前選別でLLMに渡す論文数の上限
+DEFAULT_PRESCREEN_MAX_ARTICLES = 20
+# 延期の対象とする検索語の優先度（レジストリのpriorityがこの値より大きい検索語を延期する）
+DEFAULT_DEFER_PRIORITY = 50
+
+# モデルごとの料金（USD / 100万トークン、入力・出力）。未登録のモデルはgpt-4の料金で見積もる
+MODEL_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+# DynamoDBの予算の項目を削除するまでの時間（TTL）
+COUNTER_TTL_SECONDS = 30 * 86400
+COUNTER_FIELDS = ("used_tokens", "reserved_tokens", "cost_usd", "calls")
+
+
+class BudgetExceeded(Exception):
+    """予算の上限を超えるため、LLMを呼び出さない"""
+
+
+class BudgetUnavailable(Exception):
+    """予算の状態を更新できず上限を確認できないため、LLMを呼び出さない"""
+
+
+def _number_env(name: str) -> Optional[float]:
+    value = os.environ.get(name, "").strip()
+    return float(value) if value else None
+
+
+def _parse_limits(value: str) -> Dict[str, float]:
+    """'analyze=1500000,translate=300000' 形式の上限を辞書に変換"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, limit = item.partition("=")
+        limits[s3_layout.safe_term(name.strip())] = float(limit)
+    return limits
+
+
+def limits() -> Dict[str, Any]:
+    return {
+        "daily_tokens": _number_env("BUDGET_DAILY_TOKENS"),
+        "daily_usd": _number_env("BUDGET_DAILY_USD"),
+        "stage_tokens": _parse_limits(os.environ.get("BUDGET_STAGE_TOKENS", "")),
+        "term_tokens": _parse_limits(os.environ.get("BUDGET_TERM_TOKENS", "")),
+    }
+
+
+def enabled(configured: Dict[str, Any]) -> bool:
+    return any(configured.values())
+
+
+def degradation_steps() -> List[Tuple[str, float]]:
+    """縮退の手順と開始する使用率（使用率の低い順）"""
+    steps = []
+    for item in os.environ.get("BUDGET_DEGRADATION", DEFAULT_DEGRADATION).split(","):
+        if not item.strip():
+            continue
+        step, _, threshold = item.partition(":")
+        if step.strip() not in DEGRADATION_STEPS:
+            raise ValueError(f"Unknown degradation step: {step}")
+        steps.append((step.strip(), float(threshold)))
+    return sorted(steps, key=lambda step: step[1])
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """トークン数から費用（USD）を見積もる"""
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES["gpt-4"])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def _counter() -> Dict[str, Any]:
+    return {"used_tokens": 0, "reserved_tokens": 0, "cost_usd": 0.0, "calls": 0}
+
+
+def _empty_state(day: str) -> Dict[str, Any]:
+    return {
+        "day": day,
+        "total": _counter(),
+        "stages": {},
+        "terms": {},
+        "deferred": [],
+        "updated_at": None,
+    }
+
+
+def _counters(state: Dict[str, Any], stage: str, term: Optional[str]) -> List[Dict[str, Any]]:
+    """全体・処理段階・検索語の集計（存在しない場合は作成）"""
+    counters = [state["total"], state["stages"].setdefault(stage, _counter())]
+    if term:
+        counters.append(state["terms"].setdefault(s3_layout.safe_term(term), _counter()))
+    return counters
+
+
+def _term_limit(configured: Dict[str, Any], term: str) -> Optional[float]:
+    term_tokens = configured["term_tokens"]
+    return term_tokens.get(s3_layout.safe_term(term), term_tokens.get("default"))
+
+
+def usage_ratio(
+    state: Dict[str, Any],
+    stage: str,
+    term: Optional[str],
+    configured: Dict[str, Any],
+    extra_tokens: int = 0,
+) -> float:
+    """
+    設定された上限のうち最も使用率の高いものの使用率（予約中のトークンを含む）
+    extra_tokensを指定した場合はそのトークン数を追加で使用した場合の使用率
+    """
+    ratios = []
+
+    def add(counter: Optional[Dict[str, Any]], limit: Optional[float]) -> None:
+        if limit:
+            counter = counter or _counter()
+            used = counter["used_tokens"] + counter["reserved_tokens"] + extra_tokens
+            ratios.append(used / limit)
+
+    add(state["total"], configured["daily_tokens"])
+    add(state["stages"].get(stage), configured["stage_tokens"].get(stage))
+    if term:
+        add(state["terms"].get(s3_layout.safe_term(term)), _term_limit(configured, term))
+    if configured["daily_usd"]:
+        ratios.append(state["total"]["cost_usd"] / configured["daily_usd"])
+    return max(ratios, default=0.0)
+
+
+class DynamoDBCounters:
+    """
+    DynamoDBのテーブル上の予算の集計（パーティションキー day、ソートキー scope）
+    scopeは "total"、"stage#<処理段階>"、"term#<検索語>"。committed_tokensは使用量と予約の合計
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+
+    @staticmethod
+    def _scopes(stage: str, term: Optional[str]) -> List[str]:
+        scopes = ["total", f"stage#{stage}"]
+        if term:
+            scopes.append(f"term#{s3_layout.safe_term(term)}")
+        return scopes
+
+    def load(self, day: str) -> Dict[str, Any]:
+        """全体・処理段階・検索語の集計（load_stateの形式）"""
+        counters: Dict[str, Any] = {"total": _counter(), "stages": {}, "terms": {}}
+        kwargs: Dict[str, Any] = {
+            "TableName": self.table,
+            "KeyConditionExpression": "#day = :day",
+            "ExpressionAttributeNames": {"#day": "day"},
+            "ExpressionAttributeValues": {":day": {"S": day}},
+            "ConsistentRead": True,
+        }
+        while True:
+            page = clients.get_dynamodb().query(**kwargs)
+            for item in page.get("Items", []):
+                counter = _counter()
+                for name in COUNTER_FIELDS:
+                    if name in item:
+                        counter[name] = type(counter[name])(float(item[name]["N"]))
+                kind, _, name = item["scope"]["S"].partition("#")
+                if kind == "total":
+                    counters["total"] = counter
+                else:
+                    counters["stages" if kind == "stage" else "terms"][name] = counter
+            if "LastEvaluatedKey" not in page:
+                return counters
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def _add(
+        self,
+        day: str,
+        scope: str,
+        deltas: Dict[str, Any],
+        condition: Optional[str] = None,
+        values: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        expression_values = {
+            ":expires_at": {"N": str(int(time.time()) + COUNTER_TTL_SECONDS)},
+            **{f":{name}": {"N": _number(delta)} for name, delta in deltas.items()},
+            **(values or {}),
+        }
+        kwargs: Dict[str, Any] = {
+            "TableName": self.table,
+            "Key": {"day": {"S": day}, "scope": {"S": scope}},
+            "UpdateExpression": "SET expires_at = :expires_at ADD "
+            + ", ".join(f"{name} :{name}" for name in deltas),
+            "ExpressionAttributeValues": expression_values,
+        }
+        if condition:
+            kwargs["ConditionExpression"] = condition
+        clients.get_dynamodb().update_item(**kwargs)
+
+    def reserve(
+        self, day: str, stage: str, term: Optional[str], tokens: int, configured: Dict[str, Any]
+    ) -> None:
+        """
+        集計ごとに上限を条件として予約を加算する（上限を超える場合はBudgetExceeded）
+        途中の集計で失敗した場合は加算済みの予約を取り消す
+        """
+        token_limits = {
+            "total": configured["daily_tokens"],
+            f"stage#{stage}": configured["stage_tokens"].get(stage),
+        }
+        if term:
+            token_limits[f"term#{s3_layout.safe_term(term)}"] = _term_limit(configured, term)
+        reservation = {"reserved_tokens": tokens, "committed_tokens": tokens}
+        reserved: List[str] = []
+        dynamodb = clients.get_dynamodb()
+        try:
+            for scope in self._scopes(stage, term):
+                conditions, values = [], {}
+                limit = token_limits.get(scope)
+                if limit:
+                    if tokens > limit:
+                        raise BudgetExceeded(f"Budget exceeded for {stage}/{term}: {scope}")
+                    conditions.append(
+                        "(attribute_not_exists(committed_tokens) OR committed_tokens <= :remaining)"
+                    )
+                    values[":remaining"] = {"N": _number(limit - tokens)}
+                if scope == "total" and configured["daily_usd"]:
+                    conditions.append("(attribute_not_exists(cost_usd) OR cost_usd <= :daily_usd)")
+                    values[":daily_usd"] = {"N": _number(configured["daily_usd"])}
+                try:
+                    self._add(day, scope, reservation, " AND ".join(conditions), values)
+                except dynamodb.exceptions.ConditionalCheckFailedException:
+                    raise BudgetExceeded(f"Budget exceeded for {stage}/{term}: {scope}")
+                reserved.append(scope)
+        except Exception:
+            for scope in reserved:
+                try:
+                    self._add(day, scope, {"reserved_tokens": -tokens, "committed_tokens": -tokens})
+                except Exception as e:
+                    print(f"Failed to release budget reservation for {scope}: {str(e)}")
+            raise
+
+    def settle(
+        self,
+        day: str,
+        stage: str,
+        term: Optional[str],
+        tokens: int,
+        used_tokens: int,
+        cost: float,
+        calls: int,
+    ) -> None:
+        """予約を取り消し、使用量を加算する"""
+        deltas = {
+            "reserved_tokens": -tokens,
+            "committed_tokens": used_tokens - tokens,
+            "used_tokens": used_tokens,
+            "cost_usd": cost,
+            "calls": calls,
+        }
+        for scope in self._scopes(stage, term):
+            self._add(day, scope, deltas)
+
+
+def _number(value: Any) -> str:
+    return f"{value:.6f}" if isinstance(value, float) else str(value)
+
+
+def get_counters() -> Optional[DynamoDBCounters]:
+    """BUDGET_TABLEがある場合はDynamoDBの集計、ない場合はNone（S3の予算の状態を使う）"""
+    table = os.environ.get("BUDGET_TABLE")
+    return DynamoDBCounters(table) if table else None
+
+
+def _bucket(bucket: Optional[str]) -> str:
+    return bucket or os.environ.get("BUDGET_BUCKET") or os.environ["BUCKET_NAME"]
+
+
+def load_state(bucket: Optional[str] = None, day: Optional[date] = None) -> Dict[str, Any]:
+    """指定日（省略時は当日）の予算の使用状況"""
+    day = day or datetime.now().date()
+    state, _ = s3_layout.get_json_object(
+        clients.get_s3(), _bucket(bucket), s3_layout.budget_key(day)
+    )
+    state = state if state is not None else _empty_state(day.isoformat())
+    counters = get_counters()
+    if counters:
+        state.update(counters.load(day.isoformat()))
+    return state
+
+
+def term_priority(bucket: str, search_term: str) -> int:
+    """検索語レジストリ上の優先度（登録されていない場合は既定の優先度）"""
+    data, _ = s3_layout.get_json_object(clients.get_s3(), bucket, s3_layout.TERM_REGISTRY_KEY)
+    registry = term_registry.parse_registry(data or {})
+    term = search_term.strip().lower()
+    for entry in registry["terms"]:
+        if entry["term"] == term:
+            return entry["priority"]
+    return term_registry.DEFAULT_PRIORITY
+
+
+def plan(bucket: Optional[str], stage: str, search_term: Optional[str] = None) -> Dict[str, Any]:
+    """
+    ハンドラーの開始時に予算の使用状況を確認し、この呼び出しで行う縮退を決定
+    戻り値はLLMを呼び出す関数に渡し、ハンドラーの出力にはsummary()の結果を含める
+    """
+    configured = limits()
+    day = datetime.now().date()
+    result = {
+        "enabled": enabled(configured),
+        "bucket": bucket,
+        "day": day.isoformat(),
+        "stage": stage,
+        "term": search_term,
+        "ratio": 0.0,
+        "degradation": [],
+        "model": os.environ.get("GPT_MODEL", "gpt-4"),
+        "prescreen": False,
+        "defer": False,
+    }
+    if not result["enabled"]:
+        return result
+
+    result["bucket"] = bucket = _bucket(bucket)
+    try:
+        state = load_state(bucket, day)
+    except Exception as e:
+        # 予算の状態を読めない場合は縮退せずに処理を続ける（上限の確認は予約時に行う）
+        print(f"Failed to load budget state: {str(e)}")
+        return result
+
+    ratio = usage_ratio(state, stage, search_term, configured)
+    active = [step for step, threshold in degradation_steps() if ratio >= threshold]
+    result.update(ratio=round(ratio, 4), degradation=active, prescreen="prescreen" in active)
+    if "cheaper_model" in active:
+        result["model"] = os.environ.get("BUDGET_FALLBACK_MODEL", DEFAULT_FALLBACK_MODEL)
+    if "defer" in active and search_term:
+        threshold = int(os.environ.get("BUDGET_DEFER_PRIORITY", DEFAULT_DEFER_PRIORITY))
+        result["defer"] = term_priority(bucket, search_term) > threshold
+
+    if active:
+        print(f"Budget {ratio:.0%} used for {stage}/{search_term}: {', '.join(active)}")
+    return result
+
+
+def summary(budget_plan: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """ハンドラーの出力に含める予算の状態"""
+    if not budget_plan or not budget_plan.get("enabled"):
+        return {"enabled": False}
+    keys = ("enabled", "day", "ratio", "degradation", "model", "defer")
+    return {key: budget_plan[key] for key in keys}
+
+
+def model_for(budget_plan: Optional[Dict[str, Any]]) -> str:
+    """LLMの呼び出しに使うモデル（予算の縮退時は安価なモデル）"""
+    if budget_plan:
+        return budget_plan["model"]
+    return os.environ.get("GPT_MODEL", "gpt-4")
+
+
+def term_of(budget_plan: Optional[Dict[str, Any]]) -> Optional[str]:
+    """LLMの呼び出し元の検索語（レート制限の検索語ごとの枠に使う）"""
+    return budget_plan.get("term") if budget_plan else None
+
+
+def estimate_tokens(budget_plan: Optional[Dict[str, Any]], prompt: str, max_tokens: int) -> int:
+    """予約するトークン数（プロンプトのトークン数 + 応答の上限）。予算管理が無効の場合は0"""
+    if not budget_plan or not budget_plan.get("enabled"):
+        return 0
+    return len(clients.get_encoding().encode(prompt)) + max_tokens
+
+
+def prescreen_limit() -> int:
+    return int(os.environ.get("BUDGET_PRESCREEN_MAX_ARTICLES", DEFAULT_PRESCREEN_MAX_ARTICLES))
+
+
+def _update(budget_plan: Dict[str, Any], mutate) -> Dict[str, Any]:
+    def apply(state: Dict[str, Any]) -> Dict[str, Any]:
+        mutate(state)
+        state["updated_at"] = datetime.now().isoformat()
+        return state
+
+    return s3_layout.update_json_object(
+        clients.get_s3(),
+        budget_plan["bucket"],
+        s3_layout.budget_key(date.fromisoformat(budget_plan["day"])),
+        apply,
+        lambda: _empty_state(budget_plan["day"]),
+    )
+
+
+@contextmanager
+def reserve(budget_plan: Optional[Dict[str, Any]], tokens: int) -> Iterator[Dict[str, Any]]:
+    """
+    LLM呼び出しの前に見積もりトークン数（プロンプト + max_tokens）を予約し、
+    ブロックの終了時にyieldした辞書の"response"の使用量で確定する（例外の場合は予約を取り消す）
+    予約すると上限を超える場合はBudgetExceededを送出する
+    予算の状態を更新できない場合（競合のリトライの上限を含む）はBudgetUnavailableを送出し、
+    上限を確認せずにLLMを呼び出さない（呼び出し元は処理を失敗させる）
+    確定できない場合は予約の取り消しを再試行し、その日の予約が残らないようにする
+    """
+    call: Dict[str, Any] = {}
+    if not budget_plan or not budget_plan.get("enabled"):
+        yield call
+        return
+
+    stage, term = budget_plan["stage"], budget_plan["term"]
+    configured = limits()
+    counters = get_counters()
+
+    def add_reservation(state: Dict[str, Any]) -> None:
+        ratio = usage_ratio(state, stage, term, configured, tokens)
+        if ratio > 1.0:
+            raise BudgetExceeded(
+                f"Budget exceeded for {stage}/{term}: {tokens} tokens would use {ratio:.0%}"
+            )
+        for counter in _counters(state, stage, term):
+            counter["reserved_tokens"] += tokens
+
+    try:
+        if counters:
+            counters.reserve(budget_plan["day"], stage, term, tokens, configured)
+        else:
+            _update(budget_plan, add_reservation)
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        print(f"Failed to reserve budget: {str(e)}")
+        raise BudgetUnavailable(f"Failed to reserve budget for {stage}/{term}: {str(e)}") from e
+
+    try:
+        yield call
+    finally:
+        if not settle(budget_plan, tokens, call.get("response"), call.get("model")):
+            release(budget_plan, tokens)
+
+
+def settle(
+    budget_plan: Dict[str, Any], tokens: int, response: Any, model: Optional[str] = None
+) -> bool:
+    """
+    予約を実際の使用量に置き換える（応答がない場合は予約の取り消しのみ）
+    更新できない場合はFalseを返す（予約が残るため、呼び出し元で取り消す）
+    """
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    cost = price(model or budget_plan["model"], prompt_tokens, completion_tokens)
+    counters = get_counters()
+
+    def apply(state: Dict[str, Any]) -> None:
+        for counter in _counters(state, budget_plan["stage"], budget_plan["term"]):
+            counter["reserved_tokens"] = max(0, counter["reserved_tokens"] - tokens)
+            if response is not None:
+                counter["used_tokens"] += prompt_tokens + completion_tokens
+                counter["cost_usd"] = round(counter["cost_usd"] + cost, 6)
+                counter["calls"] += 1
+
+    try:
+        if counters:
+            counters.settle(
+                budget_plan["day"],
+                budget_plan["stage"],
+                budget_plan["term"],
+                tokens,
+                prompt_tokens + completion_tokens if response is not None else 0,
+                round(cost, 6) if response is not None else 0.0,
+                1 if response is not None else 0,
+            )
+        else:
+            _update(budget_plan, apply)
+        return True
+    except Exception as e:
+        print(f"Failed to settle budget: {str(e)}")
+        return False
+
+
+def release(budget_plan: Dict[str, Any], tokens: int) -> None:
+    """確定できなかった予約を取り消す（使用量は記録できないまま、予約のみ残さない）"""
+    if settle(budget_plan, tokens, None):
+        return
+    # 取り消しの再試行も失敗した場合は、予約がその日の残りの予算から差し引かれたままになる
+    print(f"Failed to release {tokens} reserved tokens for {budget_plan['stage']}")
+
+
+def record_deferred(budget_plan: Dict[str, Any], **item: Any) -> None:
+    """延期した処理を記録（翌日のディスパッチャーが再投入する）"""
+
+    def apply(state: Dict[str, Any]) -> None:
+        entry = {"stage": budget_plan["stage"], "term": budget_plan["term"], **item}
+        if entry not in state["deferred"]:
+            state["deferred"].append(entry)
+
+    print(f"Deferring {budget_plan['stage']} for {budget_plan['term']}: {item}")
+    try:
+        _update(budget_plan, apply)
+    except Exception as e:
+        print(f"Failed to record deferred work: {str(e)}")
+
+
+def deferred_items(bucket: str, day: date) -> List[Dict[str, Any]]:
+    """指定日に延期された処理"""
+    return load_state(bucket, day)["deferred"]
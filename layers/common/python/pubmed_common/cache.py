@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from pubmed_common import records, s3_layout
+
+# 再利用されるコンテナ内で呼び出し間に保持するキャッシュ
+# メモリ → /tmp → S3（名前空間ごとに有効な場合のみ）の順に参照し、下位の層で見つかった値は上位の層にも格納する
+
+# 名前空間
+ARTICLES = "articles"  # パース済みの論文データ
+TOKENS = "tokens"  # トークン数
+COMPLETIONS = "completions"  # LLMの応答
+TRANSLATIONS = "translations"  # 翻訳結果
+
+# 名前空間ごとの容量上限（メモリのバイト数、/tmpのバイト数、S3を二次キャッシュとして使うか）
+# トークン数は小さい値が大量にできるためメモリのみに保持する
+DEFAULT_BUDGETS: Dict[str, Tuple[int, int, bool]] = {
+    ARTICLES: (64 * 1024 * 1024, 256 * 1024 * 1024, False),
+    TOKENS: (8 * 1024 * 1024, 0, False),
+    COMPLETIONS: (16 * 1024 * 1024, 64 * 1024 * 1024, True),
+    TRANSLATIONS: (16 * 1024 * 1024, 64 * 1024 * 1024, True),
+}
+
+DEFAULT_CACHE_DIR = "/tmp/pubmed_cache"
+
+
+def cache_key(*parts: Any) -> str:
+    """キーを構成する値からキャッシュキー（SHA-256）を生成"""
+    canonical = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _encode(value: Any) -> bytes:
+    """値をチェックサム付きのバイト列に変換（1行目がペイロードのSHA-256）"""
+    payload = json.dumps(
+        value, ensure_ascii=False, separators=(",", ":"), default=records.json_default
+    ).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest().encode("ascii") + b"\n" + payload
+
+
+def _decode(data: bytes) -> Tuple[bool, Any]:
+    """チェックサムを検証して値を取得（破損している場合は(False, None)）"""
+    checksum, _, payload = data.partition(b"\n")
+    if hashlib.sha256(payload).hexdigest().encode("ascii") != checksum:
+        return False, None
+    return True, json.loads(payload.decode("utf-8"))
+
+
+class _LruStore:
+    """容量（バイト数）上限付きのLRUストア（サイズのみ管理し、値の保持は呼び出し側が決める）"""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self.entries: "OrderedDict[str, Tuple[int, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[int, Any]]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, size: int, value: Any) -> List[Tuple[str, Any]]:
+        """エントリを追加し、容量を超えた分だけ古いエントリを取り除いて返す"""
+        self.discard(key)
+        if size > self.budget:
+            return []
+        self.entries[key] = (size, value)
+        self.used += size
+        evicted = []
+        while self.used > self.budget:
+            old_key, (old_size, old_value) = self.entries.popitem(last=False)
+            self.used -= old_size
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def discard(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.used -= entry[0]
+
+
+class TieredCache:
+    """
+    名前空間ごとに容量上限を持つ、メモリ・/tmp・S3の階層キャッシュ
+    値はJSONに変換できるものに限る
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        budgets: Optional[Dict[str, Tuple[int, int, bool]]] = None,
+        s3_bucket: Optional[str] = None,
+        s3_client_factory: Optional[Callable[[], Any]] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.s3_bucket = s3_bucket
+        self.s3_client_factory = s3_client_factory
+        self.memory: Dict[str, _LruStore] = {}
+        self.disk: Dict[str, _LruStore] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def _budget(self, namespace: str) -> Tuple[int, int, bool]:
+        if namespace not in self.budgets:
+            raise ValueError(f"Unknown cache namespace: {namespace}")
+        return self.budgets[namespace]
+
+    def _count(self, namespace: str, event: str) -> None:
+        counts = self.stats.setdefault(namespace, {})
+        counts[event] = counts.get(event, 0) + 1
+
+    def _path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.cache_dir, namespace, key)
+
+    def _disk_store(self, namespace: str) -> _LruStore:
+        """/tmpの既存ファイルを最終アクセス順に読み込んでストアを初期化（コンテナ内で1回のみ）"""
+        store = self.disk.get(namespace)
+        if store is not None:
+            return store
+
+        store = _LruStore(self._budget(namespace)[1])
+        directory = os.path.join(self.cache_dir, namespace)
+        files = []
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith(".tmp"):
+                    # 前回のコンテナで書き込み途中だったファイルは削除
+                    self._remove_file(namespace, name)
+                    continue
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            for evicted_key, _ in store.put(name, size, None):
+                self._remove_file(namespace, evicted_key)
+        self.disk[namespace] = store
+        return store
+
+    def _remove_file(self, namespace: str, key: str) -> None:
+        try:
+            os.remove(self._path(namespace, key))
+        except FileNotFoundError:
+            pass
+
+    def _memory_put(self, namespace: str, key: str, size: int, value: Any) -> None:
+        store = self.memory.setdefault(namespace, _LruStore(self._budget(namespace)[0]))
+        store.put(key, size, value)
+
+    def _disk_put(self, namespace: str, key: str, data: bytes) -> None:
+        store = self._disk_store(namespace)
+        if len(data) > store.budget:
+            return
+        try:
+            os.makedirs(os.path.join(self.cache_dir, namespace), exist_ok=True)
+            # 書き込み途中のファイルを読まないよう一時ファイルに書いてから置き換える
+            temp_path = f"{self._path(namespace, key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._path(namespace, key))
+        except OSError as e:
+            # /tmpの容量不足などはキャッシュなしとして処理を継続
+            print(f"Error writing cache entry {namespace}/{key} to disk: {str(e)}")
+            return
+        for evicted_key, _ in store.put(key, len(data), None):
+            self._remove_file(namespace, evicted_key)
+
+    def _disk_get(self, namespace: str, key: str) -> Optional[bytes]:
+        store = self._disk_store(namespace)
+        if store.get(key) is None:
+            return None
+        try:
+            with open(self._path(namespace, key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            store.discard(key)
+            return None
+        # 最終アクセス時刻を更新（コンテナ再起動後もLRUの順序を維持する）
+        now = time.time()
+        os.utime(self._path(namespace, key), (now, now))
+        return data
+
+    def _s3_enabled(self, namespace: str) -> bool:
+        return bool(self._budget(namespace)[2] and self.s3_bucket and self.s3_client_factory)
+
+    def _s3_get(self, namespace: str, key: str) -> Optional[bytes]:
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.s3_client_factory().get_object(
+                Bucket=self.s3_bucket, Key=s3_layout.cache_object_key(namespace, key)
+            )
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def _s3_put(self, namespace: str, key: str, data: bytes) -> None:
+        self.s3_client_factory().put_object(
+            Bucket=self.s3_bucket,
+            Key=s3_layout.cache_object_key(namespace, key),
+            Body=data,
+            ContentType="text/plain",
+        )
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """
+        キャッシュから値を取得（見つからない場合や破損していた場合はNone）
+        メモリ上の値をそのまま返すため、呼び出し側で変更しないこと
+        """
+        with self.lock:
+            memory = self.memory.get(namespace)
+            entry = memory.get(key) if memory else None
+            if entry is not None:
+                self._count(namespace, "memory_hits")
+                return entry[1]
+
+            data = self._disk_get(namespace, key)
+            if data is not None:
+                valid, value = _decode(data)
+                if valid:
+                    self._count(namespace, "disk_hits")
+                    self._memory_put(namespace, key, len(data), value)
+                    return value
+                print(f"Discarding corrupted cache entry {namespace}/{key}")
+                self.disk[namespace].discard(key)
+                self._remove_file(namespace, key)
+
+        if not self._s3_enabled(namespace):
+            self._count(namespace, "misses")
+            return None
+
+        try:
+            data = self._s3_get(namespace, key)
+        except Exception as e:
+            print(f"Error reading cache entry {namespace}/{key} from S3: {str(e)}")
+            data = None
+
+        with self.lock:
+            if data is not None:
+                valid, value = _decode(data)
+                if valid:
+                    self._count(namespace, "s3_hits")
+                    self._memory_put(namespace, key, len(data), value)
+                    self._disk_put(namespace, key, data)
+                    return value
+                print(f"Discarding corrupted cache entry {namespace}/{key} in S3")
+            self._count(namespace, "misses")
+        return None
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        """キャッシュに値を格納（S3が有効な名前空間ではS3にも保存）"""
+        data = _encode(value)
+        with self.lock:
+            self._memory_put(namespace, key, len(data), value)
+            self._disk_put(namespace, key, data)
+
+        if self._s3_enabled(namespace):
+            try:
+                self._s3_put(namespace, key, data)
+            except Exception as e:
+                print(f"Error writing cache entry {namespace}/{key} to S3: {str(e)}")
+
+    def get_or_compute(self, namespace: str, key: str, compute: Callable[[], Any]) -> Any:
+        """キャッシュにない場合はcomputeで値を計算して格納"""
+        value = self.get(namespace, key)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.put(namespace, key, value)
+        return value
+
+
+@lru_cache(maxsize=None)
+def get_cache() -> TieredCache:
+    """
+    コンテナ内で共有するキャッシュを取得
+    環境変数CACHE_BUCKETが設定されている場合、応答・翻訳の名前空間はS3を二次キャッシュとして使う
+    """
+    from pubmed_common import clients
+
+    return TieredCache(
+        cache_dir=os.environ.get("CACHE_DIR", DEFAULT_CACHE_DIR),
+        s3_bucket=os.environ.get("CACHE_BUCKET"),
+        s3_client_factory=clients.get_s3,
+    )
@@ -0,0 +1,128 @@
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from pubmed_common import s3_layout
+
+# 週次候補ストアのデフォルト設定
+DEFAULT_WINDOW_DAYS = 7
+DEFAULT_MAX_CANDIDATES = 50
+
+
+def candidate_score(article: Dict[str, Any]) -> float:
+    """
+    候補論文のスコアを計算
+    数値のscoreがあればそれを使用し、なければ日次分析と同じくimpact_reasonの長さを用いる
+    """
+    score = article.get("score")
+    if isinstance(score, (int, float)):
+        return float(score)
+    return float(len(article.get("impact_reason", "")))
+
+
+def _empty_store(search_term: str, window_days: int, max_candidates: int) -> Dict[str, Any]:
+    return {
+        "search_term": s3_layout.safe_term(search_term),
+        "window_days": window_days,
+        "max_candidates": max_candidates,
+        "updated_at": None,
+        "candidates": [],
+    }
+
+
+def prune_candidates(
+    candidates: List[Dict[str, Any]],
+    today: date,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    max_candidates: int = DEFAULT_MAX_CANDIDATES,
+) -> List[Dict[str, Any]]:
+    """
+    期間外の候補を除外し、PMIDごとに最高スコアの候補のみを残してスコア上位K件に絞る
+    """
+    oldest = (today - timedelta(days=window_days)).isoformat()
+
+    best_by_pmid: Dict[str, Dict[str, Any]] = {}
+    for candidate in candidates:
+        if candidate.get("day", "") < oldest:
+            continue
+        pmid = str(candidate.get("pmid", ""))
+        current = best_by_pmid.get(pmid)
+        if current is None or (candidate["score"], candidate["day"]) > (
+            current["score"],
+            current["day"],
+        ):
+            best_by_pmid[pmid] = candidate
+
+    ranked = sorted(
+        best_by_pmid.values(), key=lambda c: (c["score"], c["day"], c.get("pmid", "")), reverse=True
+    )
+    return ranked[:max_candidates]
+
+
+def add_candidates(
+    s3,
+    bucket: str,
+    search_term: str,
+    articles: List[Dict[str, Any]],
+    day: date,
+    source_file: str,
+    analysis_date: str,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+    max_candidates: int = DEFAULT_MAX_CANDIDATES,
+) -> Dict[str, Any]:
+    """日次分析で選定された論文を検索語ごとの週次候補ストアに追加"""
+    new_candidates = []
+    for article in articles:
+        candidate = dict(article)
+        candidate["source_file"] = source_file
+        candidate["analysis_date"] = analysis_date
+        candidate["day"] = day.isoformat()
+        candidate["score"] = candidate_score(article)
+        new_candidates.append(candidate)
+
+    def mutate(store: Dict[str, Any]) -> Dict[str, Any]:
+        # 同じ入力ファイルの再分析時は以前の候補を置き換える
+        kept = [c for c in store["candidates"] if c.get("source_file") != source_file]
+        store["candidates"] = prune_candidates(
+            kept + new_candidates, datetime.now().date(), window_days, max_candidates
+        )
+        store["window_days"] = window_days
+        store["max_candidates"] = max_candidates
+        store["updated_at"] = datetime.now().isoformat()
+        return store
+
+    return s3_layout.update_json_object(
+        s3,
+        bucket,
+        s3_layout.candidate_store_key(search_term),
+        mutate,
+        lambda: _empty_store(search_term, window_days, max_candidates),
+    )
+
+
+def candidates_from_store(
+    store: Dict[str, Any], today: date, window_days: int = DEFAULT_WINDOW_DAYS
+) -> List[Dict[str, Any]]:
+    """読み込んだ週次候補ストアから集計期間内の候補論文を取得"""
+    return prune_candidates(
+        store.get("candidates", []),
+        today,
+        window_days,
+        store.get("max_candidates", DEFAULT_MAX_CANDIDATES),
+    )
+
+
+def load_candidates(
+    s3,
+    bucket: str,
+    search_term: str,
+    today: Optional[date] = None,
+    window_days: int = DEFAULT_WINDOW_DAYS,
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    週次候補ストアから直近の候補論文を取得
+    ストアが存在しない場合はNoneを返す
+    """
+    store, _ = s3_layout.get_json_object(s3, bucket, s3_layout.candidate_store_key(search_term))
+    if store is None:
+        return None
+    return candidates_from_store(store, today or datetime.now().date(), window_days)
@@ -0,0 +1,60 @@
+import os
+from functools import lru_cache
+
+# 重いクライアントやエンコーディングはインポート時ではなく初回使用時に作成し、
+# コンテナが再利用される間はキャッシュしたものを使い回す
+
+# S3クライアントのデフォルトのコネクションプールサイズ（botocoreのデフォルトと同じ）
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+
+@lru_cache(maxsize=None)
+def get_s3(max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS):
+    """S3クライアントを取得（並列に取得する場合はmax_pool_connectionsをワーカー数以上にする）"""
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client("s3", config=Config(max_pool_connections=max_pool_connections))
+
+
+@lru_cache(maxsize=None)
+def get_stepfunctions():
+    """Step Functionsクライアントを取得"""
+    import boto3
+
+    return boto3.client("stepfunctions")
+
+
+@lru_cache(maxsize=None)
+def get_sqs():
+    """SQSクライアントを取得"""
+    import boto3
+
+    return boto3.client("sqs")
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb():
+    """DynamoDBクライアントを取得"""
+    import boto3
+
+    return boto3.client("dynamodb")
+
+
+@lru_cache(maxsize=None)
+def get_openai():
+    """OpenAIクライアントを取得"""
+    from openai import OpenAI
+
+    return OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-4"):
+    """
+    tiktokenのエンコーディングを取得
+    レイヤーに同梱したエンコーディングファイル（TIKTOKEN_CACHE_DIR）を使用し、実行時にはダウンロードしない
+    """
+    import tiktoken
+
+    return tiktoken.encoding_for_model(model)
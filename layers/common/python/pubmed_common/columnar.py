@@ -0,0 +1,597 @@
+import io
+import json
+import os
+import uuid
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from botocore.exceptions import ClientError
+from pubmed_common import article_index, metrics, s3_layout, s3_loader
+
+# 日次の取得結果・分析結果を月ごとの列指向パーティションに圧縮したもの（傾向分析用）
+# パーティションは columnar/<yyyy-mm>/ に列ごとのNumPy配列（.npy）と、辞書・入力のバージョンを持つ
+# meta.json を置く。列は世代ごとのプレフィックスに書き込み、meta.jsonの条件付き書き込みで差し替える
+# 行は取得結果の論文1件（検索語・取得日ごと）で、ジャーナル・検索語などの文字列は辞書のコードで持つ
+# 出版タイプは論文ごとに複数あるため、行番号との組を別の列で持つ
+
+# 論文の行の列と型
+ROW_COLUMNS = {
+    "day": "datetime64[D]",
+    "term": "int32",
+    "journal": "int32",
+    # 出版年（不明の場合は0）
+    "publication_year": "int16",
+    "pmid": "int64",
+    # 取得結果のキー（sources辞書のコード）
+    "source": "int32",
+    # 同じ取得結果の日次分析で選定されたか
+    "selected": "bool",
+}
+# 出版タイプの列（type_rowは論文の行番号）
+TYPE_COLUMNS = {"type_row": "int32", "publication_type": "int32"}
+COLUMNS = {**ROW_COLUMNS, **TYPE_COLUMNS}
+# 辞書と、そのコードを持つ列
+DICTIONARY_COLUMNS = {
+    "terms": "term",
+    "journals": "journal",
+    "publication_types": "publication_type",
+    "sources": "source",
+}
+META_FILE = "meta.json"
+
+# 集計の単位・項目・指標
+BUCKETS = ("day", "week", "month")
+GROUPS = ("term", "journal", "publication_type", "publication_year")
+METRICS = ("articles", "selected", "selection_rate")
+
+DEFAULT_DATA_DIR = "/tmp/columnar"
+
+Partition = Dict[str, Any]
+
+
+def month_of(day: date) -> date:
+    return day.replace(day=1)
+
+
+def months_between(start: date, end: date) -> List[date]:
+    """start から end までを含む月（各月の1日）のリスト"""
+    months = []
+    month = month_of(start)
+    while month <= end:
+        months.append(month)
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return months
+
+
+def empty_partition() -> Partition:
+    return {
+        "columns": {name: np.empty(0, dtype) for name, dtype in COLUMNS.items()},
+        "dictionaries": {name: [] for name in DICTIONARY_COLUMNS},
+        "versions": {},
+    }
+
+
+def _publication_year(value: Any) -> int:
+    try:
+        return int(str(value)[:4])
+    except ValueError:
+        return 0
+
+
+def build_rows(
+    documents: List[Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]],
+    dictionaries: Dict[str, List[str]],
+) -> Dict[str, np.ndarray]:
+    """
+    (取得結果のキー, 取得結果, 分析結果) のリストから列を作成
+    文字列は dictionaries のコードに変換し、辞書にない値は末尾に追加する
+    """
+    indexes = {
+        name: {value: i for i, value in enumerate(values)} for name, values in dictionaries.items()
+    }
+
+    def encode(name: str, value: str) -> int:
+        index = indexes[name]
+        if value not in index:
+            index[value] = len(dictionaries[name])
+            dictionaries[name].append(value)
+        return index[value]
+
+    rows: Dict[str, List[Any]] = {name: [] for name in COLUMNS}
+    for key, raw, analysis in documents:
+        info = s3_layout.parse_key(key)
+        term = encode("terms", info["term"])
+        source = encode("sources", key)
+        selected = {
+            str(article.get("pmid", ""))
+            for article in ((analysis or {}).get("impactful_articles") or [])
+        }
+        for article in (raw.get("articles") or {}).values():
+            pmid = str(article.get("pmid", ""))
+            if not pmid.isdigit():
+                continue
+            row = len(rows["pmid"])
+            rows["day"].append(info["date"])
+            rows["term"].append(term)
+            rows["journal"].append(encode("journals", article.get("journal") or ""))
+            rows["publication_year"].append(_publication_year(article.get("publication_year")))
+            rows["pmid"].append(int(pmid))
+            rows["source"].append(source)
+            rows["selected"].append(pmid in selected)
+            for publication_type in article.get("publication_types") or []:
+                rows["type_row"].append(row)
+                rows["publication_type"].append(encode("publication_types", publication_type))
+
+    return {name: np.array(rows[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def merge_rows(
+    partition: Partition, keep_sources: List[str], rows: Dict[str, np.ndarray]
+) -> Partition:
+    """
+    パーティションの keep_sources の行に、同じ辞書で作成した rows を追加
+    使われなくなった辞書の値は取り除き、コードを振り直す
+    """
+    columns = partition["columns"]
+    dictionaries = partition["dictionaries"]
+    source_index = {key: i for i, key in enumerate(dictionaries["sources"])}
+    keep = np.isin(
+        columns["source"], [source_index[key] for key in keep_sources if key in source_index]
+    )
+
+    # 残す行の新しい行番号（出版タイプの行番号の付け替えに使う）
+    row_numbers = np.cumsum(keep) - 1
+    kept_types = keep[columns["type_row"]]
+    offset = int(keep.sum())
+    merged = {name: np.concatenate([columns[name][keep], rows[name]]) for name in ROW_COLUMNS}
+    merged["type_row"] = np.concatenate(
+        [row_numbers[columns["type_row"][kept_types]], rows["type_row"] + offset]
+    ).astype(TYPE_COLUMNS["type_row"])
+    merged["publication_type"] = np.concatenate(
+        [columns["publication_type"][kept_types], rows["publication_type"]]
+    )
+
+    compacted = {}
+    for name, column in DICTIONARY_COLUMNS.items():
+        used, codes = np.unique(merged[column], return_inverse=True)
+        compacted[name] = [dictionaries[name][code] for code in used]
+        merged[column] = codes.astype(COLUMNS[column])
+    return {"columns": merged, "dictionaries": compacted, "versions": partition["versions"]}
+
+
+def _put_array(s3, bucket: str, key: str, array: np.ndarray) -> int:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    body = buffer.getvalue()
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/octet-stream")
+    return len(body)
+
+
+def _delete_generation(s3, bucket: str, month: date, generation: str) -> None:
+    for name in COLUMNS:
+        try:
+            s3.delete_object(
+                Bucket=bucket, Key=s3_layout.columnar_column_key(month, generation, name)
+            )
+        except Exception as e:
+            print(f"Failed to delete column {name} of generation {generation}: {str(e)}")
+
+
+def load_partition(
+    s3, bucket: str, month: date
+) -> Tuple[Optional[Dict[str, Any]], Optional[str], Optional[Partition]]:
+    """パーティションのメタデータ・ETagと、列を読み込んだパーティション（存在しない場合はNone）"""
+    meta, etag = s3_layout.get_json_object(s3, bucket, s3_layout.columnar_meta_key(month))
+    if meta is None:
+        return None, None, None
+    columns = {}
+    for name in COLUMNS:
+        key = s3_layout.columnar_column_key(month, meta["generation"], name)
+        body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        columns[name] = np.load(io.BytesIO(body), allow_pickle=False)
+    partition = {
+        "columns": columns,
+        "dictionaries": meta["dictionaries"],
+        "versions": meta["versions"],
+    }
+    return meta, etag, partition
+
+
+def save_partition(
+    s3,
+    bucket: str,
+    month: date,
+    partition: Partition,
+    meta: Optional[Dict[str, Any]],
+    etag: Optional[str],
+) -> Optional[Dict[str, Any]]:
+    """
+    パーティションの列を新しい世代に書き込み、meta.jsonを条件付き書き込みで差し替える
+    他の圧縮処理と競合した場合は書き込んだ列を削除してNoneを返す
+    """
+    generation = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    size = 0
+    for name, array in partition["columns"].items():
+        key = s3_layout.columnar_column_key(month, generation, name)
+        size += _put_array(s3, bucket, key, array)
+
+    updated = {
+        "month": month.strftime("%Y-%m"),
+        "generation": generation,
+        "previous": meta["generation"] if meta else None,
+        "updated_at": datetime.now().isoformat(),
+        "rows": int(partition["columns"]["pmid"].size),
+        "bytes": size,
+        "dictionaries": partition["dictionaries"],
+        "versions": partition["versions"],
+    }
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=s3_layout.columnar_meta_key(month),
+            Body=json.dumps(updated, ensure_ascii=False, sort_keys=True),
+            ContentType="application/json",
+            **condition,
+        )
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+            raise
+        _delete_generation(s3, bucket, month, generation)
+        return None
+
+    # 直前の世代は読み込み中の読み取り側のために残し、その前のものを削除する
+    if meta and meta.get("previous"):
+        _delete_generation(s3, bucket, month, meta["previous"])
+    return updated
+
+
+def list_month_versions(s3, bucket: str, month: date, terms: List[str]) -> Dict[str, str]:
+    """
+    月内の取得結果のキーと、取得結果・分析結果のバージョンを組にしたもの
+    分析結果が再作成された場合も圧縮し直すよう、分析結果のバージョンも含める
+    """
+    objects: Dict[str, Dict[str, str]] = {}
+    paginator = s3.get_paginator("list_objects_v2")
+    for term in terms:
+        for root in (s3_layout.RAW_ROOT, s3_layout.ANALYSIS_ROOT):
+            prefix = f"{root}/{s3_layout.safe_term(term)}/{month.strftime('%Y/%m')}/"
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    if obj["Key"].endswith(".json"):
+                        version = article_index.object_version(obj)
+                        objects.setdefault(root, {})[obj["Key"]] = version
+
+    analyses = objects.get(s3_layout.ANALYSIS_ROOT, {})
+    return {
+        key: f"{version}/{analyses.get(s3_layout.analysis_key(key), '')}"
+        for key, version in objects.get(s3_layout.RAW_ROOT, {}).items()
+    }
+
+
+def compact_month(
+    s3,
+    bucket: str,
+    month: date,
+    terms: Optional[List[str]] = None,
+    rebuild: bool = False,
+    max_workers: int = s3_loader.DEFAULT_MAX_WORKERS,
+) -> Dict[str, Any]:
+    """
+    月内の取得結果・分析結果を列指向パーティションに反映する
+    前回から変わっていない取得結果の行はそのまま残し、追加・更新されたものだけを読み込む
+    rebuild=Trueの場合はすべて読み込み直す。他の圧縮処理と競合した場合は最新のものに反映し直す
+    """
+    if terms is None:
+        terms = s3_layout.list_manifest_terms(s3, bucket)
+    versions = list_month_versions(s3, bucket, month, terms)
+
+    for retry in range(s3_layout.CONDITIONAL_WRITE_MAX_RETRIES):
+        meta, etag, partition = load_partition(s3, bucket, month)
+        if partition is None or rebuild:
+            partition = empty_partition()
+        result = {
+            "month": month.strftime("%Y-%m"),
+            "compacted": 0,
+            "rows": int(partition["columns"]["pmid"].size),
+            "failed": [],
+        }
+
+        stale = [
+            key for key, version in versions.items() if partition["versions"].get(key) != version
+        ]
+        removed = [key for key in partition["versions"] if key not in versions]
+        if not stale and not removed and not rebuild:
+            return result
+
+        keys = stale + [
+            s3_layout.analysis_key(key) for key in stale if not versions[key].endswith("/")
+        ]
+        loaded, failures = s3_loader.load_json_objects(
+            s3, bucket, keys, max_workers, missing_ok=True
+        )
+        result["failed"] = list(failures)
+        documents = [
+            (key, loaded[key], loaded.get(s3_layout.analysis_key(key)))
+            for key in stale
+            if key in loaded and s3_layout.analysis_key(key) not in failures
+        ]
+
+        # 読み込めなかった取得結果は以前の行とバージョンを残し、次回に読み込み直す
+        reloaded = {key for key, _, _ in documents}
+        keep = [key for key in partition["versions"] if key in versions and key not in reloaded]
+        rows = build_rows(documents, partition["dictionaries"])
+        partition = merge_rows(partition, keep, rows)
+        partition["versions"] = {
+            **{key: partition["versions"][key] for key in keep},
+            **{key: versions[key] for key in reloaded},
+        }
+
+        updated = save_partition(s3, bucket, month, partition, meta, etag)
+        if updated is None:
+            print(
+                f"Columnar partition conflict, retry {retry + 1}/"
+                f"{s3_layout.CONDITIONAL_WRITE_MAX_RETRIES}"
+            )
+            metrics.emit({"ColumnarSwapConflicts": (1, metrics.COUNT)})
+            continue
+
+        result["compacted"] = len(documents)
+        result["rows"] = updated["rows"]
+        print(
+            f"Compacted {len(documents)} files into {result['month']} "
+            f"({updated['rows']} rows, {updated['bytes']} bytes)"
+        )
+        metrics.emit(
+            {
+                "CompactedFiles": (len(documents), metrics.COUNT),
+                "CompactedRows": (updated["rows"], metrics.COUNT),
+                "ColumnarPartitionBytes": (updated["bytes"], metrics.BYTES),
+            }
+        )
+        return result
+
+    raise RuntimeError(f"Failed to update s3://{bucket}/{s3_layout.columnar_meta_key(month)}")
+
+
+def pull_partitions(s3, bucket: str, directory: str, months: List[date]) -> List[date]:
+    """
+    パーティションを directory/<yyyy-mm>/ にダウンロードし、取得できた月を返す
+    ダウンロード済みの世代と同じ場合はダウンロードしない
+    """
+    pulled = []
+    for month in months:
+        meta, _ = s3_layout.get_json_object(s3, bucket, s3_layout.columnar_meta_key(month))
+        if meta is None:
+            continue
+        target = os.path.join(directory, month.strftime("%Y-%m"))
+        meta_path = os.path.join(target, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                if json.load(f).get("generation") == meta["generation"]:
+                    pulled.append(month)
+                    continue
+
+        os.makedirs(target, exist_ok=True)
+        for name in COLUMNS:
+            key = s3_layout.columnar_column_key(month, meta["generation"], name)
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+            with open(os.path.join(target, f"{name}.npy"), "wb") as f:
+                f.write(body)
+        # 列をすべて書き込んでからメタデータを書き込む（途中で失敗した場合は次回ダウンロードし直す）
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        pulled.append(month)
+    return pulled
+
+
+def load_dataset(directory: str, months: Optional[List[date]] = None) -> Partition:
+    """
+    ダウンロードしたパーティションをメモリマップで読み込み、1つのデータセットにする
+    辞書は全パーティションで共通のものに変換する（1つの月だけの場合は列をコピーしない）
+    """
+    if months is None:
+        names = sorted(name for name in os.listdir(directory) if len(name) == 7)
+    else:
+        names = [month.strftime("%Y-%m") for month in months]
+
+    partitions = []
+    for name in names:
+        meta_path = os.path.join(directory, name, META_FILE)
+        if not os.path.exists(meta_path):
+            continue
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        columns = {
+            column: np.load(os.path.join(directory, name, f"{column}.npy"), mmap_mode="r")
+            for column in COLUMNS
+        }
+        partitions.append({"columns": columns, "dictionaries": meta["dictionaries"]})
+
+    if not partitions:
+        empty = empty_partition()
+        return {"columns": empty["columns"], "dictionaries": empty["dictionaries"]}
+    if len(partitions) == 1:
+        return partitions[0]
+
+    dictionaries = {
+        name: sorted({value for part in partitions for value in part["dictionaries"][name]})
+        for name in DICTIONARY_COLUMNS
+    }
+    indexes = {
+        name: {value: i for i, value in enumerate(values)} for name, values in dictionaries.items()
+    }
+    parts: Dict[str, List[np.ndarray]] = {name: [] for name in COLUMNS}
+    offset = 0
+    for partition in partitions:
+        columns = partition["columns"]
+        for name in COLUMNS:
+            parts[name].append(columns[name])
+        parts["type_row"][-1] = columns["type_row"] + offset
+        for name, column in DICTIONARY_COLUMNS.items():
+            remap = np.array(
+                [indexes[name][value] for value in partition["dictionaries"][name]], dtype=np.int32
+            )
+            parts[column][-1] = remap[columns[column]] if remap.size else columns[column]
+        offset += columns["pmid"].size
+
+    merged = {name: np.concatenate(parts[name]).astype(dtype) for name, dtype in COLUMNS.items()}
+    return {"columns": merged, "dictionaries": dictionaries}
+
+
+def _codes(dataset: Partition, name: str, values: List[str]) -> List[int]:
+    index = {value: i for i, value in enumerate(dataset["dictionaries"][name])}
+    return [index[value] for value in values if value in index]
+
+
+def select(
+    dataset: Partition,
+    terms: Optional[List[str]] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    journals: Optional[List[str]] = None,
+    publication_types: Optional[List[str]] = None,
+) -> np.ndarray:
+    """条件に一致する行のマスク（出版タイプはいずれかを持つ論文）"""
+    columns = dataset["columns"]
+    mask = np.ones(columns["pmid"].size, dtype=bool)
+    if terms:
+        safe_terms = [s3_layout.safe_term(term) for term in terms]
+        mask &= np.isin(columns["term"], _codes(dataset, "terms", safe_terms))
+    if start:
+        mask &= columns["day"] >= np.datetime64(start, "D")
+    if end:
+        mask &= columns["day"] <= np.datetime64(end, "D")
+    if journals:
+        mask &= np.isin(columns["journal"], _codes(dataset, "journals", journals))
+    if publication_types:
+        codes = _codes(dataset, "publication_types", publication_types)
+        typed = np.zeros(mask.size, dtype=bool)
+        typed[columns["type_row"][np.isin(columns["publication_type"], codes)]] = True
+        mask &= typed
+    return mask
+
+
+def _bucket_numbers(days: np.ndarray, bucket: str) -> np.ndarray:
+    """
+    日付を集計単位の通し番号に変換（週は月曜始まり。1970-01-01は木曜日）
+    日付の範囲は狭いため、範囲内の日ごとの番号の表を作り、各行は表を引いて変換する
+    """
+    numbers = days.view(np.int64)
+    first = int(numbers.min())
+    table = np.arange(first, int(numbers.max()) + 1)
+    if bucket == "month":
+        table = table.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    elif bucket == "week":
+        table = (table + 3) // 7
+    return table[numbers - first]
+
+
+def _bucket_labels(first: int, count: int, bucket: str) -> List[str]:
+    """通し番号の期間の開始日（月の場合は yyyy-mm）"""
+    numbers = np.arange(first, first + count)
+    if bucket == "month":
+        return [str(label) for label in numbers.astype("datetime64[M]")]
+    if bucket == "week":
+        numbers = numbers * 7 - 3
+    return [str(label) for label in numbers.astype("datetime64[D]")]
+
+
+def _rolling(values: np.ndarray, window: int) -> np.ndarray:
+    """各期間を末尾とする window 期間の合計（累積和の差で計算）"""
+    cumulative = np.cumsum(values, axis=1)
+    rolled = cumulative.copy()
+    rolled[:, window:] -= cumulative[:, :-window]
+    return rolled
+
+
+def trend(
+    dataset: Partition,
+    mask: Optional[np.ndarray] = None,
+    bucket: str = "week",
+    by: Optional[str] = None,
+    metric: str = "articles",
+    window: int = 1,
+    share: bool = False,
+    top: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    期間（日・週・月）ごと、項目（by）ごとの件数・選定数・選定率を集計
+    window を指定すると直近 window 期間の移動合計（選定率は移動合計どうしの比）にする
+    share=True の場合は期間ごとの項目の構成比、top を指定すると上位の項目以外を「other」にまとめる
+    件数は検索語・取得日ごとの行数（同じ論文を複数の検索語で取得した場合はそれぞれ数える）
+    """
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket: {bucket}")
+    if by is not None and by not in GROUPS:
+        raise ValueError(f"Unknown group: {by}")
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+
+    columns = dataset["columns"]
+    if mask is None:
+        mask = np.ones(columns["pmid"].size, dtype=bool)
+    # 全行を対象とする場合は行を選び出さずに列をそのまま使う
+    rows = slice(None) if mask.all() else np.flatnonzero(mask)
+
+    if by == "publication_type":
+        # 出版タイプは論文ごとに複数あるため、出版タイプの組ごとに数える
+        typed = mask[columns["type_row"]]
+        rows = columns["type_row"][typed]
+        groups = columns["publication_type"][typed].astype(np.int64)
+        labels = dataset["dictionaries"]["publication_types"]
+    elif by == "publication_year":
+        years, groups = np.unique(columns["publication_year"][rows], return_inverse=True)
+        labels = [str(year) if year else "" for year in years]
+    elif by in ("term", "journal"):
+        groups = columns[by][rows].astype(np.int64)
+        labels = dataset["dictionaries"][f"{by}s"]
+    else:
+        groups = np.zeros(int(mask.sum()), dtype=np.int64)
+        labels = ["all"]
+
+    if not groups.size:
+        return {"buckets": [], "groups": [], "values": np.zeros((0, 0))}
+
+    numbers = _bucket_numbers(columns["day"][rows], bucket)
+    first = int(numbers.min())
+    count = int(numbers.max()) - first + 1
+    positions = numbers - first
+
+    # 項目と期間の組を1つの整数にまとめ、bincountで一度に集計する
+    cells = groups * count + positions
+    size = len(labels) * count
+    articles = np.bincount(cells, minlength=size).reshape(len(labels), count).astype(float)
+    selected = np.bincount(cells, weights=columns["selected"][rows], minlength=size).reshape(
+        len(labels), count
+    )
+
+    # 一度も現れない項目は除く
+    present = articles.sum(axis=1) > 0
+    articles, selected = articles[present], selected[present]
+    labels = [label for label, keep in zip(labels, present) if keep]
+
+    if top is not None and len(labels) > top:
+        order = np.argsort(-articles.sum(axis=1), kind="stable")
+        head, rest = order[:top], order[top:]
+        articles = np.vstack([articles[head], articles[rest].sum(axis=0)])
+        selected = np.vstack([selected[head], selected[rest].sum(axis=0)])
+        labels = [labels[i] for i in head] + ["other"]
+
+    if window > 1:
+        articles, selected = _rolling(articles, window), _rolling(selected, window)
+
+    if metric == "articles":
+        values = articles
+    elif metric == "selected":
+        values = selected
+    else:
+        values = np.divide(selected, articles, out=np.zeros_like(selected), where=articles > 0)
+
+    if share:
+        totals = values.sum(axis=0)
+        values = np.divide(values, totals, out=np.zeros_like(values), where=totals > 0)
+
+    return {"buckets": _bucket_labels(first, count, bucket), "groups": labels, "values": values}
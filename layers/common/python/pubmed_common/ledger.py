@@ -0,0 +1,195 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+from pubmed_common import s3_layout
+
+# 処理段階
+ANALYSIS_STAGE = "analysis"
+TRANSLATION_STAGE = "translation"
+
+# エントリの状態
+STATUS_PROCESSING = "processing"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+# 処理中のエントリを有効とみなす期間
+# ワークフローのタイムアウト（15分）より長くし、分析のシャードの開始時に残りが半分を切っていれば延長する
+DEFAULT_LEASE_SECONDS = 1200
+
+
+def content_hash(data: Any) -> str:
+    """JSONデータの内容からSHA-256ハッシュを計算（キーの順序や空白に依存しない）"""
+    canonical = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_entry(
+    s3, bucket: str, stage: str, input_key: str
+) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """処理台帳のエントリとETagを取得（存在しない場合はNoneとNone）"""
+    return s3_layout.get_json_object(s3, bucket, s3_layout.ledger_key(stage, input_key))
+
+
+def is_duplicate(
+    entry: Optional[Dict[str, Any]],
+    etag: Optional[str] = None,
+    digest: Optional[str] = None,
+    now: Optional[datetime] = None,
+) -> bool:
+    """
+    入力ファイルが処理済み、または同じ内容を処理中（期限内）かを判定
+    ETagまたは内容のハッシュのどちらかが一致すれば同じ内容とみなす
+    """
+    if not entry:
+        return False
+
+    same_content = (etag is not None and entry.get("etag") == etag) or (
+        digest is not None and entry.get("content_hash") == digest
+    )
+    if not same_content:
+        return False
+
+    if entry.get("status") == STATUS_COMPLETED:
+        return True
+    if entry.get("status") == STATUS_PROCESSING:
+        now = now or datetime.now()
+        return entry.get("lease_expires_at", "") > now.isoformat()
+    return False
+
+
+def claim(
+    s3,
+    bucket: str,
+    stage: str,
+    input_key: str,
+    digest: str,
+    etag: Optional[str] = None,
+    entry: Optional[Tuple[Optional[Dict[str, Any]], Optional[str]]] = None,
+    lease_seconds: int = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    入力ファイルの処理権を取得
+    重複している場合や、同時に実行された別の処理が先に取得した場合はFalseを返す
+    entryに取得済みのエントリとETagを渡すと、台帳の読み込みを省略する
+    """
+    current, current_etag = entry if entry is not None else get_entry(s3, bucket, stage, input_key)
+    if is_duplicate(current, etag, digest):
+        return False
+
+    now = datetime.now()
+    record = {
+        "stage": stage,
+        "input_key": input_key,
+        "etag": etag,
+        "content_hash": digest,
+        "status": STATUS_PROCESSING,
+        "claimed_at": now.isoformat(),
+        "lease_expires_at": (now + timedelta(seconds=lease_seconds)).isoformat(),
+    }
+    if not _put_entry(s3, bucket, stage, input_key, record, current_etag):
+        print(f"Ledger entry for {stage}:{input_key} was claimed concurrently")
+        return False
+    return True
+
+
+def renew(
+    s3,
+    bucket: str,
+    stage: str,
+    input_key: str,
+    digest: str,
+    lease_seconds: int = DEFAULT_LEASE_SECONDS,
+) -> bool:
+    """
+    処理中のエントリの期限を延長（長い処理の途中で期限が切れ、重複して処理されないようにする）
+    残りの期限が半分を切っている場合のみ書き込む。処理権を失っている場合はFalseを返す
+    """
+    current, current_etag = get_entry(s3, bucket, stage, input_key)
+    if (
+        not current
+        or current.get("status") != STATUS_PROCESSING
+        or current.get("content_hash") != digest
+    ):
+        return False
+
+    now = datetime.now()
+    if (
+        current.get("lease_expires_at", "")
+        > (now + timedelta(seconds=lease_seconds / 2)).isoformat()
+    ):
+        return True
+    record = {
+        **current,
+        "lease_expires_at": (now + timedelta(seconds=lease_seconds)).isoformat(),
+    }
+    # 同時に別のシャードが延長した場合は、その延長を使う
+    if not _put_entry(s3, bucket, stage, input_key, record, current_etag):
+        print(f"Ledger entry for {stage}:{input_key} was renewed concurrently")
+    return True
+
+
+def _put_entry(
+    s3,
+    bucket: str,
+    stage: str,
+    input_key: str,
+    record: Dict[str, Any],
+    current_etag: Optional[str],
+) -> bool:
+    """読み込んだ時点から変更されていない場合のみ書き込む（同時実行時は一方のみ成功）"""
+    condition = {"IfMatch": current_etag} if current_etag else {"IfNoneMatch": "*"}
+    try:
+        s3.put_object(
+            Bucket=bucket,
+            Key=s3_layout.ledger_key(stage, input_key),
+            Body=json.dumps(record, ensure_ascii=False, sort_keys=True),
+            ContentType="application/json",
+            **condition,
+        )
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+            raise
+        return False
+    return True
+
+
+def _finish(
+    s3, bucket: str, stage: str, input_key: str, digest: str, status: str, **fields: Any
+) -> Dict[str, Any]:
+    def mutate(record: Dict[str, Any]) -> Dict[str, Any]:
+        # 処理中に別の内容で処理権が取得された場合は上書きしない
+        if record.get("content_hash") not in (None, digest):
+            return record
+        record.update(fields)
+        record.update(
+            {
+                "stage": stage,
+                "input_key": input_key,
+                "content_hash": digest,
+                "status": status,
+                "finished_at": datetime.now().isoformat(),
+            }
+        )
+        return record
+
+    return s3_layout.update_json_object(
+        s3, bucket, s3_layout.ledger_key(stage, input_key), mutate, dict
+    )
+
+
+def complete(
+    s3, bucket: str, stage: str, input_key: str, digest: str, **fields: Any
+) -> Dict[str, Any]:
+    """入力ファイルの処理完了を記録（出力キーなどをfieldsとして保存）"""
+    return _finish(s3, bucket, stage, input_key, digest, STATUS_COMPLETED, **fields)
+
+
+def release(
+    s3, bucket: str, stage: str, input_key: str, digest: str, error: str = ""
+) -> Dict[str, Any]:
+    """処理の失敗を記録し、再実行時に期限を待たずに処理できるようにする"""
+    return _finish(s3, bucket, stage, input_key, digest, STATUS_FAILED, error=error)
@@ -0,0 +1,201 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from pubmed_common import s3_layout
+
+# CloudWatch Embedded Metric Format（EMF）でメトリクスを出力する
+# 1レコード1行のJSONとして標準出力に書き出し、CloudWatch Logsがメトリクスとして取り込む
+# 環境変数METRICS_FILEを指定すると同じJSON行をファイルにも追記する（ローカルでの確認用）
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "PubmedPipeline")
+
+# 単位
+MILLISECONDS = "Milliseconds"
+BYTES = "Bytes"
+COUNT = "Count"
+COUNT_PER_SECOND = "Count/Second"
+PERCENT = "Percent"
+
+_defaults = {"stage": "unknown", "term": "all"}
+_local = threading.local()
+_write_lock = threading.Lock()
+# 前回出力した時点のキャッシュの統計（呼び出しごとの差分を出力する）
+_cache_stats_snapshot: Dict[str, Dict[str, int]] = {}
+
+
+def enabled() -> bool:
+    return os.environ.get("METRICS_DISABLED", "").lower() not in ("1", "true", "yes")
+
+
+def current_dimensions() -> Dict[str, str]:
+    """現在のスレッドの処理段階（Stage）と検索語（Term）"""
+    return {
+        "Stage": getattr(_local, "stage", None) or _defaults["stage"],
+        "Term": getattr(_local, "term", None) or _defaults["term"],
+    }
+
+
+@contextmanager
+def scope(stage: Optional[str] = None, term: Optional[str] = None) -> Iterator[None]:
+    """ブロック内で出力するメトリクスの処理段階・検索語を設定（スレッドごと）"""
+    previous = (getattr(_local, "stage", None), getattr(_local, "term", None))
+    if stage:
+        _local.stage = stage
+    if term:
+        _local.term = s3_layout.safe_term(term)
+    try:
+        yield
+    finally:
+        _local.stage, _local.term = previous
+
+
+def emit(
+    values: Dict[str, Tuple[float, str]],
+    dimensions: Optional[Dict[str, str]] = None,
+    **properties: Any,
+) -> Optional[Dict[str, Any]]:
+    """
+    メトリクス（名前 → (値, 単位)）を1つのEMFレコードとして出力
+    dimensionsを省略した場合は現在の処理段階・検索語をディメンションとする
+    """
+    if not enabled() or not values:
+        return None
+
+    dimensions = dimensions or current_dimensions()
+    record: Dict[str, Any] = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()],
+                }
+            ],
+        },
+        **dimensions,
+        **properties,
+    }
+    for name, (value, _) in values.items():
+        record[name] = round(value, 3) if isinstance(value, float) else value
+
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _write_lock:
+        print(line)
+        metrics_file = os.environ.get("METRICS_FILE")
+        if metrics_file:
+            with open(metrics_file, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    return record
+
+
+@contextmanager
+def timer(name: str, **properties: Any) -> Iterator[Dict[str, Tuple[float, str]]]:
+    """
+    ブロックの所要時間をミリ秒で計測して出力
+    yieldされる辞書に追加したメトリクス（バイト数など）も同じレコードに含める
+    """
+    values: Dict[str, Tuple[float, str]] = {}
+    started = time.perf_counter()
+    try:
+        yield values
+    finally:
+        values[name] = ((time.perf_counter() - started) * 1000, MILLISECONDS)
+        emit(values, **properties)
+
+
+def record_llm_call(started: float, response: Any, **properties: Any) -> None:
+    """LLM呼び出しのレイテンシとトークン数を出力（startedはtime.perf_counter()の値）"""
+    usage = getattr(response, "usage", None)
+    emit(
+        {
+            "LlmLatency": ((time.perf_counter() - started) * 1000, MILLISECONDS),
+            "PromptTokens": (getattr(usage, "prompt_tokens", 0) or 0, COUNT),
+            "CompletionTokens": (getattr(usage, "completion_tokens", 0) or 0, COUNT),
+        },
+        **properties,
+    )
+
+
+def emit_cache_stats() -> None:
+    """前回の出力以降のキャッシュのヒット・ミス数とヒット率を名前空間ごとに出力"""
+    from pubmed_common import cache
+
+    # キャッシュを使用していない場合は作成しない
+    if not cache.get_cache.cache_info().currsize:
+        return
+
+    stats = cache.get_cache().stats
+    for namespace, counts in stats.items():
+        previous = _cache_stats_snapshot.get(namespace, {})
+        hits = sum(
+            counts.get(event, 0) - previous.get(event, 0)
+            for event in ("memory_hits", "disk_hits", "s3_hits")
+        )
+        misses = counts.get("misses", 0) - previous.get("misses", 0)
+        _cache_stats_snapshot[namespace] = dict(counts)
+        if hits + misses == 0:
+            continue
+
+        emit(
+            {
+                "CacheHits": (hits, COUNT),
+                "CacheMisses": (misses, COUNT),
+                "CacheHitRate": (hits * 100.0 / (hits + misses), PERCENT),
+            },
+            dimensions={"Stage": current_dimensions()["Stage"], "Namespace": namespace},
+        )
+
+
+def event_term(event: Any) -> Optional[str]:
+    """イベントの検索語、または入力キーに含まれる検索語を取得"""
+    if not isinstance(event, dict):
+        return None
+    if event.get("search_term"):
+        return event["search_term"]
+    for field in ("key", "output_key", "input_key"):
+        info = s3_layout.parse_key(event.get(field) or "")
+        if info:
+            return info["term"]
+    return None
+
+
+def instrument_handler(stage: str) -> Callable:
+    """
+    ハンドラーの所要時間（エンドツーエンド）・エラー数・キャッシュのヒット率を出力するデコレーター
+    ハンドラー内で出力するメトリクスには処理段階と検索語のディメンションが付与される
+    """
+
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            # ハンドラー内で作成したスレッドにも処理段階が付与されるよう既定値を設定
+            _defaults["stage"] = stage
+            started = time.perf_counter()
+            status: Any = "error"
+            with scope(stage=stage, term=event_term(event)):
+                try:
+                    result = handler(event, context)
+                    status = result.get("statusCode", 200) if isinstance(result, dict) else 200
+                    return result
+                finally:
+                    duration = (time.perf_counter() - started) * 1000
+                    failed = status == "error" or (isinstance(status, int) and status >= 500)
+                    emit(
+                        {
+                            "HandlerDuration": (duration, MILLISECONDS),
+                            "HandlerErrors": (1 if failed else 0, COUNT),
+                        },
+                        StatusCode=status,
+                        RequestId=getattr(context, "aws_request_id", None),
+                    )
+                    emit_cache_stats()
+
+        return wrapper
+
+    return decorator
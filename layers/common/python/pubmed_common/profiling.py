@@ -0,0 +1,218 @@
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from pubmed_common import s3_layout
+
+# ハンドラー呼び出し単位のプロファイリング（cProfileとtracemalloc）
+# イベントの "profile" フィールド、または環境変数PROFILE_HANDLERSで有効化する
+#   {"profile": true} / {"profile": {"top_n": 50}}
+#   PROFILE_HANDLERS=1（全ハンドラー）/ PROFILE_HANDLERS=fetch,analyze（処理段階を指定）
+# 結果はPROFILE_DIR（ローカル）またはBUCKET_NAMEのS3バケット（profiles/配下）に保存し、要約をログに出力する
+# 無効な場合はイベントと環境変数の確認のみでハンドラーを呼び出す
+
+DEFAULT_TOP_N = 25
+# tracemallocで保存するスタックフレーム数（多いほどオーバーヘッドが大きい）
+TRACEMALLOC_FRAMES = 10
+# ログに出力する要約の行数
+LOG_SUMMARY_LINES = 10
+
+
+def profile_options(stage: str, event: Any) -> Optional[Dict[str, Any]]:
+    """プロファイリングの設定を取得（無効な場合はNone）"""
+    requested = event.get("profile") if isinstance(event, dict) else None
+    if requested is None:
+        handlers = os.environ.get("PROFILE_HANDLERS", "").lower()
+        if not handlers or handlers in ("0", "false", "no"):
+            return None
+        names = {name.strip() for name in handlers.split(",")}
+        if not names & {"1", "true", "yes", "all", stage}:
+            return None
+        requested = True
+    if not requested:
+        return None
+
+    options = requested if isinstance(requested, dict) else {}
+    return {
+        "top_n": int(options.get("top_n") or os.environ.get("PROFILE_TOP_N") or DEFAULT_TOP_N),
+        "memory": bool(options.get("memory", True)),
+    }
+
+
+def cpu_report(profiler: cProfile.Profile, top_n: int) -> Dict[str, Any]:
+    """累積時間の上位の関数を集計"""
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, _) in stats.stats.items():
+        rows.append(
+            {
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": nc,
+                "primitive_calls": cc,
+                "total_seconds": round(tt, 6),
+                "cumulative_seconds": round(ct, 6),
+            }
+        )
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(top_n)
+    return {
+        "total_calls": stats.total_calls,
+        "total_seconds": round(stats.total_tt, 6),
+        "top_functions": rows[:top_n],
+        "text": text.getvalue(),
+    }
+
+
+def memory_report(snapshot: tracemalloc.Snapshot, peak: int, top_n: int) -> Dict[str, Any]:
+    """確保されたままのメモリが多い箇所（行単位）を集計"""
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ]
+    )
+    statistics = snapshot.statistics("lineno")
+    return {
+        "peak_bytes": peak,
+        "retained_bytes": sum(stat.size for stat in statistics),
+        "top_allocations": [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_bytes": stat.size,
+                "count": stat.count,
+            }
+            for stat in statistics[:top_n]
+        ],
+    }
+
+
+def save_report(stage: str, report: Dict[str, Any], profiler: cProfile.Profile) -> List[str]:
+    """レポート（JSON）とcProfileの生データ（.prof）を保存し、保存先を返す"""
+    now = datetime.now()
+    name = f"{now.strftime('%Y%m%dT%H%M%S%f')}_{report.get('request_id') or 'local'}"
+    body = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+
+    profile_dir = os.environ.get("PROFILE_DIR")
+    if profile_dir:
+        directory = os.path.join(profile_dir, stage)
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, f"{name}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+        return [json_path, os.path.join(directory, f"{name}.prof")]
+
+    bucket = os.environ.get("BUCKET_NAME")
+    if not bucket:
+        return []
+
+    from pubmed_common import clients
+
+    # dump_statsはファイルにのみ書き出すため/tmpを経由する
+    prof_path = f"/tmp/{name}.prof"
+    profiler.dump_stats(prof_path)
+    try:
+        with open(prof_path, "rb") as f:
+            prof_data = f.read()
+    finally:
+        os.remove(prof_path)
+
+    s3 = clients.get_s3()
+    saved = []
+    for suffix, data, content_type in (
+        ("json", body.encode("utf-8"), "application/json"),
+        ("prof", prof_data, "application/octet-stream"),
+    ):
+        key = s3_layout.profile_key(stage, now.date(), f"{name}.{suffix}")
+        s3.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+        saved.append(f"s3://{bucket}/{key}")
+    return saved
+
+
+def log_summary(stage: str, report: Dict[str, Any]) -> None:
+    """プロファイルの要約をログに出力"""
+    cpu = report["cpu"]
+    print(
+        f"Profile of {stage}: {report['wall_seconds']:.3f}s wall, "
+        f"{cpu['total_calls']} calls, {cpu['total_seconds']:.3f}s profiled"
+    )
+    for row in cpu["top_functions"][:LOG_SUMMARY_LINES]:
+        print(
+            f"  {row['cumulative_seconds']:>9.4f}s cum {row['total_seconds']:>9.4f}s self "
+            f"{row['calls']:>8} calls  {row['function']}"
+        )
+
+    memory = report.get("memory")
+    if memory:
+        print(
+            f"Memory of {stage}: peak {memory['peak_bytes'] / 1024 / 1024:.1f} MiB, "
+            f"retained {memory['retained_bytes'] / 1024 / 1024:.1f} MiB"
+        )
+        for row in memory["top_allocations"][:LOG_SUMMARY_LINES]:
+            print(
+                f"  {row['size_bytes'] / 1024:>10.1f} KiB {row['count']:>8} blocks  "
+                f"{row['location']}"
+            )
+
+
+def profile_handler(stage: str) -> Callable:
+    """
+    ハンドラーの呼び出しをcProfileとtracemallocで計測するデコレーター
+    計測やレポートの保存に失敗してもハンドラーの結果には影響させない
+    """
+
+    def decorator(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            options = profile_options(stage, event)
+            if options is None:
+                return handler(event, context)
+
+            started_tracing = options["memory"] and not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            if options["memory"]:
+                tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                profiler.disable()
+                wall_seconds = time.perf_counter() - started
+                snapshot, peak = None, 0
+                if options["memory"]:
+                    snapshot = tracemalloc.take_snapshot()
+                    peak = tracemalloc.get_traced_memory()[1]
+                if started_tracing:
+                    tracemalloc.stop()
+
+                try:
+                    report: Dict[str, Any] = {
+                        "stage": stage,
+                        "request_id": getattr(context, "aws_request_id", None),
+                        "profiled_at": datetime.now().isoformat(),
+                        "wall_seconds": round(wall_seconds, 6),
+                        "cpu": cpu_report(profiler, options["top_n"]),
+                    }
+                    if snapshot is not None:
+                        report["memory"] = memory_report(snapshot, peak, options["top_n"])
+                    log_summary(stage, report)
+                    for location in save_report(stage, report, profiler):
+                        print(f"Profile saved to {location}")
+                except Exception as e:
+                    print(f"Error saving profile of {stage}: {str(e)}")
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,328 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator, List, Optional, Tuple
+
+from pubmed_common import clients, metrics, s3_layout
+
+# OpenAIのアカウント単位のクォータ（1分あたりのリクエスト数・トークン数）を全Lambdaで共有するトークンバケット
+# LLMを呼び出す前にリクエスト1件とトークン数（プロンプト + max_tokens、OpenAIの計上方法と同じ）の枠を取得し、
+# 枠が足りない場合は補充されるまで待機する
+# 検索語ごとにもバケットを持ち、1つの検索語がクォータのRATE_LIMIT_TERM_SHAREを超えて使わないようにする
+# バックエンド（RATE_LIMIT_BACKEND）:
+#   dynamodb: DynamoDBテーブル（RATE_LIMIT_TABLE、本番用）
+#   sqlite: SQLiteファイル（RATE_LIMIT_SQLITE_PATH、同じマシン上の複数プロセスで共有）
+#   memory: プロセス内（テスト・単一プロセスのローカル実行用）
+# OPENAI_RPM・OPENAI_TPMがいずれも未設定の場合は制限しない
+
+# バケットの容量（何秒分の補充量までまとめて送信できるか）
+DEFAULT_BURST_SECONDS = 10
+DEFAULT_TERM_SHARE = 0.5
+# 待機の上限（超えた場合は枠を取得せずに送信し、OpenAIクライアントのリトライに任せる）
+DEFAULT_MAX_WAIT_SECONDS = 120
+# 待機中に枠を再確認する間隔の上限
+MAX_POLL_SECONDS = 2.0
+# DynamoDBの検索語ごとのバケットを削除するまでの時間（TTL）
+ITEM_TTL_SECONDS = 86400
+# DynamoDBの条件付き書き込みが競合した場合のリトライ回数と初回の待機秒数（指数的に増やす）
+DYNAMODB_MAX_RETRIES = 5
+DYNAMODB_BACKOFF_SECONDS = 0.02
+
+# (バケット名, 取得量, 毎秒の補充量, 容量)
+Bucket = Tuple[str, float, float, float]
+
+
+def refill(tokens: float, updated_at: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated_at) * rate)
+
+
+def take_tokens(
+    tokens: float, amount: float, rate: float, capacity: float
+) -> Tuple[Optional[float], float]:
+    """
+    取得後の残量（取得できない場合はNone）と、取得できるまでの待機秒数
+    容量を超える取得量はバケットが満杯のときに取得し、残量を負にする（以降の取得が補充を待つ）
+    """
+    need = min(amount, capacity)
+    if tokens >= need:
+        return tokens - amount, 0.0
+    return None, (need - tokens) / rate
+
+
+def give_back_tokens(tokens: float, amount: float, capacity: float) -> float:
+    """取得した枠を使わなかった場合に戻した後の残量（容量を超えない）"""
+    return min(capacity, tokens + amount)
+
+
+class MemoryBackend:
+    """プロセス内のトークンバケット"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def take(self, name: str, amount: float, rate: float, capacity: float) -> float:
+        with self.lock:
+            now = time.time()
+            tokens, updated_at = self.buckets.get(name, (capacity, now))
+            tokens = refill(tokens, updated_at, now, rate, capacity)
+            remaining, wait = take_tokens(tokens, amount, rate, capacity)
+            self.buckets[name] = (tokens if remaining is None else remaining, now)
+            return wait
+
+    def give_back(self, name: str, amount: float, rate: float, capacity: float) -> None:
+        with self.lock:
+            now = time.time()
+            tokens, updated_at = self.buckets.get(name, (capacity, now))
+            tokens = refill(tokens, updated_at, now, rate, capacity)
+            self.buckets[name] = (give_back_tokens(tokens, amount, capacity), now)
+
+    def drain(self, name: str) -> None:
+        with self.lock:
+            self.buckets[name] = (0.0, time.time())
+
+
+class SQLiteBackend:
+    """SQLiteファイル上のトークンバケット（BEGIN IMMEDIATEでプロセス間の更新を直列化）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _update(self, name: str, compute) -> float:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)
+            ).fetchone()
+            now = time.time()
+            tokens, wait = compute(row, now)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (name, tokens, now),
+            )
+            connection.execute("COMMIT")
+            return wait
+        finally:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            connection.close()
+
+    def take(self, name: str, amount: float, rate: float, capacity: float) -> float:
+        def compute(row, now: float) -> Tuple[float, float]:
+            tokens = capacity if row is None else refill(row[0], row[1], now, rate, capacity)
+            remaining, wait = take_tokens(tokens, amount, rate, capacity)
+            return (tokens if remaining is None else remaining), wait
+
+        return self._update(name, compute)
+
+    def give_back(self, name: str, amount: float, rate: float, capacity: float) -> None:
+        def compute(row, now: float) -> Tuple[float, float]:
+            tokens = capacity if row is None else refill(row[0], row[1], now, rate, capacity)
+            return give_back_tokens(tokens, amount, capacity), 0.0
+
+        self._update(name, compute)
+
+    def drain(self, name: str) -> None:
+        self._update(name, lambda row, now: (0.0, 0.0))
+
+
+class DynamoDBBackend:
+    """
+    DynamoDBテーブル上のトークンバケット（パーティションキー bucket_id）
+    更新時刻を条件とした条件付き書き込みで、同時に取得した場合は読み直して再計算する
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+
+    def _item(self, name: str, tokens: float, now: float) -> dict:
+        return {
+            "bucket_id": {"S": name},
+            "tokens": {"N": f"{tokens:.6f}"},
+            "updated_at": {"N": f"{now:.6f}"},
+            "expires_at": {"N": str(int(now) + ITEM_TTL_SECONDS)},
+        }
+
+    def _update(self, name: str, rate: float, capacity: float, compute) -> float:
+        """
+        補充後の残量からcomputeで新しい残量と待機秒数を計算して書き込む
+        新しい残量がNoneの場合は書き込まずに待機秒数を返す
+        競合が続いてリトライの上限に達した場合はRuntimeErrorを送出する（acquireは制限せずに送信する）
+        """
+        dynamodb = clients.get_dynamodb()
+        for retry in range(DYNAMODB_MAX_RETRIES):
+            item = dynamodb.get_item(
+                TableName=self.table, Key={"bucket_id": {"S": name}}, ConsistentRead=True
+            ).get("Item")
+            now = time.time()
+            if item:
+                tokens = refill(
+                    float(item["tokens"]["N"]),
+                    float(item["updated_at"]["N"]),
+                    now,
+                    rate,
+                    capacity,
+                )
+                condition = {
+                    "ConditionExpression": "updated_at = :previous",
+                    "ExpressionAttributeValues": {":previous": item["updated_at"]},
+                }
+            else:
+                tokens = capacity
+                condition = {"ConditionExpression": "attribute_not_exists(bucket_id)"}
+
+            updated, wait = compute(tokens)
+            if updated is None:
+                return wait
+            try:
+                dynamodb.put_item(
+                    TableName=self.table, Item=self._item(name, updated, now), **condition
+                )
+                return wait
+            except dynamodb.exceptions.ConditionalCheckFailedException:
+                time.sleep(DYNAMODB_BACKOFF_SECONDS * 2**retry * random.uniform(0.5, 1.5))
+        raise RuntimeError(f"Too many conflicting updates of {name}")
+
+    def take(self, name: str, amount: float, rate: float, capacity: float) -> float:
+        return self._update(
+            name, rate, capacity, lambda tokens: take_tokens(tokens, amount, rate, capacity)
+        )
+
+    def give_back(self, name: str, amount: float, rate: float, capacity: float) -> None:
+        self._update(
+            name, rate, capacity, lambda tokens: (give_back_tokens(tokens, amount, capacity), 0.0)
+        )
+
+    def drain(self, name: str) -> None:
+        clients.get_dynamodb().put_item(
+            TableName=self.table, Item=self._item(name, 0.0, time.time())
+        )
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    """環境変数で指定されたバックエンド（RATE_LIMIT_TABLEがある場合のデフォルトはdynamodb）"""
+    default = "dynamodb" if os.environ.get("RATE_LIMIT_TABLE") else "memory"
+    backend = os.environ.get("RATE_LIMIT_BACKEND", default)
+    if backend == "dynamodb":
+        return DynamoDBBackend(os.environ["RATE_LIMIT_TABLE"])
+    if backend == "sqlite":
+        return SQLiteBackend(os.environ.get("RATE_LIMIT_SQLITE_PATH", "/tmp/rate_limit.sqlite"))
+    if backend == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown rate limit backend: {backend}")
+
+
+def _quota(name: str) -> Optional[float]:
+    value = os.environ.get(name, "").strip()
+    return float(value) if value else None
+
+
+def enabled() -> bool:
+    return bool(_quota("OPENAI_RPM") or _quota("OPENAI_TPM"))
+
+
+def buckets(tokens: int, term: Optional[str] = None) -> List[Bucket]:
+    """取得するバケット（検索語ごとのバケットを先に取得し、全体の枠を検索語の待機中に消費しない）"""
+    burst = float(os.environ.get("RATE_LIMIT_BURST_SECONDS", DEFAULT_BURST_SECONDS))
+    share = float(os.environ.get("RATE_LIMIT_TERM_SHARE", DEFAULT_TERM_SHARE))
+
+    term_buckets: List[Bucket] = []
+    global_buckets: List[Bucket] = []
+    for kind, quota, amount in (
+        ("requests", _quota("OPENAI_RPM"), 1),
+        ("tokens", _quota("OPENAI_TPM"), tokens),
+    ):
+        if not quota:
+            continue
+        rate = quota / 60
+        global_buckets.append((f"openai:{kind}", amount, rate, rate * burst))
+        if term and share < 1:
+            name = f"term:{s3_layout.safe_term(term)}:{kind}"
+            term_buckets.append((name, amount, rate * share, rate * share * burst))
+    return term_buckets + global_buckets
+
+
+def acquire(tokens: int, term: Optional[str] = None) -> float:
+    """
+    リクエスト1件とtokensトークンの枠を取得し、待機した秒数を返す
+    待機の上限を超える場合やバックエンドが使えない場合は、枠を取得せずに送信する
+    （取得済みの検索語ごと・全体の枠は戻し、送信しなかった分を他の呼び出しが使えるようにする）
+    """
+    specs = buckets(tokens, term)
+    if not specs:
+        return 0.0
+
+    max_wait = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS", DEFAULT_MAX_WAIT_SECONDS))
+    started = time.monotonic()
+    taken: List[Bucket] = []
+    try:
+        for spec in specs:
+            name, amount, rate, capacity = spec
+            while True:
+                wait = get_backend().take(name, amount, rate, capacity)
+                if wait <= 0:
+                    break
+                if time.monotonic() - started + wait > max_wait:
+                    raise TimeoutError(f"{name} needs {wait:.1f}s more")
+                # 同時に待機している呼び出しが一斉に再試行しないよう、待機時間をばらつかせる
+                time.sleep(min(wait, MAX_POLL_SECONDS) * random.uniform(1.0, 1.2))
+            taken.append(spec)
+    except Exception as e:
+        print(f"Sending without a rate limit slot: {str(e)}")
+        give_back(taken)
+
+    waited = time.monotonic() - started
+    metrics.emit({"RateLimitWait": (waited * 1000, metrics.MILLISECONDS)})
+    return waited
+
+
+def give_back(taken: List[Bucket]) -> None:
+    """取得したが使わなかった枠をバケットに戻す"""
+    for name, amount, rate, capacity in taken:
+        try:
+            get_backend().give_back(name, amount, rate, capacity)
+        except Exception as e:
+            print(f"Failed to give back {name}: {str(e)}")
+
+
+def throttled() -> None:
+    """OpenAIが429を返した場合に全体のバケットを空にし、全Lambdaの送信を補充まで止める"""
+    metrics.emit({"RateLimitThrottles": (1, metrics.COUNT)})
+    for name, _, _, _ in buckets(0):
+        try:
+            get_backend().drain(name)
+        except Exception as e:
+            print(f"Failed to drain {name}: {str(e)}")
+
+
+@contextmanager
+def slot(prompt: str, max_tokens: int, term: Optional[str] = None) -> Iterator[None]:
+    """LLM呼び出しの前に枠を取得し、呼び出しが429で失敗した場合は全体のバケットを空にする"""
+    if not enabled():
+        yield
+        return
+
+    acquire(len(clients.get_encoding().encode(prompt)) + max_tokens, term)
+    try:
+        yield
+    except Exception as e:
+        if getattr(e, "status_code", None) == 429:
+            throttled()
+        raise
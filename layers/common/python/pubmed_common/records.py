@@ -0,0 +1,159 @@
+import json
+import sys
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, Optional
+
+# 論文データ（取得結果のarticlesの各要素）のコンパクトな表現
+# 大量の論文を保持する過去分の取得・分析で、論文ごとの辞書・リストと重複する文字列のメモリを削減する
+# ジャーナル名・著者名・出版タイプ等は同じ文字列を共有し（sys.intern）、取得日時はEFetchの呼び出しごとに共有する
+
+# 取得結果のJSONのフィールド（この順序で出力する）
+FIELDS = (
+    "pmid",
+    "title",
+    "abstract",
+    "authors",
+    "journal",
+    "publication_year",
+    "publication_types",
+    "fetch_date",
+)
+_FIELD_SET = frozenset(FIELDS)
+
+# 要素を共有するリストのフィールド（タプルとして保持する）
+_LIST_FIELDS = ("authors", "publication_types")
+
+# 元のJSONにないフィールド
+_ABSENT = object()
+
+
+def _share(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def _share_list(value: Any) -> Any:
+    if isinstance(value, (list, tuple)) and all(type(item) is str for item in value):
+        return tuple(sys.intern(item) for item in value)
+    return value
+
+
+class Article(Mapping):
+    """
+    1つの論文データ（読み取り専用の辞書として参照できる）
+    authors・publication_typesはタプルで返す。JSONに変換する場合はto_dictを使う
+    """
+
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(
+        self,
+        pmid: str,
+        title: str,
+        abstract: str,
+        authors: Any,
+        journal: str,
+        publication_year: str,
+        publication_types: Any = _ABSENT,
+        fetch_date: Any = _ABSENT,
+        extra: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        self.pmid = _share(pmid)
+        self.title = title
+        self.abstract = abstract
+        self.authors = _share_list(authors)
+        self.journal = _share(journal)
+        self.publication_year = _share(publication_year)
+        self.publication_types = _share_list(publication_types)
+        self.fetch_date = _share(fetch_date)
+        # 既知のフィールド以外（将来追加されたフィールド等）はそのまま保持する
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, data: Mapping, pmid: Optional[str] = None) -> "Article":
+        """取得結果のJSONの論文データから作成（Articleの場合はそのまま返す）"""
+        if isinstance(data, Article):
+            return data
+        get = data.get
+        extra = {key: value for key, value in data.items() if key not in _FIELD_SET}
+        return cls(
+            # 辞書のキーと同じPMIDの場合はキーの文字列を共有する
+            pmid if pmid is not None and get("pmid") == pmid else get("pmid", _ABSENT),
+            get("title", _ABSENT),
+            get("abstract", _ABSENT),
+            get("authors", _ABSENT),
+            get("journal", _ABSENT),
+            get("publication_year", _ABSENT),
+            get("publication_types", _ABSENT),
+            get("fetch_date", _ABSENT),
+            extra,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """取得結果のJSONの形式に変換（from_dictの入力と同じ内容になる）"""
+        data = {}
+        for field in FIELDS:
+            value = getattr(self, field)
+            if value is _ABSENT:
+                continue
+            data[field] = list(value) if field in _LIST_FIELDS and type(value) is tuple else value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            value = getattr(self, key)
+            if value is not _ABSENT:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        for field in FIELDS:
+            if getattr(self, field) is not _ABSENT:
+                yield field
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __reduce__(self) -> Any:
+        # プロセス間の受け渡しでは辞書として送り、受け取った側で文字列を共有し直す
+        return Article.from_dict, (self.to_dict(),)
+
+    def __repr__(self) -> str:
+        return f"Article(pmid={self.pmid!r}, title={self.title!r})"
+
+
+def from_json(articles: Mapping) -> Dict[str, Article]:
+    """取得結果のarticles（PMIDをキーとする辞書）をArticleに変換"""
+    return {pmid: Article.from_dict(article, pmid) for pmid, article in articles.items()}
+
+
+def _object_hook(data: Dict[str, Any]) -> Any:
+    return Article.from_dict(data) if "pmid" in data and "abstract" in data else data
+
+
+def loads(body: Any) -> Any:
+    """
+    取得結果のJSONを読み込み、論文データをArticleとして返す
+    論文ごとに変換するため、すべての論文の辞書を同時に保持しない
+    """
+    return json.loads(body, object_hook=_object_hook)
+
+
+def to_json(articles: Mapping) -> Dict[str, Dict[str, Any]]:
+    """Articleの辞書を取得結果のarticlesの形式に変換"""
+    return {
+        pmid: article.to_dict() if isinstance(article, Article) else dict(article)
+        for pmid, article in articles.items()
+    }
+
+
+def json_default(value: Any) -> Any:
+    """json.dumpsのdefault（ArticleをJSONの論文データとして出力する）"""
+    if isinstance(value, Article):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,285 @@
+import json
+import random
+import re
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+# 成果物の種類ごとのルートプレフィックス
+# キーは {ルート}/{検索語}/{yyyy}/{mm}/{dd}/{ファイル名} の形式で日付パーティション化する
+RAW_ROOT = "raw"
+ANALYSIS_ROOT = "analysis"
+TRANSLATION_ROOT = "translation"
+WEEKLY_ROOT = "weekly"
+MANIFEST_ROOT = "manifests"
+CANDIDATE_ROOT = "candidates"
+LEDGER_ROOT = "ledger"
+CACHE_ROOT = "cache"
+PROFILE_ROOT = "profiles"
+CONFIG_ROOT = "config"
+BUDGET_ROOT = "budget"
+INDEX_ROOT = "index"
+COLUMNAR_ROOT = "columnar"
+
+# 検索語レジストリ（検索語ごとの検索式・実行頻度・優先度）のキー
+TERM_REGISTRY_KEY = f"{CONFIG_ROOT}/terms.json"
+# 論文索引（SQLite）の現在のスナップショットを指すポインタのキー
+ARTICLE_INDEX_KEY = f"{INDEX_ROOT}/articles.json"
+
+# 旧形式（バケット直下）のファイル名パターン
+LEGACY_DAILY_PATTERN = re.compile(
+    r"^pubmed_(?P<term>.+)_(?P<date>\d{8})(?P<suffix>_jp_analysis|_analysis)?\.json$"
+)
+LEGACY_WEEKLY_PATTERN = re.compile(r"^weekly_critical_(?:(?P<term>.+)_)?(?P<date>\d{8})\.json$")
+
+# パーティション化されたキーのパターン
+PARTITIONED_PATTERN = re.compile(
+    r"^(?P<root>[^/]+)/(?P<term>[^/]+)/(?P<yyyy>\d{4})/(?P<mm>\d{2})/(?P<dd>\d{2})/(?P<name>[^/]+)$"
+)
+
+_SUFFIX_TO_ROOT = {
+    None: RAW_ROOT,
+    "_analysis": ANALYSIS_ROOT,
+    "_jp_analysis": TRANSLATION_ROOT,
+}
+
+# マニフェストなどの条件付き書き込みで競合した場合のリトライ回数
+CONDITIONAL_WRITE_MAX_RETRIES = 5
+# 競合後に再読み込みするまでの待ち時間（秒、リトライごとに増やし、ばらつかせる）
+CONDITIONAL_WRITE_BACKOFF_SECONDS = 0.05
+
+
+def safe_term(search_term: str) -> str:
+    """検索語をキーに使用できる形式に変換"""
+    return search_term.lower().replace(" ", "_").replace("/", "_").replace("\\", "_")
+
+
+def partition_prefix(root: str, search_term: str, day: date) -> str:
+    """日付パーティションのプレフィックスを生成"""
+    return f"{root}/{safe_term(search_term)}/{day.strftime('%Y/%m/%d')}/"
+
+
+def raw_key(search_term: str, day: date) -> str:
+    """論文取得結果のキーを生成"""
+    term = safe_term(search_term)
+    return f"{partition_prefix(RAW_ROOT, term, day)}pubmed_{term}_{day.strftime('%Y%m%d')}.json"
+
+
+def analysis_key(input_key: str) -> str:
+    """論文取得結果のキーから分析結果のキーを生成"""
+    if input_key.startswith(f"{RAW_ROOT}/"):
+        input_key = f"{ANALYSIS_ROOT}/{input_key[len(RAW_ROOT) + 1:]}"
+    return input_key.replace(".json", "_analysis.json")
+
+
+def translation_key(input_key: str) -> str:
+    """分析結果のキーから翻訳結果のキーを生成"""
+    if input_key.startswith(f"{ANALYSIS_ROOT}/"):
+        input_key = f"{TRANSLATION_ROOT}/{input_key[len(ANALYSIS_ROOT) + 1:]}"
+    return input_key.replace("_analysis.json", "_jp_analysis.json")
+
+
+def weekly_key(search_term: Optional[str], day: date) -> str:
+    """週次レポートのキーを生成（検索語がない場合は全検索語を対象とするレポート）"""
+    date_str = day.strftime("%Y%m%d")
+    if not search_term:
+        return f"{partition_prefix(WEEKLY_ROOT, 'all', day)}weekly_critical_{date_str}.json"
+    term = safe_term(search_term)
+    return f"{partition_prefix(WEEKLY_ROOT, term, day)}weekly_critical_{term}_{date_str}.json"
+
+
+def manifest_key(search_term: str) -> str:
+    """検索語ごとのマニフェストのキーを生成"""
+    return f"{MANIFEST_ROOT}/{safe_term(search_term)}.json"
+
+
+def parse_key(key: str) -> Optional[Dict[str, Any]]:
+    """
+    キーから成果物の種類・検索語・日付を取得
+    パーティション形式と旧形式（バケット直下）の両方に対応し、解釈できない場合はNoneを返す
+    """
+    match = PARTITIONED_PATTERN.match(key)
+    if match:
+        try:
+            day = date(int(match["yyyy"]), int(match["mm"]), int(match["dd"]))
+        except ValueError:
+            return None
+        return {"root": match["root"], "term": match["term"], "date": day, "legacy": False}
+
+    match = LEGACY_DAILY_PATTERN.match(key)
+    if match:
+        root = _SUFFIX_TO_ROOT[match["suffix"]]
+    else:
+        match = LEGACY_WEEKLY_PATTERN.match(key)
+        if not match:
+            return None
+        root = WEEKLY_ROOT
+
+    try:
+        day = datetime.strptime(match["date"], "%Y%m%d").date()
+    except ValueError:
+        return None
+    return {"root": root, "term": match["term"] or "all", "date": day, "legacy": True}
+
+
+def partitioned_key(legacy_key: str) -> Optional[str]:
+    """旧形式のキーを対応するパーティション形式のキーに変換"""
+    info = parse_key(legacy_key)
+    if not info or not info["legacy"]:
+        return None
+    return f"{partition_prefix(info['root'], info['term'], info['date'])}{legacy_key}"
+
+
+def window_days(end: date, days: int = 7) -> List[date]:
+    """集計期間（end の days 日前から end まで）の日付リストを生成"""
+    return [end - timedelta(days=offset) for offset in range(days, -1, -1)]
+
+
+def candidate_store_key(search_term: str) -> str:
+    """検索語ごとの週次候補ストアのキーを生成"""
+    return f"{CANDIDATE_ROOT}/{safe_term(search_term)}.json"
+
+
+def ledger_key(stage: str, input_key: str) -> str:
+    """処理段階と入力ファイルのキーから処理台帳のエントリのキーを生成"""
+    return f"{LEDGER_ROOT}/{stage}/{input_key}"
+
+
+def cache_object_key(namespace: str, key: str) -> str:
+    """S3に保存するキャッシュエントリのキーを生成"""
+    return f"{CACHE_ROOT}/{namespace}/{key}"
+
+
+def profile_key(stage: str, day: date, name: str) -> str:
+    """処理段階ごとのプロファイリング結果のキーを生成"""
+    return f"{partition_prefix(PROFILE_ROOT, stage, day)}{name}"
+
+
+def budget_key(day: date) -> str:
+    """日ごとのLLMトークン・費用の予算の使用状況のキーを生成"""
+    return f"{BUDGET_ROOT}/{day.isoformat()}.json"
+
+
+def index_snapshot_key(name: str) -> str:
+    """論文索引のスナップショット（gzip圧縮したSQLiteファイル）のキーを生成"""
+    return f"{INDEX_ROOT}/snapshots/{name}.sqlite.gz"
+
+
+def columnar_meta_key(month: date) -> str:
+    """月ごとの列指向パーティションのメタデータ（辞書・入力のバージョン）のキーを生成"""
+    return f"{COLUMNAR_ROOT}/{month.strftime('%Y-%m')}/meta.json"
+
+
+def columnar_column_key(month: date, generation: str, column: str) -> str:
+    """列指向パーティションの世代ごとの列（NumPy配列）のキーを生成"""
+    return f"{COLUMNAR_ROOT}/{month.strftime('%Y-%m')}/{generation}/{column}.npy"
+
+
+def get_json_object(s3, bucket: str, key: str) -> Tuple[Optional[Any], Optional[str]]:
+    """JSONオブジェクトとETagを取得（存在しない場合はNoneとNone）"""
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(response["Body"].read().decode("utf-8")), response.get("ETag")
+
+
+def update_json_object(
+    s3, bucket: str, key: str, mutate: Callable[[Any], Any], default: Callable[[], Any]
+) -> Any:
+    """
+    JSONオブジェクトを読み込み、mutateで更新して書き戻す
+    同時更新による上書きを防ぐため、ETagによる条件付き書き込みでリトライする
+    リトライしても書き込めない場合はRuntimeErrorを送出する
+    """
+    for retry in range(CONDITIONAL_WRITE_MAX_RETRIES):
+        current, etag = get_json_object(s3, bucket, key)
+        updated = mutate(default() if current is None else current)
+
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=json.dumps(updated, ensure_ascii=False, sort_keys=True),
+                ContentType="application/json",
+                **condition,
+            )
+            return updated
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in ("PreconditionFailed", "ConditionalRequestConflict"):
+                raise
+            print(f"Write conflict for {key}, retry {retry + 1}/{CONDITIONAL_WRITE_MAX_RETRIES}")
+            time.sleep(CONDITIONAL_WRITE_BACKOFF_SECONDS * (retry + 1) * random.uniform(0.5, 1.5))
+
+    raise RuntimeError(f"Failed to update s3://{bucket}/{key}")
+
+
+def _empty_manifest(search_term: str) -> Dict[str, Any]:
+    return {"search_term": safe_term(search_term), "updated_at": None, "days": {}}
+
+
+def load_manifest(s3, bucket: str, search_term: str) -> Dict[str, Any]:
+    """検索語ごとのマニフェストを取得"""
+    manifest, _ = get_json_object(s3, bucket, manifest_key(search_term))
+    return manifest if manifest is not None else _empty_manifest(search_term)
+
+
+def merge_manifest(
+    s3, bucket: str, search_term: str, day_entries: Dict[str, Dict[str, str]]
+) -> Dict[str, Any]:
+    """マニフェストに日付ごとのエントリをまとめて反映"""
+
+    def mutate(manifest: Dict[str, Any]) -> Dict[str, Any]:
+        for day_str, entries in day_entries.items():
+            manifest["days"].setdefault(day_str, {}).update(entries)
+        manifest["updated_at"] = datetime.now().isoformat()
+        return manifest
+
+    return update_json_object(
+        s3, bucket, manifest_key(search_term), mutate, lambda: _empty_manifest(search_term)
+    )
+
+
+def update_manifest(s3, bucket: str, search_term: str, day: date, **entries: str) -> Dict[str, Any]:
+    """マニフェストの指定日のエントリを更新"""
+    return merge_manifest(s3, bucket, search_term, {day.isoformat(): entries})
+
+
+def list_manifest_terms(s3, bucket: str) -> List[str]:
+    """マニフェストが存在する検索語の一覧を取得"""
+    terms = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{MANIFEST_ROOT}/"):
+        for obj in page.get("Contents", []):
+            name = obj["Key"][len(MANIFEST_ROOT) + 1 :]
+            if name.endswith(".json"):
+                terms.append(name[: -len(".json")])
+    return terms
+
+
+def manifest_keys(manifest: Dict[str, Any], days: List[date], kind: str = "analysis") -> List[str]:
+    """マニフェストから指定期間・種類のキーを取得"""
+    keys = []
+    for day in days:
+        key = manifest.get("days", {}).get(day.isoformat(), {}).get(kind)
+        if key:
+            keys.append(key)
+    return keys
+
+
+def iter_partition_keys(
+    s3, bucket: str, root: str, search_term: str, days: List[date]
+) -> Iterator[str]:
+    """指定期間の日付パーティション配下のキーをページネーションしながら列挙"""
+    paginator = s3.get_paginator("list_objects_v2")
+    for day in days:
+        prefix = partition_prefix(root, search_term, day)
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"]
@@ -0,0 +1,84 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Tuple
+
+from pubmed_common import metrics
+
+# 並列取得のデフォルト設定
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_SLOW_THRESHOLD_SECONDS = 2.0
+
+
+def _fetch_json(s3, bucket: str, key: str) -> Tuple[Any, float, int]:
+    """1つのJSONオブジェクトを取得してパースし、所要時間・バイト数とともに返す"""
+    started = time.perf_counter()
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response["Body"].read()
+    data = json.loads(body.decode("utf-8"))
+    return data, time.perf_counter() - started, len(body)
+
+
+def load_json_objects(
+    s3,
+    bucket: str,
+    keys: List[str],
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    slow_threshold: float = DEFAULT_SLOW_THRESHOLD_SECONDS,
+    missing_ok: bool = False,
+) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    複数のJSONオブジェクトを上限付きスレッドプールで並列に取得・パース
+    取得できたデータ（キーの入力順）と、失敗したキーとエラー内容の組を返す
+    missing_ok=Trueの場合、存在しないキーは失敗として扱わずに読み飛ばす
+    s3クライアントは max_pool_connections を max_workers 以上に設定したものを共有すること
+    """
+    if not keys:
+        return {}, {}
+
+    loaded: Dict[str, Any] = {}
+    failures: Dict[str, str] = {}
+    slow_keys = []
+    total_bytes = 0
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        futures = {executor.submit(_fetch_json, s3, bucket, key): key for key in keys}
+
+        # 取得完了順にパースし、失敗したキーがあっても残りの処理を継続
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                data, elapsed, size = future.result()
+            except Exception as e:
+                error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+                if missing_ok and error_code in ("NoSuchKey", "404"):
+                    continue
+                print(f"Error loading s3://{bucket}/{key}: {str(e)}")
+                failures[key] = str(e)
+                continue
+
+            loaded[key] = data
+            total_bytes += size
+            if elapsed > slow_threshold:
+                slow_keys.append((key, elapsed))
+
+    for key, elapsed in sorted(slow_keys, key=lambda item: item[1], reverse=True):
+        print(f"Slow S3 load: s3://{bucket}/{key} took {elapsed:.2f}s")
+
+    duration = time.perf_counter() - started
+    print(
+        f"Loaded {len(loaded)}/{len(keys)} objects in {duration:.2f}s "
+        f"(workers: {min(max_workers, len(keys))}, failed: {len(failures)})"
+    )
+    metrics.emit(
+        {
+            "S3LoadLatency": (duration * 1000, metrics.MILLISECONDS),
+            "S3ObjectsLoaded": (len(loaded), metrics.COUNT),
+            "S3LoadBytes": (total_bytes, metrics.BYTES),
+            "S3LoadFailures": (len(failures), metrics.COUNT),
+        }
+    )
+
+    # 入力順を維持して返す
+    return {key: loaded[key] for key in keys if key in loaded}, failures
@@ -0,0 +1,118 @@
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from pubmed_common import s3_layout
+
+# 検索語レジストリ（S3の config/terms.json）
+# 検索語ごとに検索式（query）、実行頻度（cadence）、優先度（priority、小さいほど先に実行）を定義する
+# 例:
+# {
+#   "shard_size": 10,
+#   "stagger_seconds": 60,
+#   "terms": [
+#     {"term": "sepsis", "priority": 10},
+#     {"term": "ards", "query": "ards OR \"acute respiratory distress syndrome\"", "priority": 10},
+#     {"term": "ecmo", "cadence": "weekly", "weekly_report": false}
+#   ]
+# }
+
+# 実行頻度（daily: 毎日前日分を取得、weekly: 週次レポートの曜日に過去1週間分を取得、paused: 停止）
+CADENCES = ("daily", "weekly", "paused")
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+DEFAULT_PRIORITY = 100
+# 1つのメッセージ（Lambdaの1回の実行）で処理する検索語の数
+DEFAULT_SHARD_SIZE = 10
+# シャードごとの開始時刻のずらし幅
+DEFAULT_STAGGER_SECONDS = 60
+# SQSのDelaySecondsの上限（シャードが多い場合はずらし幅を縮めてこの範囲に収める）
+MAX_DELAY_SECONDS = 900
+
+
+def parse_term(entry: Any) -> Dict[str, Any]:
+    """レジストリの1件を正規化（文字列のみの場合は検索語として扱う）"""
+    if isinstance(entry, str):
+        entry = {"term": entry}
+    if not isinstance(entry, dict) or not str(entry.get("term") or "").strip():
+        raise ValueError(f"Invalid term entry: {entry!r}")
+
+    term = str(entry["term"]).strip().lower()
+    cadence = entry.get("cadence", "daily")
+    if cadence not in CADENCES:
+        raise ValueError(f"Invalid cadence for {term}: {cadence}")
+    return {
+        "term": term,
+        "query": str(entry.get("query") or term),
+        "cadence": cadence,
+        "priority": int(entry.get("priority", DEFAULT_PRIORITY)),
+        "weekly_report": bool(entry.get("weekly_report", True)),
+    }
+
+
+def parse_registry(data: Dict[str, Any]) -> Dict[str, Any]:
+    """レジストリのJSONを検証・正規化（同じ検索語が複数ある場合は後のものを使用）"""
+    weekly_day = str(data.get("weekly_day", "mon")).lower()
+    if weekly_day not in WEEKDAYS:
+        raise ValueError(f"Invalid weekly_day: {weekly_day}")
+    terms = {entry["term"]: entry for entry in map(parse_term, data.get("terms", []))}
+    return {
+        "terms": list(terms.values()),
+        "shard_size": max(1, int(data.get("shard_size", DEFAULT_SHARD_SIZE))),
+        "stagger_seconds": max(0, int(data.get("stagger_seconds", DEFAULT_STAGGER_SECONDS))),
+        "weekly_day": weekly_day,
+    }
+
+
+def default_registry(search_terms: List[str]) -> Dict[str, Any]:
+    """レジストリがない場合に使用する、検索語のみのレジストリ"""
+    return parse_registry({"terms": [term for term in search_terms if term.strip()]})
+
+
+def load_registry(s3, bucket: str, fallback_terms: List[str]) -> Dict[str, Any]:
+    """S3からレジストリを読み込む（存在しない場合はfallback_termsのみのレジストリ）"""
+    data, _ = s3_layout.get_json_object(s3, bucket, s3_layout.TERM_REGISTRY_KEY)
+    if data is None:
+        print(f"Term registry not found, using default terms: {', '.join(fallback_terms)}")
+        return default_registry(fallback_terms)
+    return parse_registry(data)
+
+
+def active_terms(registry: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """停止していない検索語（優先度順）"""
+    return sorted(
+        (entry for entry in registry["terms"] if entry["cadence"] != "paused"),
+        key=lambda entry: (entry["priority"], entry["term"]),
+    )
+
+
+def due_terms(registry: Dict[str, Any], job: str, day: date) -> List[Dict[str, Any]]:
+    """
+    指定日に実行する検索語（優先度順）
+    job="fetch"は論文取得、job="weekly"は週次レポートの対象（weekly_dayの曜日のみ）
+    """
+    is_weekly_day = WEEKDAYS[day.weekday()] == registry["weekly_day"]
+    if job == "weekly":
+        if not is_weekly_day:
+            return []
+        return [entry for entry in active_terms(registry) if entry["weekly_report"]]
+    return [
+        entry for entry in active_terms(registry) if entry["cadence"] == "daily" or is_weekly_day
+    ]
+
+
+def fetch_days(entry: Dict[str, Any]) -> int:
+    """1回の取得で遡る日数"""
+    return 7 if entry["cadence"] == "weekly" else 1
+
+
+def shard(entries: List[Any], size: int) -> List[List[Any]]:
+    return [entries[start : start + size] for start in range(0, len(entries), size)]
+
+
+def stagger_delays(
+    count: int, stagger_seconds: int, max_delay: Optional[int] = MAX_DELAY_SECONDS
+) -> List[int]:
+    """シャードごとの開始の遅延（秒）。先頭のシャード（優先度が最も高い）はすぐに開始する"""
+    if count > 1 and max_delay is not None:
+        stagger_seconds = min(stagger_seconds, max_delay // (count - 1))
+    return [index * stagger_seconds for index in range(count)]
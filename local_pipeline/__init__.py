@@ -0,0 +1,4 @@
+# デプロイせずにパイプラインのハンドラーをローカルで実行するためのツール
+# s3: ローカルディレクトリ上のS3互換ストア
+# workflow: Step Functionsのワークフロー（分割 → シャード分析 → 統合 → 翻訳）と同じ順序でハンドラーを実行
+# runner: 検索語 × 日付のパイプライン全体をプロセスプールで実行するCLI（python -m local_pipeline）
@@ -0,0 +1,5 @@
+import sys
+
+from local_pipeline.runner import main
+
+sys.exit(main())
@@ -0,0 +1,540 @@
+"""
+ローカルディレクトリ上のストアに対してパイプライン全体（取得 → 分析 → 翻訳 → 週次分析）を実行するランナー
+検索語 × 日付の処理をプロセスプールに分散し、依存する処理が終わったものから順に実行する
+出力済みの成果物がある処理は再実行しないため、中断しても同じコマンドで続きから再開できる
+
+使用例:
+    python -m local_pipeline --store ./pubmed-data --terms sepsis,ards --start 2025-01-01
+    python -m local_pipeline --store ./pubmed-data --registry config/terms.json --start 2025-01-01
+    python -m local_pipeline --store ./pubmed-data --start 2025-01-01 --end 2025-12-31 \\
+        --stages analyze,translate,weekly --force analyze --workers 8   # プロンプト変更後の再分析
+    python -m local_pipeline --store ./pubmed-data --start 2025-01-01 --openai-tpm 200000
+    python -m local_pipeline --store ./pubmed-data --start 2024-01-01 --stages fetch \
+        --parse-workers 4   # 過去分の取得でEFetchのXMLを並列に解析
+
+分析・翻訳・週次分析にはOPENAI_API_KEYが必要
+"""
+
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+from local_pipeline import workflow
+from local_pipeline.s3 import LocalS3
+
+workflow.setup_paths()
+
+from pubmed_common import ledger, s3_layout, term_registry  # noqa: E402
+
+STAGES = ["fetch", "analyze", "translate", "weekly"]
+
+# 処理段階ごとの同時実行数の上限（NCBI E-utilitiesはAPIキーなしで毎秒3リクエストまで）
+DEFAULT_STAGE_LIMITS = {"fetch": 2}
+
+# 処理台帳で重複を判定する処理段階
+LEDGER_STAGES = {"analyze": ledger.ANALYSIS_STAGE, "translate": ledger.TRANSLATION_STAGE}
+
+# 出力がなく、後続の処理を実行しない結果（deferredは予算の縮退による延期）
+NO_OUTPUT_STATUSES = {"no_articles", "no_input", "deferred"}
+# 失敗した（後続の処理を保留する）結果
+FAILED_STATUSES = {"failed", "blocked"}
+
+# ワーカープロセスごとのワークフローとストア（init_workerで初期化）
+_pipeline: Optional[workflow.Workflow] = None
+_store: Optional[LocalS3] = None
+
+
+def task_id(stage: str, search_term: str, day: date) -> str:
+    return f"{stage}:{search_term}:{day.isoformat()}"
+
+
+def output_key(stage: str, search_term: str, day: date) -> str:
+    """処理段階の出力（再開の判定に使う成果物）のキー"""
+    key: str
+    if stage == "weekly":
+        key = s3_layout.weekly_key(search_term, day)
+        return key
+    key = s3_layout.raw_key(search_term, day)
+    if stage in ("analyze", "translate"):
+        key = s3_layout.analysis_key(key)
+    if stage == "translate":
+        key = s3_layout.translation_key(key)
+    return key
+
+
+def input_key(stage: str, search_term: str, day: date) -> Optional[str]:
+    """処理段階の入力ファイルのキー（取得と週次分析はNone）"""
+    if stage not in ("analyze", "translate"):
+        return None
+    return output_key(STAGES[STAGES.index(stage) - 1], search_term, day)
+
+
+def exists(s3: Any, bucket: str, key: str) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+def report_days(days: List[date], weekday: int) -> List[date]:
+    """対象期間のうち週次レポートを作成する曜日（デプロイ時のスケジュールは月曜日）"""
+    return [day for day in days if day.weekday() == weekday]
+
+
+def plan_tasks(
+    entries: List[Dict[str, Any]], days: List[date], stages: List[str], weekday: int
+) -> Dict[str, Dict[str, Any]]:
+    """
+    検索語（レジストリの形式）× 日付の処理と依存関係を作成
+    日次の処理は同じ検索語・日付の前の段階に、週次分析は集計期間内の各日の分析に依存する
+    """
+    tasks: Dict[str, Dict[str, Any]] = {}
+
+    def add(stage: str, search_term: str, day: date, deps: List[str]) -> None:
+        tasks[task_id(stage, search_term, day)] = {
+            "id": task_id(stage, search_term, day),
+            "stage": stage,
+            "term": search_term,
+            "day": day.isoformat(),
+            "deps": [dep for dep in deps if dep in tasks],
+        }
+
+    for entry in entries:
+        search_term = entry["term"]
+        for day in days:
+            for index, stage in enumerate(STAGES[:3]):
+                if stage in stages:
+                    previous = [task_id(STAGES[index - 1], search_term, day)] if index else []
+                    add(stage, search_term, day, previous)
+            if "fetch" in stages:
+                tasks[task_id("fetch", search_term, day)]["query"] = entry["query"]
+        if "weekly" in stages and entry["weekly_report"]:
+            for day in report_days(days, weekday):
+                window = [task_id("analyze", search_term, d) for d in s3_layout.window_days(day)]
+                add("weekly", search_term, day, window)
+    return tasks
+
+
+def init_worker(store_dir: str, bucket: str, map_concurrency: int, log_dir: Optional[str]) -> None:
+    """ワーカープロセスの初期化（ハンドラーのインポートとストアの差し替えはプロセスごとに1回）"""
+    global _pipeline, _store
+    if log_dir:
+        log_path = Path(log_dir) / f"worker-{os.getpid()}.log"
+        sys.stdout = open(log_path, "a", encoding="utf-8", buffering=1)
+    _store = LocalS3(store_dir)
+    _pipeline = workflow.Workflow(bucket, map_concurrency)
+    workflow.use_s3(_store)
+
+
+def worker_state() -> Tuple[workflow.Workflow, LocalS3]:
+    """ワーカープロセスのワークフローとストア（init_workerの後に呼び出す）"""
+    assert _pipeline is not None and _store is not None, "init_worker has not been called"
+    return _pipeline, _store
+
+
+def reset_ledger(stage: str, key: str, force: bool) -> None:
+    """
+    処理台帳のエントリを削除して再処理できるようにする
+    強制実行の場合に加え、中断された実行が残した処理中のエントリも削除する
+    （ストアはこのランナーのみが使用するため、実行前に処理中のエントリは存在しない）
+    """
+    ledger_stage = LEDGER_STAGES.get(stage)
+    if not ledger_stage:
+        return
+    pipeline, store = worker_state()
+    entry, _ = ledger.get_entry(store, pipeline.bucket, ledger_stage, key)
+    if entry and (force or entry.get("status") == ledger.STATUS_PROCESSING):
+        store.delete_object(Bucket=pipeline.bucket, Key=s3_layout.ledger_key(ledger_stage, key))
+
+
+def run_task(task: Dict[str, Any], force: bool = False) -> Dict[str, Any]:
+    """ワーカープロセスで1つの処理を実行し、状態と所要時間を返す"""
+    stage, search_term = task["stage"], task["term"]
+    day = date.fromisoformat(task["day"])
+    pipeline, store = worker_state()
+    started = time.perf_counter()
+
+    key = input_key(stage, search_term, day)
+    if key and not exists(store, pipeline.bucket, key):
+        return {"status": "no_input", "seconds": 0.0}
+    if key:
+        reset_ledger(stage, key, force)
+
+    if stage == "fetch":
+        result = pipeline.fetch(search_term, day, task.get("query"))
+    elif stage == "weekly":
+        result = pipeline.weekly([search_term], day)
+    else:
+        # 分析・翻訳には必ず入力ファイルのキーがある
+        assert key is not None
+        if stage == "analyze":
+            result = pipeline.analyze(key)
+        else:
+            result = pipeline.translate(key)
+    seconds = round(time.perf_counter() - started, 3)
+
+    if not workflow.succeeded(result):
+        return {"status": "failed", "seconds": seconds, "error": workflow.error_message(result)}
+    if result.get("deferred"):
+        status = "deferred"
+    elif result.get("skipped"):
+        status = "skipped"
+    elif stage == "fetch" and not result.get("results"):
+        status = "no_articles"
+    elif stage == "weekly" and not result.get("output_file"):
+        status = "no_articles"
+    else:
+        status = "completed"
+    return {"status": status, "seconds": seconds}
+
+
+class Scheduler:
+    """
+    依存する処理がすべて終わった処理から順にプロセスプールへ投入する
+    後の段階の処理を優先して検索語・日付ごとに早く完了させ、処理段階ごとの同時実行数の上限を守る
+    出力済みの成果物があり、依存する処理がこの実行で新たに出力していない処理は再開済みとして飛ばす
+    """
+
+    def __init__(
+        self,
+        tasks: Dict[str, Dict[str, Any]],
+        store: LocalS3,
+        bucket: str,
+        workers: int,
+        stage_limits: Dict[str, int],
+        forced: Set[str],
+        on_result: Optional[Callable[[Dict[str, Any], Dict[str, Any]], None]] = None,
+    ):
+        self.tasks = tasks
+        self.store = store
+        self.bucket = bucket
+        self.workers = workers
+        self.stage_limits = stage_limits
+        self.forced = forced
+        self.on_result = on_result
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.remaining = {tid: len(task["deps"]) for tid, task in tasks.items()}
+        self.dependents: Dict[str, List[str]] = defaultdict(list)
+        for tid, task in tasks.items():
+            for dep in task["deps"]:
+                self.dependents[dep].append(tid)
+        self.ready: Dict[str, List[Any]] = {stage: [] for stage in STAGES}
+        self.active: Counter = Counter()
+
+    def _push(self, tid: str) -> None:
+        task = self.tasks[tid]
+        heapq.heappush(self.ready[task["stage"]], (task["day"], task["term"], tid))
+
+    def resolve(self, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """実行せずに結果が決まる処理の結果（実行が必要な場合はNone）"""
+        deps = [self.results[dep]["status"] for dep in task["deps"]]
+        if any(status in FAILED_STATUSES for status in deps):
+            return {"status": "blocked", "seconds": 0.0}
+        if deps and all(status in NO_OUTPUT_STATUSES for status in deps):
+            return {"status": "no_input", "seconds": 0.0}
+        if task["stage"] in self.forced or "completed" in deps:
+            return None
+        key = output_key(task["stage"], task["term"], date.fromisoformat(task["day"]))
+        if exists(self.store, self.bucket, key):
+            return {"status": "resumed", "seconds": 0.0}
+        return None
+
+    def finish(self, tid: str, result: Dict[str, Any]) -> None:
+        self.results[tid] = result
+        if self.on_result:
+            self.on_result(self.tasks[tid], result)
+        for dependent in self.dependents[tid]:
+            self.remaining[dependent] -= 1
+            if self.remaining[dependent] == 0:
+                self._push(dependent)
+
+    def _next_task(self) -> Optional[Dict[str, Any]]:
+        """同時実行数の上限に達していない処理段階のうち、最も後の段階の処理を取り出す"""
+        for stage in reversed(STAGES):
+            limit = self.stage_limits.get(stage, self.workers)
+            if self.ready[stage] and self.active[stage] < limit:
+                return self.tasks[heapq.heappop(self.ready[stage])[2]]
+        return None
+
+    def run(self, executor: ProcessPoolExecutor) -> Dict[str, Dict[str, Any]]:
+        for tid, count in self.remaining.items():
+            if count == 0:
+                self._push(tid)
+
+        running: Dict[Future, str] = {}
+        while True:
+            while len(running) < self.workers:
+                task = self._next_task()
+                if task is None:
+                    break
+                resolved = self.resolve(task)
+                if resolved:
+                    self.finish(task["id"], resolved)
+                    continue
+                future = executor.submit(run_task, task, task["stage"] in self.forced)
+                running[future] = task["id"]
+                self.active[task["stage"]] += 1
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tid = running.pop(future)
+                self.active[self.tasks[tid]["stage"]] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = f"{type(e).__name__}: {str(e)}"
+                    result = {"status": "failed", "seconds": 0.0, "error": error}
+                self.finish(tid, result)
+        return self.results
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    """ワーカープロセスを起動する前に、ハンドラーが参照する環境変数を設定"""
+    os.environ["BUCKET_NAME"] = args.bucket
+    os.environ.setdefault("CACHE_BUCKET", args.bucket)
+    os.environ.setdefault("CACHE_DIR", str(Path(args.store) / ".cache"))
+    if args.metrics_file:
+        os.environ["METRICS_FILE"] = str(Path(args.metrics_file).resolve())
+        os.environ.pop("METRICS_DISABLED", None)
+    else:
+        os.environ.setdefault("METRICS_DISABLED", "1")
+    tiktoken_cache = workflow.ROOT / "layers" / "openai" / "tiktoken_cache"
+    if tiktoken_cache.exists():
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(tiktoken_cache))
+    if args.stream_analysis:
+        os.environ["FETCH_STREAM_ANALYSIS"] = "1"
+    if args.parse_workers:
+        os.environ["EFETCH_PARSE_WORKERS"] = str(args.parse_workers)
+    # ワーカープロセス間でOpenAIのクォータを共有する（ストア内のSQLiteファイル）
+    if args.openai_rpm or args.openai_tpm:
+        os.environ["RATE_LIMIT_BACKEND"] = "sqlite"
+        sqlite_path = Path(args.store).resolve() / ".rate_limit.sqlite"
+        os.environ["RATE_LIMIT_SQLITE_PATH"] = str(sqlite_path)
+        for name, quota in (("OPENAI_RPM", args.openai_rpm), ("OPENAI_TPM", args.openai_tpm)):
+            if quota:
+                os.environ[name] = str(quota)
+
+
+def parse_stage_limits(values: List[str]) -> Dict[str, int]:
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for value in values:
+        stage, _, limit = value.partition("=")
+        if stage not in STAGES or not limit.isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"Invalid stage limit: {value}")
+        limits[stage] = int(limit)
+    return limits
+
+
+def summarize(results: Dict[str, Dict[str, Any]], tasks: Dict[str, Dict[str, Any]]) -> Dict:
+    stages: Dict[str, Counter] = {}
+    seconds: Counter = Counter()
+    for tid, result in results.items():
+        stage = tasks[tid]["stage"]
+        stages.setdefault(stage, Counter())[result["status"]] += 1
+        seconds[stage] += result["seconds"]
+    return {
+        stage: {**dict(stages[stage]), "task_seconds": round(seconds[stage], 3)}
+        for stage in STAGES
+        if stage in stages
+    }
+
+
+def print_summary(summary: Dict[str, Dict[str, Any]], wall: float) -> None:
+    statuses = [
+        "completed",
+        "skipped",
+        "resumed",
+        "deferred",
+        "no_articles",
+        "no_input",
+        "failed",
+        "blocked",
+    ]
+    print(f"{'stage':<10}" + "".join(f"{status:>12}" for status in statuses) + f"{'task s':>10}")
+    for stage, counts in summary.items():
+        print(
+            f"{stage:<10}"
+            + "".join(f"{counts.get(status, 0):>12}" for status in statuses)
+            + f"{counts['task_seconds']:>10.1f}"
+        )
+    print(f"Wall time: {wall:.1f}s")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m local_pipeline",
+        description="Run fetch, analyze, translate and weekly for many terms and days "
+        "against a local directory store",
+    )
+    parser.add_argument("--store", required=True, help="Directory of the local S3 store")
+    parser.add_argument("--bucket", default="pubmed-local", help="Bucket name inside the store")
+    parser.add_argument(
+        "--terms",
+        help="Comma separated search terms "
+        "(default: the term registry in the store, or SEARCH_TERMS)",
+    )
+    parser.add_argument("--registry", help="Read search terms from this term registry file")
+    parser.add_argument("--start", type=date.fromisoformat, required=True, help="YYYY-MM-DD")
+    parser.add_argument(
+        "--end", type=date.fromisoformat, default=date.today(), help="YYYY-MM-DD (default: today)"
+    )
+    parser.add_argument(
+        "--stages", default=",".join(STAGES), help="Comma separated stages to run (default: all)"
+    )
+    parser.add_argument(
+        "--force",
+        choices=STAGES,
+        help="Rerun this stage and the later ones even if their outputs exist",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--map-concurrency",
+        type=int,
+        default=workflow.DEFAULT_MAP_CONCURRENCY,
+        help="Concurrent shards per analysis (Map state max_concurrency)",
+    )
+    parser.add_argument(
+        "--stage-limit",
+        action="append",
+        default=[],
+        metavar="STAGE=N",
+        help="Maximum concurrent tasks of a stage (default: fetch=2)",
+    )
+    parser.add_argument(
+        "--weekly-day",
+        choices=term_registry.WEEKDAYS,
+        help="Weekday of the weekly reports (default: weekly_day in the registry)",
+    )
+    parser.add_argument(
+        "--stream-analysis",
+        action="store_true",
+        help="Analyze EFetch pages during the fetch task (the analyze task is then skipped)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        help="Processes per fetch task that parse EFetch pages in parallel (for backfills)",
+    )
+    parser.add_argument("--openai-rpm", type=int, help="OpenAI requests per minute to share")
+    parser.add_argument("--openai-tpm", type=int, help="OpenAI tokens per minute to share")
+    parser.add_argument("--log-dir", help="Handler output directory (default: STORE/.logs)")
+    parser.add_argument("--metrics-file", help="Write the handlers' EMF metrics to this file")
+    parser.add_argument("--json", help="Write the run report to this JSON file")
+    parser.add_argument("--dry-run", action="store_true", help="Show the plan without running")
+    args = parser.parse_args(argv)
+
+    stages = [stage for stage in args.stages.split(",") if stage]
+    unknown = sorted(set(stages) - set(STAGES))
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(unknown)}")
+    if args.end < args.start:
+        parser.error("--end must not be before --start")
+    try:
+        stage_limits = parse_stage_limits(args.stage_limit)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    store = LocalS3(args.store)
+    if args.terms:
+        registry = term_registry.default_registry(args.terms.split(","))
+    elif args.registry:
+        registry = term_registry.parse_registry(json.loads(Path(args.registry).read_text()))
+    else:
+        fallback_terms = os.environ.get("SEARCH_TERMS", "sepsis").split(",")
+        registry = term_registry.load_registry(store, args.bucket, fallback_terms)
+    entries = term_registry.active_terms(registry)
+    weekly_day = args.weekly_day or registry["weekly_day"]
+
+    days = [
+        args.start + timedelta(days=offset) for offset in range((args.end - args.start).days + 1)
+    ]
+    forced = set(STAGES[STAGES.index(args.force) :]) if args.force else set()
+    tasks = plan_tasks(entries, days, stages, term_registry.WEEKDAYS.index(weekly_day))
+
+    print(
+        f"Planned {len(tasks)} tasks for {len(entries)} terms x {len(days)} days "
+        f"({args.start} - {args.end}), stages: {', '.join(stages)}"
+    )
+    if args.dry_run:
+        planned = Counter(task["stage"] for task in tasks.values())
+        for stage in STAGES:
+            if stage in planned:
+                existing = sum(
+                    1
+                    for task in tasks.values()
+                    if task["stage"] == stage
+                    and exists(
+                        store,
+                        args.bucket,
+                        output_key(stage, task["term"], date.fromisoformat(task["day"])),
+                    )
+                )
+                print(f"  {stage:<10} {planned[stage]:>6} tasks, {existing:>6} outputs exist")
+        return 0
+
+    configure_environment(args)
+    log_dir = Path(args.log_dir or Path(args.store) / ".logs")
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    finished: Counter[str] = Counter()
+
+    def on_result(task: Dict[str, Any], result: Dict[str, Any]) -> None:
+        finished["tasks"] += 1
+        if result["status"] == "resumed":
+            return
+        line = (
+            f"[{finished['tasks']:>{len(str(len(tasks)))}}/{len(tasks)}] {task['stage']:<10} "
+            f"{task['term']} {task['day']} {result['status']} ({result['seconds']:.1f}s)"
+        )
+        if result.get("error"):
+            line += f": {result['error']}"
+        print(line, flush=True)
+
+    scheduler = Scheduler(tasks, store, args.bucket, args.workers, stage_limits, forced, on_result)
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=init_worker,
+            initargs=(args.store, args.bucket, args.map_concurrency, str(log_dir)),
+        ) as executor:
+            results = scheduler.run(executor)
+    except KeyboardInterrupt:
+        print("Interrupted. Run the same command again to resume.")
+        return 130
+    wall = time.perf_counter() - started
+
+    summary = summarize(results, tasks)
+    print_summary(summary, wall)
+    print(f"Handler logs: {log_dir}")
+    failures = [
+        {"task": tid, "status": result["status"], "error": result.get("error")}
+        for tid, result in results.items()
+        if result["status"] in FAILED_STATUSES
+    ]
+
+    if args.json:
+        report = {
+            "timestamp": datetime.now().isoformat(),
+            "settings": {**vars(args), "start": str(args.start), "end": str(args.end)},
+            "tasks": len(tasks),
+            "wall_s": round(wall, 3),
+            "stages": summary,
+            "failures": failures,
+        }
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"Report written to {args.json}")
+    return 1 if failures else 0
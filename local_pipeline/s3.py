@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from types import ModuleType
+from typing import Any, Dict, Iterator, List, Optional
+
+from botocore.exceptions import ClientError
+
+fcntl: Optional[ModuleType]
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# パイプラインが使用するS3 APIのみを実装した、ローカルディレクトリ上のS3互換ストア
+# オブジェクトは {root}/{バケット名}/{キー} に保存する
+# 条件付き書き込み（IfMatch / IfNoneMatch）はプロセス間でもファイルロックで排他する
+
+LIST_PAGE_SIZE = 1000
+_LOCK_FILE = ".lock"
+
+
+def _etag(data: bytes) -> str:
+    return f'"{hashlib.md5(data).hexdigest()}"'
+
+
+def _error(code: str, operation: str, message: str = "") -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+
+class _Paginator:
+    def __init__(self, store: "LocalS3"):
+        self.store = store
+
+    def paginate(self, Bucket: str, Prefix: str = "", **kwargs: Any) -> Iterator[Dict[str, Any]]:
+        token = None
+        while True:
+            page = self.store.list_objects_v2(
+                Bucket=Bucket, Prefix=Prefix, ContinuationToken=token, **kwargs
+            )
+            yield page
+            token = page.get("NextContinuationToken")
+            if not token:
+                return
+
+
+class LocalS3:
+    """
+    ローカルディレクトリをS3バケットとして扱うクライアント（boto3のS3クライアントと同じ呼び出し方）
+    latencyを指定すると呼び出しごとに待機し、S3のレイテンシを再現する
+    """
+
+    def __init__(self, root: str, latency: float = 0.0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, bucket, key))
+        if not path.startswith(os.path.join(self.root, bucket) + os.sep):
+            raise _error("InvalidKey", "PutObject", f"Invalid key: {key}")
+        return path
+
+    def _wait(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        """スレッド間・プロセス間で書き込みを排他する"""
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, _LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, bucket: str, key: str, operation: str) -> bytes:
+        try:
+            with open(self._path(bucket, key), "rb") as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise _error("404" if operation == "HeadObject" else "NoSuchKey", operation)
+
+    def get_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        self._wait()
+        data = self._read(Bucket, Key, "GetObject")
+        return {"Body": io.BytesIO(data), "ETag": _etag(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        self._wait()
+        data = self._read(Bucket, Key, "HeadObject")
+        return {"ETag": _etag(data), "ContentLength": len(data)}
+
+    def put_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Body: Any = b"",
+        IfMatch: Optional[str] = None,
+        IfNoneMatch: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._wait()
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        data = Body.encode("utf-8") if isinstance(Body, str) else bytes(Body)
+        path = self._path(Bucket, Key)
+
+        with self._write_lock():
+            if IfMatch is not None or IfNoneMatch is not None:
+                try:
+                    with open(path, "rb") as f:
+                        current: Optional[str] = _etag(f.read())
+                except FileNotFoundError:
+                    current = None
+                if IfNoneMatch == "*" and current is not None:
+                    raise _error("PreconditionFailed", "PutObject")
+                if IfMatch is not None and current != IfMatch:
+                    raise _error("PreconditionFailed", "PutObject")
+
+            # 読み込み中のファイルを壊さないよう一時ファイルに書いてから置き換える
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = os.path.join(
+                os.path.dirname(path),
+                f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp",
+            )
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return {"ETag": _etag(data)}
+
+    def copy_object(
+        self, Bucket: str, Key: str, CopySource: Dict[str, str], **kwargs: Any
+    ) -> Dict[str, Any]:
+        data = self._read(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        return self.put_object(Bucket=Bucket, Key=Key, Body=data)
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        self._wait()
+        with self._write_lock():
+            try:
+                os.remove(self._path(Bucket, Key))
+            except FileNotFoundError:
+                pass
+        return {}
+
+    def _keys(self, bucket: str, prefix: str) -> List[str]:
+        """プレフィックスに一致するキーを辞書順に列挙（書き込み途中の一時ファイルは除く）"""
+        bucket_root = os.path.join(self.root, bucket)
+        # プレフィックスのディレクトリ部分から探索して不要な走査を避ける
+        start = os.path.join(bucket_root, os.path.dirname(prefix))
+        keys = []
+        for directory, _, files in os.walk(start):
+            for name in files:
+                if name.startswith(".") and name.endswith(".tmp"):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), bucket_root)
+                key = key.replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        ContinuationToken: Optional[str] = None,
+        MaxKeys: int = LIST_PAGE_SIZE,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        self._wait()
+        keys = [
+            key
+            for key in self._keys(Bucket, Prefix)
+            if not ContinuationToken or key > ContinuationToken
+        ]
+        page = keys[:MaxKeys]
+        contents = []
+        for key in page:
+            stat = os.stat(self._path(Bucket, key))
+            contents.append(
+                {
+                    "Key": key,
+                    "Size": stat.st_size,
+                    "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                }
+            )
+
+        response: Dict[str, Any] = {"KeyCount": len(page), "IsTruncated": len(keys) > MaxKeys}
+        if contents:
+            response["Contents"] = contents
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def get_paginator(self, operation_name: str) -> _Paginator:
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return _Paginator(self)
@@ -0,0 +1,174 @@
+import importlib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# ハンドラー名と（コードのディレクトリ、モジュール名）の対応
+HANDLER_MODULES = {
+    "fetch": ("lambda", "lambda_function"),
+    "analyze": ("analyze_lambda", "analyze_function"),
+    "translate": ("translate_lambda", "translate_function"),
+    "weekly": ("weekly_analyze_lambda", "weekly_analyze_function"),
+}
+
+# Lambdaレイヤー（/opt/python）に相当するディレクトリ
+LAYER_DIRS = [ROOT / "layers" / "common" / "python", ROOT / "layers" / "openai" / "python"]
+
+# ステートマシンのMapステートの同時実行数（CDKコンテキストanalyze_max_concurrencyのデフォルトと同じ）
+DEFAULT_MAP_CONCURRENCY = 5
+
+
+def setup_paths() -> None:
+    """レイヤーと各Lambdaのコードをインポートできるようにする"""
+    for path in LAYER_DIRS + [ROOT / code_dir for code_dir, _ in HANDLER_MODULES.values()]:
+        if path.exists() and str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+def load_handlers() -> Dict[str, Any]:
+    """各Lambdaのハンドラーモジュールをインポート（環境変数は事前に設定しておくこと）"""
+    setup_paths()
+    return {name: importlib.import_module(module) for name, (_, module) in HANDLER_MODULES.items()}
+
+
+def use_s3(client: Any) -> None:
+    """全ハンドラーが使用するS3クライアントを差し替える（LocalS3など）"""
+    from pubmed_common import clients
+
+    clients.get_s3 = lambda *args, **kwargs: client
+
+
+def succeeded(result: Any) -> bool:
+    return isinstance(result, dict) and int(result.get("statusCode", 200)) < 400
+
+
+def error_message(result: Dict[str, Any]) -> str:
+    """失敗したハンドラーの結果からエラーの内容を取得"""
+    return str(result.get("details") or result.get("error") or result.get("body"))
+
+
+class Workflow:
+    """
+    デプロイ済みのワークフローと同じ順序・入力でハンドラーを呼び出す
+    取得 → 分割 → シャード分析（Map）→ 統合 → 翻訳、および週次分析
+    on_invocationには呼び出しごとに処理段階・所要時間・ステータス・エラーの辞書が渡される
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        map_concurrency: int = DEFAULT_MAP_CONCURRENCY,
+        on_invocation: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.bucket = bucket
+        self.map_concurrency = map_concurrency
+        self.on_invocation = on_invocation
+        self.handlers = load_handlers()
+
+    def invoke(self, stage: str, handler: Callable, event: Dict[str, Any]) -> Dict[str, Any]:
+        """ハンドラーを呼び出し、例外はLambdaの実行失敗としてstatusCode 500の結果に変換"""
+        started = time.perf_counter()
+        error = None
+        try:
+            result: Dict[str, Any] = handler(event, None)
+        except Exception as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            result = {"statusCode": 500, "error": "Unhandled exception", "details": error}
+        seconds = time.perf_counter() - started
+
+        if not succeeded(result) and error is None:
+            error = error_message(result)
+        if self.on_invocation:
+            self.on_invocation(
+                {
+                    "stage": stage,
+                    "seconds": seconds,
+                    "status_code": result.get("statusCode", 200),
+                    "skipped": bool(result.get("skipped")),
+                    "error": error,
+                }
+            )
+        return result
+
+    def fetch(self, search_term: str, day: date, query: Optional[str] = None) -> Dict[str, Any]:
+        event = {"search_term": search_term, "date": day.isoformat()}
+        if query:
+            event["query"] = query
+        return self.invoke("fetch", self.handlers["fetch"].lambda_handler, event)
+
+    def analyze(self, raw_key: str) -> Dict[str, Any]:
+        """分割 → シャード分析 → 統合（重複した入力は分割の結果をそのまま返す）"""
+        module = self.handlers["analyze"]
+        split = self.invoke("split", module.split_handler, {"bucket": self.bucket, "key": raw_key})
+        if not succeeded(split) or split.get("skipped"):
+            return split
+
+        shards = split.get("shards", [])
+        with ThreadPoolExecutor(max_workers=max(1, min(self.map_concurrency, len(shards)))) as pool:
+            shard_results = list(
+                pool.map(
+                    lambda shard: self.invoke("analyze", module.analyze_shard_handler, shard),
+                    shards,
+                )
+            )
+
+        return self.invoke(
+            "merge",
+            module.merge_handler,
+            {
+                "bucket": split["bucket"],
+                "key": split["key"],
+                "etag": split.get("etag"),
+                "content_hash": split.get("content_hash"),
+                "search_term": split.get("search_term"),
+                "total_articles": split.get("total_articles"),
+                "shard_results": shard_results,
+            },
+        )
+
+    def translate(self, analysis_key: str) -> Dict[str, Any]:
+        return self.invoke(
+            "translate",
+            self.handlers["translate"].lambda_handler,
+            {"bucket": self.bucket, "output_key": analysis_key},
+        )
+
+    def weekly(self, search_terms: List[str], day: Optional[date] = None) -> Dict[str, Any]:
+        """週次分析（dayを指定した場合はその日を期間の終わりとするレポートを作成）"""
+        event: Dict[str, Any] = {"search_terms": search_terms}
+        if day:
+            event["date"] = day.isoformat()
+        return self.invoke("weekly", self.handlers["weekly"].lambda_handler, event)
+
+    def run_daily(self, search_term: str, day: date) -> Dict[str, Any]:
+        """1つの検索語・日付について取得 → 分析 → 翻訳を実行し、到達した段階と出力を返す"""
+        summary: Dict[str, Any] = {"search_term": search_term, "date": day.isoformat()}
+
+        fetched = self.fetch(search_term, day)
+        if not succeeded(fetched):
+            return {**summary, "status": "failed", "stage": "fetch"}
+        files = fetched.get("results") or []
+        if not files:
+            return {**summary, "status": "no_articles"}
+        summary.update(raw_key=files[0]["file_name"], articles=files[0]["articles_count"])
+
+        # ストリーミング分析（FETCH_STREAM_ANALYSIS=1）では取得中に分析まで完了している
+        summary["analysis_key"] = files[0].get("analysis_key")
+        if not summary["analysis_key"]:
+            analyzed = self.analyze(summary["raw_key"])
+            if not succeeded(analyzed):
+                return {**summary, "status": "failed", "stage": "analyze"}
+            summary["analysis_key"] = analyzed.get("output_key")
+            if analyzed.get("skipped"):
+                return {**summary, "status": "deferred" if analyzed.get("deferred") else "skipped"}
+
+        translated = self.translate(summary["analysis_key"])
+        if not succeeded(translated):
+            return {**summary, "status": "failed", "stage": "translate"}
+        summary["translation_key"] = translated.get("output_key")
+        return {**summary, "status": "skipped" if translated.get("skipped") else "completed"}
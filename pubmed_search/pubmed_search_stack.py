@@ -1,15 +1,23 @@
-from aws_cdk import Duration, RemovalPolicy, Stack
+import json
+
+from aws_cdk import Duration, RemovalPolicy, Size, Stack
+from aws_cdk import aws_dynamodb as dynamodb
 from aws_cdk import aws_events as events
 from aws_cdk import aws_events_targets as targets
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_lambda_event_sources as lambda_event_sources
 from aws_cdk import aws_logs as logs
 from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_s3_notifications as s3n
+from aws_cdk import aws_sqs as sqs
 from aws_cdk import aws_stepfunctions as sfn
 from aws_cdk import aws_stepfunctions_tasks as tasks
 from constructs import Construct
 
+# OpenAIレイヤーに同梱したtiktokenのエンコーディングファイルの場所（create-layer.shで作成）
+TIKTOKEN_CACHE_DIR = "/opt/tiktoken_cache"
+
 
 class PubmedSearchStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -19,8 +27,21 @@ class PubmedSearchStack(Stack):
         bucket_name = self.node.try_get_context("bucket_name")
         openai_api_key = self.node.try_get_context("openai_api_key")
         gpt_model = self.node.try_get_context("gpt_model")
+        # 分析シャードを並列に処理するLambdaの最大同時実行数
+        analyze_max_concurrency = int(self.node.try_get_context("analyze_max_concurrency") or 5)
+        # LLMのトークン・費用の日次予算と縮退の設定（例: {"BUDGET_DAILY_TOKENS": "2000000"}）
+        # 未指定の場合は予算管理を行わない（-cで指定した場合はJSON文字列として渡される）
+        budget_context = self.node.try_get_context("budget") or {}
+        if isinstance(budget_context, str):
+            budget_context = json.loads(budget_context)
+        budget_environment = {name: str(value) for name, value in budget_context.items()}
+        # OpenAIのアカウントのクォータ（1分あたりのリクエスト数・トークン数）。全LLM呼び出しで共有する
+        openai_quotas = {
+            "OPENAI_RPM": self.node.try_get_context("openai_rpm"),
+            "OPENAI_TPM": self.node.try_get_context("openai_tpm"),
+        }
 
-        # 検索語を小文字で統一して定義
+        # 検索語レジストリ（S3の config/terms.json）がない場合に使用する検索語（小文字で統一）
         search_terms = ["sepsis", "ards"]
 
         # S3バケットの作成
@@ -32,6 +53,8 @@ class PubmedSearchStack(Stack):
             encryption=s3.BucketEncryption.S3_MANAGED,
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
             versioned=True,
+            # 論文索引の更新にS3の作成イベントをEventBridge経由で使う（raw/の通知は起動用のキューと共存）
+            event_bridge_enabled=True,
             lifecycle_rules=[
                 s3.LifecycleRule(
                     transitions=[
@@ -40,10 +63,73 @@ class PubmedSearchStack(Stack):
                             transition_after=Duration.days(90),
                         )
                     ]
-                )
+                ),
+                # LLMの応答・翻訳結果のキャッシュ（二次キャッシュ）は30日で削除
+                s3.LifecycleRule(
+                    prefix="cache/",
+                    expiration=Duration.days(30),
+                    noncurrent_version_expiration=Duration.days(1),
+                ),
+                # プロファイリング結果は調査用のため14日で削除
+                s3.LifecycleRule(
+                    prefix="profiles/",
+                    expiration=Duration.days(14),
+                    noncurrent_version_expiration=Duration.days(1),
+                ),
+                # 日次予算の使用状況は翌日の延期分の再投入に使うため、30日で削除
+                s3.LifecycleRule(
+                    prefix="budget/",
+                    expiration=Duration.days(30),
+                    noncurrent_version_expiration=Duration.days(1),
+                ),
+                # 論文索引の差し替え済みのスナップショットは索引Lambdaが削除するため、旧バージョンのみ削除
+                s3.LifecycleRule(
+                    prefix="index/snapshots/",
+                    noncurrent_version_expiration=Duration.days(1),
+                    expired_object_delete_marker=True,
+                ),
+                # 列指向パーティションの差し替え済みの世代は圧縮Lambdaが削除するため、旧バージョンのみ削除
+                s3.LifecycleRule(
+                    prefix="columnar/",
+                    noncurrent_version_expiration=Duration.days(1),
+                    expired_object_delete_marker=True,
+                ),
             ],
         )
 
+        # OpenAIのクォータを全Lambdaで共有するトークンバケット（検索語ごとのバケットはTTLで削除）
+        # クォータ（openai_rpm・openai_tpm）を指定した場合のみ作成する
+        rate_limit_table = None
+        rate_limit_environment = {
+            name: str(quota) for name, quota in openai_quotas.items() if quota
+        }
+        if rate_limit_environment:
+            rate_limit_table = dynamodb.Table(
+                self,
+                "RateLimitTable",
+                partition_key=dynamodb.Attribute(
+                    name="bucket_id", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="expires_at",
+                removal_policy=RemovalPolicy.DESTROY,
+            )
+            rate_limit_environment["RATE_LIMIT_TABLE"] = rate_limit_table.table_name
+
+        # LLMの日次予算の使用量・予約（日付と集計単位ごとの項目を原子的に加算する。TTLで削除）
+        budget_table = None
+        if budget_environment:
+            budget_table = dynamodb.Table(
+                self,
+                "BudgetTable",
+                partition_key=dynamodb.Attribute(name="day", type=dynamodb.AttributeType.STRING),
+                sort_key=dynamodb.Attribute(name="scope", type=dynamodb.AttributeType.STRING),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                time_to_live_attribute="expires_at",
+                removal_policy=RemovalPolicy.DESTROY,
+            )
+            budget_environment["BUDGET_TABLE"] = budget_table.table_name
+
         # 論文取得用Lambda（既存）の実装
         request_layer = _lambda.LayerVersion.from_layer_version_arn(
             self,
@@ -51,6 +137,15 @@ class PubmedSearchStack(Stack):
             "arn:aws:lambda:ap-northeast-1:438774532845:layer:request_layer:2",
         )
 
+        # 全Lambda共通ユーティリティ（S3キー構成など）のレイヤー
+        common_layer = _lambda.LayerVersion(
+            self,
+            "CommonLayer",
+            code=_lambda.Code.from_asset("layers/common"),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_11, _lambda.Runtime.PYTHON_3_12],
+            description="Shared utilities for PubMed pipeline Lambda functions",
+        )
+
         # 論文取得用Lambda実行ロール
         fetch_lambda_role = iam.Role(
             self,
@@ -86,7 +181,7 @@ class PubmedSearchStack(Stack):
             role=fetch_lambda_role,
             timeout=Duration.seconds(300),
             memory_size=512,
-            layers=[request_layer],
+            layers=[request_layer, common_layer],
             environment={
                 "BUCKET_NAME": bucket_name,
                 "SEARCH_TERMS": ",".join(search_terms),  # 小文字で統一
@@ -111,14 +206,15 @@ class PubmedSearchStack(Stack):
             assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
         )
 
-        # S3アクセス権限の追加
+        # S3アクセス権限の追加（マニフェスト未作成時にNoSuchKeyを受け取るためListBucketも付与）
         lambda_role.add_to_policy(
             iam.PolicyStatement(
                 actions=[
                     "s3:PutObject",
                     "s3:GetObject",
+                    "s3:ListBucket",
                 ],
-                resources=[f"{bucket.bucket_arn}/*"],
+                resources=[f"{bucket.bucket_arn}", f"{bucket.bucket_arn}/*"],
             )
         )
 
@@ -128,21 +224,68 @@ class PubmedSearchStack(Stack):
                 "service-role/AWSLambdaBasicExecutionRole"
             )
         )
+        if rate_limit_table:
+            rate_limit_table.grant_read_write_data(lambda_role)
+        if budget_table:
+            budget_table.grant_read_write_data(lambda_role)
 
-        # 分析用Lambda関数
+        # 分析対象の論文をシャードに分割するLambda関数
+        split_lambda = _lambda.Function(
+            self,
+            "PubmedSplitFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            handler="analyze_function.split_handler",
+            code=_lambda.Code.from_asset("analyze_lambda"),
+            role=lambda_role,
+            timeout=Duration.seconds(60),
+            memory_size=1024,
+            layers=[openai_layer, common_layer],
+            environment={
+                "OPENAI_API_KEY": openai_api_key,
+                "GPT_MODEL": gpt_model,
+                "TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR,
+                "CACHE_BUCKET": bucket_name,
+                "ANALYZE_CHUNKS_PER_SHARD": "3",
+                **budget_environment,
+            },
+        )
+
+        # 分析用Lambda関数（シャードごとに並列実行）
         analyze_lambda = _lambda.Function(
             self,
             "PubmedAnalyzeFunction",
             runtime=_lambda.Runtime.PYTHON_3_11,
-            handler="analyze_function.lambda_handler",
+            handler="analyze_function.analyze_shard_handler",
             code=_lambda.Code.from_asset("analyze_lambda"),
             role=lambda_role,
             timeout=Duration.seconds(300),
             memory_size=1024,
-            layers=[openai_layer],
+            layers=[openai_layer, common_layer],
+            environment={
+                "OPENAI_API_KEY": openai_api_key,
+                "GPT_MODEL": gpt_model,
+                "TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR,
+                "CACHE_BUCKET": bucket_name,
+                **budget_environment,
+                **rate_limit_environment,
+            },
+        )
+
+        # シャードごとの分析結果を統合するLambda関数
+        merge_lambda = _lambda.Function(
+            self,
+            "PubmedMergeFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            handler="analyze_function.merge_handler",
+            code=_lambda.Code.from_asset("analyze_lambda"),
+            role=lambda_role,
+            timeout=Duration.seconds(60),
+            memory_size=512,
+            layers=[openai_layer, common_layer],
             environment={
                 "OPENAI_API_KEY": openai_api_key,
                 "GPT_MODEL": gpt_model,
+                **budget_environment,
             },
         )
 
@@ -156,10 +299,14 @@ class PubmedSearchStack(Stack):
             role=lambda_role,
             timeout=Duration.seconds(300),
             memory_size=1024,
-            layers=[openai_layer],
+            layers=[openai_layer, common_layer],
             environment={
                 "OPENAI_API_KEY": openai_api_key,
                 "GPT_MODEL": gpt_model,
+                "TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR,
+                "CACHE_BUCKET": bucket_name,
+                **budget_environment,
+                **rate_limit_environment,
             },
         )
 
@@ -172,14 +319,53 @@ class PubmedSearchStack(Stack):
         )
 
         # Step Functions定義
-        # 分析タスク
+        # 分割タスク（トークン数で区切ったシャードのリストを作成）
+        split_task = tasks.LambdaInvoke(
+            self,
+            "SplitPapers",
+            lambda_function=split_lambda,
+            output_path="$.Payload",
+            retry_on_service_exceptions=True,
+            payload=sfn.TaskInput.from_object({"bucket": bucket.bucket_name, "key.$": "$.key"}),
+        )
+
+        # 分析タスク（シャードごと）
         analyze_task = tasks.LambdaInvoke(
             self,
             "AnalyzePapers",
             lambda_function=analyze_lambda,
             output_path="$.Payload",
             retry_on_service_exceptions=True,
-            payload=sfn.TaskInput.from_object({"bucket": bucket.bucket_name, "key.$": "$.key"}),
+        )
+
+        # シャードを並列に分析するMapステート
+        analyze_map = sfn.Map(
+            self,
+            "AnalyzeShards",
+            items_path="$.shards",
+            max_concurrency=analyze_max_concurrency,
+            result_path="$.shard_results",
+        )
+        analyze_map.item_processor(analyze_task)
+
+        # 統合タスク（シャードごとの分析結果から最終的な分析結果を作成）
+        merge_task = tasks.LambdaInvoke(
+            self,
+            "MergeAnalyses",
+            lambda_function=merge_lambda,
+            output_path="$.Payload",
+            retry_on_service_exceptions=True,
+            payload=sfn.TaskInput.from_object(
+                {
+                    "bucket.$": "$.bucket",
+                    "key.$": "$.key",
+                    "etag.$": "$.etag",
+                    "content_hash.$": "$.content_hash",
+                    "search_term.$": "$.search_term",
+                    "total_articles.$": "$.total_articles",
+                    "shard_results.$": "$.shard_results",
+                }
+            ),
         )
 
         # 翻訳タスク
@@ -202,13 +388,29 @@ class PubmedSearchStack(Stack):
             error="WorkflowFailedError",
         )
 
+        # 処理台帳で重複と判定された入力は分析・翻訳を行わずに終了
+        skip_state = sfn.Succeed(self, "SkipDuplicateInput")
+
         # ワークフロー定義
-        definition = analyze_task.add_catch(
+        process_chain = (
+            analyze_map.add_catch(errors=["States.ALL"], result_path="$.error", handler=fail_state)
+            .next(
+                merge_task.add_catch(
+                    errors=["States.ALL"], result_path="$.error", handler=fail_state
+                )
+            )
+            .next(
+                translate_task.add_catch(
+                    errors=["States.ALL"], result_path="$.error", handler=fail_state
+                )
+            )
+        )
+        definition = split_task.add_catch(
             errors=["States.ALL"], result_path="$.error", handler=fail_state
         ).next(
-            translate_task.add_catch(
-                errors=["States.ALL"], result_path="$.error", handler=fail_state
-            )
+            sfn.Choice(self, "IsDuplicateInput")
+            .when(sfn.Condition.boolean_equals("$.skipped", True), skip_state)
+            .otherwise(process_chain)
         )
 
         # Step Functions ステートマシンの作成
@@ -226,7 +428,9 @@ class PubmedSearchStack(Stack):
         )
 
         # Lambda関数への実行権限を付与
+        split_lambda.grant_invoke(state_machine)
         analyze_lambda.grant_invoke(state_machine)
+        merge_lambda.grant_invoke(state_machine)
         translate_lambda.grant_invoke(state_machine)
 
         # S3トリガー用のLambdaロールを先に作成
@@ -243,63 +447,197 @@ class PubmedSearchStack(Stack):
             )
         )
 
-        # S3からStep Functionsを起動するためのLambda
+        # S3イベントを蓄積するSQSキュー（処理できなかったメッセージはDLQへ）
+        trigger_dlq = sqs.Queue(
+            self,
+            "PubmedInputDeadLetterQueue",
+            retention_period=Duration.days(14),
+        )
+        trigger_queue = sqs.Queue(
+            self,
+            "PubmedInputQueue",
+            visibility_timeout=Duration.seconds(360),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=trigger_dlq),
+        )
+
+        # SQSのS3イベントをまとめてStep Functionsを起動するためのLambda
         s3_trigger_lambda = _lambda.Function(
             self,
             "S3TriggerFunction",
             runtime=_lambda.Runtime.PYTHON_3_11,
-            handler="index.handler",
-            code=_lambda.Code.from_inline(
-                """
-import json
-import boto3
-import os
-
-def handler(event, context):
-    try:
-        # S3イベントからバケットとキーを取得
-        print(f"Received event: {json.dumps(event)}")
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        key = event['Records'][0]['s3']['object']['key']
-
-        # JSONファイルのみ処理
-        if not key.endswith('.json') or key.endswith('_analysis.json') or key.endswith('_jp_analysis.json'):
-            print(f"Skipping non-target file: {key}")
-            return {'statusCode': 200, 'body': 'Not a target file'}
-
-        # Step Functionsを起動
-        client = boto3.client('stepfunctions')
-        response = client.start_execution(
-            stateMachineArn=os.environ['STATE_MACHINE_ARN'],
-            input=json.dumps({
-                'bucket': bucket,
-                'key': key
-            })
-        )
-
-        return {
-            'statusCode': 200,
-            'body': f"Started execution: {response['executionArn']}"
-        }
-    except Exception as e:
-        print(f"Error: {str(e)}")
-        return {'statusCode': 500, 'body': str(e)}
-            """
-            ),
-            timeout=Duration.seconds(30),
+            handler="trigger_function.handler",
+            code=_lambda.Code.from_asset("trigger_lambda"),
+            timeout=Duration.seconds(60),
             role=s3_trigger_lambda_role,
-            environment={"STATE_MACHINE_ARN": state_machine.state_machine_arn},
+            layers=[common_layer],
+            environment={
+                "BUCKET_NAME": bucket_name,
+                "STATE_MACHINE_ARN": state_machine.state_machine_arn,
+                "START_EXECUTIONS_PER_SECOND": "1",
+            },
         )
 
         # Step Functionsの実行権限を付与
         state_machine.grant_start_execution(s3_trigger_lambda)
+        # 失敗した実行を起動し直すため、同じ名前の実行の状態を参照する
+        state_machine.grant_read(s3_trigger_lambda)
+
+        # SQSからバッチで受信し、同時実行数を制限して起動レートを抑える
+        s3_trigger_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                trigger_queue,
+                batch_size=10,
+                max_batching_window=Duration.seconds(30),
+                max_concurrency=2,
+                report_batch_item_failures=True,
+            )
+        )
 
-        # S3イベント通知の設定
+        # S3イベント通知の設定（論文取得結果のプレフィックスのみをSQSへ）
         bucket.add_event_notification(
             s3.EventType.OBJECT_CREATED,
-            s3n.LambdaDestination(s3_trigger_lambda),
-            s3.NotificationKeyFilter(suffix=".json"),
+            s3n.SqsDestination(trigger_queue),
+            s3.NotificationKeyFilter(prefix="raw/", suffix=".json"),
+        )
+
+        # 取得結果・分析結果を論文索引（SQLite FTS5のスナップショット）に反映するLambda
+        index_lambda_role = iam.Role(
+            self,
+            "ArticleIndexLambdaRole",
+            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+        )
+        index_lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject", "s3:ListBucket"],
+                resources=[
+                    f"{bucket.bucket_arn}",
+                    f"{bucket.bucket_arn}/raw/*",
+                    f"{bucket.bucket_arn}/analysis/*",
+                    f"{bucket.bucket_arn}/index/*",
+                ],
+            )
+        )
+        index_lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject", "s3:DeleteObject"],
+                resources=[f"{bucket.bucket_arn}/index/*"],
+            )
+        )
+        index_lambda_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSLambdaBasicExecutionRole"
+            )
+        )
+
+        # FTS5のtrigramトークナイザー（SQLite 3.34以降）を使うため、Python 3.12のランタイムで実行する
+        index_lambda = _lambda.Function(
+            self,
+            "ArticleIndexFunction",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            handler="index_function.lambda_handler",
+            code=_lambda.Code.from_asset("index_lambda"),
+            role=index_lambda_role,
+            timeout=Duration.seconds(300),
+            memory_size=1024,
+            ephemeral_storage_size=Size.gibibytes(4),
+            layers=[common_layer],
+            environment={
+                "BUCKET_NAME": bucket_name,
+            },
+        )
+
+        index_dlq = sqs.Queue(
+            self,
+            "ArticleIndexDeadLetterQueue",
+            retention_period=Duration.days(14),
+        )
+        index_queue = sqs.Queue(
+            self,
+            "ArticleIndexQueue",
+            visibility_timeout=Duration.seconds(1800),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=index_dlq),
+        )
+
+        # 作成イベントをまとめて受信し、スナップショットの差し替え回数を抑える
+        # 同時実行数を最小にし、差し替えの競合（条件付き書き込みで再反映）を減らす
+        index_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                index_queue,
+                batch_size=500,
+                max_batching_window=Duration.seconds(60),
+                max_concurrency=2,
+                report_batch_item_failures=True,
+            )
+        )
+
+        # 取得結果・分析結果の作成イベントを論文索引のキューへ
+        index_rule = events.Rule(
+            self,
+            "ArticleIndexRule",
+            event_pattern=events.EventPattern(
+                source=["aws.s3"],
+                detail_type=["Object Created"],
+                detail={
+                    "bucket": {"name": [bucket.bucket_name]},
+                    "object": {"key": [{"prefix": "raw/"}, {"prefix": "analysis/"}]},
+                },
+            ),
+        )
+        index_rule.add_target(targets.SqsQueue(index_queue))
+
+        # 取得結果・分析結果を月ごとの列指向パーティション（傾向分析用）に圧縮するLambda
+        compact_lambda_role = iam.Role(
+            self,
+            "CompactLambdaRole",
+            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+        )
+        compact_lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject", "s3:ListBucket"],
+                resources=[
+                    f"{bucket.bucket_arn}",
+                    f"{bucket.bucket_arn}/raw/*",
+                    f"{bucket.bucket_arn}/analysis/*",
+                    f"{bucket.bucket_arn}/manifests/*",
+                    f"{bucket.bucket_arn}/columnar/*",
+                ],
+            )
+        )
+        compact_lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:PutObject", "s3:DeleteObject"],
+                resources=[f"{bucket.bucket_arn}/columnar/*"],
+            )
+        )
+        compact_lambda_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSLambdaBasicExecutionRole"
+            )
+        )
+
+        # NumPyはOpenAIレイヤーに同梱されている
+        compact_lambda = _lambda.Function(
+            self,
+            "CompactFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            handler="compact_function.lambda_handler",
+            code=_lambda.Code.from_asset("compact_lambda"),
+            role=compact_lambda_role,
+            timeout=Duration.seconds(900),
+            memory_size=1024,
+            layers=[openai_layer, common_layer],
+            environment={
+                "BUCKET_NAME": bucket_name,
+            },
+        )
+
+        # 日次分析が終わった後に圧縮する（毎日 UTC 18:00 / JST 3:00）
+        compact_rule = events.Rule(
+            self,
+            "CompactRule",
+            schedule=events.Schedule.cron(minute="0", hour="18"),
         )
+        compact_rule.add_target(targets.LambdaFunction(compact_lambda))
 
         # 週次分析用Lambda実行ロール
         weekly_lambda_role = iam.Role(
@@ -326,6 +664,10 @@ def handler(event, context):
                 "service-role/AWSLambdaBasicExecutionRole"
             )
         )
+        if rate_limit_table:
+            rate_limit_table.grant_read_write_data(weekly_lambda_role)
+        if budget_table:
+            budget_table.grant_read_write_data(weekly_lambda_role)
 
         # 週次分析用Lambda関数
         weekly_analyze_lambda = _lambda.Function(
@@ -335,86 +677,156 @@ def handler(event, context):
             handler="weekly_analyze_function.lambda_handler",
             code=_lambda.Code.from_asset("weekly_analyze_lambda"),
             role=weekly_lambda_role,
-            timeout=Duration.seconds(300),
+            timeout=Duration.seconds(900),
             memory_size=1024,
-            layers=[openai_layer],
+            # 論文索引のスナップショットを/tmpに展開する
+            ephemeral_storage_size=Size.gibibytes(2),
+            layers=[openai_layer, common_layer],
             environment={
                 "BUCKET_NAME": bucket_name,
                 "OPENAI_API_KEY": openai_api_key,
                 "GPT_MODEL": gpt_model,
+                "TIKTOKEN_CACHE_DIR": TIKTOKEN_CACHE_DIR,
+                "CACHE_BUCKET": bucket_name,
+                "S3_LOAD_CONCURRENCY": "16",
+                "WEEKLY_TERM_CONCURRENCY": "4",
+                **budget_environment,
+                **rate_limit_environment,
             },
         )
 
-        # セプシス用のEventBridgeルール（毎日実行）
-        sepsis_rule = events.Rule(
+        # 論文取得・週次分析のシャードを蓄積するSQSキュー（可視性タイムアウトは関数のタイムアウトの6倍）
+        fetch_dlq = sqs.Queue(
             self,
-            "DailySepsisSearchRule",
-            schedule=events.Schedule.cron(
-                minute="5",
-                hour="0",  # UTC 0:05 (JST 9:05)
-            ),
+            "FetchDeadLetterQueue",
+            retention_period=Duration.days(14),
         )
-
-        # セプシス用のルールにLambda関数をターゲットとして追加
-        sepsis_rule.add_target(
-            targets.LambdaFunction(
-                fetch_lambda,
-                event=events.RuleTargetInput.from_object({"search_term": "sepsis"}),
+        fetch_queue = sqs.Queue(
+            self,
+            "FetchQueue",
+            visibility_timeout=Duration.seconds(1800),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=fetch_dlq),
+        )
+        weekly_dlq = sqs.Queue(
+            self,
+            "WeeklyDeadLetterQueue",
+            retention_period=Duration.days(14),
+        )
+        weekly_queue = sqs.Queue(
+            self,
+            "WeeklyQueue",
+            visibility_timeout=Duration.seconds(5400),
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=weekly_dlq),
+        )
+
+        # シャードを1件ずつ受信し、同時実行数を制限してNCBIとOpenAIのレート制限を守る
+        fetch_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                fetch_queue,
+                batch_size=1,
+                max_concurrency=2,
+                report_batch_item_failures=True,
+            )
+        )
+        weekly_analyze_lambda.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                weekly_queue,
+                batch_size=1,
+                max_concurrency=2,
+                report_batch_item_failures=True,
             )
         )
 
-        # ARDS用のEventBridgeルール（毎日実行）- 小文字のardsで統一
-        ards_rule = events.Rule(
+        # 検索語レジストリを読み込んでシャードをキューに送信するディスパッチャー
+        dispatcher_lambda_role = iam.Role(
             self,
-            "DailyArdsSearchRule",
-            schedule=events.Schedule.cron(
-                minute="15",  # 10分ずらす
-                hour="0",  # UTC 0:15 (JST 9:15)
-            ),
+            "DispatcherLambdaRole",
+            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
         )
 
-        # ARDS用のルールにLambda関数をターゲットとして追加（小文字のards）
-        ards_rule.add_target(
-            targets.LambdaFunction(
-                fetch_lambda,
-                event=events.RuleTargetInput.from_object({"search_term": "ards"}),
+        # レジストリと日次予算（延期された処理の再投入）の読み込み権限
+        dispatcher_lambda_role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:GetObject", "s3:ListBucket"],
+                resources=[
+                    f"{bucket.bucket_arn}",
+                    f"{bucket.bucket_arn}/config/*",
+                    f"{bucket.bucket_arn}/budget/*",
+                ],
             )
         )
 
-        # 週次分析用EventBridgeルール（セプシス用）
-        weekly_sepsis_rule = events.Rule(
+        # CloudWatch Logs権限の追加
+        dispatcher_lambda_role.add_managed_policy(
+            iam.ManagedPolicy.from_aws_managed_policy_name(
+                "service-role/AWSLambdaBasicExecutionRole"
+            )
+        )
+
+        dispatcher_lambda = _lambda.Function(
+            self,
+            "DispatcherFunction",
+            runtime=_lambda.Runtime.PYTHON_3_11,
+            handler="dispatcher_function.lambda_handler",
+            code=_lambda.Code.from_asset("dispatcher_lambda"),
+            role=dispatcher_lambda_role,
+            timeout=Duration.seconds(60),
+            layers=[common_layer],
+            environment={
+                "BUCKET_NAME": bucket_name,
+                "SEARCH_TERMS": ",".join(search_terms),
+                "FETCH_QUEUE_URL": fetch_queue.queue_url,
+                "WEEKLY_QUEUE_URL": weekly_queue.queue_url,
+                "STATE_MACHINE_ARN": state_machine.state_machine_arn,
+            },
+        )
+        fetch_queue.grant_send_messages(dispatcher_lambda)
+        weekly_queue.grant_send_messages(dispatcher_lambda)
+        state_machine.grant_start_execution(dispatcher_lambda)
+
+        # ハンドラーのプロファイル（profiles/配下）の保存権限
+        # （取得・分析・翻訳・週次分析のロールはバケットへの書き込み権限に含まれる）
+        for role in (
+            s3_trigger_lambda_role,
+            index_lambda_role,
+            compact_lambda_role,
+            dispatcher_lambda_role,
+        ):
+            role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["s3:PutObject"],
+                    resources=[f"{bucket.bucket_arn}/profiles/*"],
+                )
+            )
+
+        # 論文取得のディスパッチ（毎日実行、検索語ごとのルールは作成しない）
+        daily_dispatch_rule = events.Rule(
             self,
-            "WeeklySepsisAnalysisRule",
+            "DailyDispatchRule",
             schedule=events.Schedule.cron(
-                minute="0",
-                hour="1",
-                week_day="MON",
+                minute="5",
+                hour="0",  # UTC 0:05 (JST 9:05)
             ),
         )
-
-        # セプシス用のルールにLambda関数をターゲットとして追加
-        weekly_sepsis_rule.add_target(
+        daily_dispatch_rule.add_target(
             targets.LambdaFunction(
-                weekly_analyze_lambda,
-                event=events.RuleTargetInput.from_object({"search_term": "sepsis"}),
+                dispatcher_lambda,
+                event=events.RuleTargetInput.from_object({"job": "fetch"}),
             )
         )
 
-        # 週次分析用EventBridgeルール（ARDS用）- 小文字のardsで統一
-        weekly_ards_rule = events.Rule(
+        # 週次分析のディスパッチ（毎日起動し、レジストリのweekly_dayの曜日のみ送信する）
+        weekly_dispatch_rule = events.Rule(
             self,
-            "WeeklyArdsAnalysisRule",
+            "WeeklyDispatchRule",
             schedule=events.Schedule.cron(
-                minute="15",  # 15分ずらす
-                hour="1",
-                week_day="MON",
+                minute="0",
+                hour="1",  # UTC 1:00 (JST 10:00)
             ),
         )
-
-        # ARDS用のルールにLambda関数をターゲットとして追加（小文字のards）
-        weekly_ards_rule.add_target(
+        weekly_dispatch_rule.add_target(
             targets.LambdaFunction(
-                weekly_analyze_lambda,
-                event=events.RuleTargetInput.from_object({"search_term": "ards"}),
+                dispatcher_lambda,
+                event=events.RuleTargetInput.from_object({"job": "weekly"}),
             )
         )
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+論文索引（SQLite FTS5）の更新と検索を行う
+
+使用例:
+    python scripts/article_index.py update --bucket my-pubmed-bucket             # 未反映の成果物を反映
+    python scripts/article_index.py update --store ./pubmed-data --rebuild       # ローカルのストアで作り直す
+    python scripts/article_index.py pull --bucket my-pubmed-bucket --db articles.sqlite
+    python scripts/article_index.py search --db articles.sqlite "septic shock" \\
+        --term sepsis --since 2025-01-01 --until 2025-03-31   # 今四半期に取得した論文
+    python scripts/article_index.py search --db articles.sqlite --analysis "ステロイド" --facet journal
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+from pathlib import Path
+from typing import Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "layers" / "common" / "python"))
+sys.path.insert(0, str(ROOT))
+
+from pubmed_common import article_index  # noqa: E402
+
+
+def get_client(args: argparse.Namespace):
+    if args.store:
+        from local_pipeline.s3 import LocalS3
+
+        return LocalS3(args.store)
+
+    import boto3
+
+    return boto3.client("s3")
+
+
+def open_connection(args: argparse.Namespace) -> sqlite3.Connection:
+    """--dbのファイル、またはバケットの現在のスナップショットを開く"""
+    if args.db:
+        return sqlite3.connect(f"file:{Path(args.db).resolve()}?mode=ro", uri=True)
+    connection: Optional[sqlite3.Connection] = article_index.open_snapshot(
+        get_client(args), args.bucket
+    )
+    if connection is None:
+        raise SystemExit(f"No article index in {args.bucket}")
+    return connection
+
+
+def command_update(args: argparse.Namespace) -> int:
+    result = article_index.sync_index(get_client(args), args.bucket, args.rebuild)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 1 if result["failed"] else 0
+
+
+def command_pull(args: argparse.Namespace) -> int:
+    connection: Optional[sqlite3.Connection] = article_index.open_snapshot(
+        get_client(args), args.bucket
+    )
+    if connection is None:
+        print(f"No article index in {args.bucket}")
+        return 1
+    # 読み取り専用で開いたスナップショットをSQLiteのバックアップで書き出す
+    with sqlite3.connect(args.db) as target:
+        connection.backup(target)
+    connection.close()
+    print(f"Saved article index to {args.db}")
+    return 0
+
+
+def command_search(args: argparse.Namespace) -> int:
+    filters = {
+        "query": args.query,
+        "analysis_query": args.analysis,
+        "terms": args.term,
+        "start": args.since,
+        "end": args.until,
+        "journals": args.journal,
+        "analyzed": args.analyzed,
+    }
+    connection = open_connection(args)
+    try:
+        if args.facet:
+            rows = article_index.facets(connection, args.facet, args.limit, **filters)
+            results = [{args.facet: value, "articles": count} for value, count in rows]
+        else:
+            results = article_index.search(connection, args.limit, **filters)
+    finally:
+        connection.close()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return 0
+    width = shutil.get_terminal_size().columns
+    for result in results:
+        if args.facet:
+            print(f"{result['articles']:>8}  {result[args.facet]}")
+            continue
+        line = (
+            f"{result['pmid']:>10}  {result['last_seen']}  {','.join(result['terms'])}  "
+            f"{result['journal']}  {result['title']}"
+        )
+        print(line[:width])
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_source(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument(
+            "--bucket", default=os.getenv("BUCKET_NAME"), help="対象のS3バケット名"
+        )
+        subparser.add_argument(
+            "--store", help="S3の代わりに使うローカルのストア（python -m local_pipeline）"
+        )
+
+    update = subparsers.add_parser("update", help="未反映の取得結果・分析結果を索引に反映")
+    add_source(update)
+    update.add_argument("--rebuild", action="store_true", help="空の索引から作り直す")
+    update.set_defaults(handler=command_update)
+
+    pull = subparsers.add_parser("pull", help="現在のスナップショットをファイルに保存")
+    add_source(pull)
+    pull.add_argument("--db", required=True, help="保存先のSQLiteファイル")
+    pull.set_defaults(handler=command_pull)
+
+    search = subparsers.add_parser("search", help="全文検索・絞り込み・集計")
+    add_source(search)
+    search.add_argument("query", nargs="?", help="タイトル・アブストラクトのFTS5検索式")
+    search.add_argument("--db", help="pullで保存したSQLiteファイルを検索する")
+    search.add_argument("--analysis", help="分析結果（impact_reason等）の検索語（3文字以上）")
+    search.add_argument("--term", action="append", help="検索語で絞り込む（複数指定可）")
+    search.add_argument("--since", help="取得日の開始（YYYY-MM-DD）")
+    search.add_argument("--until", help="取得日の終了（YYYY-MM-DD）")
+    search.add_argument("--journal", action="append", help="ジャーナルで絞り込む（複数指定可）")
+    search.add_argument("--analyzed", action="store_true", help="日次分析で選定された論文のみ")
+    search.add_argument(
+        "--facet", choices=sorted(article_index.FACETS), help="項目ごとに件数を集計"
+    )
+    search.add_argument("--limit", type=int, default=article_index.DEFAULT_LIMIT)
+    search.add_argument("--json", action="store_true", help="JSONで出力")
+    search.set_defaults(handler=command_search)
+
+    args = parser.parse_args()
+    if args.store and not args.bucket:
+        args.bucket = "pubmed-local"
+    if not args.bucket and not getattr(args, "db", None):
+        parser.error("--bucket or BUCKET_NAME environment variable is required")
+    status: int = args.handler(args)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
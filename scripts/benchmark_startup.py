@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+各Lambdaハンドラーモジュールのインポート時間（コールドスタート時の初期化時間）を計測する
+インポートごとに新しいPythonプロセスを起動し、繰り返し計測した中央値・最小値・最大値を出力する
+
+使用例:
+    python scripts/benchmark_startup.py                       # 全ハンドラーを5回ずつ計測
+    python scripts/benchmark_startup.py --repeat 10 analyze   # 指定したハンドラーのみ計測
+    python scripts/benchmark_startup.py --clients             # 初回のクライアント作成時間も計測
+    python scripts/benchmark_startup.py --json startup.json   # 結果をJSONで保存
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# ハンドラー名と（コードのディレクトリ、モジュール名）の対応
+HANDLERS = {
+    "fetch": ("lambda", "lambda_function"),
+    "trigger": ("trigger_lambda", "trigger_function"),
+    "analyze": ("analyze_lambda", "analyze_function"),
+    "translate": ("translate_lambda", "translate_function"),
+    "weekly": ("weekly_analyze_lambda", "weekly_analyze_function"),
+    "index": ("index_lambda", "index_function"),
+    "compact": ("compact_lambda", "compact_function"),
+    "dispatcher": ("dispatcher_lambda", "dispatcher_function"),
+}
+
+# 計測用の子プロセスで実行するコード
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import importlib
+importlib.import_module(sys.argv[1])
+result = {"import_ms": (time.perf_counter() - started) * 1000}
+if sys.argv[2] == "1":
+    from pubmed_common import clients
+    for name, create in (
+        ("s3_ms", clients.get_s3),
+        ("openai_ms", clients.get_openai),
+        ("encoding_ms", clients.get_encoding),
+    ):
+        started = time.perf_counter()
+        try:
+            create()
+            result[name] = (time.perf_counter() - started) * 1000
+        except Exception as e:
+            result[name] = None
+            result.setdefault("errors", {})[name] = str(e)
+print(json.dumps(result))
+"""
+
+
+def probe_env(code_dir: str) -> Dict[str, str]:
+    """Lambdaのレイヤー構成（/opt/python）を再現したPYTHONPATHと環境変数"""
+    paths = [
+        ROOT / code_dir,
+        ROOT / "layers" / "common" / "python",
+        ROOT / "layers" / "openai" / "python",
+    ]
+    env = dict(os.environ)
+    if env.get("PYTHONPATH"):
+        paths.append(Path(env["PYTHONPATH"]))
+    env["PYTHONPATH"] = os.pathsep.join(str(path) for path in paths if path.exists())
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    env.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+    env.setdefault("BUCKET_NAME", "benchmark")
+    tiktoken_cache = ROOT / "layers" / "openai" / "tiktoken_cache"
+    if tiktoken_cache.exists():
+        env.setdefault("TIKTOKEN_CACHE_DIR", str(tiktoken_cache))
+    return env
+
+
+def measure(name: str, repeat: int, with_clients: bool) -> Dict[str, Any]:
+    """1つのハンドラーモジュールのインポート時間を繰り返し計測"""
+    code_dir, module = HANDLERS[name]
+    env = probe_env(code_dir)
+    runs: List[Dict[str, Any]] = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-c", _PROBE, module, "1" if with_clients else "0"],
+            env=env,
+            cwd=ROOT / code_dir,
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()[-1:] or ["unknown error"]
+            return {"handler": name, "module": module, "error": error[0]}
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    summary: Dict[str, Any] = {"handler": name, "module": module, "repeat": repeat}
+    for metric in runs[0]:
+        if metric == "errors":
+            summary["errors"] = runs[0]["errors"]
+            continue
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        if values:
+            summary[metric] = {
+                "median": round(statistics.median(values), 2),
+                "min": round(min(values), 2),
+                "max": round(max(values), 2),
+            }
+    return summary
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure Lambda handler import (cold start) time")
+    parser.add_argument("handlers", nargs="*", help=f"Handlers to measure ({', '.join(HANDLERS)})")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of fresh processes per handler"
+    )
+    parser.add_argument("--clients", action="store_true", help="Also measure first client creation")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.handlers if name not in HANDLERS]
+    if unknown:
+        parser.error(f"unknown handlers: {', '.join(unknown)}")
+
+    results = [measure(name, args.repeat, args.clients) for name in args.handlers or HANDLERS]
+
+    for result in results:
+        if "error" in result:
+            print(f"{result['handler']:<10} error: {result['error']}")
+            continue
+        metrics = ", ".join(
+            f"{metric} {values['median']:.1f} (min {values['min']:.1f}, max {values['max']:.1f})"
+            for metric, values in result.items()
+            if isinstance(values, dict) and "median" in values
+        )
+        print(f"{result['handler']:<10} {metrics}")
+        for metric, error in result.get("errors", {}).items():
+            print(f"{'':<10} {metric} error: {error}")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2))
+        print(f"Results written to {args.json}")
+
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+取得結果・分析結果の列指向パーティションの圧縮と、傾向の集計を行う
+
+使用例:
+    python scripts/columnar.py compact --bucket my-pubmed-bucket --since 2025-01 --until 2025-06
+    python scripts/columnar.py compact --store ./pubmed-data --since 2025-01 --rebuild
+    python scripts/columnar.py pull --bucket my-pubmed-bucket --data ./columnar --since 2025-01
+    python scripts/columnar.py trend --data ./columnar --by journal --top 10 --share   # 月ごとの構成比
+    python scripts/columnar.py trend --data ./columnar --bucket-by week --term sepsis \\
+        --metric selection_rate --window 4   # 4週間の移動選定率
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import date, datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "layers" / "common" / "python"))
+sys.path.insert(0, str(ROOT))
+
+from pubmed_common import columnar  # noqa: E402
+
+
+def get_client(args: argparse.Namespace):
+    if args.store:
+        from local_pipeline.s3 import LocalS3
+
+        return LocalS3(args.store)
+
+    import boto3
+
+    return boto3.client("s3")
+
+
+def parse_month(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m").date()
+
+
+def month_range(args: argparse.Namespace) -> list:
+    until = args.until or date.today()
+    months: list = columnar.months_between(args.since or until, until)
+    return months
+
+
+def command_compact(args: argparse.Namespace) -> int:
+    s3 = get_client(args)
+    failed = False
+    for month in month_range(args):
+        result = columnar.compact_month(s3, args.bucket, month, rebuild=args.rebuild)
+        print(json.dumps(result, ensure_ascii=False))
+        failed = failed or bool(result["failed"])
+    return 1 if failed else 0
+
+
+def command_pull(args: argparse.Namespace) -> int:
+    pulled = columnar.pull_partitions(get_client(args), args.bucket, args.data, month_range(args))
+    print(f"Saved {len(pulled)} partitions to {args.data}")
+    return 0
+
+
+def command_trend(args: argparse.Namespace) -> int:
+    months = month_range(args) if args.since or args.until else None
+    dataset = columnar.load_dataset(args.data, months)
+    mask = columnar.select(
+        dataset,
+        terms=args.term,
+        start=args.start,
+        end=args.end,
+        journals=args.journal,
+        publication_types=args.publication_type,
+    )
+    result = columnar.trend(
+        dataset,
+        mask,
+        bucket=args.bucket_by,
+        by=args.by,
+        metric=args.metric,
+        window=args.window,
+        share=args.share,
+        top=args.top,
+    )
+
+    if args.json:
+        output = {
+            "buckets": result["buckets"],
+            "groups": {
+                group: values.tolist() for group, values in zip(result["groups"], result["values"])
+            },
+        }
+        print(json.dumps(output, ensure_ascii=False, indent=2))
+        return 0
+
+    # 期間を行、項目を列とする表で出力
+    integer = args.metric != "selection_rate" and not args.share
+    print("\t".join(["period", *result["groups"]]))
+    for index, period in enumerate(result["buckets"]):
+        values = result["values"][:, index]
+        cells = [f"{value:.0f}" if integer else f"{value:.3f}" for value in values]
+        print("\t".join([period, *cells]))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_months(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument("--since", type=parse_month, help="対象の最初の月（YYYY-MM）")
+        subparser.add_argument(
+            "--until", type=parse_month, help="対象の最後の月（YYYY-MM、既定は今月）"
+        )
+
+    def add_source(subparser: argparse.ArgumentParser) -> None:
+        subparser.add_argument(
+            "--bucket", default=os.getenv("BUCKET_NAME"), help="対象のS3バケット名"
+        )
+        subparser.add_argument(
+            "--store", help="S3の代わりに使うローカルのストア（python -m local_pipeline）"
+        )
+        add_months(subparser)
+
+    compact = subparsers.add_parser(
+        "compact", help="取得結果・分析結果を月ごとのパーティションに圧縮"
+    )
+    add_source(compact)
+    compact.add_argument("--rebuild", action="store_true", help="すべて読み込み直して作り直す")
+    compact.set_defaults(handler=command_compact)
+
+    pull = subparsers.add_parser("pull", help="パーティションをディレクトリにダウンロード")
+    add_source(pull)
+    pull.add_argument("--data", default=columnar.DEFAULT_DATA_DIR, help="保存先のディレクトリ")
+    pull.set_defaults(handler=command_pull)
+
+    trend = subparsers.add_parser("trend", help="ダウンロードしたパーティションで傾向を集計")
+    add_months(trend)
+    trend.add_argument(
+        "--data", default=columnar.DEFAULT_DATA_DIR, help="pullで保存したディレクトリ"
+    )
+    trend.add_argument("--bucket-by", choices=columnar.BUCKETS, default="month", help="集計の期間")
+    trend.add_argument("--by", choices=columnar.GROUPS, help="集計する項目")
+    trend.add_argument("--metric", choices=columnar.METRICS, default="articles")
+    trend.add_argument("--window", type=int, default=1, help="移動合計の期間数")
+    trend.add_argument("--share", action="store_true", help="期間ごとの項目の構成比")
+    trend.add_argument("--top", type=int, help="上位の項目以外をotherにまとめる")
+    trend.add_argument("--term", action="append", help="検索語で絞り込む（複数指定可）")
+    trend.add_argument("--journal", action="append", help="ジャーナルで絞り込む（複数指定可）")
+    trend.add_argument(
+        "--publication-type", action="append", help="出版タイプで絞り込む（複数指定可）"
+    )
+    trend.add_argument("--start", type=date.fromisoformat, help="取得日の開始（YYYY-MM-DD）")
+    trend.add_argument("--end", type=date.fromisoformat, help="取得日の終了（YYYY-MM-DD）")
+    trend.add_argument("--json", action="store_true", help="JSONで出力")
+    trend.set_defaults(handler=command_trend)
+
+    args = parser.parse_args()
+    if getattr(args, "store", None) and not args.bucket:
+        args.bucket = "pubmed-local"
+    if args.command != "trend" and not args.bucket:
+        parser.error("--bucket or BUCKET_NAME environment variable is required")
+    status: int = args.handler(args)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
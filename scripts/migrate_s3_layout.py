@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+バケット直下の旧形式ファイルを日付パーティション形式のキーへ移行し、検索語ごとのマニフェストを再構築する
+
+使用例:
+    python scripts/migrate_s3_layout.py --bucket my-pubmed-bucket            # 移行内容の確認のみ
+    python scripts/migrate_s3_layout.py --bucket my-pubmed-bucket --apply    # コピーとマニフェスト更新
+    python scripts/migrate_s3_layout.py --bucket my-pubmed-bucket --apply --delete-source
+
+raw/ へのコピーはS3イベント通知で分析のワークフローを起動する
+分析結果がある取得結果はコピーの前に処理台帳へ分析済みとして記録し、ワークフローが重複として
+LLMを呼び出さずに終了するようにする（分析結果のない取得結果は移行後に分析される）
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "layers" / "common" / "python"))
+
+from pubmed_common import ledger, s3_layout  # noqa: E402
+
+# 成果物の種類とマニフェストのエントリ名の対応
+MANIFEST_ENTRY_NAMES = {
+    s3_layout.RAW_ROOT: "raw",
+    s3_layout.ANALYSIS_ROOT: "analysis",
+    s3_layout.TRANSLATION_ROOT: "jp_analysis",
+}
+
+
+def find_legacy_keys(s3, bucket: str) -> List[Tuple[str, str]]:
+    """バケット直下の旧形式のキーと移行先のキーの組を列挙"""
+    migrations = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            new_key = s3_layout.partitioned_key(obj["Key"])
+            if new_key:
+                migrations.append((obj["Key"], new_key))
+    return migrations
+
+
+def has_analysis(s3, bucket: str, raw_key: str, migrated_keys: Set[str]) -> bool:
+    """取得結果（パーティション形式のキー）の分析結果が移行対象またはバケットにあるか"""
+    key = s3_layout.analysis_key(raw_key)
+    if key in migrated_keys:
+        return True
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+def seed_ledger(s3, bucket: str, old_key: str, new_key: str) -> None:
+    """
+    コピー先の取得結果を処理台帳に分析済みとして記録
+    単一パートのオブジェクトはコピー後もETagが変わらないため、ワークフローはETagで重複と判定する
+    """
+    etag = s3.head_object(Bucket=bucket, Key=old_key)["ETag"]
+    ledger.complete(
+        s3,
+        bucket,
+        ledger.ANALYSIS_STAGE,
+        new_key,
+        "",
+        etag=etag,
+        output_key=s3_layout.analysis_key(new_key),
+        migrated_from=old_key,
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bucket", default=os.getenv("BUCKET_NAME"), help="対象のS3バケット名")
+    parser.add_argument("--apply", action="store_true", help="実際にコピーとマニフェスト更新を行う")
+    parser.add_argument(
+        "--delete-source", action="store_true", help="コピー後に旧形式のファイルを削除する"
+    )
+    args = parser.parse_args()
+
+    if not args.bucket:
+        parser.error("--bucket or BUCKET_NAME environment variable is required")
+
+    s3 = boto3.client("s3")
+    migrations = find_legacy_keys(s3, args.bucket)
+    print(f"Found {len(migrations)} legacy files in s3://{args.bucket}")
+
+    # 検索語ごと・日付ごとのマニフェストエントリを収集
+    manifest_entries: Dict[str, Dict[str, Dict[str, str]]] = {}
+    migrated_keys = {new_key for _, new_key in migrations}
+
+    # 分析結果を先にコピーし、取得結果のコピーで起動したワークフローから参照できるようにする
+    migrations.sort(key=lambda migration: migration[1].startswith(f"{s3_layout.RAW_ROOT}/"))
+
+    for old_key, new_key in migrations:
+        info = s3_layout.parse_key(old_key)
+        entry_name = MANIFEST_ENTRY_NAMES.get(info["root"])
+        if entry_name:
+            day_entries = manifest_entries.setdefault(info["term"], {})
+            day_entries.setdefault(info["date"].isoformat(), {})[entry_name] = new_key
+
+        analyzed = info["root"] == s3_layout.RAW_ROOT and has_analysis(
+            s3, args.bucket, new_key, migrated_keys
+        )
+        if analyzed:
+            print(f"{'Seed' if args.apply else '[dry-run] Seed'} ledger: {new_key} (analyzed)")
+        print(f"{'Copy' if args.apply else '[dry-run] Copy'}: {old_key} -> {new_key}")
+        if not args.apply:
+            continue
+
+        if analyzed:
+            seed_ledger(s3, args.bucket, old_key, new_key)
+        s3.copy_object(
+            Bucket=args.bucket,
+            Key=new_key,
+            CopySource={"Bucket": args.bucket, "Key": old_key},
+        )
+        if args.delete_source:
+            s3.delete_object(Bucket=args.bucket, Key=old_key)
+
+    for term, days in manifest_entries.items():
+        print(
+            f"{'Update' if args.apply else '[dry-run] Update'} manifest for {term}: {len(days)} days"
+        )
+        if not args.apply:
+            continue
+
+        s3_layout.merge_manifest(s3, args.bucket, term, days)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
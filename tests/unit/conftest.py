@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# Lambdaと同じく、共通レイヤーとハンドラーのディレクトリからインポートする
+for path in ("layers/common/python", "analyze_lambda"):
+    if str(ROOT / path) not in sys.path:
+        sys.path.insert(0, str(ROOT / path))
+
+os.environ.setdefault("METRICS_DISABLED", "1")
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="pubmed_test_cache_"))
+os.environ.setdefault("OPENAI_API_KEY", "test")
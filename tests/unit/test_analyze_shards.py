@@ -0,0 +1,132 @@
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("botocore")
+pytest.importorskip("openai")
+
+import analyze_function  # noqa: E402
+
+
+def make_articles(count):
+    return {
+        str(pmid): {
+            "pmid": str(pmid),
+            "title": f"Title {pmid}",
+            "abstract": "Abstract",
+            "journal": "Journal",
+            "publication_year": "2025",
+        }
+        for pmid in range(1, count + 1)
+    }
+
+
+@pytest.fixture
+def article_tokens(monkeypatch):
+    """論文は1件100トークン、プロンプトは0トークンとして数える"""
+    monkeypatch.setattr(
+        analyze_function,
+        "num_tokens_from_string",
+        lambda string, model="gpt-4": 100 if string.startswith("PMID:") else 0,
+    )
+
+
+def test_split_into_shards_groups_chunks_in_order(article_tokens):
+    # 2件ずつのチャンク（4個）を3チャンクずつのシャードにまとめる
+    shards = analyze_function.split_into_shards(
+        make_articles(7), chunks_per_shard=3, max_tokens=250
+    )
+    assert shards == [["1", "2", "3", "4", "5", "6"], ["7"]]
+
+
+def test_split_into_shards_without_articles(article_tokens):
+    assert analyze_function.split_into_shards({}) == []
+
+
+def shard(*articles, status=200):
+    return {"statusCode": status, "results": list(articles)}
+
+
+def candidate(pmid, reason):
+    return {"pmid": pmid, "impact_reason": reason}
+
+
+def test_merge_shard_results_keeps_longest_reason_per_pmid():
+    merged = analyze_function.merge_shard_results(
+        [shard(candidate("1", "short")), shard(candidate(1, "a longer reason"))]
+    )
+    assert merged == [candidate(1, "a longer reason")]
+
+
+def test_merge_shard_results_selects_top_three():
+    merged = analyze_function.merge_shard_results(
+        [
+            shard(candidate("1", "x" * 10), candidate("2", "x" * 40)),
+            shard(candidate("3", "x" * 30), candidate("4", "x" * 20)),
+        ]
+    )
+    assert [article["pmid"] for article in merged] == ["2", "3", "4"]
+
+
+def test_merge_shard_results_ignores_failed_shards():
+    merged = analyze_function.merge_shard_results(
+        [shard(candidate("1", "reason")), {"statusCode": 500, "results": [], "details": "boom"}]
+    )
+    assert merged == [candidate("1", "reason")]
+
+
+MERGE_EVENT = {
+    "bucket": "bucket",
+    "key": "raw/sepsis/2025/03/19/articles.json",
+    "etag": '"etag"',
+    "content_hash": "digest",
+    "search_term": "sepsis",
+    "total_articles": 2,
+}
+
+
+@pytest.fixture
+def merge_services():
+    with (
+        mock.patch.object(analyze_function.clients, "get_s3") as get_s3,
+        mock.patch.object(analyze_function, "ledger") as ledger,
+        mock.patch.object(analyze_function, "save_analysis") as save_analysis,
+    ):
+        save_analysis.return_value = {"statusCode": 200, "output_key": "analysis/output.json"}
+        yield get_s3.return_value, ledger, save_analysis
+
+
+def test_merge_handler_saves_and_completes(merge_services):
+    s3, ledger, save_analysis = merge_services
+    event = {**MERGE_EVENT, "shard_results": [shard(candidate("1", "reason"))]}
+
+    output = analyze_function.merge_handler(event, None)
+
+    assert output["output_key"] == "analysis/output.json"
+    save_analysis.assert_called_once_with(
+        "bucket", MERGE_EVENT["key"], "sepsis", 2, [candidate("1", "reason")]
+    )
+    ledger.complete.assert_called_once()
+    ledger.release.assert_not_called()
+
+
+def test_merge_handler_fails_without_saving_partial_results(merge_services):
+    s3, ledger, save_analysis = merge_services
+    failed = {"statusCode": 500, "results": [], "details": "OpenAI error"}
+    event = {**MERGE_EVENT, "shard_results": [shard(candidate("1", "reason")), failed]}
+
+    with pytest.raises(analyze_function.ShardAnalysisFailed, match="1 of 2 shards failed"):
+        analyze_function.merge_handler(event, None)
+
+    save_analysis.assert_not_called()
+    ledger.complete.assert_not_called()
+    ledger.release.assert_called_once()
+    assert ledger.release.call_args.args[3:5] == (MERGE_EVENT["key"], "digest")
+
+
+def test_analyze_chunks_fails_when_budget_is_unavailable():
+    # チャンクの論文を落として一部の結果を返さず、シャードを失敗させる
+    error = analyze_function.budget.BudgetUnavailable("throttled")
+    with mock.patch.object(analyze_function, "analyze_chunk", side_effect=[[], error]):
+        with pytest.raises(analyze_function.budget.BudgetUnavailable):
+            analyze_function.analyze_chunks([{"1": {}}, {"2": {}}])
@@ -0,0 +1,134 @@
+import json
+from datetime import date
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from pubmed_common import article_index, s3_layout  # noqa: E402
+
+from local_pipeline.s3 import LocalS3  # noqa: E402
+
+BUCKET = "bucket"
+DAY = date(2025, 3, 19)
+RAW_KEY = s3_layout.raw_key("sepsis", DAY)
+ANALYSIS_KEY = s3_layout.analysis_key(RAW_KEY)
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    monkeypatch.setenv("ARTICLE_INDEX_DIR", str(tmp_path / "index"))
+    # 作業コピーの状態はテストごとにリセットする
+    monkeypatch.setitem(article_index._working, "snapshot", None)
+    return LocalS3(str(tmp_path / "store"))
+
+
+def put_json(s3, key, data):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(data))
+
+
+def article(pmid, title, abstract="Abstract"):
+    return {
+        "pmid": pmid,
+        "title": title,
+        "abstract": abstract,
+        "journal": "Critical Care",
+        "publication_year": "2025",
+        "authors": ["Sato"],
+    }
+
+
+@pytest.fixture
+def artifacts(s3):
+    put_json(
+        s3,
+        RAW_KEY,
+        {
+            "articles": {
+                "1": article("1", "Vasopressin in septic shock"),
+                "2": article("2", "Early antibiotics for sepsis"),
+            }
+        },
+    )
+    put_json(
+        s3,
+        ANALYSIS_KEY,
+        {
+            "metadata": {"analysis_date": "2025-03-19T06:00:00"},
+            "impactful_articles": [
+                {"pmid": "1", "impact_reason": "Reduced mortality", "summary": "RCT"}
+            ],
+        },
+    )
+    return s3
+
+
+def test_sync_then_search_finds_articles(artifacts):
+    result = article_index.sync_index(artifacts, BUCKET)
+    assert result["indexed"] == 2
+    assert result["articles"] == 3
+
+    connection = article_index.open_snapshot(artifacts, BUCKET)
+    try:
+        hits = article_index.search(connection, query="vasopressin")
+        assert [hit["pmid"] for hit in hits] == ["1"]
+        assert hits[0]["terms"] == ["sepsis"]
+        assert hits[0]["first_seen"] == DAY.isoformat()
+        assert hits[0]["analyses"] == 1
+
+        analyzed = article_index.search(connection, analysis_query="mortality")
+        assert [hit["pmid"] for hit in analyzed] == ["1"]
+        assert article_index.facets(connection, "journal") == [("Critical Care", 2)]
+    finally:
+        connection.close()
+
+
+def test_resync_is_idempotent(artifacts):
+    first = article_index.sync_index(artifacts, BUCKET)
+    second = article_index.sync_index(artifacts, BUCKET)
+
+    # 同じバージョンの成果物は読み込まず、スナップショットも差し替えない
+    assert second["indexed"] == 0
+    assert second["snapshot"] == first["snapshot"]
+    pointer, _ = article_index.load_pointer(artifacts, BUCKET)
+    assert pointer["snapshot"] == first["snapshot"]
+    assert (pointer["articles"], pointer["analyses"], pointer["sources"]) == (2, 1, 2)
+
+
+def test_resync_replaces_changed_artifacts(artifacts):
+    article_index.sync_index(artifacts, BUCKET)
+    put_json(artifacts, RAW_KEY, {"articles": {"1": article("1", "Corticosteroids in sepsis")}})
+
+    result = article_index.sync_index(artifacts, BUCKET)
+
+    assert result["indexed"] == 1
+    connection = article_index.open_snapshot(artifacts, BUCKET)
+    try:
+        assert article_index.search(connection, query="vasopressin") == []
+        assert [
+            hit["pmid"] for hit in article_index.search(connection, query="corticosteroids")
+        ] == ["1"]
+    finally:
+        connection.close()
+
+
+def test_indexed_analyses_returns_only_indexed_keys(artifacts):
+    article_index.sync_index(artifacts, BUCKET)
+    missing_key = s3_layout.analysis_key(s3_layout.raw_key("ards", DAY))
+
+    analyses = article_index.indexed_analyses(artifacts, BUCKET, [ANALYSIS_KEY, missing_key])
+
+    assert list(analyses) == [ANALYSIS_KEY]
+    assert analyses[ANALYSIS_KEY] == [
+        {
+            "pmid": "1",
+            "impact_reason": "Reduced mortality",
+            "summary": "RCT",
+            "source_file": ANALYSIS_KEY,
+            "analysis_date": "2025-03-19T06:00:00",
+        }
+    ]
+
+
+def test_indexed_analyses_without_index_is_empty(s3):
+    assert article_index.indexed_analyses(s3, BUCKET, [ANALYSIS_KEY]) == {}
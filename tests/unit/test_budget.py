@@ -0,0 +1,180 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from botocore.exceptions import ClientError  # noqa: E402
+from pubmed_common import budget, clients, s3_layout  # noqa: E402
+
+from local_pipeline.s3 import LocalS3  # noqa: E402
+
+BUCKET = "bucket"
+
+
+class FakeDynamoDB:
+    """予算のカウンターの更新（SET/ADDと上限の条件）のみを再現するDynamoDBクライアント"""
+
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        values = {name: float(value["N"]) for name, value in ExpressionAttributeValues.items()}
+        item = self.items.setdefault((Key["day"]["S"], Key["scope"]["S"]), {})
+        committed = item.get("committed_tokens", 0.0)
+        if ":remaining" in values and committed > values[":remaining"]:
+            raise self.exceptions.ConditionalCheckFailedException()
+        if ":daily_usd" in values and item.get("cost_usd", 0.0) > values[":daily_usd"]:
+            raise self.exceptions.ConditionalCheckFailedException()
+        for name in UpdateExpression.partition(" ADD ")[2].split(", "):
+            attribute, placeholder = name.split(" ")
+            item[attribute] = item.get(attribute, 0.0) + values[placeholder]
+
+    def query(self, TableName, ExpressionAttributeValues, **kwargs):
+        day = ExpressionAttributeValues[":day"]["S"]
+        return {
+            "Items": [
+                {
+                    "scope": {"S": scope},
+                    **{name: {"N": str(value)} for name, value in attributes.items()},
+                }
+                for (item_day, scope), attributes in self.items.items()
+                if item_day == day
+            ]
+        }
+
+
+class ConflictingS3(LocalS3):
+    """条件付き書き込みが常に競合するストア"""
+
+    def put_object(self, **kwargs):
+        raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    store = LocalS3(str(tmp_path))
+    monkeypatch.setattr(clients, "get_s3", lambda *args, **kwargs: store)
+    monkeypatch.setenv("BUDGET_DAILY_TOKENS", "1000")
+    monkeypatch.setenv("GPT_MODEL", "gpt-4o")
+    return store
+
+
+def response(prompt_tokens, completion_tokens):
+    return SimpleNamespace(
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    )
+
+
+def test_reserve_settles_actual_usage(s3):
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with budget.reserve(budget_plan, 300) as call:
+        assert budget.load_state(BUCKET)["total"]["reserved_tokens"] == 300
+        call["response"] = response(120, 30)
+
+    total = budget.load_state(BUCKET)["total"]
+    assert total["reserved_tokens"] == 0
+    assert total["used_tokens"] == 150
+    assert total["calls"] == 1
+
+
+def test_reserve_raises_when_limit_would_be_exceeded(s3):
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with pytest.raises(budget.BudgetExceeded):
+        with budget.reserve(budget_plan, 1001):
+            pytest.fail("LLM must not be called over the budget")
+
+    assert budget.load_state(BUCKET)["total"]["reserved_tokens"] == 0
+
+
+def test_reserve_fails_closed_when_state_cannot_be_written(s3, tmp_path, monkeypatch):
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    monkeypatch.setattr(clients, "get_s3", lambda *args, **kwargs: ConflictingS3(str(tmp_path)))
+    monkeypatch.setattr(s3_layout, "CONDITIONAL_WRITE_BACKOFF_SECONDS", 0)
+
+    with pytest.raises(budget.BudgetUnavailable):
+        with budget.reserve(budget_plan, 100):
+            pytest.fail("LLM must not be called without a reservation")
+
+
+def test_reserve_is_noop_without_limits(s3, monkeypatch):
+    monkeypatch.delenv("BUDGET_DAILY_TOKENS")
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with budget.reserve(budget_plan, 10_000) as call:
+        assert call == {}
+
+
+def test_reserve_releases_reservation_when_settle_fails(s3, monkeypatch):
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    update = budget._update
+    calls = []
+
+    def fail_settle_once(budget_plan, mutate):
+        calls.append(mutate)
+        if len(calls) == 2:
+            raise RuntimeError("S3 unavailable")
+        return update(budget_plan, mutate)
+
+    monkeypatch.setattr(budget, "_update", fail_settle_once)
+    with budget.reserve(budget_plan, 300) as call:
+        call["response"] = response(120, 30)
+
+    # 確定の失敗後に予約の取り消しを再試行する
+    assert len(calls) == 3
+    assert budget.load_state(BUCKET)["total"]["reserved_tokens"] == 0
+
+
+@pytest.fixture
+def dynamodb(s3, monkeypatch):
+    client = FakeDynamoDB()
+    monkeypatch.setattr(clients, "get_dynamodb", lambda: client)
+    monkeypatch.setenv("BUDGET_TABLE", "budget")
+    return client
+
+
+def test_dynamodb_counters_reserve_and_settle(dynamodb):
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with budget.reserve(budget_plan, 300) as call:
+        state = budget.load_state(BUCKET)
+        assert state["total"]["reserved_tokens"] == 300
+        assert state["terms"]["sepsis"]["reserved_tokens"] == 300
+        call["response"] = response(120, 30)
+
+    state = budget.load_state(BUCKET)
+    assert state["total"] == {
+        "used_tokens": 150,
+        "reserved_tokens": 0,
+        "cost_usd": 0.0006,
+        "calls": 1,
+    }
+    assert state["stages"]["analyze"]["used_tokens"] == 150
+    # 延期した処理の一覧はS3に残る
+    assert state["deferred"] == []
+
+
+def test_dynamodb_reserve_rolls_back_when_a_later_limit_is_exceeded(dynamodb, monkeypatch):
+    monkeypatch.setenv("BUDGET_TERM_TOKENS", "default=400")
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with budget.reserve(budget_plan, 300):
+        # 全体と処理段階には空きがあるが、検索語の上限を超える
+        with pytest.raises(budget.BudgetExceeded):
+            with budget.reserve(budget_plan, 200):
+                pytest.fail("LLM must not be called over the budget")
+        assert budget.load_state(BUCKET)["total"]["reserved_tokens"] == 300
+
+    assert budget.load_state(BUCKET)["total"]["reserved_tokens"] == 0
+
+
+def test_dynamodb_reserve_raises_budget_unavailable_on_errors(dynamodb, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("throttled")
+
+    monkeypatch.setattr(dynamodb, "update_item", fail)
+    budget_plan = budget.plan(BUCKET, "analyze", "sepsis")
+    with pytest.raises(budget.BudgetUnavailable):
+        with budget.reserve(budget_plan, 100):
+            pytest.fail("LLM must not be called without a reservation")
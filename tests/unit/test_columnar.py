@@ -0,0 +1,133 @@
+import json
+from datetime import date
+
+import pytest
+
+pytest.importorskip("botocore")
+np = pytest.importorskip("numpy")
+
+from pubmed_common import columnar, s3_layout  # noqa: E402
+
+from local_pipeline.s3 import LocalS3  # noqa: E402
+
+BUCKET = "bucket"
+MARCH = date(2025, 3, 1)
+APRIL = date(2025, 4, 1)
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return LocalS3(str(tmp_path / "store"))
+
+
+def put_json(s3, key, data):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(data))
+
+
+def put_day(s3, term, day, articles, selected=()):
+    """取得結果と、selectedのPMIDを選定した分析結果を書き込む"""
+    raw_key = s3_layout.raw_key(term, day)
+    put_json(s3, raw_key, {"articles": {article["pmid"]: article for article in articles}})
+    impactful = [{"pmid": pmid} for pmid in selected]
+    put_json(s3, s3_layout.analysis_key(raw_key), {"impactful_articles": impactful})
+    return raw_key
+
+
+def article(pmid, journal="Critical Care", publication_types=("Journal Article",)):
+    return {
+        "pmid": pmid,
+        "journal": journal,
+        "publication_year": "2025",
+        "publication_types": list(publication_types),
+    }
+
+
+@pytest.fixture
+def artifacts(s3):
+    put_day(
+        s3,
+        "sepsis",
+        date(2025, 3, 17),
+        [article("1", publication_types=("Randomized Controlled Trial",)), article("2")],
+        selected=["1"],
+    )
+    put_day(s3, "sepsis", date(2025, 3, 24), [article("3", journal="Lancet")])
+    put_day(s3, "ards", date(2025, 4, 1), [article("4", journal="Lancet")], selected=["4"])
+    return s3
+
+
+def test_partition_round_trip(s3):
+    partition = columnar.empty_partition()
+    rows = columnar.build_rows(
+        [(s3_layout.raw_key("sepsis", date(2025, 3, 17)), {"articles": {"1": article("1")}}, None)],
+        partition["dictionaries"],
+    )
+    partition = columnar.merge_rows(partition, [], rows)
+    partition["versions"] = {"raw-key": "v1"}
+
+    updated = columnar.save_partition(s3, BUCKET, MARCH, partition, None, None)
+    meta, etag, loaded = columnar.load_partition(s3, BUCKET, MARCH)
+
+    assert meta["generation"] == updated["generation"]
+    assert meta["rows"] == 1
+    assert etag
+    assert loaded["dictionaries"] == partition["dictionaries"]
+    assert loaded["versions"] == {"raw-key": "v1"}
+    for name, dtype in columnar.COLUMNS.items():
+        assert loaded["columns"][name].dtype == np.dtype(dtype)
+        np.testing.assert_array_equal(loaded["columns"][name], partition["columns"][name])
+
+
+def test_save_partition_returns_none_on_conflict(s3):
+    partition = columnar.empty_partition()
+    columnar.save_partition(s3, BUCKET, MARCH, partition, None, None)
+    # 他の圧縮処理が先にmeta.jsonを作成した場合
+    assert columnar.save_partition(s3, BUCKET, MARCH, partition, None, None) is None
+
+
+def test_compact_month_only_reloads_changed_files(artifacts):
+    first = columnar.compact_month(artifacts, BUCKET, MARCH, terms=["sepsis"])
+    assert (first["compacted"], first["rows"]) == (2, 3)
+
+    unchanged = columnar.compact_month(artifacts, BUCKET, MARCH, terms=["sepsis"])
+    assert unchanged["compacted"] == 0
+
+    # 2日目の取得結果を差し替えると、その日の行だけを読み込み直す
+    put_day(artifacts, "sepsis", date(2025, 3, 24), [article("5"), article("6")], selected=["6"])
+    changed = columnar.compact_month(artifacts, BUCKET, MARCH, terms=["sepsis"])
+    assert (changed["compacted"], changed["rows"]) == (1, 4)
+
+    _, _, partition = columnar.load_partition(artifacts, BUCKET, MARCH)
+    columns = partition["columns"]
+    assert sorted(columns["pmid"].tolist()) == [1, 2, 5, 6]
+    assert sorted(columns["pmid"][columns["selected"]].tolist()) == [1, 6]
+    # 使われなくなったジャーナルは辞書から除かれる
+    assert partition["dictionaries"]["journals"] == ["Critical Care"]
+    # 出版タイプの行番号は残した行の新しい行番号に付け替えられる
+    types = partition["dictionaries"]["publication_types"]
+    trials = columns["type_row"][
+        columns["publication_type"] == types.index("Randomized Controlled Trial")
+    ]
+    assert columns["pmid"][trials].tolist() == [1]
+
+
+def test_trend_over_pulled_months(artifacts, tmp_path):
+    columnar.compact_month(artifacts, BUCKET, MARCH, terms=["sepsis", "ards"])
+    columnar.compact_month(artifacts, BUCKET, APRIL, terms=["sepsis", "ards"])
+    directory = str(tmp_path / "columnar")
+    assert columnar.pull_partitions(artifacts, BUCKET, directory, [MARCH, APRIL]) == [MARCH, APRIL]
+    dataset = columnar.load_dataset(directory)
+
+    by_term = columnar.trend(dataset, bucket="week", by="term")
+    assert by_term["buckets"] == ["2025-03-17", "2025-03-24", "2025-03-31"]
+    assert by_term["groups"] == ["ards", "sepsis"]
+    np.testing.assert_array_equal(by_term["values"], [[0, 0, 1], [2, 1, 0]])
+
+    rate = columnar.trend(dataset, bucket="month", metric="selection_rate")
+    assert rate["buckets"] == ["2025-03", "2025-04"]
+    np.testing.assert_allclose(rate["values"], [[1 / 3, 1.0]])
+
+    trials = columnar.select(dataset, publication_types=["Randomized Controlled Trial"])
+    assert dataset["columns"]["pmid"][trials].tolist() == [1]
+    lancet = columnar.trend(dataset, columnar.select(dataset, journals=["Lancet"]), bucket="month")
+    np.testing.assert_array_equal(lancet["values"], [[1, 1]])
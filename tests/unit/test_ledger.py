@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("botocore")
+
+from pubmed_common import ledger, s3_layout  # noqa: E402
+
+from local_pipeline.s3 import LocalS3  # noqa: E402
+
+BUCKET = "bucket"
+KEY = "raw/sepsis/2025/03/19/articles.json"
+
+
+@pytest.fixture
+def s3(tmp_path):
+    return LocalS3(str(tmp_path))
+
+
+def lease_expires_at(s3):
+    entry, _ = ledger.get_entry(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY)
+    return datetime.fromisoformat(entry["lease_expires_at"])
+
+
+def set_lease(s3, expires_at):
+    entry, _ = ledger.get_entry(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY)
+    entry["lease_expires_at"] = expires_at.isoformat()
+    s3.put_object(
+        Bucket=BUCKET,
+        Key=s3_layout.ledger_key(ledger.ANALYSIS_STAGE, KEY),
+        Body=json.dumps(entry),
+    )
+
+
+def test_claim_rejects_duplicate_while_processing(s3):
+    assert ledger.claim(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    assert not ledger.claim(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+
+
+def test_renew_extends_lease_when_half_expired(s3):
+    ledger.claim(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    set_lease(s3, datetime.now() + timedelta(seconds=60))
+
+    assert ledger.renew(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    remaining = lease_expires_at(s3) - datetime.now()
+    assert remaining > timedelta(seconds=ledger.DEFAULT_LEASE_SECONDS - 60)
+
+
+def test_renew_keeps_fresh_lease(s3):
+    ledger.claim(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    before = lease_expires_at(s3)
+
+    assert ledger.renew(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    assert lease_expires_at(s3) == before
+
+
+def test_renew_fails_after_claim_is_lost(s3):
+    ledger.claim(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    ledger.release(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest", "error")
+
+    assert not ledger.renew(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "digest")
+    assert not ledger.renew(s3, BUCKET, ledger.ANALYSIS_STAGE, KEY, "other")
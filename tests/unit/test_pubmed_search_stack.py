@@ -0,0 +1,229 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+pytest.importorskip("aws_cdk")
+
+from aws_cdk.assertions import Match, Template  # noqa: E402
+
+ROOT = Path(__file__).resolve().parents[2]
+
+# アセットのパスはjsiiのプロセスの作業ディレクトリからの相対パスのため、別プロセスで合成する
+SYNTH_SCRIPT = """
+import json
+import sys
+
+import aws_cdk as cdk
+from aws_cdk.assertions import Template
+
+sys.path.insert(0, sys.argv[1])
+from pubmed_search.pubmed_search_stack import PubmedSearchStack
+
+app = cdk.App(context=json.loads(sys.argv[2]))
+print(json.dumps(Template.from_stack(PubmedSearchStack(app, "PubmedSearchStack")).to_json()))
+"""
+
+
+@pytest.fixture(scope="module")
+def asset_root(tmp_path_factory):
+    """
+    Lambdaのコードのディレクトリを参照できる作業ディレクトリ
+    OpenAIのレイヤー（./create-layer.sh で作成）がない場合は空のレイヤーで代用する
+    """
+    root = tmp_path_factory.mktemp("assets")
+    for path in ROOT.iterdir():
+        if path.name != "layers":
+            (root / path.name).symlink_to(path)
+    (root / "layers").mkdir()
+    (root / "layers" / "common").symlink_to(ROOT / "layers" / "common")
+    openai_layer = ROOT / "layers" / "openai"
+    if openai_layer.exists():
+        (root / "layers" / "openai").symlink_to(openai_layer)
+    else:
+        (root / "layers" / "openai" / "python").mkdir(parents=True)
+    return root
+
+
+def synth(asset_root: Path, **context) -> Template:
+    context = {
+        "bucket_name": "pubmed-test-bucket",
+        "openai_api_key": "test",
+        "gpt_model": "gpt-4",
+        **context,
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", SYNTH_SCRIPT, str(ROOT), json.dumps(context)],
+        cwd=asset_root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return Template.from_json(json.loads(result.stdout))
+
+
+@pytest.fixture(scope="module")
+def template(asset_root):
+    return synth(asset_root)
+
+
+def workflow_definition(template: Template) -> Dict[str, Any]:
+    """ステートマシンの定義（Fn::Joinの参照部分は空文字列として結合）"""
+    state_machine = next(iter(template.find_resources("AWS::StepFunctions::StateMachine").values()))
+    parts = state_machine["Properties"]["DefinitionString"]["Fn::Join"][1]
+    definition: Dict[str, Any] = json.loads(
+        "".join(part for part in parts if isinstance(part, str))
+    )
+    return definition
+
+
+def test_bucket_is_private_and_versioned(template):
+    template.has_resource_properties(
+        "AWS::S3::Bucket",
+        {
+            "BucketName": "pubmed-test-bucket",
+            "VersioningConfiguration": {"Status": "Enabled"},
+            "PublicAccessBlockConfiguration": {
+                "BlockPublicAcls": True,
+                "BlockPublicPolicy": True,
+                "IgnorePublicAcls": True,
+                "RestrictPublicBuckets": True,
+            },
+        },
+    )
+
+
+@pytest.mark.parametrize(
+    "handler",
+    [
+        "lambda_function.lambda_handler",
+        "analyze_function.split_handler",
+        "analyze_function.analyze_shard_handler",
+        "analyze_function.merge_handler",
+        "translate_function.lambda_handler",
+        "trigger_function.handler",
+        "weekly_analyze_function.lambda_handler",
+    ],
+)
+def test_pipeline_functions_exist(template, handler):
+    template.has_resource_properties("AWS::Lambda::Function", {"Handler": handler})
+
+
+def test_workflow_analyzes_shards_and_fails_on_errors(template):
+    definition = workflow_definition(template)
+    states = definition["States"]
+
+    assert definition["StartAt"] == "SplitPapers"
+    assert definition["TimeoutSeconds"] == 900
+    assert states["AnalyzeShards"]["Type"] == "Map"
+    assert states["AnalyzeShards"]["MaxConcurrency"] == 5
+    assert states["AnalyzeShards"]["Next"] == "MergeAnalyses"
+    for name in ("SplitPapers", "AnalyzeShards", "MergeAnalyses", "TranslateToPapers"):
+        assert states[name]["Catch"][0]["ErrorEquals"] == ["States.ALL"]
+
+
+def test_analyze_max_concurrency_from_context(asset_root):
+    template = synth(asset_root, analyze_max_concurrency=8)
+    assert workflow_definition(template)["States"]["AnalyzeShards"]["MaxConcurrency"] == 8
+
+
+def test_trigger_can_start_and_describe_executions(template):
+    template.has_resource_properties(
+        "AWS::IAM::Policy",
+        {
+            "PolicyDocument": {
+                "Statement": Match.array_with(
+                    [Match.object_like({"Action": "states:StartExecution"})]
+                )
+            },
+            "Roles": [{"Ref": Match.string_like_regexp("S3TriggerLambdaRole")}],
+        },
+    )
+    template.has_resource_properties(
+        "AWS::IAM::Policy",
+        {
+            "PolicyDocument": {
+                "Statement": Match.array_with(
+                    [Match.object_like({"Action": Match.array_with(["states:DescribeExecution"])})]
+                )
+            },
+            "Roles": [{"Ref": Match.string_like_regexp("S3TriggerLambdaRole")}],
+        },
+    )
+
+
+def test_trigger_queue_has_dead_letter_queue(template):
+    template.has_resource_properties(
+        "AWS::SQS::Queue",
+        {"RedrivePolicy": Match.object_like({"maxReceiveCount": 5})},
+    )
+
+
+@pytest.mark.parametrize(
+    "role",
+    ["S3TriggerLambdaRole", "ArticleIndexLambdaRole", "CompactLambdaRole", "DispatcherLambdaRole"],
+)
+def test_profiled_handlers_can_save_profiles(template, role):
+    template.has_resource_properties(
+        "AWS::IAM::Policy",
+        {
+            "PolicyDocument": {
+                "Statement": Match.array_with(
+                    [
+                        Match.object_like(
+                            {
+                                "Action": "s3:PutObject",
+                                "Resource": {"Fn::Join": ["", [Match.any_value(), "/profiles/*"]]},
+                            }
+                        )
+                    ]
+                )
+            },
+            "Roles": [{"Ref": Match.string_like_regexp(role)}],
+        },
+    )
+
+
+def test_dynamodb_tables_only_with_their_context(template):
+    template.resource_count_is("AWS::DynamoDB::Table", 0)
+
+
+def test_rate_limit_table_with_openai_quotas(asset_root):
+    quota_template = synth(asset_root, openai_tpm=800000)
+    quota_template.resource_count_is("AWS::DynamoDB::Table", 1)
+    quota_template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "translate_function.lambda_handler",
+            "Environment": {
+                "Variables": Match.object_like(
+                    {
+                        "OPENAI_TPM": "800000",
+                        "RATE_LIMIT_TABLE": {"Ref": Match.string_like_regexp("RateLimitTable")},
+                    }
+                )
+            },
+        },
+    )
+
+
+def test_budget_table_with_budget_context(asset_root):
+    budget_template = synth(asset_root, budget={"BUDGET_DAILY_TOKENS": "2000000"})
+    budget_template.has_resource_properties(
+        "AWS::DynamoDB::Table",
+        {"KeySchema": [{"AttributeName": "day", "KeyType": "HASH"}, Match.any_value()]},
+    )
+    budget_template.has_resource_properties(
+        "AWS::Lambda::Function",
+        {
+            "Handler": "analyze_function.analyze_shard_handler",
+            "Environment": {
+                "Variables": Match.object_like(
+                    {"BUDGET_TABLE": {"Ref": Match.string_like_regexp("BudgetTable")}}
+                )
+            },
+        },
+    )
@@ -0,0 +1,126 @@
+import pytest
+from pubmed_common import rate_limiter
+
+
+def test_refill_is_capped_at_capacity():
+    assert rate_limiter.refill(2.0, 100.0, 103.0, 1.5, 10.0) == 6.5
+    assert rate_limiter.refill(2.0, 100.0, 200.0, 1.5, 10.0) == 10.0
+    # 時刻が戻った場合は補充しない
+    assert rate_limiter.refill(2.0, 100.0, 99.0, 1.5, 10.0) == 2.0
+
+
+def test_take_tokens_returns_remaining_or_wait():
+    assert rate_limiter.take_tokens(10.0, 4.0, 2.0, 10.0) == (6.0, 0.0)
+    assert rate_limiter.take_tokens(3.0, 4.0, 2.0, 10.0) == (None, 0.5)
+
+
+def test_take_tokens_over_capacity_waits_for_full_bucket():
+    assert rate_limiter.take_tokens(8.0, 25.0, 2.0, 10.0) == (None, 1.0)
+    assert rate_limiter.take_tokens(10.0, 25.0, 2.0, 10.0) == (-15.0, 0.0)
+
+
+def test_give_back_tokens_is_capped_at_capacity():
+    assert rate_limiter.give_back_tokens(3.0, 4.0, 10.0) == 7.0
+    assert rate_limiter.give_back_tokens(8.0, 4.0, 10.0) == 10.0
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return rate_limiter.MemoryBackend()
+    return rate_limiter.SQLiteBackend(str(tmp_path / "rate_limit.sqlite"))
+
+
+@pytest.fixture
+def frozen_time(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "time", lambda: now[0])
+    return now
+
+
+def test_backend_take_until_empty_then_refill(backend, frozen_time):
+    assert backend.take("b", 6, 1.0, 10.0) == 0.0
+    assert backend.take("b", 6, 1.0, 10.0) == 2.0
+    frozen_time[0] += 2.0
+    assert backend.take("b", 6, 1.0, 10.0) == 0.0
+
+
+def test_backend_give_back_restores_tokens(backend, frozen_time):
+    assert backend.take("b", 8, 1.0, 10.0) == 0.0
+    backend.give_back("b", 8, 1.0, 10.0)
+    assert backend.take("b", 10, 1.0, 10.0) == 0.0
+
+
+def test_backend_drain_empties_bucket(backend, frozen_time):
+    backend.drain("b")
+    assert backend.take("b", 1, 1.0, 10.0) == 1.0
+
+
+def test_backends_are_separate_per_name(backend, frozen_time):
+    backend.drain("a")
+    assert backend.take("b", 1, 1.0, 10.0) == 0.0
+
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path, frozen_time):
+    path = str(tmp_path / "rate_limit.sqlite")
+    rate_limiter.SQLiteBackend(path).take("b", 10, 1.0, 10.0)
+    assert rate_limiter.SQLiteBackend(path).take("b", 1, 1.0, 10.0) == 1.0
+
+
+@pytest.fixture
+def memory_backend(monkeypatch):
+    backend = rate_limiter.MemoryBackend()
+    monkeypatch.setattr(rate_limiter, "get_backend", lambda: backend)
+    monkeypatch.setenv("OPENAI_TPM", "600")
+    monkeypatch.delenv("OPENAI_RPM", raising=False)
+    monkeypatch.setenv("RATE_LIMIT_TERM_SHARE", "0.5")
+    return backend
+
+
+def test_acquire_takes_term_and_global_tokens(memory_backend):
+    rate_limiter.acquire(30, "sepsis")
+    # 全体: 毎秒10トークン・容量100、検索語: 毎秒5トークン・容量50
+    assert memory_backend.buckets["openai:tokens"][0] == pytest.approx(70, abs=0.1)
+    assert memory_backend.buckets["term:sepsis:tokens"][0] == pytest.approx(20, abs=0.1)
+
+
+def test_acquire_gives_back_term_tokens_when_global_bucket_times_out(memory_backend, monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_MAX_WAIT_SECONDS", "1")
+    memory_backend.drain("openai:tokens")
+
+    rate_limiter.acquire(30, "sepsis")
+
+    assert memory_backend.buckets["term:sepsis:tokens"][0] == pytest.approx(50, abs=0.1)
+
+
+class ConflictingDynamoDB:
+    """条件付き書き込みが常に競合するDynamoDBクライアント"""
+
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    def __init__(self):
+        self.puts = 0
+
+    def get_item(self, **kwargs):
+        return {}
+
+    def put_item(self, **kwargs):
+        self.puts += 1
+        raise self.exceptions.ConditionalCheckFailedException()
+
+
+def test_dynamodb_backend_gives_up_after_conflicts(memory_backend, monkeypatch):
+    client = ConflictingDynamoDB()
+    monkeypatch.setattr(rate_limiter.clients, "get_dynamodb", lambda: client)
+    monkeypatch.setattr(rate_limiter, "DYNAMODB_BACKOFF_SECONDS", 0)
+    backend = rate_limiter.DynamoDBBackend("rate_limit")
+    monkeypatch.setattr(rate_limiter, "get_backend", lambda: backend)
+
+    with pytest.raises(RuntimeError):
+        backend.take("b", 1, 1.0, 10.0)
+    assert client.puts == rate_limiter.DYNAMODB_MAX_RETRIES
+
+    # acquireは枠を取得せずに送信する
+    assert rate_limiter.acquire(30, "sepsis") >= 0.0
@@ -0,0 +1,75 @@
+import json
+import pickle
+
+import pytest
+from pubmed_common import records
+
+ARTICLE = {
+    "pmid": "12345",
+    "title": "Vasopressin in septic shock",
+    "abstract": "Abstract",
+    "authors": ["Sato", "Suzuki"],
+    "journal": "Critical Care",
+    "publication_year": "2025",
+    "publication_types": ["Randomized Controlled Trial"],
+    "fetch_date": "2025-03-19T06:00:00",
+}
+
+
+def test_from_dict_to_dict_round_trip_keeps_extra_fields():
+    data = {**ARTICLE, "doi": "10.1000/example", "mesh_terms": ["Sepsis"]}
+    article = records.Article.from_dict(data)
+
+    assert article.to_dict() == data
+    assert list(article.to_dict()) == list(records.FIELDS) + ["doi", "mesh_terms"]
+    assert article["doi"] == "10.1000/example"
+    assert article["authors"] == ("Sato", "Suzuki")
+    assert records.Article.from_dict(article) is article
+
+
+def test_absent_fields_are_not_added():
+    data = {"pmid": "1", "title": "Title", "abstract": "", "authors": [], "journal": ""}
+    article = records.Article.from_dict(data)
+
+    assert article.to_dict() == data
+    assert "publication_types" not in article
+    assert len(article) == len(data)
+    with pytest.raises(KeyError):
+        article["fetch_date"]
+
+
+def test_from_dict_shares_repeated_strings():
+    first = records.Article.from_dict(json.loads(json.dumps(ARTICLE)), "12345")
+    second = records.Article.from_dict(json.loads(json.dumps(ARTICLE)))
+
+    assert first.pmid is second.pmid
+    assert first.journal is second.journal
+    assert first.authors[0] is second.authors[0]
+
+
+def test_loads_converts_only_article_objects():
+    body = json.dumps({"metadata": {"pmid": "x"}, "articles": {"12345": ARTICLE}})
+    data = records.loads(body)
+
+    assert isinstance(data["articles"]["12345"], records.Article)
+    # pmidとabstractの両方を持つオブジェクトのみ論文データとして扱う
+    assert data["metadata"] == {"pmid": "x"}
+    assert not isinstance(data["metadata"], records.Article)
+
+
+def test_json_default_serializes_articles():
+    articles = records.from_json({"12345": ARTICLE})
+    body = json.dumps({"articles": articles}, default=records.json_default)
+
+    assert json.loads(body) == {"articles": {"12345": ARTICLE}}
+    assert records.to_json(articles) == {"12345": ARTICLE}
+    with pytest.raises(TypeError, match="set"):
+        json.dumps({"value": {1}}, default=records.json_default)
+
+
+def test_pickle_round_trip():
+    article = records.Article.from_dict({**ARTICLE, "doi": "10.1000/example"})
+    restored = pickle.loads(pickle.dumps(article))
+
+    assert isinstance(restored, records.Article)
+    assert restored.to_dict() == article.to_dict()
@@ -0,0 +1,40 @@
+from datetime import date
+
+from pubmed_common import term_registry
+
+MONDAY = date(2025, 3, 17)
+THURSDAY = date(2025, 3, 20)
+
+
+def registry(**data):
+    return term_registry.parse_registry(
+        {
+            "terms": [
+                {"term": "sepsis", "priority": 10},
+                {"term": "ecmo", "cadence": "weekly", "weekly_report": False},
+                {"term": "ards", "cadence": "paused"},
+            ],
+            **data,
+        }
+    )
+
+
+def terms(entries):
+    return [entry["term"] for entry in entries]
+
+
+def test_weekly_reports_run_only_on_weekly_day():
+    assert terms(term_registry.due_terms(registry(), "weekly", MONDAY)) == ["sepsis"]
+    assert term_registry.due_terms(registry(), "weekly", THURSDAY) == []
+
+
+def test_weekly_day_moves_weekly_reports_and_fetches():
+    thursday = registry(weekly_day="thu")
+    assert term_registry.due_terms(thursday, "weekly", MONDAY) == []
+    assert terms(term_registry.due_terms(thursday, "weekly", THURSDAY)) == ["sepsis"]
+    assert terms(term_registry.due_terms(thursday, "fetch", THURSDAY)) == ["sepsis", "ecmo"]
+
+
+def test_daily_fetches_skip_weekly_terms_on_other_days():
+    assert terms(term_registry.due_terms(registry(), "fetch", THURSDAY)) == ["sepsis"]
+    assert terms(term_registry.due_terms(registry(), "fetch", MONDAY)) == ["sepsis", "ecmo"]
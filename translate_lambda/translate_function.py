@@ -1,15 +1,19 @@
+import copy
 import json
-import os
+import time
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
-import boto3
-from openai import OpenAI
-
-# S3クライアント作成
-s3 = boto3.client("s3")
-# OpenAIクライアント作成
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+from pubmed_common import (
+    budget,
+    cache,
+    clients,
+    ledger,
+    metrics,
+    profiling,
+    rate_limiter,
+    s3_layout,
+)
 
 
 def get_translation_prompt(analysis_data: Dict[str, Any]) -> str:
@@ -39,6 +43,65 @@ JSON形式で返答してください。キー名は英語のまま維持し、
 """
 
 
+def analysis_content_hash(analysis_data: Dict[str, Any]) -> str:
+    """分析結果の内容ハッシュを計算（再分析のたびに変わる分析日時は除外）"""
+    metadata = {k: v for k, v in analysis_data.get("metadata", {}).items() if k != "analysis_date"}
+    return ledger.content_hash({**analysis_data, "metadata": metadata})
+
+
+def translate_analysis(
+    analysis_data: Dict[str, Any], budget_plan: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """ChatGPTで分析結果を日本語に翻訳（同じ内容の翻訳結果はキャッシュから取得）"""
+    prompt = get_translation_prompt(analysis_data)
+    translated = cache.get_cache().get_or_compute(
+        cache.TRANSLATIONS,
+        cache.cache_key(budget.model_for(budget_plan), prompt),
+        lambda: request_translation(prompt, budget_plan),
+    )
+
+    # キャッシュ上のデータを変更しないようコピーしてからメタデータを拡張
+    translated_data = copy.deepcopy(translated)
+    if "metadata" in translated_data:
+        translated_data["metadata"]["translation_date"] = datetime.now().isoformat()
+        translated_data["metadata"]["original_language"] = "en"
+        translated_data["metadata"]["target_language"] = "ja"
+
+    return translated_data
+
+
+def request_translation(
+    prompt: str, budget_plan: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """ChatGPT APIに翻訳を依頼し、翻訳結果のJSONを返す（budget_planを渡すと予算を予約する）"""
+    estimated_tokens = budget.estimate_tokens(budget_plan, prompt, 2000)
+    with budget.reserve(budget_plan, estimated_tokens) as call:
+        with rate_limiter.slot(prompt, 2000, budget.term_of(budget_plan)):
+            started = time.perf_counter()
+            response = clients.get_openai().chat.completions.create(
+                model=budget.model_for(budget_plan),
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                max_tokens=2000,
+            )
+        call["response"] = response
+    metrics.record_llm_call(started, response)
+
+    # レスポンスのパース
+    content = response.choices[0].message.content
+
+    # JSONを抽出（余分なテキストがある場合の対策）
+    import re
+
+    json_match = re.search(r"({[\s\S]*})", content)
+    if json_match:
+        content = json_match.group(1)
+
+    return json.loads(content)
+
+
+@metrics.instrument_handler("translate")
+@profiling.profile_handler("translate")
 def lambda_handler(event, context):
     try:
         print(f"Received event: {json.dumps(event)}")
@@ -66,44 +129,57 @@ def lambda_handler(event, context):
         print(f"Processing s3://{bucket}/{input_key}")
 
         # S3から分析済み論文データを取得
-        response = s3.get_object(Bucket=bucket, Key=input_key)
-        analysis_data = json.loads(response["Body"].read().decode("utf-8"))
-
-        # ChatGPTによる翻訳
-        prompt = get_translation_prompt(analysis_data)
-
-        response = client.chat.completions.create(
-            model=os.environ.get("GPT_MODEL", "gpt-4"),
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=2000,
-        )
-
-        # レスポンスのパース
-        content = response.choices[0].message.content
-
-        # JSONを抽出（余分なテキストがある場合の対策）
-        import re
-
-        json_match = re.search(r"({[\s\S]*})", content)
-        if json_match:
-            content = json_match.group(1)
-
-        translated_data = json.loads(content)
-
-        # 元データのメタデータを拡張
-        if "metadata" in translated_data:
-            translated_data["metadata"]["translation_date"] = datetime.now().isoformat()
-            translated_data["metadata"]["original_language"] = "en"
-            translated_data["metadata"]["target_language"] = "ja"
+        s3 = clients.get_s3()
+        with metrics.timer("S3GetLatency") as m:
+            response = s3.get_object(Bucket=bucket, Key=input_key)
+            body = response["Body"].read()
+            m["S3GetBytes"] = (len(body), metrics.BYTES)
+        analysis_data = json.loads(body.decode("utf-8"))
+
+        # 処理台帳を確認し、同じ内容の分析結果は再翻訳しない
+        output_key = s3_layout.translation_key(input_key)
+        digest = analysis_content_hash(analysis_data)
+        if not ledger.claim(
+            s3, bucket, ledger.TRANSLATION_STAGE, input_key, digest, response.get("ETag")
+        ):
+            print(f"Skipping duplicate input s3://{bucket}/{input_key}")
+            return {
+                "statusCode": 200,
+                "skipped": True,
+                "bucket": bucket,
+                "input_key": input_key,
+                "output_key": output_key,
+                "message": "Input already translated",
+            }
 
-        # 翻訳結果をS3に保存
-        output_key = input_key.replace("_analysis.json", "_jp_analysis.json")
-        s3.put_object(
-            Bucket=bucket,
-            Key=output_key,
-            Body=json.dumps(translated_data, ensure_ascii=False, indent=2),
-            ContentType="application/json",
+        try:
+            # 予算の縮退時は安価なモデルで翻訳する（上限に達した場合は失敗として台帳を解放）
+            search_term = analysis_data.get("metadata", {}).get("search_term")
+            budget_plan = budget.plan(bucket, "translate", search_term)
+            translated_data = translate_analysis(analysis_data, budget_plan)
+
+            # 翻訳結果をS3に保存
+            body = json.dumps(translated_data, ensure_ascii=False, indent=2)
+            with metrics.timer("S3PutLatency") as m:
+                s3.put_object(
+                    Bucket=bucket,
+                    Key=output_key,
+                    Body=body,
+                    ContentType="application/json",
+                )
+                m["S3PutBytes"] = (len(body.encode("utf-8")), metrics.BYTES)
+        except Exception as e:
+            ledger.release(s3, bucket, ledger.TRANSLATION_STAGE, input_key, digest, str(e))
+            raise
+
+        ledger.complete(
+            s3,
+            bucket,
+            ledger.TRANSLATION_STAGE,
+            input_key,
+            digest,
+            etag=response.get("ETag"),
+            output_key=output_key,
         )
 
         return {
@@ -112,6 +188,7 @@ def lambda_handler(event, context):
             "input_key": input_key,
             "output_key": output_key,
             "message": "Translation completed successfully",
+            "budget": budget.summary(budget_plan),
         }
 
     except Exception as e:
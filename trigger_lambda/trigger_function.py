@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Any, Dict, List, Tuple
+from urllib.parse import unquote_plus
+
+from pubmed_common import clients, metrics, profiling
+
+# 実行名に使用できない文字
+_INVALID_NAME_CHARS = re.compile(r"[^0-9A-Za-z_-]")
+
+# 同じ内容のファイルに対して起動し直せる回数（失敗した実行の名前は90日間再利用できないため番号を付ける）
+MAX_EXECUTION_ATTEMPTS = 5
+# 再実行を許可する（完了していない）実行の状態
+RETRYABLE_STATUSES = ("FAILED", "TIMED_OUT", "ABORTED")
+
+
+def is_target_key(key: str) -> bool:
+    """ワークフローの対象となる論文取得結果（raw/配下のJSONファイル）かを判定"""
+    return key.startswith("raw/") and key.endswith(".json") and not key.endswith("_analysis.json")
+
+
+def parse_s3_records(sqs_record: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """SQSメッセージ本文のS3イベント通知からS3レコードを取得（テストイベントは空リスト）"""
+    body = json.loads(sqs_record["body"])
+    return body.get("Records", [])
+
+
+def coalesce_events(
+    sqs_records: List[Dict[str, Any]],
+) -> Tuple[Dict[Tuple[str, str], Dict[str, Any]], List[str]]:
+    """
+    バッチ内のS3イベントを対象キーごとに1件にまとめる
+    同じキーの重複イベントは、S3のsequencerが最も新しいものを採用する
+    対象キーごとのイベント（対応するSQSメッセージIDを含む）と、解析できなかったメッセージIDを返す
+    """
+    latest: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    invalid_message_ids = []
+
+    for sqs_record in sqs_records:
+        try:
+            s3_records = parse_s3_records(sqs_record)
+        except Exception as e:
+            print(f"Error parsing message {sqs_record.get('messageId')}: {str(e)}")
+            invalid_message_ids.append(sqs_record["messageId"])
+            continue
+
+        for record in s3_records:
+            bucket = record["s3"]["bucket"]["name"]
+            key = unquote_plus(record["s3"]["object"]["key"])
+            if not is_target_key(key):
+                print(f"Skipping non-target file: {key}")
+                continue
+
+            event = {
+                "bucket": bucket,
+                "key": key,
+                "etag": record["s3"]["object"].get("eTag", ""),
+                "sequencer": record["s3"]["object"].get("sequencer", ""),
+                "message_ids": [sqs_record["messageId"]],
+            }
+            current = latest.get((bucket, key))
+            if current is None:
+                latest[(bucket, key)] = event
+                continue
+
+            # 重複イベントを統合（sequencerは同じキーのイベント間で16進数として比較できる）
+            event["message_ids"] = current["message_ids"] + event["message_ids"]
+            if int(event["sequencer"] or "0", 16) >= int(current["sequencer"] or "0", 16):
+                latest[(bucket, key)] = event
+            else:
+                current["message_ids"] = event["message_ids"]
+
+    return latest, invalid_message_ids
+
+
+def execution_name(key: str, etag: str, attempt: int = 1) -> str:
+    """
+    キーと内容（ETag）から決定的な実行名を生成（2回目以降の起動には番号を付ける）
+    同じ内容のファイルに対する重複した実行はStep Functions側でExecutionAlreadyExistsになる
+    """
+    digest = hashlib.sha256(f"{key}:{etag}".encode("utf-8")).hexdigest()[:16]
+    base_name = _INVALID_NAME_CHARS.sub("_", key.rsplit("/", 1)[-1].removesuffix(".json"))
+    name = f"{base_name[:60]}-{digest}"
+    return name if attempt == 1 else f"{name}-{attempt}"
+
+
+def execution_arn(state_machine_arn: str, name: str) -> str:
+    """ステートマシンのARNと実行名から実行のARNを作成"""
+    return f"{state_machine_arn.replace(':stateMachine:', ':execution:', 1)}:{name}"
+
+
+def start_workflow(sfn, state_machine_arn: str, target: Dict[str, Any]) -> bool:
+    """
+    ファイルに対するワークフローを起動（実行中・成功済みの実行がある場合は起動せずFalse）
+    同じ名前の実行が失敗していた場合は、番号を付けた名前で起動し直す
+    """
+    for attempt in range(1, MAX_EXECUTION_ATTEMPTS + 1):
+        name = execution_name(target["key"], target["etag"], attempt)
+        try:
+            response = sfn.start_execution(
+                stateMachineArn=state_machine_arn,
+                name=name,
+                input=json.dumps({"bucket": target["bucket"], "key": target["key"]}),
+            )
+        except sfn.exceptions.ExecutionAlreadyExists:
+            existing = sfn.describe_execution(executionArn=execution_arn(state_machine_arn, name))
+            status = existing["status"]
+            if status not in RETRYABLE_STATUSES:
+                print(f"Execution {name} is {status} for {target['key']}, skipping duplicate")
+                return False
+            print(f"Execution {name} is {status} for {target['key']}, starting a new attempt")
+            continue
+        print(f"Started execution: {response['executionArn']}")
+        return True
+
+    print(f"Giving up {target['key']} after {MAX_EXECUTION_ATTEMPTS} failed executions")
+    return False
+
+
+@metrics.instrument_handler("trigger")
+@profiling.profile_handler("trigger")
+def handler(event, context):
+    """
+    SQSに蓄積されたS3イベントをバッチで受け取り、キーごとに1回だけStep Functionsを起動する
+    同じ内容のファイルの実行が実行中・成功済みの場合は起動せず、失敗していた場合は起動し直す
+    起動に失敗したメッセージはbatchItemFailuresとして返し、SQSから再配信させる
+    """
+    sqs_records = event.get("Records", [])
+    print(f"Received {len(sqs_records)} messages")
+
+    sfn = clients.get_stepfunctions()
+    latest, failed_message_ids = coalesce_events(sqs_records)
+    print(f"Coalesced into {len(latest)} target files")
+
+    # 起動レートを制限（OpenAIのクォータをバックフィル時のバーストから保護）
+    interval = 1.0 / float(os.environ.get("START_EXECUTIONS_PER_SECOND", "1"))
+    started = 0
+
+    for index, target in enumerate(latest.values()):
+        if index > 0:
+            time.sleep(interval)
+
+        try:
+            if start_workflow(sfn, os.environ["STATE_MACHINE_ARN"], target):
+                started += 1
+        except Exception as e:
+            print(f"Error starting execution for {target['key']}: {str(e)}")
+            failed_message_ids.extend(target["message_ids"])
+
+    print(f"Started {started} executions, {len(failed_message_ids)} messages to retry")
+    metrics.emit(
+        {
+            "MessagesReceived": (len(sqs_records), metrics.COUNT),
+            "ExecutionsStarted": (started, metrics.COUNT),
+            "MessagesRetried": (len(failed_message_ids), metrics.COUNT),
+        }
+    )
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message_id} for message_id in dict.fromkeys(failed_message_ids)
+        ]
+    }
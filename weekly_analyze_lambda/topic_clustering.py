@@ -0,0 +1,136 @@
+import re
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+# クラスタリングに使用するテキストフィールド
+CLUSTER_TEXT_FIELDS = ("title", "summary", "key_findings")
+
+# 英数字の単語と、日本語などスペースで区切られない文字列（2文字組に分解する）
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+_CJK_PATTERN = re.compile(r"[぀-ヿ㐀-鿿]+")
+
+_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "were", "was", "are", "have",
+    "has", "had", "not", "but", "than", "which", "their", "these", "those", "into",
+    "between", "among", "after", "before", "during", "may", "can", "also", "study",
+    "patients", "results", "using", "based",
+}  # fmt: skip
+
+
+def tokenize(text: str) -> List[str]:
+    """テキストを単語（英語）と文字2-gram（日本語）に分割"""
+    text = text.lower()
+    tokens = [word for word in _WORD_PATTERN.findall(text) if len(word) > 2]
+    tokens = [word for word in tokens if word not in _STOPWORDS]
+    for run in _CJK_PATTERN.findall(text):
+        tokens.extend(run[i : i + 2] for i in range(max(len(run) - 1, 1)))
+    return tokens
+
+
+def _article_text(article: Dict[str, Any]) -> str:
+    parts = []
+    for field in CLUSTER_TEXT_FIELDS:
+        value = article.get(field)
+        if isinstance(value, list):
+            value = " ".join(str(item) for item in value)
+        if value:
+            parts.append(str(value))
+    return " ".join(parts)
+
+
+def tfidf_matrix(texts: List[str]) -> np.ndarray:
+    """TF-IDF行列（各行をL2正規化済み）を作成"""
+    vocabulary: Dict[str, int] = {}
+    rows: List[int] = []
+    cols: List[int] = []
+    for row, text in enumerate(texts):
+        for token in tokenize(text):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(token, len(vocabulary)))
+
+    matrix = np.zeros((len(texts), max(len(vocabulary), 1)), dtype=np.float32)
+    if not rows:
+        return matrix
+
+    np.add.at(matrix, (np.array(rows), np.array(cols)), 1.0)
+
+    # 対数スケールのTFと平滑化したIDF
+    document_frequency = np.count_nonzero(matrix, axis=0)
+    idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1.0
+    matrix = np.log1p(matrix) * idf
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms == 0, 1.0, norms)).astype(np.float32)
+
+
+def agglomerate(similarity: np.ndarray, threshold: float) -> List[List[int]]:
+    """
+    類似度行列から平均連結法で階層的にクラスタを統合
+    クラスタ間の平均類似度がthresholdを下回った時点で終了する
+    """
+    n = similarity.shape[0]
+    sim = similarity.astype(np.float64, copy=True)
+    np.fill_diagonal(sim, -np.inf)
+    sizes = np.ones(n)
+    members: Dict[int, List[int]] = {i: [i] for i in range(n)}
+
+    while len(members) > 1:
+        flat_index = int(np.argmax(sim))
+        i, j = divmod(flat_index, n)
+        if sim[i, j] < threshold:
+            break
+
+        # クラスタjをクラスタiに統合し、平均類似度を更新
+        merged = (sizes[i] * sim[i] + sizes[j] * sim[j]) / (sizes[i] + sizes[j])
+        sim[i, :] = merged
+        sim[:, i] = merged
+        sim[i, i] = -np.inf
+        sim[j, :] = -np.inf
+        sim[:, j] = -np.inf
+        sizes[i] += sizes[j]
+        members[i].extend(members.pop(j))
+
+    # 統合先は常に小さい方の番号なので、クラスタは元の候補の出現順に並ぶ
+    return [sorted(indices) for _, indices in sorted(members.items())]
+
+
+def cluster_articles(
+    articles_data: List[Dict[str, Any]],
+    score: Callable[[Dict[str, Any]], float],
+    threshold: float = 0.35,
+) -> Tuple[List[Dict[str, Any]], List[List[str]]]:
+    """
+    候補論文をトピックごとにクラスタリングし、各クラスタで最もスコアの高い論文を代表として返す
+    代表論文のrelated_articlesには同じクラスタの他の論文のPMIDを追加する
+    代表論文のリストと、クラスタごとのPMIDのリストを返す
+    """
+    if len(articles_data) < 2:
+        return list(articles_data), [[str(a.get("pmid", ""))] for a in articles_data]
+
+    started = time.perf_counter()
+    vectors = tfidf_matrix([_article_text(article) for article in articles_data])
+    clusters = agglomerate(vectors @ vectors.T, threshold)
+
+    representatives = []
+    memberships = []
+    for indices in clusters:
+        best = max(indices, key=lambda index: (score(articles_data[index]), -index))
+        pmids = [str(articles_data[index].get("pmid", "")) for index in indices]
+
+        representative = dict(articles_data[best])
+        related = [str(pmid) for pmid in representative.get("related_articles") or []]
+        for pmid in pmids:
+            if pmid != str(representative.get("pmid", "")) and pmid not in related:
+                related.append(pmid)
+        representative["related_articles"] = related
+
+        representatives.append(representative)
+        memberships.append(pmids)
+
+    print(
+        f"Clustered {len(articles_data)} candidates into {len(clusters)} topics "
+        f"in {(time.perf_counter() - started) * 1000:.1f}ms"
+    )
+    return representatives, memberships
@@ -1,64 +1,189 @@
 import json
 import os
 import re
-from datetime import datetime, timedelta
-from typing import Any, Dict, List
-
-import boto3
-import tiktoken
-from openai import OpenAI
-
-# S3クライアント作成
-s3 = boto3.client("s3")
-# OpenAIクライアント作成
-client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import topic_clustering
+from pubmed_common import (
+    article_index,
+    budget,
+    cache,
+    candidate_store,
+    clients,
+    metrics,
+    profiling,
+    rate_limiter,
+    s3_layout,
+    s3_loader,
+)
+
+# S3並列取得の同時実行数
+S3_LOAD_CONCURRENCY = int(os.environ.get("S3_LOAD_CONCURRENCY", "16"))
+
+# 最終選定プロンプトのトークン上限（超える場合はトーナメント方式で候補を絞り込む）
+FINAL_SELECTION_MAX_TOKENS = int(os.environ.get("FINAL_SELECTION_MAX_TOKENS", "6000"))
+# トーナメントのブラケットを並列に処理する際の同時実行数
+BRACKET_CONCURRENCY = int(os.environ.get("BRACKET_CONCURRENCY", "4"))
+# トーナメントの最大ラウンド数
+MAX_REDUCTION_ROUNDS = 5
+# 同じトピックとみなす候補論文間のTF-IDFコサイン類似度（クラスタ間の平均）
+TOPIC_SIMILARITY_THRESHOLD = float(os.environ.get("TOPIC_SIMILARITY_THRESHOLD", "0.35"))
+# 複数検索語モードで検索語ごとのレポートを並列に作成する際の同時実行数
+WEEKLY_TERM_CONCURRENCY = int(os.environ.get("WEEKLY_TERM_CONCURRENCY", "4"))
+# 週次レポートで選定する論文の最大件数
+FINAL_SELECTION_COUNT = 3
+
+# LLMに渡す論文データの短縮キー（元のキー → 短縮キー、この順序でシリアライズする）
+PROJECTION_KEYS = {
+    "pmid": "id",
+    "title": "t",
+    "journal": "j",
+    "publication_year": "y",
+    "impact_reason": "r",
+    "summary": "s",
+    "implications": "i",
+    "weekly_importance_reason": "w",
+    "key_findings": "k",
+    "clinical_impact": "c",
+    "related_articles": "rel",
+}
+PROJECTION_LEGEND = ", ".join(f"{short}={key}" for key, short in PROJECTION_KEYS.items())
+EXPANDED_KEYS = {short: key for key, short in PROJECTION_KEYS.items()}
+
+
+def get_s3():
+    """S3クライアントを取得（並列取得用にコネクションプールを拡張し、呼び出し間で再利用）"""
+    return clients.get_s3(S3_LOAD_CONCURRENCY)
 
 
 def num_tokens_from_string(string: str, model: str = "gpt-4") -> int:
     """文字列のトークン数を計算"""
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(string))
+    return len(clients.get_encoding(model).encode(string))
+
+
+def project_article(article: Dict[str, Any]) -> Dict[str, Any]:
+    """論文データからLLMに渡す最小限のフィールドのみを短縮キーで抽出"""
+    projected = {}
+    for key, short in PROJECTION_KEYS.items():
+        value = article.get(key)
+        if value:
+            projected[short] = str(value) if key == "pmid" else value
+    return projected
+
+
+def serialize_projection(articles_data: List[Dict[str, Any]]) -> str:
+    """論文データを短縮キーのコンパクトなJSON文字列に変換"""
+    return json.dumps(
+        [project_article(article) for article in articles_data],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+
+@lru_cache(maxsize=8192)
+def _projection_tokens(projected_text: str) -> int:
+    return num_tokens_from_string(projected_text)
+
+
+def article_tokens(article: Dict[str, Any]) -> int:
+    """プロンプトに含まれる論文1件分のトークン数を計算（同じ内容は再計算しない）"""
+    return _projection_tokens(serialize_projection([article]))
 
 
-def get_files_from_last_week(bucket_name: str, search_term: str = None) -> List[str]:
+def join_selection(
+    selection: List[Dict[str, Any]], candidates: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
     """
-    過去1週間分の解析済み論文ファイル（_analysis.json）を取得
-    search_termが指定されている場合は、その検索語に関連するファイルのみ返す
+    LLMが選定した論文をPMIDで元の論文データと結合
+    候補に存在しないPMIDは除外する
+    """
+    candidates_by_pmid = {str(article.get("pmid", "")): article for article in candidates}
+
+    joined = []
+    for pick in selection:
+        if not isinstance(pick, dict):
+            continue
+        pick = {EXPANDED_KEYS.get(key, key): value for key, value in pick.items()}
+        pmid = str(pick.get("pmid", ""))
+        original = candidates_by_pmid.get(pmid)
+        if original is None:
+            print(f"Ignoring selected article with unknown PMID: {pmid}")
+            continue
+
+        merged = dict(original)
+        merged.update(pick)
+        merged["pmid"] = pmid
+
+        # 関連論文はクラスタリング結果とLLMの回答を統合
+        related = [str(p) for p in original.get("related_articles") or []]
+        for related_pmid in pick.get("related_articles") or []:
+            if str(related_pmid) not in related and str(related_pmid) != pmid:
+                related.append(str(related_pmid))
+        if related:
+            merged["related_articles"] = related
+        joined.append(merged)
+
+    return joined
+
+
+def get_files_for_terms(
+    bucket_name: str, search_terms: List[str], report_day: Optional[date] = None
+) -> Dict[str, List[str]]:
+    """
+    複数の検索語の過去1週間分の解析済み論文ファイル（_analysis.json）を検索語ごとに取得
+    検索語ごとのマニフェストをまとめて並列に読み込み、対象期間のキーのみを参照する
+    マニフェストがない検索語は対象期間の日付パーティションのみを列挙する
     """
-    # 1週間前の日付を計算
-    one_week_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+    # 1週間前からレポート日（デフォルトは今日）までの日付パーティション
+    days = s3_layout.window_days(report_day or datetime.now().date())
+
+    manifest_terms = {s3_layout.manifest_key(term): term for term in search_terms}
+    manifests, _ = s3_loader.load_json_objects(
+        get_s3(),
+        bucket_name,
+        list(manifest_terms),
+        max_workers=S3_LOAD_CONCURRENCY,
+        missing_ok=True,
+    )
+
+    files_by_term: Dict[str, List[str]] = {}
+    for key, term in manifest_terms.items():
+        manifest = manifests.get(key)
+        if manifest and manifest.get("days"):
+            files_by_term[term] = s3_layout.manifest_keys(manifest, days)
+            continue
+
+        print(f"Manifest not found for {term}, listing date partitions")
+        files_by_term[term] = [
+            key
+            for key in s3_layout.iter_partition_keys(
+                get_s3(), bucket_name, s3_layout.ANALYSIS_ROOT, term, days
+            )
+            if key.endswith("_analysis.json")
+        ]
 
+    return files_by_term
+
+
+def get_files_from_last_week(
+    bucket_name: str, search_term: str = None, report_day: Optional[date] = None
+) -> List[str]:
+    """
+    過去1週間分の解析済み論文ファイル（_analysis.json）を取得
+    search_termが指定されていない場合は、マニフェストが存在する全検索語を対象とする
+    """
     try:
-        # S3バケット内のファイル一覧を取得
-        response = s3.list_objects_v2(Bucket=bucket_name)
-
-        if "Contents" not in response:
-            return []
-
-        analysis_files = []
-
-        for obj in response["Contents"]:
-            # _analysis.jsonのファイルを対象とする（_jp_analysis.jsonは除外）
-            if obj["Key"].endswith("_analysis.json") and not obj["Key"].endswith(
-                "_jp_analysis.json"
-            ):
-                # 最終更新日が1週間以内のファイルを選択
-                if obj["LastModified"].strftime("%Y-%m-%d") >= one_week_ago:
-                    # 検索語が指定されている場合、ファイル名に検索語が含まれているかチェック
-                    if search_term:
-                        # ファイル名を検査
-                        safe_term = (
-                            search_term.lower()
-                            .replace(" ", "_")
-                            .replace("/", "_")
-                            .replace("\\", "_")
-                        )
-                        if f"pubmed_{safe_term}_" in obj["Key"].lower():
-                            analysis_files.append(obj["Key"])
-                    else:
-                        analysis_files.append(obj["Key"])
-
-        return analysis_files
+        if search_term:
+            terms = [search_term]
+        else:
+            terms = s3_layout.list_manifest_terms(get_s3(), bucket_name)
+
+        files_by_term = get_files_for_terms(bucket_name, terms, report_day)
+        return [key for term in terms for key in files_by_term.get(term, [])]
 
     except Exception as e:
         print(f"Error fetching files from S3: {str(e)}")
@@ -79,18 +204,17 @@ def chunk_articles(
     available_tokens = max_tokens - base_prompt_tokens
 
     for article in articles_data:
-        # 論文データをJSON文字列に変換してトークン数を計算
-        article_text = json.dumps(article, ensure_ascii=False)
-        article_tokens = num_tokens_from_string(article_text)
+        # LLMに渡す短縮表現でトークン数を計算
+        tokens = article_tokens(article)
 
         # チャンクのトークン数が制限を超える場合、新しいチャンクを開始
-        if current_tokens + article_tokens > available_tokens and current_chunk:
+        if current_tokens + tokens > available_tokens and current_chunk:
             chunks.append(current_chunk)
             current_chunk = []
             current_tokens = 0
 
         current_chunk.append(article)
-        current_tokens += article_tokens
+        current_tokens += tokens
 
     # 最後のチャンクを追加
     if current_chunk:
@@ -99,79 +223,266 @@ def chunk_articles(
     return chunks
 
 
+def request_article_selection(
+    prompt: str, max_tokens: int = 2000, budget_plan: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    GPT APIに論文選定を依頼し、選定結果のリストとトークン使用量を返す
+    同じプロンプトの応答がキャッシュにある場合はAPIを呼び出さない（トークン使用量は0）
+    budget_planを渡すと呼び出しごとに予算を予約する
+    （上限を超える場合はBudgetExceeded、予算の状態を更新できない場合はBudgetUnavailable）
+    """
+    model = budget.model_for(budget_plan)
+    completion_key = cache.cache_key(model, prompt, 0.1, max_tokens)
+    content = cache.get_cache().get(cache.COMPLETIONS, completion_key)
+
+    if content is not None:
+        print("Using cached selection response")
+        token_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    else:
+        estimated_tokens = budget.estimate_tokens(budget_plan, prompt, max_tokens)
+        with budget.reserve(budget_plan, estimated_tokens) as call:
+            with rate_limiter.slot(prompt, max_tokens, budget.term_of(budget_plan)):
+                started = time.perf_counter()
+                response = clients.get_openai().chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0.1,
+                    max_tokens=max_tokens,
+                )
+            call["response"] = response
+        metrics.record_llm_call(started, response)
+
+        usage = getattr(response, "usage", None)
+        token_usage = {
+            "prompt_tokens": usage.prompt_tokens if usage else num_tokens_from_string(prompt),
+            "completion_tokens": usage.completion_tokens if usage else 0,
+        }
+
+        content = response.choices[0].message.content
+
+    # JSONを抽出（余分なテキストがある場合の対策）
+    json_match = re.search(r"(\[[\s\S]*\])", content)
+    selection = json.loads(json_match.group(1) if json_match else content)
+
+    # パースできた応答のみキャッシュする
+    cache.get_cache().put(cache.COMPLETIONS, completion_key, content)
+    return (selection if isinstance(selection, list) else []), token_usage
+
+
+def _usage_entry(stage: str, candidates_in: int) -> Dict[str, Any]:
+    return {
+        "stage": stage,
+        "calls": 0,
+        "candidates_in": candidates_in,
+        "candidates_out": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+    }
+
+
+def _add_usage(entry: Dict[str, Any], token_usage: Dict[str, int]) -> None:
+    entry["calls"] += 1
+    entry["prompt_tokens"] += token_usage["prompt_tokens"]
+    entry["completion_tokens"] += token_usage["completion_tokens"]
+
+
+def top_by_score(articles_data: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """スコア順に上位の論文を返す（GPT APIが使えない場合のフォールバック）"""
+    return sorted(articles_data, key=candidate_store.candidate_score, reverse=True)[:limit]
+
+
+def group_into_brackets(
+    articles_data: List[Dict[str, Any]], max_tokens: int = FINAL_SELECTION_MAX_TOKENS
+) -> List[List[Dict[str, Any]]]:
+    """最終選定プロンプトがトークン上限に収まるように候補論文をブラケットに分割"""
+    base_prompt_tokens = num_tokens_from_string(create_final_selection_prompt([]))
+    available_tokens = max_tokens - base_prompt_tokens
+
+    brackets = []
+    current_bracket: List[Dict[str, Any]] = []
+    current_tokens = 0
+
+    for article in articles_data:
+        tokens = article_tokens(article)
+
+        if current_tokens + tokens > available_tokens and current_bracket:
+            brackets.append(current_bracket)
+            current_bracket = []
+            current_tokens = 0
+
+        current_bracket.append(article)
+        current_tokens += tokens
+
+    if current_bracket:
+        brackets.append(current_bracket)
+
+    return brackets
+
+
+def trim_to_token_budget(
+    articles_data: List[Dict[str, Any]], max_tokens: int = FINAL_SELECTION_MAX_TOKENS
+) -> List[Dict[str, Any]]:
+    """スコア上位から最終選定プロンプトのトークン上限に収まる分だけ候補を残す"""
+    ranked = top_by_score(articles_data, len(articles_data))
+    return group_into_brackets(ranked, max_tokens)[0] if ranked else []
+
+
+def reduce_bracket(
+    bracket: List[Dict[str, Any]], budget_plan: Optional[Dict[str, Any]] = None
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """1つのブラケットから上位の論文を選定"""
+    if len(bracket) <= FINAL_SELECTION_COUNT:
+        return bracket, {"prompt_tokens": 0, "completion_tokens": 0}
+
+    try:
+        winners, token_usage = request_article_selection(
+            create_final_selection_prompt(bracket), max_tokens=3000, budget_plan=budget_plan
+        )
+        return join_selection(winners, bracket)[:FINAL_SELECTION_COUNT], token_usage
+    except budget.BudgetUnavailable:
+        raise
+    except Exception as e:
+        print(f"Error reducing bracket of {len(bracket)} articles: {str(e)}")
+        return top_by_score(bracket, FINAL_SELECTION_COUNT), {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+
+def reduce_candidates(
+    articles_data: List[Dict[str, Any]],
+    usage_log: List[Dict[str, Any]],
+    budget_plan: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    候補論文が最終選定プロンプトのトークン上限に収まるまで、トーナメント方式で絞り込む
+    各ラウンドでは候補をトークン上限内のブラケットに分割し、ブラケットごとに並列で選定する
+    """
+    candidates = articles_data
+    round_number = 0
+
+    base_prompt_tokens = num_tokens_from_string(create_final_selection_prompt([]))
+
+    while (
+        base_prompt_tokens + sum(article_tokens(article) for article in candidates)
+        > FINAL_SELECTION_MAX_TOKENS
+    ):
+        round_number += 1
+        if round_number > MAX_REDUCTION_ROUNDS:
+            print(f"Reached {MAX_REDUCTION_ROUNDS} reduction rounds, trimming by score")
+            return trim_to_token_budget(candidates)
+
+        brackets = group_into_brackets(candidates)
+        entry = _usage_entry(f"reduction_round_{round_number}", len(candidates))
+
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(BRACKET_CONCURRENCY, len(brackets)))
+        ) as executor:
+            results = list(
+                executor.map(lambda bracket: reduce_bracket(bracket, budget_plan), brackets)
+            )
+
+        winners = []
+        for bracket_winners, token_usage in results:
+            winners.extend(bracket_winners)
+            if token_usage["prompt_tokens"]:
+                _add_usage(entry, token_usage)
+
+        entry["candidates_out"] = len(winners)
+        usage_log.append(entry)
+        print(
+            f"Reduction round {round_number}: {len(candidates)} -> {len(winners)} candidates "
+            f"in {len(brackets)} brackets ({entry['prompt_tokens']} prompt tokens)"
+        )
+
+        # 候補が減らない場合（各候補が大きすぎる場合）はスコア順に切り詰めて終了
+        if len(winners) >= len(candidates):
+            return trim_to_token_budget(winners)
+
+        candidates = winners
+
+    return candidates
+
+
 def analyze_weekly_important_articles(
     articles_data: List[Dict[str, Any]],
+    usage_log: Optional[List[Dict[str, Any]]] = None,
+    budget_plan: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
     """
     GPT APIを使用して、週次の最重要論文を2-3件厳選
+    usage_logを渡すと、段階ごとのトークン使用量が追記される
+    予算の上限に達した呼び出しは他のエラーと同様にスコア順の選定で代替する
+    予算の状態を更新できない場合はBudgetUnavailableを送出する（候補を落とさず検索語ごと失敗させる）
     """
+    if usage_log is None:
+        usage_log = []
+
     # 論文を複数のチャンクに分割
     article_chunks = chunk_articles(articles_data)
     print(f"Split {len(articles_data)} articles into {len(article_chunks)} chunks")
+    chunk_base_tokens = num_tokens_from_string(create_weekly_analysis_prompt([]))
 
     # 各チャンクから重要論文を抽出
     all_important_articles = []
+    chunk_usage = _usage_entry("chunk", len(articles_data))
 
     # 各チャンクを処理
     for i, chunk in enumerate(article_chunks):
         print(f"Processing chunk {i+1}/{len(article_chunks)} with {len(chunk)} articles")
         prompt = create_weekly_analysis_prompt(chunk)
 
-        # トークン数を計算して表示
-        prompt_tokens = num_tokens_from_string(prompt)
+        # トークン数を表示（チャンク分割時の計算結果を再利用）
+        prompt_tokens = chunk_base_tokens + sum(article_tokens(article) for article in chunk)
         print(f"Chunk {i+1} prompt tokens: {prompt_tokens}")
 
         try:
-            # ChatGPT APIの呼び出し
-            response = client.chat.completions.create(
-                model=os.environ.get("GPT_MODEL", "gpt-4"),
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=2000,
+            chunk_results, token_usage = request_article_selection(
+                prompt, max_tokens=2000, budget_plan=budget_plan
             )
+            _add_usage(chunk_usage, token_usage)
+            all_important_articles.extend(join_selection(chunk_results, chunk))
 
-            # レスポンスのパース
-            content = response.choices[0].message.content
-
-            # JSONを抽出（余分なテキストがある場合の対策）
-            json_match = re.search(r"(\[[\s\S]*\])", content)
-            if json_match:
-                content = json_match.group(1)
-
-            chunk_results = json.loads(content)
-            if isinstance(chunk_results, list):
-                all_important_articles.extend(chunk_results)
-
+        except budget.BudgetUnavailable:
+            raise
         except Exception as e:
             print(f"Error processing chunk {i+1}: {str(e)}")
             continue
 
+    chunk_usage["candidates_out"] = len(all_important_articles)
+    usage_log.append(chunk_usage)
+
     # 全チャンクの結果から最も重要な論文を2-3件厳選
     if all_important_articles:
-        # 重要度スコアでソート（週次レポートとしての価値を評価）
-        final_prompt = create_final_selection_prompt(all_important_articles)
+        # 同じトピックの候補をクラスタリングし、各トピックの代表論文のみを最終選定に渡す
+        representatives, _ = topic_clustering.cluster_articles(
+            all_important_articles, candidate_store.candidate_score, TOPIC_SIMILARITY_THRESHOLD
+        )
+
+        # 最終選定プロンプトがコンテキストに収まるまでトーナメント方式で絞り込む
+        finalists = reduce_candidates(representatives, usage_log, budget_plan)
+        final_prompt = create_final_selection_prompt(finalists)
+        final_usage = _usage_entry("final", len(finalists))
 
         try:
-            response = client.chat.completions.create(
-                model=os.environ.get("GPT_MODEL", "gpt-4"),
-                messages=[{"role": "user", "content": final_prompt}],
-                temperature=0.1,
-                max_tokens=3000,
+            final_selection, token_usage = request_article_selection(
+                final_prompt, max_tokens=3000, budget_plan=budget_plan
             )
-
-            content = response.choices[0].message.content
-            json_match = re.search(r"(\[[\s\S]*\])", content)
-            if json_match:
-                content = json_match.group(1)
-
-            final_selection = json.loads(content)
+            final_selection = join_selection(final_selection, finalists)
+            _add_usage(final_usage, token_usage)
+            final_usage["candidates_out"] = len(final_selection[:FINAL_SELECTION_COUNT])
+            usage_log.append(final_usage)
             # 最大3件に制限（通常は2-3件が選定される）
-            return final_selection[:3]
+            return final_selection[:FINAL_SELECTION_COUNT]
 
+        except budget.BudgetUnavailable:
+            raise
         except Exception as e:
             print(f"Error in final selection: {str(e)}")
-            # エラーの場合は最初の3件を返す
-            return all_important_articles[:3]
+            usage_log.append(final_usage)
+            # エラーの場合はスコア上位の3件を返す
+            return top_by_score(finalists, FINAL_SELECTION_COUNT)
 
     return []
 
@@ -180,12 +491,13 @@ def create_weekly_analysis_prompt(articles_data: List[Dict[str, Any]]) -> str:
     """
     週次最重要論文分析用のプロンプトを生成（2-3件厳選版）
     """
-    articles_json = json.dumps(articles_data, ensure_ascii=False)
+    articles_json = serialize_projection(articles_data)
 
     return f"""
 あなたは医学研究の専門家です。提供された論文データから、今週の最も重要な論文を2-3件のみ厳選してください。
 
 ## 分析対象の論文データ
+各論文は短縮キーで表現されています（{PROJECTION_LEGEND}）。
 {articles_json}
 
 ## 厳選基準（優先順位順）
@@ -238,12 +550,14 @@ def create_final_selection_prompt(articles_data: List[Dict[str, Any]]) -> str:
     """
     最終選定用のプロンプトを生成（2-3件厳選版）
     """
-    articles_json = json.dumps(articles_data, ensure_ascii=False)
+    articles_json = serialize_projection(articles_data)
 
     return f"""
 あなたは医学研究の専門家です。以下の候補論文から、今週の週次レポートに絶対に含めるべき最重要論文を2-3件のみ厳選してください。
 
 ## 候補論文
+各論文は短縮キーで表現されています（{PROJECTION_LEGEND}）。
+候補は事前にトピックごとにまとめられており、relには同じトピックの他の論文のPMIDが含まれます。
 {articles_json}
 
 ## 最終選定基準
@@ -257,83 +571,178 @@ def create_final_selection_prompt(articles_data: List[Dict[str, Any]]) -> str:
 - 「興味深い」だけでは不十分。「重要」かつ「実践的」である必要がある
 - 2-3件に絞ることで、本当に重要な情報だけを伝える
 
-選定した2-3件の論文を重要度順に並べ、元のデータ構造を保持したまま返してください。
-必要に応じて、weekly_importance_reasonを更新して、なぜこの論文が週次レポートのトップ2-3に入るべきかを明確にしてください。
+選定した2-3件の論文を重要度順に並べ、短縮キーではなく元のキー名（pmid, weekly_importance_reason など）で返してください。
+必ずpmidを含め、必要に応じて、weekly_importance_reasonを更新して、なぜこの論文が週次レポートのトップ2-3に入るべきかを明確にしてください。
 
 JSON形式で、選定した論文のリストを返してください。
 """
 
 
-def lambda_handler(event, context):
-    try:
-        print(f"Weekly analysis started at {datetime.now().isoformat()}")
-
-        # バケット名を取得
-        bucket_name = os.environ.get("BUCKET_NAME")
-        if not bucket_name:
-            raise ValueError("BUCKET_NAME environment variable is not set")
-
-        # イベントから検索語を取得（指定されていない場合はNone）
-        search_term = None
-        if event and isinstance(event, dict) and "search_term" in event:
-            search_term = event["search_term"]
-            print(f"Using search term from event: {search_term}")
-
-        # 過去1週間の解析済みファイルを取得（検索語に基づいてフィルタリング）
-        analysis_files = get_files_from_last_week(bucket_name, search_term)
+def load_weekly_articles(
+    bucket_name: str,
+    search_terms: List[Optional[str]],
+    use_candidate_store: bool = True,
+    report_day: Optional[date] = None,
+) -> Dict[Optional[str], Dict[str, Any]]:
+    """
+    複数の検索語の週次対象論文をまとめて取得（検索語Noneは全検索語をまとめたレポート用）
+    週次候補ストアを優先し、ストアがない検索語は過去1週間の解析済みファイルを1回で並列に読み込む
+    （論文索引に反映済みの解析済みファイルは索引から取得する）
+    検索語ごとに論文データ、読み込んだファイル、読み込めなかったファイル、取得元を返す
+    """
+    weekly_data: Dict[Optional[str], Dict[str, Any]] = {}
+    report_day = report_day or datetime.now().date()
+
+    # 日次分析で更新される週次候補ストアを全検索語分まとめて取得
+    if use_candidate_store:
+        store_terms = {s3_layout.candidate_store_key(term): term for term in search_terms if term}
+        stores, _ = s3_loader.load_json_objects(
+            get_s3(),
+            bucket_name,
+            list(store_terms),
+            max_workers=S3_LOAD_CONCURRENCY,
+            missing_ok=True,
+        )
+        for key, store in stores.items():
+            candidates = candidate_store.candidates_from_store(store, report_day)
+            if not candidates:
+                continue
+            term = store_terms[key]
+            print(f"Loaded {len(candidates)} candidates from candidate store for {term}")
+            weekly_data[term] = {
+                "articles": candidates,
+                "source_files": sorted({c.get("source_file", "") for c in candidates}),
+                "failed_files": [],
+                "article_source": "candidate_store",
+            }
+
+    # ストアがない検索語は過去1週間の解析済みファイルから取得
+    file_terms: Dict[str, Optional[str]] = {}
+    remaining_terms = [term for term in search_terms if term not in weekly_data]
+    files_by_term: Dict[Optional[str], List[str]] = {}
+    if None in remaining_terms:
+        files_by_term[None] = get_files_from_last_week(bucket_name, None, report_day)
+    named_terms = [term for term in remaining_terms if term]
+    if named_terms:
+        files_by_term.update(get_files_for_terms(bucket_name, named_terms, report_day))
+
+    for term in remaining_terms:
+        analysis_files = files_by_term.get(term, [])
         print(
-            f"Found {len(analysis_files)} analysis files from last week for term: {search_term or 'all terms'}"
+            f"Found {len(analysis_files)} analysis files from last week for term: {term or 'all terms'}"
         )
+        for file_key in analysis_files:
+            file_terms[file_key] = term
+        weekly_data[term] = {
+            "articles": [],
+            "source_files": [],
+            "failed_files": [],
+            "article_source": "analysis_files",
+        }
 
-        if not analysis_files:
-            print("No files to process. Exiting.")
-            return {"statusCode": 200, "message": "No files to process"}
+    # 論文索引に反映済みのファイルは索引から取得する
+    indexed_files = article_index.indexed_analyses(get_s3(), bucket_name, list(file_terms))
+    for file_key, articles in indexed_files.items():
+        term_data = weekly_data[file_terms[file_key]]
+        term_data["source_files"].append(file_key)
+        term_data["articles"].extend(articles)
+    if indexed_files:
+        print(f"Loaded {len(indexed_files)}/{len(file_terms)} analysis files from article index")
+
+    # 残りのファイルを全検索語分1回で並列に取得（失敗したファイルはスキップ）
+    loaded_files, failed_files = s3_loader.load_json_objects(
+        get_s3(),
+        bucket_name,
+        [file_key for file_key in file_terms if file_key not in indexed_files],
+        max_workers=S3_LOAD_CONCURRENCY,
+    )
+
+    for file_key, file_data in loaded_files.items():
+        term_data = weekly_data[file_terms[file_key]]
+        term_data["source_files"].append(file_key)
+
+        # impactful_articles配列から論文データを取得
+        if isinstance(file_data, dict) and "impactful_articles" in file_data:
+            # 元ファイル情報を追加
+            for article in file_data["impactful_articles"]:
+                article["source_file"] = file_key
+                article["analysis_date"] = file_data.get("metadata", {}).get("analysis_date", "")
+            term_data["articles"].extend(file_data["impactful_articles"])
+
+    for file_key in sorted(failed_files):
+        weekly_data[file_terms[file_key]]["failed_files"].append(file_key)
+
+    return weekly_data
+
+
+def create_weekly_report(
+    bucket_name: str,
+    search_term: Optional[str],
+    term_data: Dict[str, Any],
+    report_day: Optional[date] = None,
+) -> Dict[str, Any]:
+    """1つの検索語（Noneの場合は全検索語）の週次レポートを作成してS3に保存"""
+    term_label = search_term or "all"
+    report_day = report_day or datetime.now().date()
+    try:
+        all_articles = term_data["articles"]
+        source_files = term_data["source_files"]
 
-        # 全ての論文データを取得
-        all_articles = []
-        for file_key in analysis_files:
-            try:
-                response = s3.get_object(Bucket=bucket_name, Key=file_key)
-                file_data = json.loads(response["Body"].read().decode("utf-8"))
-
-                # impactful_articles配列から論文データを取得
-                if "impactful_articles" in file_data:
-                    # 元ファイル情報を追加
-                    for article in file_data["impactful_articles"]:
-                        article["source_file"] = file_key
-                        article["analysis_date"] = file_data.get("metadata", {}).get(
-                            "analysis_date", ""
-                        )
-                    all_articles.extend(file_data["impactful_articles"])
-            except Exception as e:
-                print(f"Error processing file {file_key}: {str(e)}")
-                continue
+        if not source_files and not term_data["failed_files"]:
+            print(f"No files to process for {term_label}.")
+            return {"statusCode": 200, "search_term": term_label, "message": "No files to process"}
 
-        print(f"Total articles to analyze: {len(all_articles)}")
+        print(f"Total articles to analyze for {term_label}: {len(all_articles)}")
 
         if not all_articles:
-            print("No articles found in the analysis files. Exiting.")
-            return {"statusCode": 200, "message": "No articles found"}
+            print(f"No articles found in the analysis files for {term_label}.")
+            return {"statusCode": 200, "search_term": term_label, "message": "No articles found"}
+
+        # 予算の縮退時は優先度の低い検索語を延期し、LLMに渡す候補をスコア上位に絞り込む
+        budget_plan = budget.plan(bucket_name, "weekly", search_term)
+        if budget_plan["defer"]:
+            budget.record_deferred(budget_plan, date=report_day.isoformat())
+            return {
+                "statusCode": 200,
+                "search_term": term_label,
+                "deferred": True,
+                "message": "Deferred by budget",
+                "budget": budget.summary(budget_plan),
+            }
+        candidates = all_articles
+        if budget_plan["prescreen"]:
+            candidates = top_by_score(all_articles, budget.prescreen_limit())
+            print(f"Prescreened {len(all_articles)} candidates down to {len(candidates)}")
 
         # 週次の最重要論文を分析・選定（2-3件厳選）
-        weekly_important_articles = analyze_weekly_important_articles(all_articles)
+        token_usage: List[Dict[str, Any]] = []
+        weekly_important_articles = analyze_weekly_important_articles(
+            candidates, token_usage, budget_plan
+        )
 
         if not weekly_important_articles:
-            print("No important articles selected for weekly report. Exiting.")
-            return {"statusCode": 200, "message": "No important articles selected"}
+            print(f"No important articles selected for weekly report of {term_label}.")
+            return {
+                "statusCode": 200,
+                "search_term": term_label,
+                "message": "No important articles selected",
+            }
 
         # 出力JSONの作成
         output_json = {
             "metadata": {
                 "generated_date": datetime.now().isoformat(),
-                "period_start": (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d"),
-                "period_end": datetime.now().strftime("%Y-%m-%d"),
-                "search_term": search_term or "all",
-                "files_analyzed": len(analysis_files),
+                "period_start": (report_day - timedelta(days=7)).strftime("%Y-%m-%d"),
+                "period_end": report_day.strftime("%Y-%m-%d"),
+                "search_term": term_label,
+                "files_analyzed": len(source_files),
+                "files_failed": term_data["failed_files"],
+                "article_source": term_data["article_source"],
                 "total_articles_reviewed": len(all_articles),
                 "articles_selected": len(weekly_important_articles),
                 "report_type": "weekly_critical_articles",
                 "selection_criteria": "top_2_3_most_impactful",
+                "token_usage": token_usage,
             },
             "weekly_highlights": {
                 "summary": f"今週は{len(all_articles)}件の論文から最も重要な{len(weekly_important_articles)}件を厳選しました。",
@@ -345,31 +754,126 @@ def lambda_handler(event, context):
             "critical_articles": weekly_important_articles,
         }
 
-        # 結果をS3に保存（検索語をファイル名に含める）
-        date_str = datetime.now().strftime("%Y%m%d")
-        # ファイル名に使用できる形式に検索語を変換
-        safe_term = ""
-        if search_term:
-            safe_term = search_term.lower().replace(" ", "_").replace("/", "_").replace("\\", "_")
-            output_key = f"weekly_critical_{safe_term}_{date_str}.json"
-        else:
-            output_key = f"weekly_critical_{date_str}.json"
+        # 結果をS3に保存（検索語をファイル名に含め、日付パーティションに配置）
+        output_key = s3_layout.weekly_key(search_term, report_day)
 
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=output_key,
-            Body=json.dumps(output_json, ensure_ascii=False, indent=2),
-            ContentType="application/json",
-        )
+        body = json.dumps(output_json, ensure_ascii=False, indent=2)
+        with metrics.timer("S3PutLatency") as m:
+            get_s3().put_object(
+                Bucket=bucket_name,
+                Key=output_key,
+                Body=body,
+                ContentType="application/json",
+            )
+            m["S3PutBytes"] = (len(body.encode("utf-8")), metrics.BYTES)
 
         print(f"Weekly critical articles report saved to s3://{bucket_name}/{output_key}")
+        metrics.emit(
+            {
+                "ArticlesReviewed": (len(all_articles), metrics.COUNT),
+                "ArticlesSelected": (len(weekly_important_articles), metrics.COUNT),
+            }
+        )
 
         return {
             "statusCode": 200,
             "message": "Weekly critical articles analysis completed successfully",
-            "search_term": search_term or "all",
+            "search_term": term_label,
             "output_file": output_key,
             "articles_selected": len(weekly_important_articles),
+            "budget": budget.summary(budget_plan),
+        }
+
+    except Exception as e:
+        print(f"Error in weekly analysis for {term_label}: {str(e)}")
+        return {
+            "statusCode": 500,
+            "search_term": term_label,
+            "error": "Error processing request",
+            "details": str(e),
+        }
+
+
+def create_term_report(
+    bucket_name: str,
+    search_term: Optional[str],
+    term_data: Dict[str, Any],
+    report_day: Optional[date] = None,
+) -> Dict[str, Any]:
+    """検索語をメトリクスのディメンションに設定して週次レポートを作成"""
+    with metrics.scope(term=search_term):
+        return create_weekly_report(bucket_name, search_term, term_data, report_day)
+
+
+def run_weekly(event: Dict[str, Any]) -> Dict[str, Any]:
+    """イベントで指定された検索語・日付の週次分析を実行"""
+    try:
+        print(f"Weekly analysis started at {datetime.now().isoformat()}")
+
+        # バケット名を取得
+        bucket_name = os.environ.get("BUCKET_NAME")
+        if not bucket_name:
+            raise ValueError("BUCKET_NAME environment variable is not set")
+
+        if not isinstance(event, dict):
+            event = {}
+
+        search_terms: List[Optional[str]]
+        if "search_terms" in event:
+            # 複数検索語モード（空リストの場合はマニフェストが存在する全検索語）
+            search_terms = list(
+                dict.fromkeys(
+                    event["search_terms"] or s3_layout.list_manifest_terms(get_s3(), bucket_name)
+                )
+            )
+            print(f"Using search terms from event: {', '.join(search_terms)}")
+        else:
+            # イベントから検索語を取得（指定されていない場合はNone）
+            search_term = event.get("search_term")
+            if search_term:
+                print(f"Using search term from event: {search_term}")
+            search_terms = [search_term]
+
+        if not search_terms:
+            print("No search terms to process. Exiting.")
+            return {"statusCode": 200, "message": "No files to process"}
+
+        # イベントで日付（YYYY-MM-DD）が指定された場合はその日を期間の終わりとするレポートを作成
+        today = datetime.now().date()
+        report_day = date.fromisoformat(event["date"]) if event.get("date") else today
+        # 週次候補ストアは実行時点の直近1週間のみを保持するため、過去の週は解析済みファイルから読み込む
+        use_candidate_store = event.get("use_candidate_store", report_day == today)
+
+        # 対象期間のデータを全検索語分まとめて1回で読み込む
+        weekly_data = load_weekly_articles(
+            bucket_name, search_terms, use_candidate_store, report_day
+        )
+
+        if len(search_terms) == 1:
+            return create_term_report(
+                bucket_name, search_terms[0], weekly_data[search_terms[0]], report_day
+            )
+
+        # 検索語ごとのレポートを並列に作成
+        with ThreadPoolExecutor(
+            max_workers=min(WEEKLY_TERM_CONCURRENCY, len(search_terms))
+        ) as executor:
+            results = list(
+                executor.map(
+                    lambda term: create_term_report(
+                        bucket_name, term, weekly_data[term], report_day
+                    ),
+                    search_terms,
+                )
+            )
+
+        failed_terms = [result["search_term"] for result in results if result["statusCode"] != 200]
+        return {
+            "statusCode": 500 if failed_terms else 200,
+            "message": f"Weekly analysis completed for {len(search_terms) - len(failed_terms)}"
+            f"/{len(search_terms)} search terms",
+            "failed_terms": failed_terms,
+            "results": results,
         }
 
     except Exception as e:
@@ -379,3 +883,32 @@ def lambda_handler(event, context):
             "error": "Error processing request",
             "details": str(e),
         }
+
+
+@metrics.instrument_handler("weekly")
+@profiling.profile_handler("weekly")
+def lambda_handler(event, context):
+    """
+    EventBridgeなどからの直接の呼び出しと、ディスパッチャーがSQSに送信したシャードの両方を処理する
+    SQSの場合は失敗した検索語を含むシャードのメッセージをbatchItemFailuresとして返し、再配信させる
+    （再配信時に成功済みの検索語もLLMの応答キャッシュを使って再作成される）
+    """
+    if not isinstance(event, dict) or "Records" not in event:
+        return run_weekly(event)
+
+    failed_message_ids = []
+    results = []
+    for record in event["Records"]:
+        try:
+            result = run_weekly(json.loads(record["body"]))
+        except Exception as e:
+            result = {"statusCode": 500, "error": "Invalid message", "details": str(e)}
+        if result["statusCode"] != 200:
+            print(f"Failed to process message {record['messageId']}")
+            failed_message_ids.append(record["messageId"])
+        results.append(result)
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids],
+        "results": results,
+    }